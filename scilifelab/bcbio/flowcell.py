@@ -7,8 +7,9 @@ import json
 import csv
 import glob
 import copy
+import weakref
 from cStringIO import StringIO
-from scilifelab.utils.misc import filtered_walk
+from scilifelab.utils.misc import iter_filtered_walk
 from scilifelab.log import minimal_logger
 
 LOG = minimal_logger(__name__)
@@ -25,6 +26,176 @@ LOG = minimal_logger(__name__)
 ## sample-level basis, making the flowcell object slightly obsolete in
 ## these cases.
 
+## File name patterns of lane files and sample files
+RE_LANE = re.compile('^([0-9]+)_[0-9]+_[A-Za-z0-9]+(_nophix)?\.(filter|bc)_metrics|^([0-9]+)_[0-9]+_[A-Za-z0-9]+(_nophix)?_[12]_fastq.txt')
+RE_SAMPLE = re.compile('^([0-9]+)_[0-9]+_[A-Za-z0-9]+(_nophix)?_([0-9]+|unmatched)?.*')
+RE_CASAVA_SEQUENCE = re.compile("fastq(\.gz)?$")
+## Characters that make a sample name a regular expression rather than a literal prefix
+RE_SPECIAL = set(".^$*+?{}[]\\|()")
+
+class RunInfoIndex(object):
+    """Columns and hash indexes of the rows of a Flowcell.
+
+    Columns, and the indexes of their values, are built on first use
+    and dropped by invalidate when a column changes. Lookups follow
+    Flowcell.subset, which matches positions in Flowcell._column, so
+    that the results are unchanged.
+
+    :param data: rows of a Flowcell
+    :param key_index: map of column label to row index
+    """
+    def __init__(self, data, key_index):
+        self.data = data or []
+        self.key_index = key_index
+        self._columns = {}
+        self._positions = {}
+        self._lane_columns = {}
+        self._barcode_maps = {}
+
+    def column(self, label):
+        """Get the values of a column that are not None, in row order"""
+        if not label in self._columns:
+            i = self.key_index[label]
+            self._columns[label] = [row[i] for row in self.data if not row[i] is None]
+        return self._columns[label]
+
+    def positions(self, label, value):
+        """Get the positions in column(label) of the values equal to value"""
+        index = self._positions.get(label)
+        if index is None:
+            index = {}
+            try:
+                for (j, v) in enumerate(self.column(label)):
+                    index.setdefault(v, []).append(j)
+            except TypeError:
+                ## Unhashable values, such as file lists
+                index = False
+            self._positions[label] = index
+        if index is False:
+            return [j for (j, v) in enumerate(self.column(label)) if v == value]
+        try:
+            return index.get(value, [])
+        except TypeError:
+            return []
+
+    def lane_column(self, lane, label):
+        """Get the values of a column in a lane that are not None"""
+        columns = self._lane_columns.setdefault(label, {})
+        if not lane in columns:
+            i = self.key_index[label]
+            rows = [self.data[j] for j in self.positions("lane", lane)]
+            columns[lane] = [row[i] for row in rows if not row[i] is None]
+        return columns[lane]
+
+    def barcode_map(self, lane):
+        """Get the map of barcode id to sequence of a lane"""
+        if not lane in self._barcode_maps:
+            self._barcode_maps[lane] = dict(zip(self.lane_column(lane, "barcode_id"), self.lane_column(lane, "sequence")))
+        return self._barcode_maps[lane]
+
+    def invalidate(self, label):
+        """Drop the column and indexes that depend on a column"""
+        self._columns.pop(label, None)
+        self._positions.pop(label, None)
+        self._lane_columns.pop(label, None)
+        if label == "lane":
+            self._lane_columns = {}
+        if label in ["lane", "barcode_id", "sequence"]:
+            self._barcode_maps = {}
+
+class NameTrie(object):
+    """Prefix trie over sample names.
+
+    :param names: list of names; None entries are skipped
+    """
+    def __init__(self, names):
+        self.root = {}
+        for (i, name) in enumerate(names):
+            if name is None:
+                continue
+            node = self.root
+            for c in name:
+                node = node.setdefault(c, {})
+            if not None in node:
+                node[None] = i
+
+    def prefixes(self, s):
+        """Yield (index, length) of the names that are prefixes of s, shortest first"""
+        node = self.root
+        if None in node:
+            yield (node[None], 0)
+        for (j, c) in enumerate(s):
+            node = node.get(c)
+            if node is None:
+                return
+            if None in node:
+                yield (node[None], j + 1)
+
+def _split_names(names):
+    """Split names into a NameTrie of literal names and a list of
+    (index, name) of names containing regular expression characters."""
+    literal = [x if not RE_SPECIAL.intersection(x) else None for x in names]
+    return (NameTrie(literal), [(i, x) for (i, x) in enumerate(names) if literal[i] is None])
+
+class FileClassifier(object):
+    """File name matching of a flowcell, compiled once.
+
+    Sample names are matched as prefixes with a NameTrie; names
+    containing regular expression characters are matched as regular
+    expressions, as in Flowcell.glob_pfx_str. Barcode id to sequence
+    maps are looked up in the RunInfoIndex of the flowcell.
+
+    :param fc: Flowcell
+    """
+    def __init__(self, fc):
+        self.fc = fc
+        ## Names as in Flowcell._column, for classify_file
+        self.names = fc._column("name")
+        (self.trie, re_names) = _split_names([str(x) for x in self.names])
+        self.re_names = [(i, re.compile("^({})".format(x))) for (i, x) in re_names]
+        ## collect_files patterns of Flowcell.glob_pfx_str. Barcode
+        ## and extension are optional or empty there, so that lane and
+        ## flowcell id decide a match
+        lane_patterns = set()
+        sample_names = []
+        for sample in fc:
+            lane_patterns.add("{}_[0-9]+_.?{}".format(sample['lane'], sample['flowcell_id']))
+            sample_names.append("{}".format(sample['name']))
+        self.re_lane_files = re.compile("|".join(sorted(lane_patterns))) if lane_patterns else None
+        self.re_other = re.compile("^[0-1][0-9].*\.txt|^bcbb_software_versions\.txt")
+        (self.filter_trie, re_names) = _split_names(sample_names)
+        self.re_filter_names = [re.compile("^{}[_\-]".format(x)) for (i, x) in re_names]
+
+    def barcode_id_to_sequence(self, lane):
+        return self.fc._index().barcode_map(lane)
+
+    def match_name(self, fname):
+        """Get the first name, in flowcell order, that a file name starts with.
+
+        :param fname: file base name
+
+        :returns: index into Flowcell._column("name"), or None
+        """
+        matches = [i for (i, _) in self.trie.prefixes(fname)]
+        matches += [i for (i, regex) in self.re_names if regex.search(fname)]
+        if not matches:
+            return None
+        return min(matches)
+
+    def file_filter(self, fname):
+        """Return True for file names matched by Flowcell.glob_pfx_str"""
+        if self.re_lane_files and self.re_lane_files.search(fname):
+            return True
+        if self.re_other.search(fname):
+            return True
+        for (_, j) in self.filter_trie.prefixes(fname):
+            if fname[j:j + 1] in ("_", "-"):
+                return True
+        for regex in self.re_filter_names:
+            if regex.search(fname):
+                return True
+        return False
+
 class Flowcell(object):
     """Class for handling (Illumina) run information.
 
@@ -37,6 +208,7 @@ class Flowcell(object):
     _keys = dict(lane = ['lane', 'lane_description', 'flowcell_id', 'lane_analysis', 'genome_build'],
                  mp = ['mp_analysis', 'barcode_id', 'barcode_type', 'sample_prj', 'name', 'sequence', 'files', 'genomes_filter_out', 'mp_description', 'results'])
     keys = _keys['lane'] + _keys['mp']
+    _key_index = dict((k, i) for (i, k) in enumerate(keys))
     
     ## csv keys
     _csv_keys = ['flowcell_id', 'lane', 'name', 'genome_build', 'sequence', 'sample_prj', 'control', 'recipe', 'operator', 'sample_prj']
@@ -59,11 +231,23 @@ class Flowcell(object):
         self.path = None
         self.data = None
         self.i = 0
+        self._classifier = None
+        self._runinfo_index = None
+        self._shared = None
         if not infile:
             return
         self.data = self._read(infile)
         self._set_sample_dict()
 
+    def __getstate__(self):
+        ## Compiled patterns cannot be copied; the classifier is rebuilt on use
+        state = self.__dict__.copy()
+        state["_classifier"] = None
+        state["_runinfo_index"] = None
+        ## Copies have rows of their own
+        state["_shared"] = None
+        return state
+
     def fc_id(self):
         m = re.search("([0-9]+)_[A-Za-z0-9]+_[A-Za-z0-9]+_([A-Z0-9]+)", os.path.dirname(self.filename))
         if m:
@@ -149,13 +333,34 @@ class Flowcell(object):
         return self._tab_to_yaml()
 
     def _set_sample_dict(self):
-        i = 0
+        self._classifier = None
+        self._runinfo_index = None
+        (lane, sequence) = (self._key_index['lane'], self._key_index['sequence'])
         self.samples = {}
-        for row in self.data:
-            d = dict(zip(self.keys, row))
-            key = "{}_{}".format(d['lane'], d['sequence'])
+        for (i, row) in enumerate(self.data):
+            key = "{}_{}".format(row[lane], row[sequence])
             self.samples[key] = i
-            i += 1
+
+    def _index(self):
+        """Get the RunInfoIndex of the flowcell, built on first use"""
+        if getattr(self, "_runinfo_index", None) is None:
+            self._runinfo_index = RunInfoIndex(self.data, self._key_index)
+        return self._runinfo_index
+
+    def _sharing(self):
+        """Get the flowcells sharing rows with the flowcell, as subsets
+        of one another, including the flowcell itself"""
+        if getattr(self, "_shared", None) is None:
+            self._shared = weakref.WeakSet([self])
+        return self._shared
+
+    def _invalidate(self, label):
+        """Drop what depends on a column from the flowcells sharing rows"""
+        for fc in list(self._sharing()):
+            if label in ["lane", "flowcell_id", "barcode_id", "name", "sequence"]:
+                fc._classifier = None
+            if fc._runinfo_index:
+                fc._runinfo_index.invalidate(label)
             
     def _yaml_to_tab(self, runinfo_yaml):
         """Convert yaml to internal representation"""
@@ -210,19 +415,22 @@ class Flowcell(object):
         return self.data[self.samples[key]]
 
     def get_entry(self, key, label):
-        return self.data[self.samples[key]][self.keys.index(label)]
+        return self.data[self.samples[key]][self._key_index[label]]
 
     def set_entry(self, key, label, value):
-        self.data[self.samples[key]][self.keys.index(label)] = value
+        self._invalidate(label)
+        self.data[self.samples[key]][self._key_index[label]] = value
 
     def append_to_entry(self, key, label, value):
-        if not self.data[self.samples[key]][self.keys.index(label)]:
-            self.data[self.samples[key]][self.keys.index(label)] = []
-        self.data[self.samples[key]][self.keys.index(label)].append(value)
+        row = self.data[self.samples[key]]
+        i = self._key_index[label]
+        if not row[i]:
+            row[i] = []
+            self._invalidate(label)
+        row[i].append(value)
                 
     def _column(self, label):
-        i = self.keys.index(label)
-        return [row[i] for row in self.data if not row[i] is None]
+        return list(self._index().column(label))
 
     def _row(self, i):
         return self.data[i]
@@ -237,18 +445,15 @@ class Flowcell(object):
 
     def barcodes(self, lane):
         """List barcodes for a lane"""
-        fc = self.subset("lane", lane)
-        return list(fc._column("barcode_id"))
+        return list(self._index().lane_column(lane, "barcode_id"))
 
     def names(self, lane):
         """List names for a lane"""
-        fc = self.subset("lane", lane)
-        return list(fc._column("name"))
+        return list(self._index().lane_column(lane, "name"))
 
     def barcode_sequences(self, lane):
         """List barcode sequences for a lane"""
-        fc = self.subset("lane", lane)
-        return list(fc._column("sequence"))
+        return list(self._index().lane_column(lane, "sequence"))
 
     def barcode_id_to_name(self, lane):
         """Map barcode id to name"""
@@ -268,7 +473,7 @@ class Flowcell(object):
 
     def barcode_id_to_sequence(self, lane):
         """Map barcode id to sequence"""
-        return dict(zip(self.barcodes(lane), self.barcode_sequences(lane)))
+        return dict(self._index().barcode_map(lane))
 
     def fc_with_unique_lanes(self):
         """Transform flowcell to one with unique lane numbers"""
@@ -283,11 +488,12 @@ class Flowcell(object):
         return new_fc
             
     def subset(self, column, query):
-        """Subset runinfo. Returns new flowcell object."""
+        """Subset runinfo. Returns new flowcell object, sharing its rows
+        with the flowcell."""
         pruned_fc = Flowcell()
-        vals = list(self._column(column))
-        i = [j for j in range(0, len(vals)) if vals[j]==query]
-        pruned_fc.data = [self.data[j] for j in i]
+        pruned_fc.data = [self.data[j] for j in self._index().positions(column, query)]
+        pruned_fc._shared = self._sharing()
+        pruned_fc._shared.add(pruned_fc)
         pruned_fc.filename = self.filename.replace(".yaml", "-pruned.yaml")
         pruned_fc._set_sample_dict()
         pruned_fc.lane_files = dict((x, self.lane_files[x]) for x in pruned_fc.lanes())
@@ -376,22 +582,22 @@ class Flowcell(object):
         
         :returns: None
         """
-        re_lane = re.compile('^([0-9]+)_[0-9]+_[A-Za-z0-9]+(_nophix)?\.(filter|bc)_metrics|^([0-9]+)_[0-9]+_[A-Za-z0-9]+(_nophix)?_[12]_fastq.txt')
-        m_lane = re_lane.search(os.path.basename(f))
+        classifier = self.classifier()
+        fname = os.path.basename(f)
+        m_lane = RE_LANE.search(fname)
         if m_lane:
-            lane = os.path.basename(f).split("_")[0]
+            lane = fname.split("_")[0]
             sample = None
             self.lane_files[lane].append(os.path.abspath(f))
             return
-        re_sample = re.compile('^([0-9]+)_[0-9]+_[A-Za-z0-9]+(_nophix)?_([0-9]+|unmatched)?.*')
-        m_sample = re_sample.search(os.path.basename(f))
+        m_sample = RE_SAMPLE.search(fname)
         if m_sample:
             lane = m_sample.group(1)
             sample = m_sample.group(3)
             if sample == "unmatched":
                 self.lane_files[lane].append(os.path.abspath(f))
                 return
-            sequence = self.barcode_id_to_sequence(lane).get(int(sample), None)
+            sequence = self._index().barcode_map(lane).get(int(sample), None)
             key = "{}_{}".format(lane, sequence)
             if f.find("fastq.txt") > 0:
                 self.append_to_entry(key, "files", os.path.abspath(f))
@@ -400,14 +606,11 @@ class Flowcell(object):
                 self.append_to_entry(key, "results", os.path.abspath(f))
                 return
 
-        names = self._column("name")
-        pattern = "|".join("^({}).*".format(x) for x in names)
-        re_casava_sample = re.compile(pattern)
-        m_casava_sample = re_casava_sample.search(os.path.basename(f))
-        if m_casava_sample:
-            row = self._row(names.index(m_casava_sample.group(1)))
+        i = classifier.match_name(fname)
+        if i is not None:
+            row = self._row(i)
             key = "{}_{}".format(row[0], row[10])
-            if re.search("fastq(\.gz)?$", f):
+            if RE_CASAVA_SEQUENCE.search(f):
                 LOG.debug("Adding sequence file {} to files, key {}".format(f, key))
                 self.append_to_entry(key, "files", os.path.abspath(f))
                 return
@@ -417,6 +620,13 @@ class Flowcell(object):
                 return
         return
 
+    def classifier(self):
+        """Get the FileClassifier of the flowcell, compiled on first use
+        and whenever lanes, barcodes or names change."""
+        if getattr(self, "_classifier", None) is None:
+            self._classifier = FileClassifier(self)
+        return self._classifier
+
     def collect_files(self, path, project=None):
         """Collect files for a given project.
 
@@ -426,12 +636,7 @@ class Flowcell(object):
             fc = self.subset("sample_prj", project)
         else:
             fc = self
-        pattern = "|".join(fc.glob_pfx_str())
-        def file_filter(f):
-            if not pattern:
-                return
-            return re.search(pattern, f) != None
-        flist = filtered_walk(path, file_filter)
+        flist = iter_filtered_walk(path, fc.classifier().file_filter)
         for f in flist:
             self.classify_file(f)
         fc.path = path
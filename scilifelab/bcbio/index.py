@@ -0,0 +1,332 @@
+"""Persistent index of a production/project directory tree.
+
+The index is an SQLite database, INDEX_FILE, below the root of the
+tree. It is kept in a directory of its own, which is not indexed, so
+that writing the database does not change the modification time of
+the root.
+It records every directory with its modification time, every file, and
+the fields of each -bcbb-config.yaml file that find_samples,
+_group_samples and sample_table in scilifelab.bcbio.run otherwise get
+by walking the tree and parsing the configs again.
+
+A refresh only lists directories whose modification time has changed
+since they were indexed, and only parses configs whose modification
+time has changed. Once an index has been created, with
+
+  pm project index --rebuild
+
+it is used, and refreshed, by find_samples for paths below its root.
+find_samples only lists stale directories, and leaves configs to be
+parsed when their fields are read, since config_fields checks their
+modification time. Files found in the index are sorted by path, rather
+than in the directory listing order of filtered_walk.
+"""
+import os
+import re
+import yaml
+import sqlite3
+import cPickle as pickle
+
+from scilifelab.utils.misc import scan_dir, DirFilter
+from scilifelab.log import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+# Directory of the index database at the root of the indexed tree
+INDEX_DIR = ".pm_index"
+# Index database, relative to the root of the indexed tree
+INDEX_FILE = os.path.join(INDEX_DIR, "index.sqlite")
+
+# Config files whose fields are indexed
+CONFIG_PATTERN = "-bcbb-config.yaml$"
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime REAL)",
+    "CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent)",
+    "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dir TEXT, name TEXT)",
+    "CREATE INDEX IF NOT EXISTS files_dir ON files (dir)",
+    "CREATE TABLE IF NOT EXISTS configs (path TEXT PRIMARY KEY, dir TEXT, mtime REAL, project TEXT, sample TEXT, flowcell TEXT, "
+    "sample_id TEXT, fc_id TEXT, fields BLOB)",
+    "CREATE INDEX IF NOT EXISTS configs_dir ON configs (dir)",
+    "CREATE TABLE IF NOT EXISTS config_lanes (path TEXT, lane TEXT)",
+    "CREATE INDEX IF NOT EXISTS config_lanes_path ON config_lanes (path)",
+    ]
+
+def config_fields(conf):
+    """Get the fields of a bcbb-config that samples are grouped and
+    tabulated by.
+
+    :param conf: parsed bcbb-config.yaml
+
+    :returns: dictionary with sample_id and fc_id, used by
+      _group_samples, and rows of [sample, lane, barcode_id, fc_name,
+      fc_date], used by sample_table
+    """
+    fields = {"sample_id": None, "fc_id": None, "rows": []}
+    details = conf.get("details", None)
+    if details:
+        if details[0].get("multiplex", []):
+            fields["sample_id"] = details[0].get("multiplex", [])[0].get("name", None)
+        else:
+            fields["sample_id"] = details[0].get("description")
+        if details[0].get("flowcell_id", None):
+            fields["fc_id"] = details[0].get("flowcell_id")
+        else:
+            fields["fc_id"] = conf.get("fc_name", None)
+    runinfo = details if details else conf
+    for info in runinfo:
+        lane = info.get("lane", None)
+        fc_name = info.get("flowcell_id", None)
+        fc_date = info.get("fc_date", None)
+        if info.get("multiplex", None):
+            for mp in info.get("multiplex"):
+                fields["rows"].append([mp.get("name", None), lane, mp.get("barcode_id", None), fc_name, fc_date])
+        else:
+            fields["rows"].append([info.get("description", None), lane, None, conf.get("fc_name", None), conf.get("fc_date", None)])
+    return fields
+
+def read_config_fields(fname):
+    """Read a bcbb-config.yaml file and get its fields, see config_fields"""
+    with open(fname) as fh:
+        conf = yaml.load(fh)
+    return config_fields(conf)
+
+def _subtree(path):
+    """SQL condition and arguments matching path and everything below it"""
+    return "(path = ? OR (path >= ? AND path < ?))", (path, path + os.sep, path + chr(ord(os.sep) + 1))
+
+class ProductionIndex(object):
+    """Index of a directory tree.
+
+    :param root: root directory of the tree
+    :param db: index database; defaults to INDEX_FILE in root
+    """
+    def __init__(self, root, db=None):
+        self.root = os.path.abspath(root)
+        self.db = db or os.path.join(self.root, INDEX_FILE)
+        if not os.path.exists(os.path.dirname(self.db)):
+            os.makedirs(os.path.dirname(self.db))
+        self.con = sqlite3.connect(self.db)
+        self.con.text_factory = str
+        for stmt in SCHEMA:
+            self.con.execute(stmt)
+        self.con.commit()
+        self.config_re = re.compile(CONFIG_PATTERN)
+
+    def close(self):
+        self.con.close()
+
+    def _location(self, path):
+        """project, sample and flowcell directory names of a path"""
+        parts = os.path.relpath(path, self.root).split(os.sep) + [None, None, None]
+        return [x if x != "." else None for x in parts[0:3]]
+
+    def _remove_tree(self, path):
+        cond, args = _subtree(path)
+        self.con.execute("DELETE FROM dirs WHERE " + cond, args)
+        self.con.execute("DELETE FROM files WHERE " + cond, args)
+        self.con.execute("DELETE FROM config_lanes WHERE path IN (SELECT path FROM configs WHERE " + cond + ")", args)
+        self.con.execute("DELETE FROM configs WHERE " + cond, args)
+
+    def _index_config(self, path, st=None):
+        st = st or os.stat(path)
+        try:
+            fields = read_config_fields(path)
+        except Exception as e:
+            LOG.warn("Could not parse config file {}: {}".format(path, e))
+            fields = {"sample_id": None, "fc_id": None, "rows": []}
+        (project, sample, flowcell) = self._location(os.path.dirname(path))
+        self.con.execute("DELETE FROM config_lanes WHERE path = ?", (path,))
+        self.con.execute("INSERT OR REPLACE INTO configs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (path, os.path.dirname(path), st.st_mtime, project, sample, flowcell,
+                          None if fields["sample_id"] is None else str(fields["sample_id"]),
+                          None if fields["fc_id"] is None else str(fields["fc_id"]),
+                          sqlite3.Binary(pickle.dumps(fields, 2))))
+        self.con.executemany("INSERT INTO config_lanes VALUES (?, ?)", set((path, str(row[1])) for row in fields["rows"]))
+        return fields
+
+    def _index_dir(self, path, st):
+        """List a directory into the index, returning its subdirectories"""
+        try:
+            dirs, files, descend = scan_dir(path)
+        except OSError:
+            self._remove_tree(path)
+            return []
+        self.con.execute("DELETE FROM files WHERE dir = ?", (path,))
+        self.con.executemany("INSERT INTO files VALUES (?, ?, ?)", [(os.path.join(path, x), path, x) for x in files])
+        configs = set(os.path.join(path, x) for x in files if self.config_re.search(x))
+        for (cfg,) in self.con.execute("SELECT path FROM configs WHERE dir = ?", (path,)).fetchall():
+            if cfg not in configs:
+                self.con.execute("DELETE FROM config_lanes WHERE path = ?", (cfg,))
+                self.con.execute("DELETE FROM configs WHERE path = ?", (cfg,))
+        subdirs = [os.path.join(path, x) for x in descend if not (path == self.root and x == INDEX_DIR)]
+        for (old,) in self.con.execute("SELECT path FROM dirs WHERE parent = ?", (path,)).fetchall():
+            if old not in subdirs:
+                self._remove_tree(old)
+        self.con.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)", (path, os.path.dirname(path), st.st_mtime))
+        return subdirs
+
+    def refresh(self, path=None, rebuild=False, configs=True):
+        """Bring the index of a subtree up to date, listing only the
+        directories, and parsing only the configs, that have changed.
+
+        :param path: top of the subtree; defaults to the root
+        :param rebuild: drop the indexed subtree and index it from scratch
+        :param configs: also check configs rewritten in place; otherwise
+          only configs in listed directories are parsed, by config_fields
+
+        :returns: tuple of numbers of directories listed and configs parsed
+        """
+        top = os.path.abspath(path or self.root)
+        if rebuild:
+            self._remove_tree(top)
+        n_dirs = 0
+        n_configs = 0
+        stack = [top]
+        while stack:
+            d = stack.pop()
+            try:
+                st = os.stat(d)
+            except OSError:
+                self._remove_tree(d)
+                continue
+            row = self.con.execute("SELECT mtime FROM dirs WHERE path = ?", (d,)).fetchone()
+            if row and row[0] == st.st_mtime:
+                subdirs = [x for (x,) in self.con.execute("SELECT path FROM dirs WHERE parent = ?", (d,))]
+            else:
+                subdirs = self._index_dir(d, st)
+                n_dirs += 1
+            stack.extend(sorted(subdirs, reverse=True))
+        ## Configs may be rewritten in place without changing their directory
+        if not configs:
+            self.con.commit()
+            LOG.debug("Refreshed index of {}: listed {} directories".format(top, n_dirs))
+            return (n_dirs, n_configs)
+        cond, args = _subtree(top)
+        indexed = dict(self.con.execute("SELECT path, mtime FROM configs WHERE " + cond, args).fetchall())
+        for (cfg,) in self.con.execute("SELECT path FROM files WHERE name LIKE '%.yaml' AND " + cond, args).fetchall():
+            if not self.config_re.search(os.path.basename(cfg)):
+                continue
+            try:
+                st = os.stat(cfg)
+            except OSError:
+                continue
+            if indexed.get(cfg) != st.st_mtime:
+                self._index_config(cfg, st)
+                n_configs += 1
+        self.con.commit()
+        LOG.debug("Refreshed index of {}: listed {} directories, parsed {} configs".format(top, n_dirs, n_configs))
+        return (n_dirs, n_configs)
+
+    def find_files(self, path, filter_fn, include_dirs=None, exclude_dirs=None):
+        """Find indexed files, with the semantics of filtered_walk.
+
+        :param path: directory to search in
+        :param filter_fn: filtering function on file names that returns boolean
+        :param include_dirs: only search these directories (list)
+        :param exclude_dirs: exclude these directories (list)
+
+        :returns: list of file names, sorted by path rather than in the
+          directory listing order of filtered_walk
+        """
+        top = os.path.abspath(path)
+        dir_filter = DirFilter(include_dirs, exclude_dirs)
+        relative = os.path.normpath(path) != top
+        cond, args = _subtree(top)
+        flist = []
+        selected = {}
+        for (fname, d, name) in self.con.execute("SELECT path, dir, name FROM files WHERE " + cond + " ORDER BY path", args):
+            ## Match directories as filtered_walk would see them from path
+            if relative:
+                d = os.path.join(path, os.path.relpath(d, top)) if d != top else path
+                fname = os.path.join(d, name)
+            if d not in selected:
+                selected[d] = dir_filter.selects(d)
+            if selected[d] and filter_fn(name):
+                flist.append(fname)
+        return flist
+
+    def config_fields(self, path):
+        """Get the fields of a config file, from the index if it is up to
+        date, and otherwise by parsing and indexing it.
+
+        :param path: config file name
+
+        :returns: dictionary, see config_fields
+        """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        row = self.con.execute("SELECT mtime, fields FROM configs WHERE path = ?", (path,)).fetchone()
+        if row and row[0] == st.st_mtime:
+            return pickle.loads(str(row[1]))
+        try:
+            fields = self._index_config(path, st)
+            self.con.commit()
+        except sqlite3.Error as e:
+            LOG.warn("Could not index config file {}: {}".format(path, e))
+            fields = read_config_fields(path)
+        return fields
+
+    def configs(self, project=None, sample=None, flowcell=None, lane=None):
+        """Get indexed config files by project, sample and flowcell
+        directory names and lane.
+
+        :returns: sorted list of config file names
+        """
+        cond = []
+        args = []
+        for (col, val) in [("project", project), ("sample", sample), ("flowcell", flowcell)]:
+            if val is not None:
+                cond.append("{} = ?".format(col))
+                args.append(val)
+        if lane is not None:
+            cond.append("path IN (SELECT path FROM config_lanes WHERE lane = ?)")
+            args.append(str(lane))
+        query = "SELECT path FROM configs" + (" WHERE " + " AND ".join(cond) if cond else "") + " ORDER BY path"
+        return [x for (x,) in self.con.execute(query, args)]
+
+    def result_files(self, config, filter_fn=None):
+        """Get the files in the directory of a config file, and below it.
+
+        :param config: config file name
+        :param filter_fn: filtering function on file names that returns boolean
+
+        :returns: sorted list of file names
+        """
+        cond, args = _subtree(os.path.dirname(os.path.abspath(config)))
+        return [x for (x, name) in self.con.execute("SELECT path, name FROM files WHERE " + cond + " ORDER BY path", args)
+                if filter_fn is None or filter_fn(name)]
+
+_INDEXES = {}
+_ROOTS = {}
+
+def lookup(path):
+    """Get the index of the tree that path is in, if there is one.
+    Indexes are opened once per process.
+
+    :param path: file or directory name
+
+    :returns: ProductionIndex, or None
+    """
+    d = os.path.abspath(path)
+    if not os.path.isdir(d):
+        d = os.path.dirname(d)
+    if d not in _ROOTS:
+        root = d
+        while not os.path.exists(os.path.join(root, INDEX_FILE)):
+            parent = os.path.dirname(root)
+            if parent == root:
+                root = None
+                break
+            root = parent
+        _ROOTS[d] = root
+    root = _ROOTS[d]
+    if root is None:
+        return None
+    if root not in _INDEXES:
+        try:
+            _INDEXES[root] = ProductionIndex(root)
+        except sqlite3.Error as e:
+            LOG.warn("Could not open production index in {}: {}".format(root, e))
+            _INDEXES[root] = None
+    return _INDEXES[root]
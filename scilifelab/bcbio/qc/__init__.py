@@ -474,6 +474,85 @@ class ExtendedFastQCParser(FastQCParser):
 ##############################
 ##  objects
 ##############################
+class FileCatalog(object):
+    """Catalog of the files below a directory, collected in a single
+    walk and indexed by basename, extension and the lane tokens
+    (lane_date_flowcell) of bcbb file names, so that parsers look up
+    candidate files by index instead of searching every path.
+
+    A catalog can be shared by several parsers working on the same
+    directory.
+
+    :param path: root directory
+    :param reignore: compiled regular expression; directories whose path below <path> matches it are skipped
+    """
+    ## Lane tokens can start anywhere in a path component, as in the regular expressions of the parsers
+    re_lane_token = re.compile("(?=([0-9]+)_[0-9]+_[0-9A-Za-z])")
+
+    def __init__(self, path, reignore=None):
+        self.path = path
+        self.files = []
+        self.by_basename = collections.defaultdict(list)
+        self.by_ext = collections.defaultdict(list)
+        self.by_lane = collections.defaultdict(list)
+        self._order = {}
+        self._patterns = {}
+        for root, dirs, files in os.walk(path):
+            ## Match below the root only, so that the location of the root does not exclude it
+            relroot = os.path.relpath(root, path)
+            if reignore and relroot != os.curdir and reignore.search(relroot):
+                continue
+            for x in files:
+                self._add(os.path.join(root, x))
+
+    def __repr__(self):
+        return "<FileCatalog {} ({} files)>".format(self.path, len(self.files))
+
+    def _add(self, f):
+        self._order[f] = len(self.files)
+        self.files.append(f)
+        base = os.path.basename(f)
+        self.by_basename[base].append(f)
+        self.by_ext[os.path.splitext(base)[1]].append(f)
+        relpath = os.path.relpath(f, self.path)
+        for lane in set(m.group(1) for m in self.re_lane_token.finditer(relpath)):
+            self.by_lane[lane].append(f)
+
+    def _compile(self, pattern):
+        if pattern not in self._patterns:
+            self._patterns[pattern] = re.compile(pattern)
+        return self._patterns[pattern]
+
+    def search(self, pattern, lane=None, ext=None):
+        """Get files matching a regular expression.
+
+        Candidates are restricted to files with lane token <lane> below
+        the catalog root and/or extension(s) <ext> before <pattern> is
+        applied.
+
+        :param pattern: regular expression, searched for in the full path
+        :param lane: lane token
+        :param ext: extension or list of extensions, including the dot
+
+        :returns: list of matching files, in walk order
+        """
+        candidates = self.files
+        if lane is not None:
+            candidates = self.by_lane.get(str(lane), [])
+        if ext is not None:
+            exts = [ext] if isinstance(ext, basestring) else ext
+            by_ext = set(f for e in exts for f in self.by_ext.get(e, []))
+            candidates = sorted((f for f in candidates if f in by_ext), key=self._order.get)
+        if pattern is None:
+            return list(candidates)
+        regex = self._compile(pattern)
+        return [f for f in candidates if regex.search(f)]
+
+    def basename(self, name):
+        """Get files with basename <name>, in walk order"""
+        return list(self.by_basename.get(name, []))
+
+
 class RunMetricsParser(dict):
     """Generic Run Parser class"""
     _metrics = []
@@ -481,10 +560,11 @@ class RunMetricsParser(dict):
     ignore = "|".join(["tmp", "tx", "-split", "log"])
     reignore = re.compile(ignore)
 
-    def __init__(self, log=None):
+    def __init__(self, log=None, catalog=None):
         super(RunMetricsParser, self).__init__()
         self.files = []
         self.path=None
+        self.catalog = catalog
         self.log = LOG
         if log:
             self.log = log
@@ -494,42 +574,43 @@ class RunMetricsParser(dict):
             return
         if not os.path.exists(self.path):
             raise IOError
-        self.files = []
-        for root, dirs, files in os.walk(self.path):
-            if re.search(self.reignore, root):
-                continue
-            self.files = self.files + [os.path.join(root, x) for x in files]
-
-    def filter_files(self, pattern, filter_fn=None):
-        """Take file list and return those files that pass the filter_fn criterium"""
-        def filter_function(f):
-            return re.search(pattern, f) != None
-        if not filter_fn:
-            filter_fn = filter_function
-        return filter(filter_fn, self.files)
+        if self.catalog is None or self.catalog.path != self.path:
+            self.catalog = FileCatalog(self.path, self.reignore)
+        self.files = self.catalog.files
+
+    def filter_files(self, pattern, filter_fn=None, lane=None, ext=None):
+        """Take file list and return those files that pass the filter_fn
+        criterium, or that match pattern. Lookups with pattern use the
+        file catalog, optionally restricted to a lane token and extension.
+        """
+        if filter_fn:
+            return filter(filter_fn, self.files)
+        if self.catalog is None:
+            return []
+        return self.catalog.search(pattern, lane=lane, ext=ext)
 
-    def parse_json_files(self, filter_fn=None):
+    def parse_json_files(self, filter_fn=None, files=None):
         """Parse json files and return the corresponding dicts
         """
-        def filter_function(f):
-            return f is not None and f.endswith(".json")
-        if not filter_fn:
-            filter_fn = filter_function
-        files = self.filter_files(None,filter_fn)
+        if files is None:
+            if filter_fn:
+                files = self.filter_files(None, filter_fn)
+            else:
+                files = self.filter_files(None, ext=".json")
         dicts = []
         for f in files:
             with open(f) as fh:
                 dicts.append(json.load(fh))
         return dicts
 
-    def parse_csv_files(self, filter_fn=None):
+    def parse_csv_files(self, filter_fn=None, files=None):
         """Parse csv files and return a dict with filename as key and the corresponding dicts as value
         """
-        def filter_function(f):
-            return f is not None and f.endswith(".csv")
-        if not filter_fn:
-            filter_fn = filter_function
-        files = self.filter_files(None,filter_fn)
+        if files is None:
+            if filter_fn:
+                files = self.filter_files(None, filter_fn)
+            else:
+                files = self.filter_files(None, ext=".csv")
         dicts = {}
         for f in files:
             with open(f) as fh:
@@ -539,8 +620,8 @@ class RunMetricsParser(dict):
 class SampleRunMetricsParser(RunMetricsParser):
     """Sample-level class for parsing run metrics data"""
 
-    def __init__(self, path):
-        RunMetricsParser.__init__(self)
+    def __init__(self, path, catalog=None):
+        RunMetricsParser.__init__(self, catalog=catalog)
         self.path = path
         self._collect_files()
 
@@ -549,7 +630,7 @@ class SampleRunMetricsParser(RunMetricsParser):
         picard_parser = ExtendedPicardMetricsParser()
         pattern = "|".join(["{}_[0-9]+_[0-9A-Za-z]+(_nophix)?(_{})?-.*.(align|hs|insert|dup)_metrics".format(lane, barcode_id),
                             "{}_[0-9]+_[0-9A-Za-z]+(_{})?(_nophix)?-.*.(align|hs|insert|dup)_metrics".format(lane, barcode_id)])
-        files = self.filter_files(pattern)
+        files = self.filter_files(pattern, lane=lane)
         if len(files) == 0:
             self.log.warn("no picard metrics files for sample {}; pattern {}".format(barcode_name, pattern))
             return {}
@@ -567,7 +648,7 @@ class SampleRunMetricsParser(RunMetricsParser):
         pattern = "|".join(["{}_[0-9]+_[0-9A-Za-z]+(_nophix)?(_{})?_[12]_screen.txt".format(lane, barcode_id),
                             "{}_[0-9]+_[0-9A-Za-z]+(_{})?(_nophix)?_[12]_screen.txt".format(lane, barcode_id),
                             "{}_{}_L0*{}_.*_screen.txt".format(barcode_name, kw.get("sequence"), lane)])
-        files = self.filter_files(pattern)
+        files = self.filter_files(pattern, ext=".txt")
         self.log.debug("files {}".format(",".join(files)))
         try:
             fp = open(files[0])
@@ -581,10 +662,8 @@ class SampleRunMetricsParser(RunMetricsParser):
     def parse_bcbb_checkpoints(self, barcode_name, sample_prj, flowcell, barcode_id, **kw):
         self.log.debug("parse_bcbb_checkpoints for sample {}, project {} in run {}".format(barcode_name, sample_prj, flowcell))
         parser = MetricsParser()
-        def filter_fn(f):
-            return re.match("[0-9][0-9]_[^\/]+\.txt", os.path.basename(f)) != None
-
-        files = self.filter_files(None,filter_fn)
+        pattern = "[0-9][0-9]_[^\/]+\.txt"
+        files = [f for f in self.filter_files(None, ext=".txt") if re.match(pattern, os.path.basename(f))]
         self.log.debug("files {}".format(",".join(files)))
 
         checkpoints = {}
@@ -602,7 +681,7 @@ class SampleRunMetricsParser(RunMetricsParser):
         self.log.debug("parse_software_versions for sample {}, project {} in run {}".format(barcode_name, sample_prj, flowcell))
         parser = MetricsParser()
         pattern = "bcbb_software_versions.txt"
-        files = self.filter_files(pattern)
+        files = self.catalog.basename(pattern) if self.catalog else []
         self.log.debug("files {}".format(",".join(files)))
         data = {}
         try:
@@ -619,7 +698,7 @@ class SampleRunMetricsParser(RunMetricsParser):
         if barcode_name == "unmatched":
             return
         pattern = "fastqc/{}_[0-9]+_[0-9A-Za-z]+(_nophix)?(_{})?-*".format(lane, barcode_id)
-        files = self.filter_files(pattern)
+        files = self.filter_files(pattern, lane=lane)
         self.log.debug("files {}".format(",".join(files)))
         try:
             fastqc_dir = os.path.dirname(files[0])
@@ -635,9 +714,7 @@ class SampleRunMetricsParser(RunMetricsParser):
         """Parse the json output from the GATK genotype evaluation"""
         self.log.debug("parse_eval_metrics for lane {}, project {} in flowcell {}".format(lane, sample_prj, flowcell))
         pattern = "{}_[0-9]+_[0-9A-Za-z]+(_{})?(_nophix)?.*.eval_metrics".format(lane, barcode_id)
-        def filter_function(f):
-            return re.search(pattern, f) != None
-        metrics = self.parse_json_files(filter_fn=filter_function)
+        metrics = self.parse_json_files(files=self.filter_files(pattern, lane=lane))
         if metrics:
             return metrics[0]
         return {}
@@ -646,9 +723,7 @@ class SampleRunMetricsParser(RunMetricsParser):
         """Parse the project summary output"""
         self.log.debug("parse_project_summary for lane {}, project {} in flowcell {}".format(lane, sample_prj, flowcell))
         pattern = "project-summary.csv"
-        def filter_function(f):
-            return os.path.basename(f) == pattern
-        metrics = self.parse_csv_files(filter_fn=filter_function)
+        metrics = self.parse_csv_files(files=self.catalog.basename(pattern) if self.catalog else [])
         if metrics:
             return metrics.values()[0][0]
         return {}
@@ -681,7 +756,7 @@ class SampleRunMetricsParser(RunMetricsParser):
         """CASAVA: Parse filter metrics at sample level"""
         self.log.debug("parse_filter_metrics for lane {}, project {} in flowcell {}".format(lane, sample_prj, flowcell))
         pattern = "{}_[0-9]+_[0-9A-Za-z]+(_{})?(_nophix)?.filter_metrics".format(lane, barcode_id)
-        files = self.filter_files(pattern)
+        files = self.filter_files(pattern, lane=lane)
         self.log.debug("files {}".format(",".join(files)))
         try:
             fp = open(files[0])
@@ -709,7 +784,7 @@ class SampleRunMetricsParser(RunMetricsParser):
                 else:
                     return reads/2
         pattern = "{}_[0-9]+_[0-9A-Za-z]+(_nophix)?[\._]bc[\._]metrics".format(lane)
-        files = self.filter_files(pattern)
+        files = self.filter_files(pattern, lane=lane)
         if len(files) == 0:
             self.log.debug("no bc metrics files for sample {}, lane {}; pattern {}".format(barcode_name, lane, pattern))
             return None
@@ -733,8 +808,8 @@ class SampleRunMetricsParser(RunMetricsParser):
 class FlowcellRunMetricsParser(RunMetricsParser):
     """Flowcell level class for parsing flowcell run metrics data."""
     _lanes = range(1,9)
-    def __init__(self, path):
-        RunMetricsParser.__init__(self)
+    def __init__(self, path, catalog=None):
+        RunMetricsParser.__init__(self, catalog=catalog)
         self.path = path
         self._collect_files()
 
@@ -843,7 +918,7 @@ class FlowcellRunMetricsParser(RunMetricsParser):
         for lane in self._lanes:
             pattern = "{}_[0-9]+_[0-9A-Za-z]+(_nophix)?.filter_metrics".format(lane)
             lanes[str(lane)]["filter_metrics"] = {"reads":None, "reads_aligned":None, "reads_fail_align":None}
-            files = self.filter_files(pattern)
+            files = self.filter_files(pattern, lane=lane)
             self.log.debug("filter metrics files {}".format(",".join(files)))
             try:
                 fp = open(files[0])
@@ -862,7 +937,7 @@ class FlowcellRunMetricsParser(RunMetricsParser):
         for lane in self._lanes:
             pattern = "{}_[0-9]+_[0-9A-Za-z]+(_nophix)?[\._]bc[\._]metrics".format(lane)
             lanes[str(lane)]["bc_metrics"] = {}
-            files = self.filter_files(pattern)
+            files = self.filter_files(pattern, lane=lane)
             self.log.debug("bc metrics files {}".format(",".join(files)))
             try:
                 parser = MetricsParser()
@@ -3,15 +3,17 @@ import os
 import re
 import yaml
 import glob
+import sqlite3
 from itertools import chain
 import pandas as pd
 import datetime
 
-from scilifelab.utils.misc import filtered_walk, query_yes_no, prune_option_list
+from scilifelab.utils.misc import filtered_walk, iter_filtered_walk, query_yes_no, prune_option_list
 from scilifelab.utils.dry import dry_write, dry_backup, dry_unlink, dry_rmdir, dry_makedir
 from scilifelab.log import minimal_logger
 from scilifelab.bcbio import sort_sample_config_fastq, update_sample_config, update_pp_platform_args, merge_sample_config
 from scilifelab.bcbio.flowcell import Flowcell
+from scilifelab.bcbio import index as production_index
 
 LOG = minimal_logger(__name__)
 
@@ -35,13 +37,28 @@ def _sample_status(x):
     else:
         return "FAIL"
 
-def _group_samples(flist, include_merged=False):
+def _config_fields(f, index=None):
+    """Get the grouping and table fields of a bcbb-config.yaml file, from
+    the production index if f is in an indexed tree.
+
+    :param f: bcbb-config.yaml file
+    :param index: ProductionIndex; by default looked up from f
+
+    :returns: dictionary, see scilifelab.bcbio.index.config_fields
+    """
+    index = index or production_index.lookup(f)
+    if index:
+        return index.config_fields(f)
+    return production_index.read_config_fields(f)
+
+def _group_samples(flist, include_merged=False, index=None):
     """Group samples by sample name and flowcell
 
     This function assumes flist consists of bcbb-config.yaml files. It reads each file
     and extracts sample name and flowcell for subsequent grouping. Exclude MERGED_SAMPLE_OUTPUT_DIR from grouping.
 
     :param flist: list of bcbb-config.yaml files
+    :param index: ProductionIndex to get config fields from
 
     :returns: dictionary of samples grouped by name and flowcell
     """
@@ -49,19 +66,12 @@ def _group_samples(flist, include_merged=False):
     for f in flist:
         if not include_merged and os.path.dirname(f).endswith(MERGED_SAMPLE_OUTPUT_DIR):
             continue
-        with open(f) as fh:
-            conf = yaml.load(fh)
-        if conf.get("details", [])[0].get("multiplex", []):
-            sample_id = conf.get("details", [])[0].get("multiplex", [])[0].get("name", None)
-        else:
-            sample_id = conf.get("details", [])[0].get("description")
+        fields = _config_fields(f, index)
+        sample_id = fields["sample_id"]
         if not sample_id:
             LOG.warn("No sample_id found in file {}; skipping".format(f))
             continue
-        if conf.get("details", [])[0].get("flowcell_id", None):
-            fc_id = conf.get("details", [])[0].get("flowcell_id")
-        else:
-            fc_id = conf.get("fc_name", None)
+        fc_id = fields["fc_id"]
         if not fc_id:
             LOG.warn("No flowcell_id found in file {}; skipping".format(f))
             continue
@@ -73,34 +83,18 @@ def _group_samples(flist, include_merged=False):
 
 ## FIXME: make pandas data frame of all samples, with info about lane,
 ## flowcell, date, barcode_id, path, sample name -> makes searching for files much easier
-def sample_table(flist):
+def sample_table(flist, index=None):
     """Make a table from bcbb-config yaml files.
 
     :param flist: file list of config files
+    :param index: ProductionIndex to get config fields from
 
     :returns: data frame
     """
     samples = []
     for f in flist:
         path = os.path.dirname(f)
-        with open(f) as fh:
-            conf = yaml.load(fh)
-        runinfo = conf.get("details") if conf.get("details", None) else conf
-        for info in runinfo:
-            lane = info.get("lane", None)
-            fc_name = info.get("flowcell_id", None)
-            fc_date = info.get("fc_date", None)
-            if info.get("multiplex", None):
-                for mp in info.get("multiplex"):
-                    barcode_id = mp.get("barcode_id", None)
-                    sample = mp.get("name", None)
-                    samples.append([sample, lane, barcode_id, fc_name, fc_date, path])
-            else:
-                barcode_id = None
-                sample = info.get("description", None)
-                fc_name = conf.get("fc_name", None)
-                fc_date = conf.get("fc_date", None)
-                samples.append([sample, lane, barcode_id, fc_name, fc_date, path])
+        samples.extend([row + [path] for row in _config_fields(f, index)["rows"]])
     return pd.DataFrame(samples, columns=["sample", "lane", "barcode_id", "fc_name", "fc_date", "path"])
 
 def get_vcf_files(flist, vcfext="sort-gatkrecal-realign-variants-combined-phased-annotated", **kw):
@@ -110,7 +104,7 @@ def get_vcf_files(flist, vcfext="sort-gatkrecal-realign-variants-combined-phased
 
     """
     vcf_d = {}
-    samples = sample_table(flist)
+    samples = sample_table(flist, kw.get("index", None))
     grouped = samples.groupby("sample")
     for name, group in grouped:
         LOG.debug("Getting vcf file for sample {}".format(name))
@@ -207,14 +201,19 @@ def validate_sample_directories(flist, pdir):
             LOG.warning("{} *must* be in a subdirectory of {}".format(run_info, pdir))
             raise Exception
 
-def find_samples(path, sample=None, pattern = "-bcbb-config.yaml$", only_failed=False, **kw):
-    """Find bcbb config files in a path.
+def find_samples(path, sample=None, pattern = "-bcbb-config.yaml$", only_failed=False, use_index=True, **kw):
+    """Find bcbb config files in a path. If path is in a tree indexed by
+    scilifelab.bcbio.index, the directories of path that changed since
+    they were indexed are listed, and the index is searched instead of
+    walking path.
 
     :param path: path to search in
     :param sample: a specific sample, or a file consisting of -bcbb-config.yaml files
     :param pattern: pattern to search for
+    :param use_index: use a production index if there is one
 
-    :returns: list of file names
+    :returns: list of file names; sorted by path if found in the index,
+      and otherwise in the order of filtered_walk
     """
     def bcbb_yaml_filter(f):
         return re.search(pattern, f) != None
@@ -227,13 +226,23 @@ def find_samples(path, sample=None, pattern = "-bcbb-config.yaml$", only_failed=
             if len(flist) == 0:
                 flist = [os.path.join(path, x.rstrip()) for x in samplelist if len(x) > 1]
                 # Make sure there actually is a config file in path
-                flist = list(chain.from_iterable([filtered_walk(x, bcbb_yaml_filter, exclude_dirs=kw.get("exclude_dirs", None), include_dirs=kw.get("include_dirs", None)) for x in flist]))
+                flist = list(chain.from_iterable([iter_filtered_walk(x, bcbb_yaml_filter, exclude_dirs=kw.get("exclude_dirs", None), include_dirs=kw.get("include_dirs", None)) for x in flist]))
             if len(flist) == 0:
                 return flist
         else:
             pattern = "{}{}".format(sample, pattern)
     if not flist:
-        flist = filtered_walk(path, bcbb_yaml_filter, exclude_dirs=kw.get("exclude_dirs", None), include_dirs=kw.get("include_dirs", None))
+        index = production_index.lookup(path) if use_index and os.path.isdir(path) else None
+        if index:
+            try:
+                index.refresh(path, configs=False)
+            except sqlite3.Error as e:
+                LOG.warn("Could not refresh production index of {}: {}; walking the directory tree instead".format(path, e))
+                index = None
+        if index:
+            flist = index.find_files(path, bcbb_yaml_filter, exclude_dirs=kw.get("exclude_dirs", None), include_dirs=kw.get("include_dirs", None))
+        else:
+            flist = filtered_walk(path, bcbb_yaml_filter, exclude_dirs=kw.get("exclude_dirs", None), include_dirs=kw.get("include_dirs", None))
     if only_failed:
         status = {x:_sample_status(x) for x in flist}
         flist = [x for x in flist if _sample_status(x)=="FAIL"]
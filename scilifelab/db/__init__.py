@@ -1,10 +1,17 @@
 """Database module"""
 import os
 import sys
+import copy
+import time
+import threading
 import couchdb
+import couchdb.http
+from collections import OrderedDict
 
 from scilifelab.log import minimal_logger
 from scilifelab.utils.http import check_url
+from scilifelab.db.replica import open_replica
+from scilifelab.db.statusDB_utils import content_hash, hash_matches, HASH_VIEW
 
 class ConnectionError(Exception):
     """Exception raised for connection errors.
@@ -37,13 +44,239 @@ class Database(object):
     def __repr__(self):
         return "{}".format(self.__class__)
 
+class LazyView(object):
+    """Read-only, dict-like wrapper around a couchdb view.
+
+    Keys are looked up on the server with the ``key`` option the first
+    time they are requested and memoized; the full view is only
+    downloaded when the wrapper is iterated or explicitly loaded.
+
+    :param db: couch database
+    :param viewname: view name, e.g. 'names/name'
+    :param value: function mapping a view row to the stored value; defaults to the row itself
+    :param options: extra view options, e.g. reduce=False
+    """
+    def __init__(self, db, viewname, value=None, **options):
+        self.db = db
+        self.viewname = viewname
+        self.options = options
+        self._value = value if value else lambda row: row
+        self._cache = {}
+        self._complete = False
+
+    def __repr__(self):
+        return "<LazyView {} ({} cached{})>".format(self.viewname, len(self._cache), ", complete" if self._complete else "")
+
+    def rows(self, **options):
+        """Query the view with server-side filtering.
+
+        :param options: view options such as key, keys, startkey, endkey
+
+        :returns: list of view rows
+        """
+        opts = dict(self.options)
+        opts.update(options)
+        return [row for row in self.db.view(self.viewname, **opts)]
+
+    def load(self):
+        """Download the complete view"""
+        if not self._complete:
+            self._cache = {row.key:self._value(row) for row in self.rows()}
+            self._complete = True
+        return self
+
+    def get(self, key, default=None):
+        if key not in self._cache and not self._complete:
+            rows = self.rows(key=key)
+            if rows:
+                self._cache[key] = self._value(rows[-1])
+        return self._cache.get(key, default)
+
+    def get_many(self, keys):
+        """Look up several keys in one request.
+
+        :param keys: list of view keys
+
+        :returns: dictionary of key to value for keys present in view
+        """
+        missing = [k for k in set(keys) if k not in self._cache]
+        if missing and not self._complete:
+            for row in self.rows(keys=missing):
+                self._cache[row.key] = self._value(row)
+        return {k:self._cache[k] for k in keys if k in self._cache}
+
+    def prime(self, mapping):
+        """Add already known key to value mappings to the cache
+
+        :param mapping: dictionary of view key to value
+        """
+        self._cache.update(mapping)
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __iter__(self):
+        return iter(self.load()._cache)
+
+    def __len__(self):
+        return len(self.load()._cache)
+
+    def keys(self):
+        return self.load()._cache.keys()
+
+    def values(self):
+        return self.load()._cache.values()
+
+    def items(self):
+        return self.load()._cache.items()
+
+    def iteritems(self):
+        return self.load()._cache.iteritems()
+
+# Default number of documents kept in a document cache
+CACHE_SIZE = 256
+
+class DocumentCache(object):
+    """Bounded LRU cache of couchdb documents, keyed by document id.
+    Documents are copied on the way in and out, so that callers can
+    modify them as they would a freshly retrieved document.
+
+    A cache belongs to one connection object and lives for one
+    invocation, e.g. one delivery note run. Lookups by id do not check
+    the revision in the database, so documents modified by others
+    during that time are not seen, unless the caller passes the
+    revision it expects to get, or invalidates the document.
+
+    :param maxsize: maximum number of cached documents
+    """
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._docs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<DocumentCache ({}/{} documents, {} hits, {} misses)>".format(len(self._docs), self.maxsize, self.hits, self.misses)
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __contains__(self, docid):
+        return docid in self._docs
+
+    def get(self, docid, rev=None):
+        """Get cached document.
+
+        :param docid: document id
+        :param rev: required revision; a cached document with another revision is dropped
+
+        :returns: copy of document, or None if not cached
+        """
+        with self._lock:
+            doc = self._docs.pop(docid, None)
+            if doc is None or (rev is not None and doc.get("_rev") != rev):
+                self.misses += 1
+                return None
+            self._docs[docid] = doc
+            self.hits += 1
+        return copy.deepcopy(doc)
+
+    def put(self, doc):
+        """Add document to cache, evicting the least recently used
+        documents if the cache is full"""
+        if doc is None or "_id" not in doc:
+            return
+        doc = copy.deepcopy(doc)
+        with self._lock:
+            self._docs.pop(doc["_id"], None)
+            self._docs[doc["_id"]] = doc
+            while len(self._docs) > self.maxsize:
+                self._docs.popitem(last=False)
+
+    def invalidate(self, docid=None):
+        """Drop document <docid> from cache, or all documents if docid is None"""
+        with self._lock:
+            if docid is None:
+                self._docs.clear()
+            else:
+                self._docs.pop(docid, None)
+
+# Default number of idle keep-alive connections kept per server
+POOL_SIZE = 10
+# Default socket timeout in seconds of server sessions
+TIMEOUT = 60
+
+# Process-wide couchdb servers, one per url and session settings
+_SERVERS = {}
+_SERVERS_LOCK = threading.Lock()
+
+if hasattr(couchdb.http, "ConnectionPool"):
+    class BoundedConnectionPool(couchdb.http.ConnectionPool):
+        """Connection pool that keeps at most <pool_size> idle
+        keep-alive connections per host, closing the surplus."""
+        def __init__(self, timeout=None, pool_size=POOL_SIZE, **kw):
+            couchdb.http.ConnectionPool.__init__(self, timeout, **kw)
+            self.pool_size = pool_size
+
+        def release(self, url, conn):
+            couchdb.http.ConnectionPool.release(self, url, conn)
+            surplus = []
+            self.lock.acquire()
+            try:
+                for conns in self.conns.values():
+                    while len(conns) > self.pool_size:
+                        surplus.append(conns.pop(0))
+            finally:
+                self.lock.release()
+            for c in surplus:
+                c.close()
+else:
+    BoundedConnectionPool = None
+
+def get_server(url_string, pool_size=POOL_SIZE, timeout=TIMEOUT):
+    """Get the process-wide couchdb server for a url. Servers share
+    one http session per url, pool size and timeout, so that
+    connections are kept alive and reused across database connection
+    objects.
+
+    :param url_string: server url, including credentials
+    :param pool_size: maximum number of idle connections to keep
+    :param timeout: socket timeout in seconds of new sessions
+
+    :returns: tuple of couchdb.Server and boolean indicating if the server was reused
+    """
+    key = (url_string, int(pool_size), timeout)
+    with _SERVERS_LOCK:
+        if key in _SERVERS:
+            return (_SERVERS[key], True)
+        if BoundedConnectionPool:
+            session = couchdb.http.Session(timeout=timeout)
+            session.connection_pool = BoundedConnectionPool(timeout, pool_size=int(pool_size))
+        else:
+            session = couchdb.http.Session()
+        _SERVERS[key] = couchdb.Server(url=url_string, session=session)
+        return (_SERVERS[key], False)
+
 ## From http://stackoverflow.com/questions/8780168/how-to-begin-writing-a-python-wrapper-around-another-wrapper
 class Couch(Database):
     _doc_type = None
     _update_fn = None
+    _merge_fn = None
+    # Number of documents to request per bulk request
+    _chunk_size = 500
 
-    def __init__(self, log=None, url="localhost", **kwargs):
+    def __init__(self, log=None, url="localhost", cache_size=0, replica=None, **kwargs):
         self.db = None
+        self.cache = DocumentCache(cache_size) if cache_size else None
+        self.replica_root = replica
+        self.replica = None
         self.url = url
         self.port = 5984
         self.user = kwargs.get("username", None)
@@ -60,15 +293,16 @@ class Couch(Database):
         if not self.con:
             raise ConnectionError("Connection failed for url {}".format(self.display_url_string))
 
-    def connect(self, username=None, password=None, url="localhost", port=5984, **kw):
+    def connect(self, username=None, password=None, url="localhost", port=5984, pool_size=None, timeout=None, **kw):
         if not username or not password or not url:
             self.log.warn("please supply username, password, and url")
             return None
+        t0 = time.time()
         if not check_url(self.url_string):
             self.log.warn("No such url {}".format(self.display_url_string))
             return None
-        self.con = couchdb.Server(url=self.url_string)
-        self.log.debug("Connected to server @{}".format(self.display_url_string))
+        (self.con, reused) = get_server(self.url_string, pool_size or POOL_SIZE, timeout or TIMEOUT)
+        self.log.debug("Connected to server @{} ({} session) in {:.1f} ms".format(self.display_url_string, "pooled" if reused else "new", 1000 * (time.time() - t0)))
         self.user = username
         self.pw = password
 
@@ -93,7 +327,7 @@ class Couch(Database):
         if self.name_view.get(name, None) is None:
             self.log.warn("no entry '{}' in {}".format(name, self.db))
             return None
-        doc = self.db.get(self.name_view.get(name))
+        doc = self._get_doc(self.name_view.get(name))
         if field:
             if not self._doc_type:
                 return
@@ -102,6 +336,138 @@ class Couch(Database):
         else:
             return doc
 
+    def _open_replica(self, label):
+        """Open and sync the local view replica of the current
+        database, if a replica directory was given.
+
+        :param label: database label; only databases with views in scilifelab.db.replica.VIEWS are replicated
+        """
+        if self.replica_root and self.db is not None:
+            self.replica = open_replica(self.db, self.replica_root, label, self.url)
+
+    def _view_rows(self, viewname, **options):
+        """Get the rows of a view, from the local replica if it holds the view
+
+        :param viewname: view name
+        :param options: view options, used when querying the database
+        """
+        if self.replica is not None and self.replica.has_view(viewname):
+            return self.replica.rows(viewname)
+        return self.db.view(viewname, **options)
+
+    def _get_doc(self, docid):
+        """Retrieve document by id, through the document cache if
+        enabled. Cached documents are returned without checking their
+        revision, see DocumentCache."""
+        if self.cache is None:
+            return self.db.get(docid)
+        doc = self.cache.get(docid)
+        if doc is None:
+            doc = self.db.get(docid)
+            self.cache.put(doc)
+        return doc
+
+    def invalidate(self, name=None):
+        """Drop entry <name> from the document cache, or all entries if
+        name is None. Use when documents are modified by other means than
+        this connection.
+
+        :param name: unique name identifier
+        """
+        if self.cache is None:
+            return
+        if name is None:
+            self.cache.invalidate()
+        elif self.name_view.get(name, None) is not None:
+            self.cache.invalidate(self.name_view.get(name))
+
+    def _get_ids(self, names, viewname=None):
+        """Map names to document ids in as few requests as possible.
+
+        :param names: list of unique name identifiers
+        :param viewname: view emitting names by document id to use instead of the name view
+
+        :returns: dictionary of name to document id for names present in db
+        """
+        if viewname:
+            names = set(names)
+            return {row.value:row.id for row in self.db.view(viewname) if row.value in names}
+        name_view = getattr(self, "name_view", None)
+        if hasattr(name_view, "get_many"):
+            return name_view.get_many(names)
+        if name_view is not None:
+            return {x:name_view[x] for x in names if x in name_view}
+        self.log.debug("no name view for {}; using names/id_to_name view".format(self.db))
+        names = set(names)
+        return {row.value:row.id for row in self.db.view("names/id_to_name") if row.value in names}
+
+    def _get_docs(self, docids, chunk_size=None, cached=True):
+        """Retrieve documents by id using _all_docs with include_docs in
+        chunks of <chunk_size> keys.
+
+        :param docids: list of document ids
+        :param chunk_size: number of documents per request
+        :param cached: use documents in the document cache, if enabled
+
+        :returns: dictionary of document id to document for documents present in db
+        """
+        chunk_size = chunk_size or self._chunk_size
+        docids = list(set(docids))
+        docs = {}
+        if self.cache is not None and cached:
+            for docid in docids:
+                doc = self.cache.get(docid)
+                if doc is not None:
+                    docs[docid] = doc
+            docids = [x for x in docids if x not in docs]
+        for i in range(0, len(docids), chunk_size):
+            chunk = docids[i:i + chunk_size]
+            self.log.debug("retrieving {} documents from {}".format(len(chunk), self.db))
+            for row in self.db.view("_all_docs", keys=chunk, include_docs=True):
+                if row.get("doc", None) is not None:
+                    docs[row.id] = row.doc
+                    if self.cache is not None:
+                        self.cache.put(row.doc)
+        return docs
+
+    def _get_hashes(self, docids, chunk_size=None):
+        """Retrieve revisions and content hashes of stored documents from
+        the hash view in chunks of <chunk_size> keys, without retrieving
+        the documents.
+
+        :param docids: list of document ids
+        :param chunk_size: number of keys per request
+
+        :returns: dictionary of document id to (rev, content hash) for documents with a hash, empty if the view is missing
+        """
+        chunk_size = chunk_size or self._chunk_size
+        docids = list(set(docids))
+        hashes = {}
+        try:
+            for i in range(0, len(docids), chunk_size):
+                for row in self.db.view(HASH_VIEW, keys=docids[i:i + chunk_size]):
+                    hashes[row.key] = tuple(row.value)
+        except couchdb.http.ResourceNotFound:
+            self.log.debug("no view {} in {}; comparing full documents".format(HASH_VIEW, self.db))
+            return {}
+        return hashes
+
+    def get_entries(self, names, chunk_size=None):
+        """Retrieve several entries from db in bulk, using _all_docs
+        with include_docs in chunks of <chunk_size> keys.
+
+        :param names: list of unique name identifiers (primary keys, not the uuids)
+        :param chunk_size: number of documents per request
+
+        :returns: list of documents in the order of names, None for missing entries
+        """
+        ids = self._get_ids(names)
+        for name in names:
+            if name not in ids:
+                self.log.warn("no entry '{}' in {}".format(name, self.db))
+        docs = self._get_docs(ids.values(), chunk_size)
+        return [docs.get(ids.get(x, None), None) for x in names]
+
     def save(self, obj, **kwargs):
         """Save/update database object <obj>. If <obj> already exists
         and <update_fn> is defined, update will only take place if
@@ -112,14 +478,80 @@ class Couch(Database):
         if not self._update_fn:
             self.db.save(obj)
             self.log.info("Saving object with id '{}' in {}".format(obj["_id"], str(self.db)))
+            if self.cache is not None:
+                self.cache.invalidate(obj["_id"])
         else:
             (new_obj, dbid) = self._update_fn(self.db, obj, **kwargs)
             if not new_obj is None:
                 self.log.info("Saving object with id '{}' in {}".format(new_obj["_id"], str(self.db)))
                 self.db.save(new_obj)
+                if self.cache is not None:
+                    self.cache.invalidate(new_obj["_id"])
             else:
                 self.log.info("Object with id '{}' present in {} and not in need of updating".format(dbid.id, str(self.db)))
 
+    def save_many(self, objs, key="name", chunk_size=None, viewname="names/id_to_name"):
+        """Save/update several database objects with one name lookup,
+        one batched fetch of existing documents and _bulk_docs writes.
+        If <merge_fn> is defined, objects are compared with the
+        existing documents and only modified objects are written.
+        Existing documents are only fetched if they were not saved from
+        an object with the content hash of the object, or have been
+        modified since. Of several objects with the
+        same name, only the last one is saved.
+
+        :param objs: list of database objects to save
+        :param key: object field holding the unique name
+        :param chunk_size: number of documents per request
+        :param viewname: view emitting names by document id, as used by update_fn
+
+        :returns: list of (success, docid, rev or exception) tuples, one per written document
+        """
+        if not objs:
+            return []
+        chunk_size = chunk_size or self._chunk_size
+        unique = OrderedDict()
+        for obj in objs:
+            if obj[key] in unique:
+                self.log.warn("Object '{}' given more than once; saving the last one".format(obj[key]))
+                del unique[obj[key]]
+            unique[obj[key]] = obj
+        objs = unique.values()
+        if not self._merge_fn:
+            to_save = objs
+        else:
+            ids = self._get_ids([obj[key] for obj in objs], viewname)
+            hashes = self._get_hashes(ids.values(), chunk_size)
+            changed = []
+            for obj in objs:
+                docid = ids.get(obj[key], None)
+                if hash_matches(hashes.get(docid, None), content_hash(obj)):
+                    self.log.info("Object with id '{}' present in {} and not in need of updating".format(docid, str(self.db)))
+                else:
+                    changed.append(obj)
+            dbobjs = self._get_docs([ids[obj[key]] for obj in changed if obj[key] in ids], chunk_size, cached=False)
+            to_save = []
+            for obj in changed:
+                dbobj = dbobjs.get(ids.get(obj[key], None), None)
+                new_obj = self._merge_fn(obj, dbobj)
+                if new_obj is None:
+                    self.log.info("Object with id '{}' present in {} and not in need of updating".format(dbobj["_id"], str(self.db)))
+                else:
+                    to_save.append(new_obj)
+        results = []
+        for i in range(0, len(to_save), chunk_size):
+            chunk = to_save[i:i + chunk_size]
+            self.log.info("Saving {} objects in {}".format(len(chunk), str(self.db)))
+            results.extend(self.db.update(chunk))
+        for (success, docid, rev_or_exc) in results:
+            if self.cache is not None:
+                self.cache.invalidate(docid)
+            if success:
+                self.log.debug("Saved object with id '{}' in {}".format(docid, str(self.db)))
+            else:
+                self.log.warn("Failed to save object with id '{}' in {}: {}".format(docid, str(self.db), rev_or_exc))
+        return results
+
 
 class GenoLogics(Database):
     def __init__(**kwargs):
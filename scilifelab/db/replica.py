@@ -0,0 +1,232 @@
+"""Local on-disk replicas of statusdb views.
+
+A replica keeps the rows of the views that statusdb connections load
+at startup in an SQLite file, one per couch database. It is brought
+up to date by following the database's _changes feed from the
+sequence stored in a checkpoint file next to it, so that only
+documents changed since the last sync are transferred. View rows are
+computed locally by python equivalents of the couchdb views defined in
+scilifelab.db.statusdb.VIEWS. The rows of views defined only in the
+design documents on the server are copied from the server, and copied
+again only when the database has changed since.
+"""
+import os
+import json
+import sqlite3
+from collections import namedtuple
+
+from scilifelab.log import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+# View row, with the attributes of couchdb.client.Row that connections use
+Row = namedtuple("Row", ["key", "id", "value"])
+
+# Python equivalents of the replicated views, keyed by database label.
+# Only views defined in scilifelab.db.statusdb.VIEWS are replicated, so
+# that the replica rows follow the design documents kept in this
+# repository; other views are always read from the database.
+VIEWS = {'flowcells' : {'names/name' : lambda doc: [(doc.get("name"), None)],
+                        },
+         'projects' : {'project/project_name' : lambda doc: [(doc.get("project_name"), doc["_id"])],
+                       },
+         }
+
+# Views defined only in the design documents on the server, keyed by
+# database label, with the options they are queried with. Their rows
+# are copied from the server.
+SERVER_VIEWS = {'flowcells' : {'info/storage_status' : {},
+                               'info/id' : {},
+                               'names/project_ids_list' : {'reduce' : False},
+                               },
+                'x_flowcells' : {'info/name' : {'reduce' : False},
+                                 'names/project_ids_list' : {'reduce' : False},
+                                 },
+                }
+
+def labels():
+    """Get the labels of the databases that are replicated"""
+    return sorted(set(VIEWS.keys() + SERVER_VIEWS.keys()))
+
+class ViewReplica(object):
+    """SQLite replica of the rows of a set of views of a couch database.
+
+    :param db: couch database
+    :param path: replica file name; the checkpoint is written to <path>.checkpoint
+    :param views: dictionary of view name to function mapping a document to a list of (key, value) tuples
+    :param server_views: dictionary of view name to view options of views whose rows are copied from the server
+    """
+    # Number of changes to request per _changes request
+    _batch_size = 1000
+
+    def __init__(self, db, path, views, server_views=None):
+        self.db = db
+        self.path = path
+        self.checkpoint = "{}.checkpoint".format(path)
+        self.views = views
+        self.server_views = server_views or {}
+        self._con = None
+
+    def __repr__(self):
+        return "<ViewReplica {} ({})>".format(self.path, ", ".join(sorted(self.views.keys() + self.server_views.keys())))
+
+    def has_view(self, viewname):
+        return viewname in self.views or viewname in self.server_views
+
+    def _connect(self):
+        if self._con is None:
+            self._con = sqlite3.connect(self.path)
+            self._con.execute("CREATE TABLE IF NOT EXISTS rows (view TEXT, key TEXT, docid TEXT, value TEXT)")
+            self._con.execute("CREATE INDEX IF NOT EXISTS rows_view ON rows (view, key)")
+            self._con.execute("CREATE INDEX IF NOT EXISTS rows_docid ON rows (docid)")
+            self._con.execute("CREATE TABLE IF NOT EXISTS server_rows (view TEXT, key TEXT, docid TEXT, value TEXT)")
+            self._con.execute("CREATE INDEX IF NOT EXISTS server_rows_view ON server_rows (view)")
+            self._con.execute("CREATE TABLE IF NOT EXISTS server_views (view TEXT PRIMARY KEY, seq TEXT)")
+        return self._con
+
+    def close(self):
+        if self._con is not None:
+            self._con.close()
+            self._con = None
+
+    def read_checkpoint(self):
+        """Read the sequence the replica was last synced to.
+
+        :returns: sequence, or None if there is no valid checkpoint for this database and set of views
+        """
+        if not os.path.exists(self.checkpoint) or not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.checkpoint) as fh:
+                checkpoint = json.load(fh)
+        except ValueError:
+            LOG.warn("Invalid checkpoint file {}".format(self.checkpoint))
+            return None
+        if checkpoint.get("db") != self.db.name or checkpoint.get("views") != sorted(self.views.keys()):
+            return None
+        return checkpoint.get("seq")
+
+    def write_checkpoint(self, seq):
+        """Atomically write the checkpoint file"""
+        tmp = "{}.tmp".format(self.checkpoint)
+        with open(tmp, "w") as fh:
+            json.dump({"db":self.db.name, "views":sorted(self.views.keys()), "seq":seq}, fh)
+        os.rename(tmp, self.checkpoint)
+
+    def _apply(self, con, change):
+        """Replace the rows of the changed document"""
+        docid = change["id"]
+        con.execute("DELETE FROM rows WHERE docid = ?", (docid,))
+        doc = change.get("doc", None)
+        if change.get("deleted", False) or doc is None or docid.startswith("_design/"):
+            return
+        for viewname, fn in self.views.iteritems():
+            con.executemany("INSERT INTO rows VALUES (?, ?, ?, ?)",
+                            [(viewname, json.dumps(key), docid, json.dumps(value)) for key, value in fn(doc)])
+
+    def sync(self):
+        """Bring the replica up to date with the database, starting
+        from the checkpoint, or from scratch if there is none.
+
+        :returns: number of changes applied
+        """
+        since = self.read_checkpoint()
+        con = self._connect()
+        if since is None:
+            LOG.info("No checkpoint for replica {}; replicating all of {}".format(self.path, self.db.name))
+            with con:
+                con.execute("DELETE FROM rows")
+                con.execute("DELETE FROM server_rows")
+                con.execute("DELETE FROM server_views")
+            since = 0
+        n = 0
+        while True:
+            changes = self.db.changes(since=since, include_docs=bool(self.views), limit=self._batch_size)
+            results = changes.get("results", [])
+            with con:
+                for change in results:
+                    self._apply(con, change)
+            since = changes.get("last_seq", since)
+            self.write_checkpoint(since)
+            n += len(results)
+            if len(results) < self._batch_size:
+                break
+        LOG.debug("Applied {} changes from {} to replica {}".format(n, self.db.name, self.path))
+        return n
+
+    def rebuild(self):
+        """Discard the replica and checkpoint, and replicate from scratch
+
+        :returns: number of changes applied
+        """
+        self.close()
+        for fn in [self.path, self.checkpoint]:
+            if os.path.exists(fn):
+                os.unlink(fn)
+        return self.sync()
+
+    def _copy_server_view(self, con, viewname, seq):
+        """Copy the rows of a server view, unless they were copied at
+        sequence <seq>"""
+        cur = con.execute("SELECT seq FROM server_views WHERE view = ?", (viewname,))
+        copied = cur.fetchone()
+        if copied is not None and json.loads(copied[0]) == seq:
+            return
+        LOG.debug("Copying view {} of {} to replica {}".format(viewname, self.db.name, self.path))
+        rows = [(viewname, json.dumps(row.key), row.id, json.dumps(row.value))
+                for row in self.db.view(viewname, **self.server_views[viewname])]
+        with con:
+            con.execute("DELETE FROM server_rows WHERE view = ?", (viewname,))
+            con.executemany("INSERT INTO server_rows VALUES (?, ?, ?, ?)", rows)
+            con.execute("INSERT OR REPLACE INTO server_views VALUES (?, ?)", (viewname, json.dumps(seq)))
+
+    def rows(self, viewname):
+        """Get the rows of a replicated view. Rows of server views are
+        copied from the server first if the database has changed since
+        they were last copied.
+
+        :param viewname: view name
+
+        :returns: list of <Row>
+        """
+        con = self._connect()
+        if viewname in self.server_views:
+            seq = self.read_checkpoint()
+            if seq is None:
+                return [Row(row.key, row.id, row.value) for row in self.db.view(viewname, **self.server_views[viewname])]
+            self._copy_server_view(con, viewname, seq)
+            cur = con.execute("SELECT key, docid, value FROM server_rows WHERE view = ? ORDER BY rowid", (viewname,))
+        else:
+            cur = con.execute("SELECT key, docid, value FROM rows WHERE view = ? ORDER BY key, docid", (viewname,))
+        return [Row(json.loads(key), docid, json.loads(value)) for (key, docid, value) in cur]
+
+
+def replica_path(root, url, dbname):
+    """Get the replica file name of database <dbname> on server <url>"""
+    return os.path.join(root, "{}_{}.sqlite".format(url.replace(":", "_").replace("/", "_"), dbname))
+
+def open_replica(db, root, label, url="localhost", sync=True):
+    """Open the replica of a database in directory <root>.
+
+    :param db: couch database
+    :param root: replica directory
+    :param label: database label; databases without VIEWS or SERVER_VIEWS are not replicated
+    :param url: server url, used to keep replicas of different servers apart
+    :param sync: sync replica with database
+
+    :returns: <ViewReplica>, or None if the database is not replicated or the replica could not be synced
+    """
+    if not label in labels():
+        return None
+    root = os.path.expanduser(root)
+    if not os.path.exists(root):
+        os.makedirs(root)
+    replica = ViewReplica(db, replica_path(root, url, db.name), VIEWS.get(label, {}), SERVER_VIEWS.get(label, {}))
+    if sync:
+        try:
+            replica.sync()
+        except Exception as e:
+            LOG.warn("Failed to sync replica {}: {}; using views of {}".format(replica.path, e, db.name))
+            replica.close()
+            return None
+    return replica
@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 from uuid import uuid4
 import time
+import json
+import hashlib
 from  datetime  import  datetime
 import couchdb
+from couchdb.http import ResourceNotFound
 #Make it backwards compatible
 try:
     import bcbio.pipeline.config_utils as cl
@@ -19,18 +22,74 @@ def load_couch_server(config_file):
     except KeyError:
         raise RuntimeError("\"statusdb\" section missing from configuration file.")
 
+# Document field holding the content hash, tagged with the revision
+# number it was saved with, and fields left out of the hash
+HASH_FIELD = "content_hash"
+HASH_EXCLUDE = ["_id", "_rev", "creation_time", "modification_time", HASH_FIELD]
+# View emitting [_rev, content_hash] keyed by document id
+HASH_VIEW = "hash/content_hash"
+
+def content_hash(obj):
+    """Hash the content of a document: the sha1 of its JSON
+    serialization with sorted keys, leaving out the id, revision,
+    timestamps and the hash itself."""
+    content = {k:v for k, v in obj.iteritems() if k not in HASH_EXCLUDE}
+    return hashlib.sha1(json.dumps(content, sort_keys=True, separators=(",", ":"), default=str)).hexdigest()
+
+def stamp_hash(h, rev=None):
+    """Tag content hash <h> with the revision number that a document
+    saved over revision <rev>, or a new document if rev is None, gets.
+    Writers that do not update the hash change the revision, so that
+    the stored hash no longer matches."""
+    return "{}-{}".format(int(rev.split("-")[0]) + 1 if rev else 1, h)
+
+def hash_matches(stored, h):
+    """Check that a stored document was saved with content hash <h>
+    and has not been modified since.
+
+    :param stored: tuple (rev, content hash) of the stored document, or None
+    :param h: content hash of the object to save
+
+    :returns: True if the stored hash was saved with the current revision and equals h
+    """
+    if stored is None or not stored[0] or not stored[1]:
+        return False
+    return stored[1] == "{}-{}".format(stored[0].split("-")[0], h)
+
+def get_content_hash(db, docid):
+    """Get revision and content hash of a stored document from the
+    hash view, without retrieving the document.
+
+    :returns: tuple (rev, content hash), or None if the document has no hash or the view is missing
+    """
+    try:
+        rows = [row for row in db.view(HASH_VIEW, key=docid)]
+    except ResourceNotFound:
+        return None
+    if not rows:
+        return None
+    return tuple(rows[0].value)
+
 def find_or_make_key(key):
     if not key:
         key = uuid4().hex
     return key
 
 def save_couchdb_obj(db, obj):
-    """Updates ocr creates the object obj in database db."""
+    """Updates ocr creates the object obj in database db. If the stored
+    document was saved from an object with the content hash of obj and
+    has not been modified since, it is left alone without being
+    retrieved. Documents without a valid hash are rewritten once to add
+    the hash."""
+    h = content_hash(obj)
+    if hash_matches(get_content_hash(db, obj['_id']), h):
+        return 'not uppdated'
     dbobj = db.get(obj['_id'])
     time_log = datetime.utcnow().isoformat() + "Z"
     if dbobj is None:
         obj["creation_time"] = time_log
         obj["modification_time"] = time_log
+        obj[HASH_FIELD] = stamp_hash(h)
         db.save(obj)
         return 'created'
     else:
@@ -38,7 +97,8 @@ def save_couchdb_obj(db, obj):
         obj["modification_time"] = time_log
         dbobj["modification_time"] = time_log
         obj["creation_time"] = dbobj["creation_time"]
-        if not comp_obj(obj, dbobj):
+        if not comp_obj(obj, dbobj) or not hash_matches((dbobj.get("_rev"), dbobj.get(HASH_FIELD)), h):
+            obj[HASH_FIELD] = stamp_hash(h, dbobj.get("_rev"))
             db.save(obj)
             return 'uppdated'
     return 'not uppdated'
@@ -64,7 +124,7 @@ def comp_obj(obj, dbobj):
             obj=dont_load_status_if_20158_not_found(obj, dbobj)
     ###end temporary
     """compares the two dictionaries obj and dbobj"""
-    keys = list(set(obj.keys() + dbobj.keys()))
+    keys = [k for k in set(obj.keys() + dbobj.keys()) if k != HASH_FIELD]
     for key in keys:
         if (obj.has_key(key)) and dbobj.has_key(key):
             if (obj[key] != dbobj[key]):
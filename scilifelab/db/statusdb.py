@@ -2,15 +2,19 @@
 import re
 import collections
 from itertools import izip
-from scilifelab.db import Couch
+from couchdb.http import ResourceNotFound
+from scilifelab.db import Couch, LazyView
 from scilifelab.utils.timestamp import utc_time
 from scilifelab.utils.misc import query_yes_no, merge
-from scilifelab.db.statusDB_utils import save_couchdb_obj
+from scilifelab.db.statusDB_utils import save_couchdb_obj, content_hash, get_content_hash, stamp_hash, hash_matches, HASH_FIELD
 from uuid import uuid4
 from scilifelab.log import minimal_logger
 
 LOG = minimal_logger(__name__)
 
+# Content hash view, emitting revision and content hash by document id
+HASH_VIEW_FN = '''function(doc) {if (doc["content_hash"]) {emit(doc["_id"], [doc["_rev"], doc["content_hash"]]);}}'''
+
 # Statusdb views essential for pm qc functionality
 # FIXME: import ViewDefinition from couchdb.design and create views if not present
 VIEWS = {'samples' : {'names': {'name' : '''function(doc) {if (!doc["name"].match(/_[0-9]+$/)) {emit(doc["name"], null);}}''',
@@ -18,14 +22,19 @@ VIEWS = {'samples' : {'names': {'name' : '''function(doc) {if (!doc["name"].matc
                                 'name_fc_proj' : '''var list; function(doc) {if (!doc["name"].match(/_[0-9]+$/)) {list = [doc["flowcell"], doc["sample_prj"]];emit(doc["name"], list);}}''',
                                 'name_proj' : '''function(doc) {if (!doc["name"].match(/_[0-9]+$/)) {emit(doc["name"], doc["sample_prj"]);}}''',
                                 'id_to_name' : '''function(doc) {emit(doc["_id"], doc["name"]);}''',
-                                }},
+                                'fc_name' : '''function(doc) {if (!doc["name"].match(/_[0-9]+$/)) {emit(doc["flowcell"], doc["name"]);}}''',
+                                'proj_name' : '''function(doc) {if (!doc["name"].match(/_[0-9]+$/)) {emit(doc["sample_prj"], doc["name"]);}}''',
+                                },
+                      'hash' : {'content_hash' : HASH_VIEW_FN}},
          'flowcells' : {'names' : {'name' : '''function(doc) {emit(doc["name"], null);}''',
                                    'id_to_name' : '''function(doc) {emit(doc["_id"], doc["name"]);}''',
-                                   'Barcode_lane_stat' : '''function(doc) {emit(doc["name"],doc["illumina"]["Demultiplex_Stats"]["Barcode_lane_statistics"] );}'''}},
+                                   'Barcode_lane_stat' : '''function(doc) {emit(doc["name"],doc["illumina"]["Demultiplex_Stats"]["Barcode_lane_statistics"] );}'''},
+                        'hash' : {'content_hash' : HASH_VIEW_FN}},
          'projects' : {'project' : {'project_id' : '''function(doc) {emit(doc.project_id, doc._id)}''',
                                     'project_name' : '''function(doc) {emit(doc.project_name, doc._id)}'''},
                        'names' : {'id_to_name' : '''function(doc) {emit(doc["_id"], doc["project_name"]);}''',
-                                  'name' : '''function(doc) {emit(doc["project_name"], null);}'''}},
+                                  'name' : '''function(doc) {emit(doc["project_name"], null);}'''},
+                       'hash' : {'content_hash' : HASH_VIEW_FN}},
          }
 
 # Regular expressions for general use
@@ -215,35 +224,32 @@ class AnalysisDocument(StatusDocument):
     def __init__(self, **kw):
         StatusDocument.__init__(self, **kw)
 
-# Updating function for object comparison
-def update_fn(cls, db, obj, viewname = "names/id_to_name", key="name"):
-    """Compare object with object in db if present.
+# Merging function for object comparison
+def merge_fn(cls, obj, dbobj, t_utc=None):
+    """Compare object with its version in db, if present.
 
     :param cls: calling class
-    :param db: couch database
     :param obj: database object to save
+    :param dbobj: database object as stored in db, or None
 
-    :returns: database object to save and database id if present
+    :returns: database object to save or None if not in need of updating
     """
-    t_utc = utc_time()
+    t_utc = t_utc or utc_time()
+    # Hash of obj as given, so that documents with fields added by
+    # other writers match the next object with the same content
+    h = content_hash(obj)
     def equal(a, b):
-        a_keys = [str(x) for x in a.keys() if x not in ["_id", "_rev", "creation_time", "modification_time"]]
-        b_keys = [str(x) for x in b.keys() if x not in ["_id", "_rev", "creation_time", "modification_time"]]
+        a_keys = [str(x) for x in a.keys() if x not in ["_id", "_rev", "creation_time", "modification_time", HASH_FIELD]]
+        b_keys = [str(x) for x in b.keys() if x not in ["_id", "_rev", "creation_time", "modification_time", HASH_FIELD]]
         keys = list(set(a_keys + b_keys))
         return {k:a.get(k, None) for k in keys} == {k:b.get(k, None) for k in keys}
 
-    view = db.view(viewname)
-    d_view = {k.value:k for k in view}
-    dbid =  d_view.get(obj[key], None)
-    dbobj = None
-
-    if dbid:
-        dbobj = db.get(dbid.id, None)
     if dbobj is None:
         obj["creation_time"] = t_utc
-        return (obj, dbid)
+        obj[HASH_FIELD] = stamp_hash(h)
+        return obj
     if equal(obj, dbobj):
-        return (None, dbid)
+        return None
     else:
         # Merge the newly created object with the one found in the database, replacing
         # the information found in the database for the new one if found the same key
@@ -253,7 +259,31 @@ def update_fn(cls, db, obj, viewname = "names/id_to_name", key="name"):
         obj["modification_time"] = t_utc
         obj["_rev"] = dbobj.get("_rev")
         obj["_id"] = dbobj.get("_id")
-        return (obj, dbid)
+        obj[HASH_FIELD] = stamp_hash(h, dbobj.get("_rev"))
+        return obj
+
+# Updating function for object comparison
+def update_fn(cls, db, obj, viewname = "names/id_to_name", key="name"):
+    """Compare object with object in db if present. The stored document
+    is only retrieved if it was not saved from an object with the
+    content hash of obj, or has been modified since.
+
+    :param cls: calling class
+    :param db: couch database
+    :param obj: database object to save
+
+    :returns: database object to save and database id if present
+    """
+    view = db.view(viewname)
+    d_view = {k.value:k for k in view}
+    dbid =  d_view.get(obj[key], None)
+    dbobj = None
+
+    if dbid:
+        if hash_matches(get_content_hash(db, dbid.id), content_hash(obj)):
+            return (None, dbid)
+        dbobj = db.get(dbid.id, None)
+    return (merge_fn(cls, obj, dbobj), dbid)
 
 ##############################
 # functions that operate on status_document objects
@@ -328,9 +358,10 @@ def get_scilife_to_customer_name(project_name, p_con, s_con, get_barcode_seq=Fal
     :returns: dictionary with keys scilife name and values customer name and barcodes(optional)
     """
     name_d = {}
+    project = p_con.get_entry(project_name)
     for samp in s_con.get_samples(sample_prj=project_name):
         bcname = samp.get("barcode_name", None)
-        s = p_con.get_project_sample(project_name, bcname)
+        s = p_con.get_project_sample(project_name, bcname, project=project)
         name_d[bcname] = {'scilife_name': s['project_sample'].get('scilife_name', bcname),
                           'customer_name' : s['project_sample'].get('customer_name', None)
                           }
@@ -345,45 +376,82 @@ def get_scilife_to_customer_name(project_name, p_con, s_con, get_barcode_seq=Fal
 class SampleRunMetricsConnection(Couch):
     _doc_type = SampleRunMetricsDocument
     _update_fn = update_fn
-    def __init__(self, dbname="samples", **kwargs):
+    _merge_fn = merge_fn
+    def __init__(self, dbname="samples", lazy=True, **kwargs):
+        """Connect to the samples database.
+
+        Views are wrapped in <LazyView> objects that are queried by key
+        on first use. Set lazy=False to download the complete views up
+        front.
+
+        :param dbname: database name
+        :param lazy: query views on demand (default True)
+        """
         super(SampleRunMetricsConnection, self).__init__(**kwargs)
         self.db = self.con[dbname]
-        self.name_view = {k.key:k.id for k in self.db.view("names/name", reduce=False)}
-        self.name_fc_view = {k.key:k for k in self.db.view("names/name_fc", reduce=False)}
-        self.name_proj_view = {k.key:k for k in self.db.view("names/name_proj", reduce=False)}
-        self.name_fc_proj_view = {k.key:k for k in self.db.view("names/name_fc_proj", reduce=False)}
+        self.name_view = LazyView(self.db, "names/name", value=lambda row: row.id, reduce=False)
+        self.name_fc_view = LazyView(self.db, "names/name_fc", reduce=False)
+        self.name_proj_view = LazyView(self.db, "names/name_proj", reduce=False)
+        self.name_fc_proj_view = LazyView(self.db, "names/name_fc_proj", reduce=False)
+        if not lazy:
+            for view in [self.name_view, self.name_fc_view, self.name_proj_view, self.name_fc_proj_view]:
+                view.load()
 
     def set_db(self, dbname):
         """Make sure we don't change db from samples"""
         pass
 
-    def get_sample_ids(self, fc_id=None, sample_prj=None):
-        """Retrieve sample ids subset by fc_id and/or sample_prj
+    def _query_sample_names(self, viewname, key, fallback_view):
+        """Get sample ids for a key in a view keyed by flowcell or
+        project. Falls back on filtering <fallback_view> client side
+        if the view is missing in the database.
 
-        :param fc_id: flowcell id
-        :param sample_prj: sample project name
+        :param viewname: view keyed by flowcell or project, emitting sample name
+        :param key: view key
+        :param fallback_view: <LazyView> keyed by sample name, emitting the key
 
-        :returns sample_ids: list of couchdb sample ids
+        :returns: dictionary of couchdb sample ids to sample names
         """
-        self.log.debug("retrieving sample ids subset by flowcell '{}' and sample_prj '{}'".format(fc_id, sample_prj))
-        fc_sample_ids = [self.name_fc_view[k].id for k in self.name_fc_view.keys() if self.name_fc_view[k].value == fc_id] if fc_id else []
-        prj_sample_ids = [self.name_proj_view[k].id for k in self.name_proj_view.keys() if self.name_proj_view[k].value == sample_prj] if sample_prj else []
+        try:
+            return {row.id:row.value for row in self.db.view(viewname, key=key, reduce=False)}
+        except ResourceNotFound:
+            self.log.warn("No view '{}' in {}; filtering '{}' client side".format(viewname, self.db, fallback_view.viewname))
+            return {row.id:row.key for row in fallback_view.values() if row.value == key}
+
+    def _get_sample_names(self, fc_id=None, sample_prj=None):
+        """Retrieve mapping of sample ids to sample names subset by
+        fc_id and/or sample_prj
+        """
+        fc_samples = self._query_sample_names("names/fc_name", fc_id, self.name_fc_view) if fc_id else {}
+        prj_samples = self._query_sample_names("names/proj_name", sample_prj, self.name_proj_view) if sample_prj else {}
         # | -> union, & -> intersection
-        if len(fc_sample_ids) > 0 and len(prj_sample_ids) > 0:
-            sample_ids = list(set(fc_sample_ids) & set(prj_sample_ids))
+        if len(fc_samples) > 0 and len(prj_samples) > 0:
+            sample_ids = set(fc_samples.keys()) & set(prj_samples.keys())
         else:
-            sample_ids = list(set(fc_sample_ids) | set(prj_sample_ids))
+            sample_ids = set(fc_samples.keys()) | set(prj_samples.keys())
         # Set to empty list if we actually had supplied a flowcell id and project id but one of them is non-existent
         if fc_id and sample_prj:
-            if len(fc_sample_ids)==0:
-                sample_ids = []
+            if len(fc_samples)==0:
+                sample_ids = set()
                 self.log.warn("No such flowcell '{}' for project '{}'".format(fc_id, sample_prj))
-            elif len(prj_sample_ids)==0:
-                sample_ids = []
+            elif len(prj_samples)==0:
+                sample_ids = set()
                 self.log.warn("No such project '{}' for flowcell '{}'".format(sample_prj, fc_id))
+        self.log.debug("Number of samples: {}, number of fc samples: {}, number of project samples: {}".format(len(sample_ids), len(fc_samples), len(prj_samples)))
+        names = dict(prj_samples)
+        names.update(fc_samples)
+        return {x:names[x] for x in sample_ids}
 
-        self.log.debug("Number of samples: {}, number of fc samples: {}, number of project samples: {}".format(len(sample_ids), len(fc_sample_ids), len(prj_sample_ids)))
-        return sample_ids
+    def get_sample_ids(self, fc_id=None, sample_prj=None):
+        """Retrieve sample ids subset by fc_id and/or sample_prj
+
+        :param fc_id: flowcell id
+        :param sample_prj: sample project name
+
+        :returns sample_ids: list of couchdb sample ids
+        """
+        self.log.debug("retrieving sample ids subset by flowcell '{}' and sample_prj '{}'".format(fc_id, sample_prj))
+        return self._get_sample_names(fc_id, sample_prj).keys()
 
     def get_samples(self, fc_id=None, sample_prj=None):
         """Retrieve samples subset by fc_id and/or sample_prj
@@ -394,42 +462,98 @@ class SampleRunMetricsConnection(Couch):
         :returns samples: list of sample_run_metrics documents
         """
         self.log.debug("retrieving samples subset by flowcell '{}' and sample_prj '{}'".format(fc_id, sample_prj))
-        sample_ids = self.get_sample_ids(fc_id, sample_prj)
-        inv_view = {v:k for k,v in self.name_view.iteritems()}
-        sample_names = [inv_view[x] for x in sample_ids]
-        return [self.get_entry(x) for x in sample_names]
+        sample_names = self._get_sample_names(fc_id, sample_prj)
+        self.name_view.prime({v:k for k,v in sample_names.iteritems()})
+        return [x for x in self.get_entries(sample_names.values()) if x is not None]
+
+class BarcodeLaneStatistics(object):
+    """Index of the Demultiplex_Stats barcode lane statistics of a
+    flowcell, keyed by (project, sample id, lane). Project names are
+    translated from the J__Doe_00_01 form used in Demultiplex_stats.htm.
+    Iterating yields the statistics rows in their original order.
+
+    :param stats: list of Barcode_lane_statistics rows
+    """
+    def __init__(self, stats):
+        self.stats = stats
+        self._index = {}
+        self._pool_size = None
+        for item in stats:
+            self._index[self._key(item.get("Project", None).replace("__", "."), item.get("Sample ID", None), item.get("Lane", None))] = item
+
+    def __repr__(self):
+        return "<BarcodeLaneStatistics ({} rows)>".format(len(self.stats))
+
+    def __iter__(self):
+        return iter(self.stats)
+
+    def __len__(self):
+        return len(self.stats)
+
+    def _key(self, project_id, sample_id, lane):
+        return (project_id, sample_id, str(lane))
+
+    def get(self, project_id, sample_id, lane, default=None):
+        """Get the statistics row of a sample in a lane"""
+        return self._index.get(self._key(project_id, sample_id, lane), default)
+
+    def pool_size(self):
+        """Get the number of demultiplexed samples per lane"""
+        if self._pool_size is None:
+            self._pool_size = collections.defaultdict(int)
+            for item in self.stats:
+                if item['Index'] != "Undetermined":
+                    self._pool_size[item['Lane']] += 1
+        return collections.defaultdict(int, self._pool_size)
 
 class FlowcellRunMetricsConnection(Couch):
     _doc_type = FlowcellRunMetricsDocument
     _update_fn = update_fn
+    _merge_fn = merge_fn
     def __init__(self, dbname="flowcells", **kwargs):
         super(FlowcellRunMetricsConnection, self).__init__(**kwargs)
         self.db = self.con[dbname]
-        self.name_view = {k.key:k.id for k in self.db.view("names/name", reduce=False)}
-        self.storage_status_view = {k.key:k.value for k in self.db.view("info/storage_status")}
-        self.id_view = {k.key:k.value for k in self.db.view("info/id")}
-        self.stat_view = {k.key:k.value for k in self.db.view("names/Barcode_lane_stat", reduce=False)}
-        self.proj_list = {k.key:k.value for k in self.db.view("names/project_ids_list", reduce=False) if k.key}
+        self._open_replica("flowcells")
+        self.name_view = {k.key:k.id for k in self._view_rows("names/name", reduce=False)}
+        self.storage_status_view = {k.key:k.value for k in self._view_rows("info/storage_status")}
+        self.id_view = {k.key:k.value for k in self._view_rows("info/id")}
+        self.stat_view = LazyView(self.db, "names/Barcode_lane_stat", value=lambda row: row.value, reduce=False)
+        self._stat_index = {}
+        self.proj_list = {k.key:k.value for k in self._view_rows("names/project_ids_list", reduce=False) if k.key}
 
     def set_db(self):
         """Make sure we don't change db from flowcells"""
         pass
 
+    def get_barcode_lane_index(self, flowcell, fc_doc=None):
+        """Get the barcode lane statistics index of a flowcell. The
+        index is built on first use, from <fc_doc> if provided or else
+        from the Barcode_lane_stat view row of that flowcell only, and
+        is kept for the lifetime of the connection.
+
+        :param flowcell: flowcell name, <date>_<flowcell id>
+        :param fc_doc: flowcell document, if already retrieved
+
+        :returns: <BarcodeLaneStatistics>, or None if there are no statistics for flowcell
+        """
+        if flowcell not in self._stat_index:
+            if fc_doc is not None:
+                stats = fc_doc.get("illumina", {}).get("Demultiplex_Stats", {}).get("Barcode_lane_statistics", None)
+            else:
+                stats = self.stat_view.get(flowcell)
+            self._stat_index[flowcell] = BarcodeLaneStatistics(stats) if stats is not None else None
+        return self._stat_index[flowcell]
+
     def get_barcode_lane_statistics(self, project_id, sample_id, flowcell, lane):
 	"""Get Mean Quality Score (PF) and % of >= Q30 Bases (PF) for
-        project_id, sample_id, flow_cell, lane. In the current
-        implementation a unique key is made consisting of
-        project-sample-lane. Relies entirely on assumption that all
-        project names are formatted as J__Doe_00_01 in
-        Demultiplex_stats.htm.
+        project_id, sample_id, flow_cell, lane. Relies entirely on
+        assumption that all project names are formatted as
+        J__Doe_00_01 in Demultiplex_stats.htm.
         """
-        if flowcell not in self.stat_view.keys():
+        index = self.get_barcode_lane_index(flowcell)
+        if index is None:
             return None, None
-        stats = self.stat_view.get(flowcell)
-        stats_d = {"{}-{}-{}".format(item.get("Project", None).replace("__", "."),
-                                     item.get("Sample ID", None),
-                                     item.get("Lane", None)):item for item in stats}
-        sample_data = stats_d.get("{}-{}-{}".format(project_id, sample_id, lane), None)
+        sample_data = index.get(project_id, sample_id, lane)
         if not sample_data:
             return None, None
         return sample_data.get('Mean Quality Score (PF)', None), sample_data.get('% of >= Q30 Bases (PF)', None)
@@ -504,40 +628,46 @@ class FlowcellRunMetricsConnection(Couch):
                             db_run.get('RunInfo').get('Id'), db_run.get('storage_status'), status))
             db_run['storage_status'] = status
             save_couchdb_obj(self.db, db_run)
+            if self.cache is not None:
+                self.cache.invalidate(doc_id)
 
 
 class X_FlowcellRunMetricsConnection(Couch):
     def __init__(self, dbname="x_flowcells", **kwargs):
         super(X_FlowcellRunMetricsConnection, self).__init__(**kwargs)
         self.db = self.con[dbname]
-        self.name_view = {k.key:k.id for k in self.db.view("info/name", reduce=False)}
-        self.proj_list = {k.key:k.value for k in self.db.view("names/project_ids_list", reduce=False) if k.key} 
+        self.name_view = {k.key:k.id for k in self._view_rows("info/name", reduce=False)}
+        self.proj_list = {k.key:k.value for k in self._view_rows("names/project_ids_list", reduce=False) if k.key} 
 
 
 class ProjectSummaryConnection(Couch):
     _doc_type = ProjectSummaryDocument
     _update_fn = update_fn
+    _merge_fn = merge_fn
     def __init__(self, dbname="projects", **kwargs):
         super(ProjectSummaryConnection, self).__init__(**kwargs)
         self.db = self.con[dbname]
-        self.name_view = {k.key:k.id for k in self.db.view("project/project_name", reduce=False)}
+        self._open_replica("projects")
+        self.name_view = {k.key:k.id for k in self._view_rows("project/project_name", reduce=False)}
 
     def set_db(self, dbname):
         """Make sure we don't change db from projects"""
         pass
 
-    def get_project_sample(self, project_name, barcode_name=None, extensive_matching=False):
+    def get_project_sample(self, project_name, barcode_name=None, extensive_matching=False, project=None):
         """Get project sample name for a SampleRunMetrics barcode_name.
 
         :param project_name: the project name
         :param barcode_name: the barcode name of a sample run
         :param extensive_matching: do extensive matching of barcode names
+        :param project: project document, if already retrieved
 
         :returns: dict(sample_name:project sample name, project_sample:project sample dict) or None
         """
         if not barcode_name:
             return None
-        project = self.get_entry(project_name)
+        if project is None:
+            project = self.get_entry(project_name)
         if not project:
             return None
         project_samples = project.get('samples', None)
@@ -602,6 +732,7 @@ class ProjectSummaryConnection(Couch):
 class AnalysisConnection(Couch):
     _doc_type = AnalysisDocument
     _update_fn = update_fn
+    _merge_fn = merge_fn
     def __init__(self, dbname="analysis", **kwargs):
         super(AnalysisConnection, self).__init__(**kwargs)
         self.db = self.con[dbname]
@@ -10,7 +10,7 @@ from fabric.api import task, run, execute, cd, settings, local
 from fabric.network import disconnect_all
 from datetime import datetime
 
-from scilifelab.utils.misc import filtered_walk
+from scilifelab.utils.misc import iter_filtered_walk
 from scilifelab.utils.misc import query_yes_no, md5sum
 
 import scilifelab.log
@@ -54,7 +54,7 @@ def flowcell_remove_status(archive_dir, swestore_dir, to_remove="to_remove"):
     pattern = "slurm.*.out$"
     def compress_fn(f):
         return re.search(pattern, f) != None
-    compress_log_files = filtered_walk(os.path.join(archive_dir, "compress_logs"), compress_fn)
+    compress_log_files = iter_filtered_walk(os.path.join(archive_dir, "compress_logs"), compress_fn)
     for f in compress_log_files:
         with open(f) as fh:
             compress_str = "".join([x.strip() for x in fh.readlines()])
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""A cache of lims queries and entities shared by the objects that build up
+one project, so that processes, artifacts and samples that several samples
+of the project go through are only listed and retrieved once.
+
+Entities without content are retrieved with the batch endpoints of the lims
+where there is one (artifacts, samples and containers), and otherwise in a
+bounded thread pool.
+"""
+import threading
+from multiprocessing.pool import ThreadPool
+from genologics.lims import *
+
+# Entity classes that can be retrieved with <uri>/batch/retrieve
+BATCH_CLASSES = (Artifact, Sample, Container)
+
+class LimsCache():
+    """Instances of this class hold the results of lims queries made while
+    building up one project. Entity instances are already shared through
+    the cache of the Lims instance, so only their content has to be
+    retrieved once, which prefetch does in as few requests as possible.
+
+    Arguments:
+        lims_instance   Lims instance
+        threads         number of threads for retrieving entities and for map
+        batch_size      maximum number of entities per batch request"""
+
+    def __init__(self, lims_instance, threads = 1, batch_size = 500):
+        self.lims = lims_instance
+        self.threads = max(1, threads)
+        self.batch_size = batch_size
+        self._queries = {}
+        self._lock = threading.Lock()
+        # Marks the threads of map pools
+        self._local = threading.local()
+
+    def _query(self, method, **kw):
+        key = (method, repr(sorted(kw.items())))
+        with self._lock:
+            if key in self._queries:
+                return list(self._queries[key])
+        result = getattr(self.lims, method)(**kw)
+        with self._lock:
+            self._queries.setdefault(key, result)
+        return list(result)
+
+    def get_processes(self, **kw):
+        """Memoized Lims.get_processes"""
+        return self._query('get_processes', **kw)
+
+    def get_artifacts(self, **kw):
+        """Memoized Lims.get_artifacts"""
+        return self._query('get_artifacts', **kw)
+
+    def get_samples(self, **kw):
+        """Memoized Lims.get_samples"""
+        return self._query('get_samples', **kw)
+
+    def prefetch(self, entities):
+        """Retrieves the content of the entities that have not yet been
+        retrieved; with one batch request per batch_size entities of classes
+        that have a batch endpoint, and in the thread pool for the others.
+        Returns the entities."""
+        pending = {}
+        for entity in entities:
+            if entity is not None and entity.root is None:
+                pending.setdefault(entity.__class__, {})[entity.uri] = entity
+        singles = []
+        for cls, instances in pending.items():
+            instances = instances.values()
+            if cls in BATCH_CLASSES:
+                for i in range(0, len(instances), self.batch_size):
+                    self.lims.get_batch(instances[i:i + self.batch_size])
+            else:
+                singles += instances
+        self.map(lambda entity: entity.get(), singles)
+        return entities
+
+    def map(self, function, items):
+        """Applies function to items in a pool of at most self.threads
+        threads. Called from within a pool thread, as by prefetch in
+        functions passed to map, items are processed serially so that
+        the number of threads stays bounded. Returns the results in the
+        order of items."""
+        items = list(items)
+        if self.threads == 1 or len(items) < 2 or getattr(self._local, "worker", False):
+            return map(function, items)
+        def work(item):
+            self._local.worker = True
+            return function(item)
+        pool = ThreadPool(min(self.threads, len(items)))
+        try:
+            return pool.map(work, items)
+        finally:
+            pool.close()
+            pool.join()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+"""A process pool shared by the lims uploaders.
+
+Tasks are handed out longest first, by the cost given with each task, to
+whichever worker is idle. Every worker has a pipe of its own to the master,
+which carries tasks, results and log records, and the master blocks in
+select on these pipes until a worker reports back or a task times out. A
+worker that runs past the timeout is terminated and replaced, and workers
+retire after max_tasks tasks or once their resident set size has reached
+max_rss MB, so that the memory of huge projects is returned to the system.
+"""
+import os
+import time
+import signal
+import select
+import logging
+import resource
+import traceback
+import multiprocessing as mp
+from collections import deque, namedtuple
+
+DONE = 'done'
+FAILED = 'failed'
+TIMEOUT = 'timeout'
+
+# Seconds to wait for a terminated worker to exit before it is killed
+KILL_TIMEOUT = 5
+
+# Outcome of a task: status is one of DONE, FAILED and TIMEOUT, result the
+# return value of the task function or the error. worker is the pid of the
+# worker, max_rss its peak resident set size in MB after the task.
+TaskResult = namedtuple('TaskResult', ['key', 'status', 'result', 'worker',
+                                       'elapsed', 'max_rss'])
+
+def max_rss_mb():
+    """Peak resident set size of this process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+class PipeHandler(logging.Handler):
+    """Sends log records of a worker to the master through its pipe. Like
+    the QueueHandler of python 3.2, the message is formatted and the record
+    stripped of arguments and exception info, which might not pickle."""
+
+    def __init__(self, conn):
+        logging.Handler.__init__(self)
+        self.conn = conn
+
+    def emit(self, record):
+        try:
+            self.format(record)
+            record.msg = record.message
+            record.args = None
+            record.exc_info = None
+            self.conn.send(('log', record))
+        except Exception:
+            self.handleError(record)
+
+def _worker(conn, function, initializer, initargs, max_tasks, max_rss):
+    # Handlers inherited from the master, such as those of cement, must not
+    # keep terminate() from stopping the worker
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    log = logging.getLogger(mp.current_process().name)
+    log.setLevel(level=logging.INFO)
+    handler = PipeHandler(conn)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - '
+                                           '%(levelname)s - %(message)s'))
+    log.addHandler(handler)
+    context = initializer(log, *initargs) if initializer else log
+    ntasks = 0
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        key, args = task
+        start = time.time()
+        try:
+            status, result = DONE, function(context, *args)
+        except Exception:
+            status, result = FAILED, traceback.format_exc()
+        ntasks += 1
+        rss = max_rss_mb()
+        retire = bool((max_tasks and ntasks >= max_tasks) or
+                      (max_rss and rss >= max_rss))
+        try:
+            conn.send(('result', key, status, result, time.time() - start, rss, retire))
+        except Exception:
+            conn.send(('result', key, FAILED, traceback.format_exc(),
+                       time.time() - start, rss, retire))
+        if retire:
+            break
+    conn.close()
+
+class _Worker():
+    def __init__(self, target, args):
+        self.conn, child_conn = mp.Pipe()
+        self.process = mp.Process(target=target, args=(child_conn,) + args)
+        self.process.start()
+        child_conn.close()
+        self.task = None
+        self.started = None
+        self.completed = 0
+        self.retiring = False
+
+    def send(self, task):
+        self.task = task
+        self.started = time.time()
+        self.conn.send(task)
+
+    def stop(self):
+        self.retiring = True
+        self.conn.send(None)
+
+    def close(self, terminate=False):
+        if terminate:
+            self.process.terminate()
+            self.process.join(KILL_TIMEOUT)
+            if self.process.is_alive():
+                os.kill(self.process.pid, signal.SIGKILL)
+        self.process.join()
+        self.conn.close()
+
+class Executor():
+    """Runs function(context, *args) for each task in a pool of processes.
+
+    Arguments:
+        function        task function
+        initializer     called as initializer(log, *initargs) once in each
+                        worker; its return value is passed to function as
+                        context. Without initializer, the context is the
+                        worker log, whose records are handled by log.
+        processes       number of workers
+        max_tasks       tasks after which a worker is replaced
+        max_rss         peak resident set size in MB after which a worker is
+                        replaced
+        timeout         seconds after which a task is stopped
+        log             logger of the master"""
+
+    def __init__(self, function, initializer=None, initargs=(), processes=4,
+                 max_tasks=None, max_rss=None, timeout=None, log=None):
+        self.function = function
+        self.initializer = initializer
+        self.initargs = tuple(initargs)
+        self.processes = max(1, processes)
+        self.max_tasks = max_tasks
+        self.max_rss = max_rss
+        self.timeout = timeout
+        self.log = log or logging.getLogger(__name__)
+
+    def _start(self):
+        return _Worker(_worker, (self.function, self.initializer, self.initargs,
+                                 self.max_tasks, self.max_rss))
+
+    def run(self, tasks):
+        """Runs tasks, a list of tuples (key, args, cost), highest cost
+        first. Returns a list of TaskResult in the order the tasks finished."""
+        pending = deque([(key, tuple(args)) for key, args, cost in
+                         sorted(tasks, key=lambda t: t[2], reverse=True)])
+        size = min(self.processes, len(pending))
+        workers = [self._start() for i in range(size)]
+        results = []
+        while workers:
+            for w in workers:
+                if w.task is None and not w.retiring:
+                    if pending:
+                        w.send(pending.popleft())
+                    else:
+                        w.stop()
+            wait = None
+            if self.timeout:
+                deadlines = [w.started + self.timeout for w in workers if w.task]
+                if deadlines:
+                    wait = max(0, min(deadlines) - time.time())
+            ready = select.select([w.conn for w in workers], [], [], wait)[0]
+            for w in [w for w in workers if w.conn in ready]:
+                try:
+                    msg = w.conn.recv()
+                except EOFError:
+                    workers.remove(w)
+                    w.close()
+                    if w.task:
+                        results.append(TaskResult(w.task[0], FAILED,
+                            'worker exited with code {}'.format(w.process.exitcode),
+                            w.process.pid, time.time() - w.started, None))
+                    if pending and (w.task or w.completed):
+                        workers.append(self._start())
+                    continue
+                if msg[0] == 'log':
+                    self.log.handle(msg[1])
+                else:
+                    key, status, result, elapsed, rss, retire = msg[1:]
+                    results.append(TaskResult(key, status, result, w.process.pid,
+                                              elapsed, rss))
+                    w.task = None
+                    w.completed += 1
+                    w.retiring = w.retiring or retire
+            for w in list(workers):
+                if w.task and self.timeout and time.time() - w.started > self.timeout:
+                    workers.remove(w)
+                    w.close(terminate=True)
+                    results.append(TaskResult(w.task[0], TIMEOUT, None, w.process.pid,
+                                              time.time() - w.started, None))
+                    if pending:
+                        workers.append(self._start())
+        for key, args in pending:
+            results.append(TaskResult(key, FAILED, 'no worker could be started',
+                                      None, 0, None))
+        return results
+
+def timing_report(results):
+    """Lines of a report of the wall time, worker and peak memory of each task,
+    longest first, followed by totals per status."""
+    lines = ['{:<24} {:>8} {:>8} {:>10} {:>12}'.format('task', 'status', 'worker',
+                                                       'time_s', 'max_rss_mb')]
+    for r in sorted(results, key=lambda r: r.elapsed, reverse=True):
+        lines.append('{:<24} {:>8} {:>8} {:>10.1f} {:>12}'.format(r.key, r.status,
+                     r.worker, r.elapsed, '{:.0f}'.format(r.max_rss) if r.max_rss else '-'))
+    for status in [DONE, FAILED, TIMEOUT]:
+        done = [r for r in results if r.status == status]
+        lines.append('{} tasks {}, {:.1f} s'.format(len(done), status,
+                                                    sum([r.elapsed for r in done])))
+    return lines
@@ -12,6 +12,7 @@ from genologics.lims_utils import *
 from process_categories import *
 from scilifelab.db.statusDB_utils import *
 from functions import *
+from entity_cache import LimsCache
 import os
 import couchdb
 import time
@@ -21,38 +22,43 @@ import logging
 class ProjectDB():
     """Instances of this class holds a dictionary formatted for building up the 
     project database on statusdb. Source of information come from different lims
-    artifacts and processes."""
+    artifacts and processes. Lims queries and entities are cached for the
+    project and shared by its samples, which are built up in a pool of
+    <threads> threads."""
 
-    def __init__(self, lims_instance, project_id, samp_db):
+    def __init__(self, lims_instance, project_id, samp_db, threads = 1):
         self.lims = lims_instance 
         self.samp_db = samp_db
+        self.cache = LimsCache(self.lims, threads)
         self.project = Project(self.lims,id = project_id)
-        self.preps = ProcessInfo(self.lims , self.lims.get_processes(
-               projectname = self.project.name, type = AGRLIBVAL.values()))
-        self.demux = self.lims.get_processes(projectname = self.project.name,
+        self.preps = ProcessInfo(self.lims , self.cache.get_processes(
+               projectname = self.project.name, type = AGRLIBVAL.values()),
+               self.cache)
+        self.demux = self.cache.get_processes(projectname = self.project.name,
                                                     type = DEMULTIPLEX.values())
-        self.demux_procs = ProcessInfo(self.lims, self.demux)
-        self.seq = self.lims.get_processes(projectname = self.project.name,
+        self.demux_procs = ProcessInfo(self.lims, self.demux, self.cache)
+        self.seq = self.cache.get_processes(projectname = self.project.name,
                                                     type = SEQUENCING.values())
-        self.seq_procs = ProcessInfo(self.lims, self.seq)
+        self.seq_procs = ProcessInfo(self.lims, self.seq, self.cache)
         self._get_project_level_info()
         self._make_DB_samples()
         self._get_sequencing_finished()
         self._get_open_escalations()
 
     def _get_open_escalations(self):
-        escalation_ids=[]
-        processes=self.lims.get_processes(projectname=self.project.name)
-        for p in processes:
-            step=gent.Step(self.lims, id=p.id)
-            if step.actions.escalation:
-                samples_escalated=set()
-                if step.actions.escalation['status'] == "Pending":
-                    shortid=step.id.split("-")[1]
-                    escalation_ids.append(shortid)
+        processes=self.cache.get_processes(projectname=self.project.name)
+        escalation_ids=filter(None, self.cache.map(self._get_escalation, processes))
         if escalation_ids:
             self.obj['escalations']=escalation_ids
 
+    def _get_escalation(self, process):
+        """Returns the short id of the step of process if it has a pending 
+        escalation"""
+        step=gent.Step(self.lims, id=process.id)
+        if step.actions.escalation:
+            if step.actions.escalation['status'] == "Pending":
+                return step.id.split("-")[1]
+        return None
 
     def _get_project_level_info(self):
         self.obj = {'source' : 'lims',
@@ -76,7 +82,7 @@ class ProjectDB():
 
 
     def _get_project_summary_info(self):
-        project_summary = self.lims.get_processes(projectname =
+        project_summary = self.cache.get_processes(projectname =
                                 self.project.name, type = SUMMARY.values())
         if len(project_summary) > 0:
             self.obj['project_summary'] = udf_dict(project_summary[0])
@@ -102,22 +108,26 @@ class ProjectDB():
 
     def _make_DB_samples(self):
         ## Getting sample info
-        samples = self.lims.get_samples(projectlimsid = self.project.id)
+        samples = self.cache.get_samples(projectlimsid = self.project.id)
         self.obj['no_of_samples'] = len(samples)
         runinfo=self.demux_procs or self.seq_procs 
         if len(samples) > 0:
             procss_per_art = self.build_processes_per_artifact(self.lims,
                                                          self.project.name)
+            self.cache.prefetch(samples)
+            self.cache.prefetch([samp.artifact for samp in samples])
             self.obj['first_initial_qc'] = '3000-10-10'
-            for samp in samples:
-                sampDB = SampleDB(self.lims,
+            def make_sample(samp):
+                return SampleDB(self.lims,
                                   samp.id,
                                   self.obj['project_name'],
                                   self.samp_db,
                                   self.obj['application'],
                                   self.preps.info,
                                   runinfo.info,
-                                  processes_per_artifact = procss_per_art)
+                                  processes_per_artifact = procss_per_art,
+                                  cache = self.cache)
+            for sampDB in self.cache.map(make_sample, samples):
                 self.obj['samples'][sampDB.name] = sampDB.obj
                 try:
                     initial_qc_start_date = self.obj['samples'][sampDB.name]['initial_qc']['start_date']
@@ -135,7 +145,7 @@ class ProjectDB():
         present should be included. The values of the dictionary is sets, to avoid
         duplicated projects for a single artifact.
         """
-        processes = lims.get_processes(projectname = pname)
+        processes = self.cache.prefetch(self.cache.get_processes(projectname = pname))
         processes_per_artifact = {}
         for process in processes:
             for inart, outart in process.input_output_maps:
@@ -158,24 +168,32 @@ class ProcessInfo():
                          in_art_id2: [in_art2, out_art2]},
                      'P424_115': ...},
                        ...},
-        '24-8480':...}"""
-    def __init__(self, lims_instance, processes):
+        '24-8480':...}
+    The processes, their input artifacts and the samples of these are 
+    retrieved up front through the cache."""
+    def __init__(self, lims_instance, processes, cache = None):
         self.lims = lims_instance
+        self.cache = cache or LimsCache(self.lims)
         self.info = self._get_process_info(processes)
 
     def _get_process_info(self, processes):
         process_info = {}
+        self.cache.prefetch(processes)
+        in_arts = [in_art_id['uri'] for process in processes 
+                               for in_art_id, out_art_id in process.input_output_maps]
+        self.cache.prefetch(in_arts)
+        self.cache.prefetch([samp for in_art in in_arts for samp in in_art.samples])
         for process in processes:
             process_info[process.id] = {'type' : process.type.name ,
                                 'start_date': process.date_run,
                                 'samples' : {}}
-            in_arts=[]
+            in_arts=set()
             for in_art_id, out_art_id in process.input_output_maps:
                 in_art = in_art_id['uri']       #these are actually artifacts
                 out_art = out_art_id['uri']
                 samples = in_art.samples
                 if in_art.id not in in_arts:
-                    in_arts.append(in_art.id)
+                    in_arts.add(in_art.id)
                     for samp in samples:
                         if not samp.name in process_info[process.id]['samples']:
                             process_info[process.id]['samples'][samp.name] = {}
@@ -186,11 +204,13 @@ class ProcessInfo():
 class SampleDB():
     """Instances of this class holds a dictionary formatted for building up the 
     samples in the project database on status db. Source of information come 
-    from different lims artifacts and processes."""
+    from different lims artifacts and processes. Lims queries and entities 
+    are shared with the other samples of the project through cache."""
     def __init__(self, lims_instance , sample_id, project_name, samp_db,
                         application = None, AgrLibQCs = [], run_info = [],
-                        processes_per_artifact = None): 
+                        processes_per_artifact = None, cache = None): 
         self.lims = lims_instance
+        self.cache = cache or LimsCache(self.lims)
         self.samp_db = samp_db
         self.AgrLibQCs = AgrLibQCs
         self.lims_sample = Sample(self.lims, id = sample_id)
@@ -214,7 +234,7 @@ class SampleDB():
                     preps[prep_id]['sample_run_metrics'] = runs[prep_id]
             self.obj['library_prep'] = self._get_prep_leter(preps)
         initqc = InitialQC(self.lims, self.name, self.processes_per_artifact, 
-                                                            self.application)
+                                                self.application, self.cache)
         self.obj['initial_qc'] = initqc.set_initialqc_info()
         if self.application in ['Finished library', 'Amplicon with adaptors']:
             chategory = INITALQCFINISHEDLIB.values()
@@ -229,8 +249,9 @@ class SampleDB():
     def _get_firts_day(self, sample_name ,process_list, last_day = False):
         """process_list is a list of process type names, sample_name is a 
         sample name :)"""
-        arts = self.lims.get_artifacts(sample_name = sample_name, 
-                                        process_type = process_list)
+        arts = self.cache.prefetch(self.cache.get_artifacts(
+                          sample_name = sample_name, process_type = process_list))
+        self.cache.prefetch([a.parent_process for a in arts])
         index = -1 if last_day else 0 
         uniqueDates=set([a.parent_process.date_run for a in arts])
         try:
@@ -293,18 +314,18 @@ class SampleDB():
                     else:
                         key = None 
                     if key:
-                        lims_run = Process(lims, id = steps.lastseq['id'])
+                        lims_run = Process(self.lims, id = steps.lastseq['id'])
                         run_dict = dict(lims_run.udf.items())
                         if preps[key].has_key('reagent_label') and run_dict.has_key('Finish Date'):
                             try:
-                                dem_art = Artifact(lims, id = steps.latestdem['outart'])
+                                dem_art = Artifact(self.lims, id = steps.latestdem['outart'])
                                 dem_qc=dem_art.qc_flag
                             except ValueError:
                                 #Miseq projects might not have a demultiplexing step here
                                 #so the artifact id might be None
                                 dem_qc=None
-                            seq_art = Artifact(lims, id = steps.lastseq['inart'])
-                            lims_run = Process(lims, id = steps.lastseq['id'])
+                            seq_art = Artifact(self.lims, id = steps.lastseq['inart'])
+                            lims_run = Process(self.lims, id = steps.lastseq['id'])
                             samp_run_met_id = self._make_sample_run_id(seq_art, 
                                                            lims_run, preps[key],
                                                           steps.lastseq['type'])
@@ -382,7 +403,7 @@ class SampleDB():
                                         pro_per_art = self.processes_per_artifact)
                     steps = ProcessSpec(history.history, history.history_list, 
                                         self.application)
-                    prep = Prep(self.name)
+                    prep = Prep(self.name, self.lims)
                     prep.set_prep_info(steps, self.application)
                     if not preps.has_key(prep.id2AB) and prep.id2AB:
                         preps[prep.id2AB] = prep.prep_info
@@ -417,7 +438,7 @@ class SampleDB():
 
     def _pars_reagent_labels(self, steps, last_libval):
         if steps.firstpoolstep:
-            inart = Artifact(lims, id = steps.firstpoolstep['inart'])
+            inart = Artifact(self.lims, id = steps.firstpoolstep['inart'])
             if len(inart.reagent_labels) == 1:
                 return inart.reagent_labels[0]
         if last_libval.has_key('reagent_labels'): 
@@ -456,8 +477,9 @@ class SampleDB():
 
 class InitialQC():
     """"""
-    def __init__(self, lims_inst ,sample, procs_per_art, application):
+    def __init__(self, lims_inst ,sample, procs_per_art, application, cache = None):
         self.lims = lims_inst
+        self.cache = cache or LimsCache(self.lims)
         self.processes_per_artifact = procs_per_art
         self.sample_name = sample
         self.initialqc_info = {}
@@ -465,7 +487,7 @@ class InitialQC():
         self.application = application
 
     def _get_initialqc_processes(self):
-        outarts = self.lims.get_artifacts(sample_name = self.sample_name,
+        outarts = self.cache.get_artifacts(sample_name = self.sample_name,
                                           process_type = AGRINITQC.values())
         if outarts:
             outart = Artifact(self.lims, id = max(map(lambda a: a.id, outarts)))
@@ -485,8 +507,8 @@ class InitialQC():
             if self.steps.initialqstart:
                 self.initialqc_info['start_date'] = self.steps.initialqstart['date']
             if self.steps.initialqcend:
-                inart = Artifact(lims, id = self.steps.initialqcend['inart'])
-                process = Process(lims,id = self.steps.initialqcend['id'])
+                inart = Artifact(self.lims, id = self.steps.initialqcend['inart'])
+                process = Process(self.lims,id = self.steps.initialqcend['id'])
                 self.initialqc_info.update(udf_dict(inart))
                 initials = process.technician.initials
                 self.initialqc_info['initials'] = initials
@@ -495,7 +517,7 @@ class InitialQC():
             if self.steps.latestCaliper:
                 self.initialqc_info['caliper_image'] = get_caliper_img(
                                                                self.sample_name,
-                                           self.steps.latestCaliper['id'], lims)
+                                      self.steps.latestCaliper['id'], self.lims)
         return delete_Nones(self.initialqc_info)
 
 
@@ -620,8 +642,9 @@ class ProcessSpec():
         self.seqstart = get_last_first(self.seqstarts, last = False)
 
 class Prep():
-    def __init__(self, sample_name):
+    def __init__(self, sample_name, lims_inst = None):
         self.sample_name=sample_name
+        self.lims = lims_inst or lims
         self.prep_info = {
             'reagent_label': None,
             'library_validation':{},
@@ -659,12 +682,12 @@ class Prep():
                 self.prep_info['pre_prep_start_date'] = steps.preprepstart['date']
                 self.id2AB = steps.preprepstart['id']
                 if steps.preprepstart['outart']:
-                    art = Artifact(lims, id = steps.preprepstart['outart'])
+                    art = Artifact(self.lims, id = steps.preprepstart['outart'])
                     self.prep_info.update(udf_dict(art))
             elif steps.prepstart:
                 self.id2AB = steps.prepstart['id']
                 if steps.prepstart['outart']:
-                    art = Artifact(lims, id = steps.prepstart['outart'])
+                    art = Artifact(self.lims, id = steps.prepstart['outart'])
                     self.prep_info.update(udf_dict(art))
         if steps.libvalend:
             self.library_validations = self._get_lib_val_info(steps.libvalends,
@@ -680,7 +703,7 @@ class Prep():
                                          libvalstart.has_key('date')) else None
         for agrlibQCstep in agrlibQCsteps:
             library_validation = self.lib_val_templ
-            inart = Artifact(lims, id = agrlibQCstep['inart'])
+            inart = Artifact(self.lims, id = agrlibQCstep['inart'])
             if agrlibQCstep.has_key('date'):
                 library_validation['finish_date'] = agrlibQCstep['date']
             library_validation['start_date'] = start_date
@@ -688,14 +711,14 @@ class Prep():
             library_validation['prep_status'] = inart.qc_flag
             library_validation['reagent_labels'] = inart.reagent_labels
             library_validation.update(udf_dict(inart))
-            initials = Process(lims, id = agrlibQCstep['id']).technician.initials
+            initials = Process(self.lims, id = agrlibQCstep['id']).technician.initials
             if initials:
                 library_validation['initials'] = initials
             if library_validation.has_key("size_(bp)"):
                 average_size_bp = library_validation.pop("size_(bp)")
                 library_validation["average_size_bp"] = average_size_bp
-            if latest_caliper_id and (Process(lims, id=latest_caliper_id['id'])).date_run >= (Process(lims, id=libvalstart['id']).date_run):
+            if latest_caliper_id and (Process(self.lims, id=latest_caliper_id['id'])).date_run >= (Process(self.lims, id=libvalstart['id']).date_run):
                 library_validation["caliper_image"] = get_caliper_img(self.sample_name,
-                                                        latest_caliper_id['id'], lims)
+                                                        latest_caliper_id['id'], self.lims)
             library_validations[agrlibQCstep['id']] = delete_Nones(library_validation)
         return delete_Nones(library_validations) 
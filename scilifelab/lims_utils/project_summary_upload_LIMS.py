@@ -16,16 +16,17 @@ from pprint import pprint
 from genologics.lims import *
 from genologics.config import BASEURI, USERNAME, PASSWORD
 import objectsDB as DB
+from entity_cache import LimsCache
+from executor import Executor, DONE, timing_report
+import json
 import datetime
 import time
-import multiprocessing as mp
-import Queue
 import logging
 import logging.handlers
 
    
 class PSUL():
-    def __init__(self, proj, samp_db, proj_db, upload_data, days, man_name, output_f, log):
+    def __init__(self, proj, samp_db, proj_db, upload_data, days, man_name, output_f, log, threads = 1):
         self.proj = proj
         self.id = proj.id
         self.udfs = proj.udf
@@ -41,6 +42,11 @@ class PSUL():
         self.ordered_opened = None
         self.lims = Lims(BASEURI, USERNAME, PASSWORD)
         self.log=log
+        self.threads = threads
+        self.status = 'not_updated'
+        self.uploaded = False
+        self.no_of_samples = None
+        self.elapsed = None
 
     def print_couchdb_obj_to_file(self, obj):
         if self.output_f is not None:
@@ -104,21 +110,26 @@ class PSUL():
         opended_after_140630 = comp_dates('2014-06-30', self.ordered_opened)
         try:
             self.log.info('Handeling {proj}'.format(proj = self.name))
-            project = database.ProjectDB(self.lims, self.id, self.samp_db)
+            project = database.ProjectDB(self.lims, self.id, self.samp_db, self.threads)
+            self.no_of_samples = project.obj.get('no_of_samples')
             key = find_proj_from_view(self.proj_db, self.name)
             project.obj['_id'] = find_or_make_key(key)
             if not opended_after_140630:
                 try:
                     project.obj = load_status_from_google_docs.get(self.name, project.obj)
                 except RequestError:
+                    self.status = 'failed'
                     return "Failed to get the 20158 spreadsheet for project{}".format(self.id)
             if self.upload_data:
                 info = save_couchdb_obj(self.proj_db, project.obj)
+                self.uploaded = info in ['created', 'uppdated']
             else:
                 info = self.print_couchdb_obj_to_file(project.obj)
+            self.status = 'rebuilt'
             return "project {name} is handled and {info}: _id = {id}".format(
                                name=self.name, info=info, id=project.obj['_id'])
         except IOError:
+            self.status = 'failed'
             return ('Issues geting info for {name}. The "Application" udf might'
                                          ' be missing'.format(name = self.name))
 
@@ -130,11 +141,99 @@ class PSUL():
         else:
             log_info = ('No open date or order date found for project {name}. '
                         'Project not updated.'.format(name = self.name))
-        elapsed = time.time() - start_time
+        self.elapsed = time.time() - start_time
         self.log.info('Time - {elapsed} : Proj Name - '
-                 '{name}'.format(elapsed = elapsed, name = self.name))
+                 '{name}'.format(elapsed = self.elapsed, name = self.name))
         self.log.info(log_info) 
 
+    def result(self):
+        """Outcome of the update, as sent back to the master process"""
+        return (self.id, self.name, self.status, self.uploaded, 
+                                            self.no_of_samples, self.elapsed)
+
+class ProjectState():
+    """High-water marks of incremental uploads, kept in a json file. For each
+    project id the start time of the last run that handled the project or found 
+    it unchanged in lims is recorded, together with its number of samples. A 
+    project is up to date if its mark is that of the previous run, and is 
+    rebuilt if it is not, or if it has changed in lims since then."""
+
+    # Subtracted from the previous run's start time in changed since queries,
+    # to allow for clock differences between this host and the lims server
+    margin = datetime.timedelta(minutes = 10)
+    time_format = "%Y-%m-%dT%H:%M:%SZ"
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.start = datetime.datetime.utcnow()
+        self.since = None
+        self.projects = {}
+        if os.path.exists(state_file):
+            with open(state_file) as f:
+                state = json.load(f)
+            self.since = state.get('since')
+            self.projects = state.get('projects', {})
+
+    def is_current(self, proj_id):
+        mark = self.projects.get(proj_id, {}).get('modified')
+        return self.since is not None and mark is not None and mark >= self.since
+
+    def no_of_samples(self, proj_id):
+        return self.projects.get(proj_id, {}).get('no_of_samples')
+
+    def mark(self, proj_id, no_of_samples = None):
+        entry = self.projects.setdefault(proj_id, {})
+        entry['modified'] = self.start.strftime(self.time_format)
+        if no_of_samples is not None:
+            entry['no_of_samples'] = no_of_samples
+
+    def select(self, lims, projects, threads = 1):
+        """Splits projects into those that have to be rebuilt and those that
+        have not changed since the previous run, and marks the latter."""
+        if self.since is None:
+            return projects, []
+        since = datetime.datetime.strptime(self.since, self.time_format) - self.margin
+        changed = changed_project_ids(lims, since.strftime(self.time_format), threads)
+        rebuild = [p for p in projects if p.id in changed or not self.is_current(p.id)]
+        rebuild_ids = set([p.id for p in rebuild])
+        skipped = [p for p in projects if p.id not in rebuild_ids]
+        for proj in skipped:
+            self.mark(proj.id)
+        return rebuild, skipped
+
+    def save(self):
+        """Writes the state, with this run as the previous run"""
+        tmp = self.state_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'since' : self.start.strftime(self.time_format),
+                       'projects' : self.projects}, f)
+        os.rename(tmp, self.state_file)
+
+def changed_project_ids(lims, since, threads = 1):
+    """Ids of the projects that were modified, or that have samples in 
+    processes that were modified, since the ISO formatted time since. Lims 
+    has no changed since queries for samples and artifacts; their changes are
+    picked up through the processes that make them."""
+    ids = set([proj.id for proj in lims.get_projects(last_modified = since)])
+    cache = LimsCache(lims, threads)
+    processes = cache.prefetch(lims.get_processes(last_modified = since))
+    inputs = set([inp['uri'] for proc in processes 
+                      for inp, outp in proc.input_output_maps if inp is not None])
+    cache.prefetch(inputs)
+    samples = set([samp for art in inputs for samp in art.samples])
+    cache.prefetch(samples)
+    ids.update([samp.project.id for samp in samples if samp.project is not None])
+    return ids
+
+def log_metrics(log, results, skipped):
+    """Logs the number of skipped, rebuilt, uploaded and failed projects"""
+    count = lambda status: len([r for r in results if r[2] == status])
+    log.info('Projects: {skipped} skipped, {rebuilt} rebuilt, {uploaded} uploaded,'
+             ' {not_updated} not updated, {failed} failed'.format(
+             skipped = len(skipped), rebuilt = count('rebuilt'),
+             uploaded = len([r for r in results if r[3]]),
+             not_updated = count('not_updated'), failed = count('failed')))
+
 def main(options):
     man_name = options.project_name
     all_projects = options.all_projects
@@ -155,145 +254,76 @@ def main(options):
 
     if all_projects:
         projects = mainlims.get_projects()
-        masterProcess(options,projects, mainlims, mainlog)
+        state = None
+        skipped = []
+        if options.incremental:
+            state = ProjectState(options.state_file)
+            projects, skipped = state.select(mainlims, projects, options.threads)
+            mainlog.info('{n} projects unchanged since {since}'.format(
+                                            n = len(skipped), since = state.since))
+        results = masterProcess(options, projects, mainlims, mainlog, state)
+        if state:
+            for (proj_id, name, status, uploaded, no_of_samples, elapsed) in results:
+                if status != 'failed':
+                    state.mark(proj_id, no_of_samples)
+            state.save()
+        log_metrics(mainlog, results, skipped)
     elif man_name:
         proj = mainlims.get_projects(name = man_name)
         if not proj:
             mainlog.warn('No project named {man_name} in Lims'.format(
                         man_name = man_name))
         else:
-            P = PSUL(proj[0], samp_db, proj_db, upload_data, days, man_name, output_f, mainlog)
+            P = PSUL(proj[0], samp_db, proj_db, upload_data, days, man_name, output_f, mainlog, options.threads)
             P.project_update_and_logging()
 
-def processPSUL(options, queue, logqueue):
+def initPSUL(log, options):
+    """Connects a worker process to statusdb and lims. Returns the context 
+    passed to processPSUL"""
     couch = load_couch_server(options.conf)
-    proj_db = couch['projects']
-    samp_db = couch['samples']
-    mylims = Lims(BASEURI, USERNAME, PASSWORD)
-    work=True
-    procName=mp.current_process().name
-    proclog=logging.getLogger(procName)
-    proclog.setLevel(level=logging.INFO)
-    mfh = QueueHandler(logqueue)
-    mft = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    mfh.setFormatter(mft)
-    proclog.addHandler(mfh)
+    return {'options': options, 'log': log, 'proj_db': couch['projects'],
+            'samp_db': couch['samples'], 'lims': Lims(BASEURI, USERNAME, PASSWORD)}
 
-    while work:
-        #grabs project from queue
-        try:
-            projname = queue.get(block=True, timeout=3)
-        except Queue.Empty:
-            work=False
-            proclog.info("exiting gracefully")
-            break
-        else:
-            proj=mylims.get_projects(name=projname)[0]
-            P = PSUL(proj, samp_db, proj_db, options.upload, options.days, options.project_name, options.output_f, proclog)
-            P.project_update_and_logging()
-            #signals to queue job is done
-            queue.task_done()
+def processPSUL(context, projid):
+    """Updates one project in a worker process. Returns PSUL.result()"""
+    options = context['options']
+    proj = Project(context['lims'], id=projid)
+    P = PSUL(proj, context['samp_db'], context['proj_db'], options.upload, 
+             options.days, options.project_name, options.output_f, 
+             context['log'], options.threads)
+    P.project_update_and_logging()
+    return P.result()
 
-def masterProcess(options,projectList, mainlims, logger):
-    projectsQueue=mp.JoinableQueue()
-    logQueue=mp.Queue()
-    childs=[]
-    #Initial step : order projects by sample number:
+def masterProcess(options,projectList, mainlims, logger, state=None):
+    """Updates the projects in a pool of processes, largest projects first, 
+    and logs the timing report of the pool. Returns the list of 
+    PSUL.result() of the projects, with status 'failed' for the projects
+    that raised an error or timed out."""
+    #order projects by sample number, as recorded by the previous 
+    #incremental run if there was one:
+    def sample_number(proj):
+        if state and state.no_of_samples(proj.id) is not None:
+            return state.no_of_samples(proj.id)
+        return mainlims.get_sample_number(projectlimsid=proj.id)
     logger.info("ordering the project list")
-    orderedprojectlist=sorted(projectList, key=lambda x: (mainlims.get_sample_number(projectname=x.name)), reverse=True)
+    tasks = [(proj.id, (proj.id,), sample_number(proj)) for proj in projectList]
     logger.info("done ordering the project list")
-    #spawn a pool of processes, and pass them queue instance 
-    for i in range(options.processes):
-        p = mp.Process(target=processPSUL, args=(options,projectsQueue, logQueue))
-        p.start()
-        childs.append(p)
-    #populate queue with data   
-    for proj in orderedprojectlist:
-        projectsQueue.put(proj.name)
-
-    #wait on the queue until everything has been processed     
-    notDone=True
-    while notDone:
-        try:
-            log=logQueue.get(False)
-            logger.handle(log)
-        except Queue.Empty:
-            if not stillRunning(childs):
-                notDone=False
-                break
-
-def stillRunning(processList):
-    ret=False
-    for p in processList:
-        if p.is_alive():
-            ret=True
-
-    return ret
-
-class QueueHandler(logging.Handler):
-    """
-    This handler sends events to a queue. Typically, it would be used together
-    with a multiprocessing Queue to centralise logging to file in one process
-    (in a multi-process application), so as to avoid file write contention
-    between processes.
-
-    This code is new in Python 3.2, but this class can be copy pasted into
-    user code for use with earlier Python versions.
-    """
-
-    def __init__(self, queue):
-        """
-        Initialise an instance, using the passed queue.
-        """
-        logging.Handler.__init__(self)
-        self.queue = queue
-
-    def enqueue(self, record):
-        """
-        Enqueue a record.
-
-        The base implementation uses put_nowait. You may want to override
-        this method if you want to use blocking, timeouts or custom queue
-        implementations.
-        """
-        self.queue.put_nowait(record)
-
-    def prepare(self, record):
-        """
-        Prepares a record for queuing. The object returned by this method is
-        enqueued.
-
-        The base implementation formats the record to merge the message
-        and arguments, and removes unpickleable items from the record
-        in-place.
-
-        You might want to override this method if you want to convert
-        the record to a dict or JSON string, or send a modified copy
-        of the record while leaving the original intact.
-        """
-        # The format operation gets traceback text into record.exc_text
-        # (if there's exception data), and also puts the message into
-        # record.message. We can then use this to replace the original
-        # msg + args, as these might be unpickleable. We also zap the
-        # exc_info attribute, as it's no longer needed and, if not None,
-        # will typically not be pickleable.
-        self.format(record)
-        record.msg = record.message
-        record.args = None
-        record.exc_info = None
-        return record
-
-    def emit(self, record):
-        """
-        Emit a record.
+    executor = Executor(processPSUL, initPSUL, (options,), options.processes,
+                        options.max_tasks, options.max_rss, options.timeout, 
+                        logger)
+    taskresults = executor.run(tasks)
+    for line in timing_report(taskresults):
+        logger.info(line)
+    results = []
+    for r in taskresults:
+        if r.status == DONE:
+            results.append(r.result)
+        else:
+            logger.error('{key} {status}: {error}'.format(key = r.key, 
+                         status = r.status, error = r.result))
+            results.append((r.key, r.key, 'failed', False, None, r.elapsed))
+    return results
 
-        Writes the LogRecord to the queue, preparing it for pickling first.
-        """
-        try:
-            self.enqueue(self.prepare(record))
-        except Exception:
-            self.handleError(record)
-                  
 if __name__ == '__main__':
     usage = "Usage:       python project_summary_upload_LIMS.py [options]"
     parser = OptionParser(usage=usage)
@@ -316,6 +346,24 @@ if __name__ == '__main__':
                       " that will be used only if --no_upload tag is used"), default=None)
     parser.add_option("-m", "--multiprocs", type='int', dest = "processes", default = 4,
                       help = "How many processes will be spawned. Will only work with -a")
+    parser.add_option("--max_tasks", type='int', dest = "max_tasks", default = 20,
+                      help = "Projects after which a process is replaced. Default is 20")
+    parser.add_option("--max_rss", type='int', dest = "max_rss", default = 4000,
+                      help = "Peak memory in MB after which a process is replaced. "
+                      "Default is 4000")
+    parser.add_option("--timeout", type='int', dest = "timeout", default = None,
+                      help = "Seconds after which the update of a project is "
+                      "stopped and the project counted as failed. Default is none")
+    parser.add_option("-t", "--threads", type='int', dest = "threads", default = 4,
+                      help = "How many threads per project will retrieve lims "
+                      "entities and build up samples. Default is 4")
+    parser.add_option("-i", "--incremental", dest = "incremental", action = 
+                      "store_true", default = False, help = "Only rebuild projects "
+                      "that have changed in lims since the previous incremental "
+                      "run, as recorded in the state file. Use with -a flagg")
+    parser.add_option("--state_file", dest = "state_file", help = "State file of "
+                      "incremental runs. Default is $HOME/lims2db_projects_state.json",
+                      default = os.path.expanduser("~/lims2db_projects_state.json"))
     parser.add_option("-l", "--logfile", dest = "logfile", help = ("log file",
                       " that will be used. default is $HOME/lims2db_projects.log "), default=os.path.expanduser("~/lims2db_projects.log"))
 
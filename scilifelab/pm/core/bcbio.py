@@ -86,11 +86,13 @@ class BcbioRunController(AbstractBaseController):
         if self.pargs.only_failed:
             status = {x:self._sample_status(x) for x in flist}
             flist = [x for x in flist if self._sample_status(x)=="FAIL"]
+        ## Poll the status of any previous jobs of all samples at once
+        running = self.app.cmd.monitor_jobs([os.path.dirname(x) for x in flist])
         ## Here process files again, removing if requested, and running the pipeline
         for run_info in flist:
             self.app.log.info("Running analysis defined by config file {}".format(run_info))
             os.chdir(os.path.abspath(os.path.dirname(run_info)))
-            if self.app.cmd.monitor(work_dir=os.path.dirname(run_info)):
+            if running.get(os.path.dirname(run_info)):
                 self.app.log.warn("Not running job")
                 continue
             if self.pargs.restart:
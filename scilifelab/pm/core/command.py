@@ -44,6 +44,17 @@ class ICommand(interface.Interface):
         :param idfile: process/job id file
         """
 
+    def monitor_jobs(work_dirs, idfile=None):
+        """
+        Check for process/job id files in several working directories.
+
+        :param work_dirs: working directories
+        :param idfile: process/job id file
+
+        :returns: dictionary with value True for the working directories
+          whose process/job is still running
+        """
+
     def command(cmd_args, capture=True, ignore_error=False, cwd=None, **kw):
         """
         Run the command interface function
@@ -90,6 +101,17 @@ class CommandHandler(handler.CementBaseHandler):
     def __init__(self, *args, **kw):
         super(CommandHandler, self).__init__(*args, **kw)
 
+    def monitor_jobs(self, work_dirs, idfile=None):
+        """Check for process/job id files in several working directories,
+        one at a time. Handlers that can poll several jobs at once override
+        this.
+
+        :param work_dirs: working directories
+        :param idfile: process/job id file
+        """
+        kw = {'idfile': idfile} if idfile else {}
+        return dict((d, True) for d in work_dirs if self.monitor(d, **kw))
+
     ## Taken from paver.easy
     ## FIXME: add time stamp (better: make DRY_RUN a log level that only prints to console, for instance by using the interface ILog)
     def dry(self, message, func, *args, **kw):
@@ -303,13 +325,14 @@ class CommandHandler(handler.CementBaseHandler):
     def verify_md5sum(self, md5file):
         """Verify the md5sums and files given in the supplied md5file
         """
-        import scilifelab.utils.misc
+        import scilifelab.utils.checksum
         def runpipe():
             if not os.path.exists(md5file):
                 self.app.log.warn("not verifying md5sums in non-existant file {}".format(md5file))
                 return False
             passed = True
             self.app.log.debug("Verifying md5sums in file {}".format(md5file))
+            entries = []
             with open(md5file) as fh:
                 for line in fh:
                     line = line.strip()
@@ -320,15 +343,18 @@ class CommandHandler(handler.CementBaseHandler):
                     if not len(pcs) == 2:
                         self.app.log.warn("malformed line: {} in {}".format(line,md5file))
                         continue
-                    fpath = os.path.join(os.path.dirname(md5file),pcs[1])
-                    self.app.log.debug("Calculating md5sum of file {}. Expecting {}".format(fpath,pcs[0]))
-                    md5 = scilifelab.utils.misc.md5sum(fpath)
-                    self.app.log.debug("Calculated md5sum is {}".format(md5))
-                    if md5 == pcs[0]:
-                        self.app.log.info("{}: OK".format(pcs[1]))
-                    else: 
-                        self.app.log.warn("{}: FAILED".format(pcs[1]))
-                        passed = False
+                    entries.append(pcs)
+            # Calculate the md5sums of all files at once, concurrently
+            checksums = scilifelab.utils.checksum.checksums([os.path.join(os.path.dirname(md5file),entry[1]) for entry in entries])
+            for pcs in entries:
+                fpath = os.path.join(os.path.dirname(md5file),pcs[1])
+                md5 = checksums[fpath].md5
+                self.app.log.debug("Calculated md5sum of file {} is {}. Expecting {}".format(fpath,md5,pcs[0]))
+                if md5 == pcs[0]:
+                    self.app.log.info("{}: OK".format(pcs[1]))
+                else: 
+                    self.app.log.warn("{}: FAILED".format(pcs[1]))
+                    passed = False
             return passed
         return self.dry("verifying md5sums in {}".format(md5file), runpipe)
     
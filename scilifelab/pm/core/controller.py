@@ -8,6 +8,7 @@ from cement.core import interface, handler, controller, backend
 
 from scilifelab.pm.lib.help import PmHelpFormatter
 from scilifelab.utils.misc import filtered_output, query_yes_no, filtered_walk
+from scilifelab.utils.parallel_compress import compress_files
 
 class AbstractBaseController(controller.CementBaseController):
     """
@@ -125,6 +126,9 @@ class AbstractExtendedBaseController(AbstractBaseController):
         group.add_argument('--bzip2', help="Use bzip2 as compressing device", default=False, action="store_true")
         group.add_argument('--pigz', help="Use pigz as compressing device", default=False, action="store_true")
         group.add_argument('--input_file', help="Run on specific input file", default=None)
+        group.add_argument('--local', help="Run compression/decompression jobs in parallel on this node, largest files first", default=False, action="store_true")
+        group.add_argument('--cores', help="Number of cores to use with --local. Default all", default=None, action="store", type=int)
+        group.add_argument('--job_threads', help="Number of threads per job for pigz and pbzip2 with --local. Default 4", default=4, action="store", type=int)
 
 
     def _process_args(self):
@@ -226,6 +230,13 @@ class AbstractExtendedBaseController(AbstractBaseController):
             return
         if len(flist) > 0 and not query_yes_no("Going to {} {} files ({}...). Are you sure you want to continue?".format(label, len(flist), ",".join([os.path.basename(x) for x in flist[0:10]])), force=self.pargs.force):
             sys.exit()
+        if self.pargs.local and not self.pargs.dry_run and self.app.cmd._meta.label == "shell":
+            results = compress_files(flist, prog=self._meta.compress_prog, decompress=(label == "decompress"),
+                                     cores=self.pargs.cores, job_threads=self.pargs.job_threads)
+            failed = [r for r in results if r.error]
+            if failed:
+                self.app.log.warn("{} of {} files failed to {}".format(len(failed), len(results), label))
+            return
         for f in flist:
             self.log.info("{}ing {}".format(label, f))
             self.app.cmd.command([self._meta.compress_prog, self._meta.compress_opt, "%s" % f], label, ignore_error=True, **{'workingDirectory':os.path.dirname(f), 'outputPath':os.path.join(os.path.dirname(f), "{}-{}-drmaa.log".format(label, os.path.basename(f)))})
@@ -20,7 +20,8 @@ from scilifelab.report.delivery_notes import sample_status_note, project_status_
 from scilifelab.report.survey import initiate_survey, closed_projects
 from scilifelab.report.best_practice import best_practice_note, SEQCAP_KITS
 from scilifelab.db.statusdb import SampleRunMetricsConnection, ProjectSummaryConnection, FlowcellRunMetricsConnection, get_scilife_to_customer_name, X_FlowcellRunMetricsConnection
-from scilifelab.utils.misc import query_yes_no, filtered_walk, md5sum
+from scilifelab.utils.misc import query_yes_no, filtered_walk
+from scilifelab.utils.transfer import transfer_files
 from scilifelab.report.gdocs_report import upload_to_gdocs
 from scilifelab.utils.timestamp import utc_time
 from ConfigParser import NoSectionError, NoOptionError
@@ -53,6 +54,7 @@ class DeliveryController(AbstractBaseController):
             (['--statusdb_project_name'], dict(help="Project name in statusdb.", action="store", default=None)),
             (['--group'], dict(help="After raw data delivery, transfer group ownership of the delivered files to this group", action="store", default=None)),
             (['--outdir'], dict(help="Deliver to this (sub)directory instead. Added for cases where the delivery directory already exists and there is no write permission.", action="store", default=None)),
+            (['--threads'], dict(help="Number of files to transfer and verify at a time. Default 4", action="store", default=4, type=int)),
             ]
 
     def _setup(self, base_app):
@@ -185,52 +187,51 @@ class DeliveryController(AbstractBaseController):
         if not query_yes_no("Continue?"):
             return
 
-        # Make sure that transfer will be with rsync
-        if not self.pargs.rsync:
-            self.log.warn("Files must be transferred using rsync")
-            if not query_yes_no("Do you wish to continue delivering using rsync?", default="yes"):
+        # Raw data is always copied, never moved
+        if self.pargs.move:
+            self.log.warn("Raw data files are copied and verified, not moved")
+            if not query_yes_no("Do you wish to continue delivering by copying?", default="yes"):
                 return
-            self.pargs.rsync = True
+            self.pargs.move = False
+
+        # Copy and verify all files on a worker pool, computing the
+        # source md5sums while copying. Completed files are recorded in
+        # the manifest so that an interrupted delivery can be resumed.
+        results = {}
+        if not (self.pargs.link or self.pargs.dry_run):
+            sources = [s for flowcells in samples.values() for files in flowcells.values() for s in files['src']]
+            targets = [d for flowcells in samples.values() for files in flowcells.values() for d in files['dst']]
+            manifest = os.path.join(proj_base_dir, "{}_raw_data_delivery_manifest.json".format(self.pargs.project))
+            self.log.info("Transferring and verifying {} files with {} threads".format(len(sources), self.pargs.threads))
+            results = {r.src: r for r in transfer_files(sources, targets, manifest=manifest, threads=self.pargs.threads)}
 
         # Process each sample
         for sample, flowcells in samples.iteritems():
             for fc, files in flowcells.iteritems():
                 self.log.info("Processing sample {} and flowcell {}".format(sample, fc))
 
-                # transfer files
-                self.log.debug("Transferring {} fastq files".format(len(files['src'])))
-                self._transfer_files(sources=files['src'], targets=files['dst'])
-
                 passed = True
+                md5 = []
                 if self.pargs.link or self.pargs.dry_run:
+                    self.log.debug("Transferring {} fastq files".format(len(files['src'])))
+                    self._transfer_files(sources=files['src'], targets=files['dst'])
                     passed = False
                 else:
-                    # calculate md5sums on the source side and write it on the destination
-                    md5 = []
-                    for s,d in zip(files['src'], files['dst']):
-                        m = md5sum(s)
-                        mfile = "{}.md5".format(d)
-                        md5.append([m,mfile,s])
-                        self.log.debug("md5sum for source file {}: {}".format(s,m))
-
-                    # write the md5sum to a file at the destination and verify the transfer
-                    for m, mfile, srcpath in md5:
-                        dstfile = os.path.splitext(mfile)[0]
-                        self.log.debug("Writing md5sum to file {}".format(mfile))
-                        self.app.cmd.write(mfile,"{}  {}".format(m,os.path.basename(dstfile)),True)
-                        self.log.debug("Verifying md5sum for file {}".format(dstfile))
-                        dm = md5sum(dstfile)
-                        self.log.debug("md5sum for destination file {}: {}".format(dstfile,dm))
-                        if m != dm:
-                            self.log.warn("md5sum verification FAILED for {}. Source: {}, Target: {}".format(dstfile,m,dm))
-                            self.log.warn("Improperly transferred file {} is removed from destination, please retry transfer of this file".format(dstfile))
-                            self.app.cmd.safe_unlink(dstfile)
-                            self.app.cmd.safe_unlink(mfile)
+                    # write the md5sum to a file at the destination
+                    for s in files['src']:
+                        result = results[s]
+                        if not result.passed:
+                            self.log.warn("Transfer of {} to {} FAILED: {}, please retry transfer of this file".format(s, result.dst, result.error))
                             passed = False
                             continue
+                        mfile = "{}.md5".format(result.dst)
+                        md5.append([result.md5,mfile,s])
+                        self.log.debug("md5sum for file {}: {}".format(result.dst,result.md5))
+                        self.log.debug("Writing md5sum to file {}".format(mfile))
+                        self.app.cmd.write(mfile,"{}  {}".format(result.md5,os.path.basename(result.dst)),True)
 
                         # Modify the permissions to ug+rw
-                        for f in [dstfile, mfile]:
+                        for f in [result.dst, mfile]:
                             self.app.cmd.chmod(f,stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP)
 
                 # touch the flag to trigger uppmax inbox permission fix
@@ -417,6 +418,7 @@ class DeliveryReportController(AbstractBaseController):
         group.add_argument('--credentials-file', help="Text file containing base64-encoded Google Docs credentials",  action="store", default=None, type=str)
         group.add_argument('--from-date', help="Consider projects closed on or after this date, specified on the form 'YYYY-MM-DD'", default=None, action="store", type=str)
         group.add_argument('--to-date', help="Consider projects closed on or before this date, specified on the form 'YYYY-MM-DD'", default=None, action="store", type=str)
+        group.add_argument('-j', '--jobs', help="Number of processes for rendering notes in sample_status and project_status. Defaults to 1.", default=1, action="store", type=int)
         super(DeliveryReportController, self)._setup(app)
 
     def _process_args(self):
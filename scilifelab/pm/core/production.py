@@ -13,7 +13,7 @@ from datetime import datetime
 
 from cement.core import controller
 from scilifelab.pm.core.controller import AbstractExtendedBaseController
-from scilifelab.utils.misc import query_yes_no, filtered_walk, last_lines
+from scilifelab.utils.misc import query_yes_no, filtered_walk, iter_filtered_walk, last_lines
 from scilifelab.bcbio import prune_pp_platform_args
 from scilifelab.bcbio.flowcell import Flowcell
 from scilifelab.bcbio.status import status_query
@@ -119,7 +119,7 @@ class ProductionController(AbstractExtendedBaseController, BcbioRunController):
         pattern = "-post_process.yaml$"
         def pp_yaml_filter(f):
             return re.search(pattern, f) != None
-        ppfiles = filtered_walk(dirs["data"], pp_yaml_filter)
+        ppfiles = iter_filtered_walk(dirs["data"], pp_yaml_filter)
         for pp in ppfiles:
             self.app.log.debug("Rewriting platform args for {}".format(pp))
             with open(pp, "r") as fh:
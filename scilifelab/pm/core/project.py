@@ -9,6 +9,7 @@ from scilifelab.pm.core.controller import AbstractExtendedBaseController, Abstra
 from scilifelab.utils.misc import query_yes_no, filtered_walk, walk
 from scilifelab.pm.lib.clean import purge_alignments
 from scilifelab.bcbio.run import find_samples, setup_sample, remove_files, run_bcbb_command
+from scilifelab.bcbio.index import ProductionIndex, INDEX_FILE
 from scilifelab.pm.core.bcbio import BcbioRunController
 from scilifelab.pm.core.deliver import BestPracticeReportController
 from scilifelab.pm.core.halo import HaloController
@@ -31,6 +32,9 @@ class ProjectController(AbstractExtendedBaseController, BcbioRunController, Best
         group.add_argument('--finished', help="include finished project listing", action="store_true", default=False)
         group.add_argument('--intermediate', help="Work on intermediate data", default=False, action="store_true")
         group.add_argument('--data', help="Work on data folder", default=False, action="store_true")
+        group = base_app.args.add_argument_group('Project index group.', 'Options for the index of the project tree.')
+        group.add_argument('--rebuild', help="Index the project tree, or the given project, from scratch", default=False, action="store_true")
+        group.add_argument('--refresh', help="Update the index of the project tree, or the given project, with changed directories and config files", default=False, action="store_true")
 
 
     ## Remember: need to do argument processing here also for stacked controllers
@@ -97,6 +101,21 @@ class ProjectController(AbstractExtendedBaseController, BcbioRunController, Best
             files = os.listdir(self._meta.flowcelldir)
         return files
         
+    ## index
+    @controller.expose(help="Create or update the index of the project tree that is used to find samples")
+    def index(self):
+        root = self._meta.project_root
+        path = os.path.join(root, self._meta.path_id) if self._meta.path_id else root
+        if not self.pargs.rebuild and not os.path.exists(os.path.join(root, INDEX_FILE)):
+            self.app.log.warn("No index {} in {}; use --rebuild to create one".format(INDEX_FILE, root))
+            return
+        def runpipe():
+            index = ProductionIndex(root)
+            (n_dirs, n_configs) = index.refresh(path, rebuild=self.pargs.rebuild)
+            index.close()
+            self.app.log.info("Indexed {}: listed {} directories, parsed {} config files".format(path, n_dirs, n_configs))
+        return self.app.cmd.dry("{} index of {}".format("rebuilding" if self.pargs.rebuild else "refreshing", path), runpipe)
+
     ## NOTE: this is a temporary workaround for cases where data has
     ## been removed from production directory
     @controller.expose(help="Transfer project data to customer. Temporary fix for cases where data has been removed from production directory.")
@@ -1,5 +1,8 @@
 """Couchdb extension."""
-from cement.core import hook
+from cement.core import controller, handler, hook
+from scilifelab.pm.core.controller import AbstractBaseController
+from scilifelab.db import Couch
+from scilifelab.db.replica import open_replica, labels
 
 def add_shared_couchdb_options(app):
     """
@@ -11,18 +14,62 @@ def add_shared_couchdb_options(app):
     user = None
     url = None
     password = None
+    pool_size = 10
+    timeout = 60
+    replica = None
     if app.config.has_option("db", "user"):
         user = app.config.get("db", "user") 
     if app.config.has_option("db", "password"):
         password = app.config.get("db", "password") 
     if app.config.has_option("db", "url"):
         url = app.config.get("db", "url") 
+    if app.config.has_option("db", "pool_size"):
+        pool_size = app.config.getint("db", "pool_size")
+    if app.config.has_option("db", "timeout"):
+        timeout = app.config.getint("db", "timeout")
+    if app.config.has_option("db", "replica"):
+        replica = app.config.get("db", "replica")
     group = app.args.add_argument_group('couchdb', 'Options for couchdb connections')
     group.add_argument('--url', help="Database url (excluding http://). Default '{}'".format(url), default=url, nargs="?", type=str)
     group.add_argument('--port', help="Database port. Default 5984", nargs="?", default="5984", type=str)
     group.add_argument('--username', help="Database user. Default '{}'".format(user), nargs="?", default=user, type=str)
     group.add_argument('--password', help="Database password.", default=password, type=str)
+    group.add_argument('--pool_size', help="Number of keep-alive connections to keep per database server. Default {}".format(pool_size), default=pool_size, type=int)
+    group.add_argument('--timeout', help="Socket timeout in seconds of database connections. Default {}".format(timeout), default=timeout, type=int)
+    group.add_argument('--replica', help="Directory of local replicas of flowcell and project views, synced with the database changes feed on connection. Default '{}'".format(replica), default=replica, type=str)
+
+class CouchdbController(AbstractBaseController):
+    """
+    Functionality for managing local replicas of statusdb views.
+    """
+    class Meta:
+        label = 'db'
+        description = "Manage local replicas of statusdb views"
+        arguments = [
+            (['--rebuild'], dict(help="Discard replicas and replicate from scratch", default=False, action="store_true")),
+            ]
+
+    @controller.expose(hide=True)
+    def default(self):
+        print self._help_text
+
+    @controller.expose(help="Sync local replicas in --replica with the changes feeds of the flowcell, x_flowcell and project databases")
+    def replica(self):
+        if not self._check_pargs(["replica"]):
+            return
+        con = Couch(username=self.pargs.username, password=self.pargs.password, url=self.pargs.url, port=self.pargs.port,
+                    pool_size=self.pargs.pool_size, timeout=self.pargs.timeout)
+        for label in labels():
+            dbname = self.app.config.get("db", label) if self.app.config.has_option("db", label) else label
+            replica = open_replica(con.con[dbname], self.pargs.replica, label, con.url, sync=False)
+            n = replica.rebuild() if self.pargs.rebuild else replica.sync()
+            # Copy the rows of server views, so that connections do not query them
+            for viewname in sorted(replica.server_views.keys()):
+                replica.rows(viewname)
+            replica.close()
+            self.app._output_data['stdout'].write("{}\t{}\t{} changes\n".format(dbname, replica.path, n))
 
 def load():
     """Called by the framework when the extension is 'loaded'."""
     hook.register('post_setup', add_shared_couchdb_options)
+    handler.register(CouchdbController)
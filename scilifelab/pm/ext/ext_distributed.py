@@ -2,16 +2,16 @@
 import re
 import os
 import sys
-try:
-    import drmaa
-except:
-    pass
+import pipes
+import shutil
+import tempfile
 import itertools
 import argparse
 
 from cement.core import backend, handler, hook
 
 from scilifelab.pm.core import command
+from scilifelab.utils.scheduler import get_backend, DECODE_STATUS, ACTIVE_STATES, PARAMETRIC_INDEX
 
 LOG = backend.minimal_logger(__name__)
 
@@ -19,6 +19,10 @@ class DistributedCommandHandler(command.CommandHandler):
     """ 
     This class is an implementation of the :ref:`ICommand
     <scilifelab.pm.core.command>` interface.
+
+    Jobs are submitted with the scheduler backend of the process (see
+    :ref:`scilifelab.utils.scheduler`), so that all jobs of a pm run
+    share one drmaa session.
     """    
 
     class Meta:
@@ -42,6 +46,18 @@ class DistributedCommandHandler(command.CommandHandler):
         batch_command = []
         """Batch command array"""
 
+        array_jobs = None
+        """Commands to submit as job arrays"""
+
+    def _setup(self, app_obj):
+        super(DistributedCommandHandler, self)._setup(app_obj)
+        self._meta.array_jobs = []
+
+    @property
+    def backend(self):
+        """The scheduler backend"""
+        return get_backend()
+
     def command(self, cmd_args, capture=True, ignore_error=False, cwd=None, **kw):
         ## Is there no easier way to get at --drmaa?!?
         if '--drmaa' in self.app._meta.argv:
@@ -70,45 +86,69 @@ class DistributedCommandHandler(command.CommandHandler):
 
     def monitor(self, work_dir, idfile="JOBID"):
         """Check for existing job"""
-        return self._monitor_job(idfile, **{'workingDirectory':work_dir})
+        return self.monitor_jobs([work_dir], idfile).get(work_dir)
+
+    def monitor_jobs(self, work_dirs, idfile="JOBID"):
+        """Check if jobs are currently being run or in queue, polling the
+        status of the jobids saved in all working directories at once. For
+        now, the user will manually have to terminate jobs before proceeding.
+
+        :param work_dirs: working directories
+        :param idfile: jobid file name
+
+        :returns: dictionary with value True for the working directories 
+          whose job is being run or in queue
+        """
+        jobids = {}
+        for work_dir in work_dirs:
+            JOBIDFILE = os.path.join(work_dir, idfile)
+            if not os.path.exists(JOBIDFILE):
+                continue
+            self.app.log.debug("Will read {} for jobid".format(JOBIDFILE))
+            with open(JOBIDFILE) as fh:
+                jobids[work_dir] = fh.read().strip()
+        if not jobids:
+            return {}
+        self.app.log.debug("Getting status for jobids {}".format(", ".join(sorted(set(jobids.values())))))
+        status = self.backend.job_status(set(jobids.values()))
+        running = {}
+        for work_dir, jobid in sorted(jobids.items()):
+            if status.get(jobid) is None:
+                self.app.log.warn("No such jobid {}".format(jobid))
+                continue
+            self.app.log.info("{}: {}".format(work_dir, DECODE_STATUS[status[jobid]]))
+            if status[jobid] in ACTIVE_STATES:
+                self.app.log.warn("{}; please terminate job before proceeding".format(DECODE_STATUS[status[jobid]]))
+                running[work_dir] = True
+        return running
 
     def _monitor_job(self, idfile="JOBID", **job_args):
         """Check if job is currently being run or in queue. For now,
         the user will manually have to terminate job before proceeding"""
-        JOBIDFILE = os.path.join(job_args['workingDirectory'], idfile)
-        if not os.path.exists(JOBIDFILE):
-            return 
-        self.app.log.debug("Will read {} for jobid".format(JOBIDFILE))
-        with open(JOBIDFILE) as fh:
-            jobid = fh.read()
-        ## http://code.google.com/p/drmaa-python/wiki/Tutorial
-        decodestatus = {
-            drmaa.JobState.UNDETERMINED: 'process status cannot be determined',
-            drmaa.JobState.QUEUED_ACTIVE: 'job is queued and active',
-            drmaa.JobState.SYSTEM_ON_HOLD: 'job is queued and in system hold',
-            drmaa.JobState.USER_ON_HOLD: 'job is queued and in user hold',
-            drmaa.JobState.USER_SYSTEM_ON_HOLD: 'job is queued and in user and system hold',
-            drmaa.JobState.RUNNING: 'job is running',
-            drmaa.JobState.SYSTEM_SUSPENDED: 'job is system suspended',
-            drmaa.JobState.USER_SUSPENDED: 'job is user suspended',
-            drmaa.JobState.DONE: 'job finished normally',
-            drmaa.JobState.FAILED: 'job finished, but failed',
-            }
-        s = drmaa.Session()
-        s.initialize()
-        try:
-            status = s.jobStatus(str(jobid))
-            self.app.log.debug("Getting status for jobid {}".format(jobid))
-            self.app.log.info("{}".format(decodestatus[status]))
-            if status in [drmaa.JobState.QUEUED_ACTIVE, drmaa.JobState.RUNNING, drmaa.JobState.UNDETERMINED]:
-                self.app.log.warn("{}; please terminate job before proceeding".format(decodestatus[status]))
-                return True
-        except drmaa.errors.InternalException:
-            self.app.log.warn("No such jobid {}".format(jobid))
-            pass
-        s.exit()
-        return
+        return self.monitor(job_args['workingDirectory'], idfile)
 
+    def _job_template(self, cmd_args, job_args, kw):
+        """Make the job template dictionary of a command"""
+        template = {'remoteCommand': cmd_args[0], 'args': cmd_args[1:], 'jobName': job_args['jobname']}
+        if os.path.isdir(job_args['outputPath']):
+            template['outputPath'] = ":{}".format(os.path.join(os.path.abspath(job_args['outputPath']), template['jobName'] + "-drmaa.out"))
+        else:
+            template['outputPath'] = ":{}".format(os.path.abspath(job_args['outputPath']))
+        if os.path.isdir(job_args['errorPath']):
+            template['errorPath'] = ":{}".format(os.path.join(os.path.abspath(job_args['errorPath']), template['jobName'] + "-drmaa.err"))
+        else:
+            template['errorPath'] = ":{}".format(os.path.abspath(job_args['errorPath']))
+        template['workingDirectory'] = os.path.abspath(job_args['workingDirectory'])
+        template['nativeSpecification'] = "-t {time} -p {partition} -A {account} {extra}".format(**job_args)
+        if kw.get('email', None):
+            template['email'] = [kw.get('email')]
+        return template
+
+    def _log_template(self, template):
+        self.app.log.info("Submitting job with native specification {}".format(template['nativeSpecification']))
+        self.app.log.info("Working directory: {}".format(template['workingDirectory']))
+        self.app.log.info("Output logging: {}".format(template['outputPath']))
+        self.app.log.info("Error logging: {}".format(template['errorPath']))
 
     def drmaa(self, cmd_args, capture=True, ignore_error=False, cwd=None, **kw):
         if self.app.pargs.partition == "node" and self.app.pargs.max_node_jobs < self._meta.n_submitted_jobs:
@@ -132,40 +172,89 @@ class DistributedCommandHandler(command.CommandHandler):
 
         command = " ".join(cmd_args)
         def runpipe():
-            s = drmaa.Session()
-            s.initialize()
-            jt = s.createJobTemplate()
-            jt.remoteCommand = cmd_args[0]
-            jt.args = cmd_args[1:]
-            jt.jobName = job_args['jobname']
-            if os.path.isdir(job_args['outputPath']):
-                jt.outputPath = ":{}".format(os.path.join(os.path.abspath(job_args['outputPath']), jt.jobName + "-drmaa.out"))
-            else:
-                jt.outputPath = ":{}".format(os.path.abspath(job_args['outputPath']))
-            if os.path.isdir(job_args['errorPath']):
-                jt.errorPath = ":{}".format(os.path.join(os.path.abspath(job_args['errorPath']), jt.jobName + "-drmaa.err"))
-            else:
-                jt.errorPath = ":{}".format(os.path.abspath(job_args['errorPath']))
-
-            jt.workingDirectory = os.path.abspath(job_args['workingDirectory'])
-            jt.nativeSpecification = "-t {time} -p {partition} -A {account} {extra}".format(**job_args)
-            if kw.get('email', None):
-                jt.email=[kw.get('email')]
-            self.app.log.info("Submitting job with native specification {}".format(jt.nativeSpecification))
-            self.app.log.info("Working directory: {}".format(jt.workingDirectory))
-            self.app.log.info("Output logging: {}".format(jt.outputPath))
-            self.app.log.info("Error logging: {}".format(jt.errorPath))
-            self._meta.jobid = s.runJob(jt)
+            template = self._job_template(cmd_args, job_args, kw)
+            self._log_template(template)
+            self._meta.jobid = self.backend.run_job(template)
             self.app.log.info('Your job has been submitted with id ' + self._meta.jobid)
             if kw.get('saveJobId', False):
                 self._save_job_id(**job_args)
-            s.deleteJobTemplate(jt)
-            s.exit()
         if self.app.pargs.batch:
             self._meta.batch_command.append(command)
+        elif self.app.pargs.array:
+            self._meta.array_jobs.append((cmd_args, job_args, kw))
         else:
             return self.dry(command, runpipe)
 
+    def run_arrays(self):
+        """Submit the commands collected with --array as job arrays, one
+        array per group of commands that run the same program with the 
+        same job name and native specification."""
+        groups = {}
+        for cmd_args, job_args, kw in self._meta.array_jobs:
+            template = self._job_template(cmd_args, job_args, kw)
+            key = (template['remoteCommand'], template['jobName'], template['nativeSpecification'], repr(template.get('email')))
+            groups.setdefault(key, []).append((template, job_args, kw))
+        self._meta.array_jobs = []
+        return [self._run_array(groups[group]) for group in sorted(groups.keys())]
+
+    def _run_array(self, jobs):
+        templates = [template for template, job_args, kw in jobs]
+        command = "; ".join([" ".join([t['remoteCommand']] + list(t['args'])) for t in templates])
+        def runpipe():
+            arraydir = tempfile.mkdtemp(prefix="{}-array-".format(templates[0]['jobName']),
+                                        dir=common_dir([t['workingDirectory'] for t in templates]))
+            # The task scripts are kept for the submitted tasks to run,
+            # and removed if the array is not submitted
+            jobids = None
+            try:
+                template = write_array_tasks(arraydir, templates)
+                self._log_template(template)
+                jobids = self.backend.run_array(template, len(templates))
+            finally:
+                if jobids is None:
+                    shutil.rmtree(arraydir, ignore_errors=True)
+            self.app.log.info('Your job array of {} tasks has been submitted with ids {}'.format(len(jobids), ", ".join(jobids)))
+            for jobid, (t, job_args, kw) in zip(jobids, jobs):
+                if kw.get('saveJobId', False):
+                    self._meta.jobid = jobid
+                    self._save_job_id(**job_args)
+            return jobids
+        return self.dry("job array of {} tasks: {}".format(len(templates), command), runpipe)
+
+def common_dir(dirs):
+    """Get the deepest directory containing all dirs.
+
+    :param dirs: absolute directory names
+
+    :returns: directory name
+    """
+    return os.path.dirname(os.path.commonprefix([os.path.join(d, "") for d in dirs]))
+
+def write_array_tasks(arraydir, templates):
+    """Write the task scripts of a job array, one per job template, and
+    make the job template of the array. The script of task i, in
+    arraydir/i, changes to the working directory of template i and runs
+    its command with its output and error paths.
+
+    :param arraydir: directory of the task scripts
+    :param templates: job template dictionaries of the tasks
+
+    :returns: job template dictionary of the array
+    """
+    for i, t in enumerate(templates):
+        taskdir = os.path.join(arraydir, str(i + 1))
+        os.makedirs(taskdir)
+        with open(os.path.join(taskdir, "task.sh"), "w") as fh:
+            fh.write("#!/bin/sh\ncd {} || exit 1\nexec {} >> {} 2>> {}\n".format(
+                    pipes.quote(t['workingDirectory']), " ".join([pipes.quote(x) for x in [t['remoteCommand']] + list(t['args'])]),
+                    pipes.quote(t['outputPath'].lstrip(":")), pipes.quote(t['errorPath'].lstrip(":"))))
+    template = dict(templates[0])
+    template.update({'remoteCommand': "/bin/sh", 'args': ["task.sh"],
+                     'workingDirectory': os.path.join(arraydir, PARAMETRIC_INDEX),
+                     'outputPath': ":{}".format(os.path.join(arraydir, PARAMETRIC_INDEX, "drmaa.out")),
+                     'errorPath': ":{}".format(os.path.join(arraydir, PARAMETRIC_INDEX, "drmaa.err"))})
+    return template
+
 def opt_to_dict(opts):
     """Transform option list to a dictionary.
 
@@ -274,6 +363,7 @@ def add_shared_distributed_options(app):
                           action='store', help='maximum number of node jobs (default 10)')
     group.add_argument('--email', help="set user email address", action="store", default=None, type=str)
     group.add_argument('--batch', help="submit jobs as a batch, useful for submitting a number of jobs to the same node", action="store_true", default=False)
+    group.add_argument('--array', help="submit jobs as job arrays, one array per program and job template, useful for submitting per-sample jobs", action="store_true", default=False)
 
 def set_distributed_handler(app):
     """
@@ -303,13 +393,25 @@ def run_batch_command(app):
     app.pargs.batch = False
     app.cmd.command([command], **{'platform_args':{}, 'saveJobId':True, 'workingDirectory':os.curdir})
 
+def run_array_command(app):
+    """
+    If option 'array' was set, submit commands stored in array_jobs as
+    job arrays.
+
+    :param app: The application object.
+    """
+    if not app.pargs.array or not isinstance(app.cmd, DistributedCommandHandler):
+        return
+    app.cmd.run_arrays()
+
 def load():
     """Called by the framework when the extension is 'loaded'."""
-    if not os.getenv("DRMAA_LIBRARY_PATH"):
+    if not os.getenv("DRMAA_LIBRARY_PATH") and os.getenv("PM_DISTRIBUTED_BACKEND", "drmaa") == "drmaa":
         LOG.debug("No environment variable $DRMAA_LIBRARY_PATH: loading {} failed".format(__name__))
         return
     hook.register('post_setup', add_drmaa_option)
     hook.register('post_setup', add_shared_distributed_options)
     hook.register('pre_run', set_distributed_handler)
     hook.register('post_run', run_batch_command)
+    hook.register('post_run', run_array_command)
     handler.register(DistributedCommandHandler)
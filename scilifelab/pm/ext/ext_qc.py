@@ -6,6 +6,8 @@ import ast
 import itertools
 import re
 import glob
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from collections import defaultdict
 
 from cement.core import backend, controller, handler, hook
@@ -20,6 +22,127 @@ import scilifelab.log
 
 LOG = scilifelab.log.minimal_logger(__name__)
 
+def collect_sample_run_metrics(path, sample_kw, catalog=None, runinfo_yaml_file=None, demultiplex_stats=None, setup=None):
+    """Collect run metrics for a sample run.
+
+    :param path: directory holding the sample run files
+    :param sample_kw: sample keyword arguments to the parsers
+    :param catalog: file catalog of path
+    :param runinfo_yaml_file: bcbb config file to read barcode_id and sequence from
+    :param demultiplex_stats: parsed Demultiplex_Stats.htm
+    :param setup: run setup reads
+
+    :returns: SampleRunMetricsDocument
+    """
+    sample_kw = dict(sample_kw)
+    if runinfo_yaml_file:
+        if not os.path.exists(runinfo_yaml_file):
+            raise IOError(2, "No such yaml file for sample: {}".format(runinfo_yaml_file), runinfo_yaml_file)
+        with open(runinfo_yaml_file) as fh:
+            runinfo_yaml = yaml.load(fh)
+        if not runinfo_yaml['details'][0].get("multiplex", None):
+            LOG.warn("No multiplex information for sample {}".format(sample_kw['barcode_name']))
+            runinfo_yaml['details'][0]['multiplex'] = [{'barcode_id': 0, 'sequence': 'NoIndex'}]
+        sample_kw.update(barcode_id=runinfo_yaml['details'][0]['multiplex'][0]['barcode_id'], sequence=runinfo_yaml['details'][0]['multiplex'][0]['sequence'])
+    parser = SampleRunMetricsParser(path, catalog=catalog)
+    obj = SampleRunMetricsDocument(**sample_kw)
+    obj["picard_metrics"] = parser.read_picard_metrics(**sample_kw)
+    obj["fastq_scr"] = parser.parse_fastq_screen(**sample_kw)
+    obj["bc_count"] = parser.get_bc_count(demultiplex_stats=demultiplex_stats, run_setup=setup, **sample_kw)
+    obj["fastqc"] = parser.read_fastqc_metrics(**sample_kw)
+    obj["bcbb_checkpoints"] = parser.parse_bcbb_checkpoints(**sample_kw)
+    obj["software_versions"] = parser.parse_software_versions(**sample_kw)
+    return obj
+
+def collect_analysis_metrics(sdir, project_name):
+    """Collect analysis metrics for a sample flowcell directory.
+
+    :param sdir: sample flowcell directory
+    :param project_name: project name
+
+    :returns: tuple of sample name and dictionary of metrics
+    """
+    config = glob.glob(os.path.join(sdir,"*-bcbb-config.yaml"))
+    if not config:
+        raise IOError(2, "Could not find sample configuration file in {}".format(sdir), sdir)
+    if len(config) > 1:
+        LOG.warn("Multiple sample configuration files found in {}. Will only use {}.".format(sdir,os.path.basename(config[0])))
+
+    # Parse the config file and get the flowcell, lane and index sequence that may be needed to parse
+    info = {}
+    sinfos = []
+    with open(config[0]) as fh:
+        info = yaml.load(fh)
+    fcdate = info.get("fc_date")
+    fcname = info.get("fc_name")
+    for laneinfo in info.get("details",[]):
+        for sampleinfo in laneinfo.get("multiplex",[laneinfo]):
+            linfo = laneinfo
+            linfo.update(sampleinfo)
+            name = linfo.get("name",linfo.get("description","unknown"))
+            m = re.match(r'(P[0-9_]{4,}[0-9])',name)
+            if m:
+                name = m.group(1)
+            sample_kw = {'flowcell': linfo.get("flowcell_id") if not fcname else fcname,
+                         'date': fcdate,
+                         'lane': linfo.get("lane"),
+                         'barcode_name': name,
+                         'sample_prj': linfo.get("sample_prj",project_name),
+                         'barcode_id': linfo.get("barcode_id","1"),
+                         'sequence': linfo.get("sequence","NoIndex")}
+            sinfos.append(sample_kw)
+
+    # Create a parser object and collect the metrics
+    parser = SampleRunMetricsParser(sdir)
+    sinfo = sinfos[0]
+    name = sinfo.get("barcode_name","unknown")
+    metrics = {}
+    metrics["bcbb_checkpoints"] = parser.parse_bcbb_checkpoints(**sinfo)
+    metrics["software_versions"] = parser.parse_software_versions(**sinfo)
+    metrics["project_summary"] = parser.parse_project_summary(**sinfo)
+    metrics["snpeff_genes"] = parser.parse_snpeff_genes(**sinfo)
+    for sinfo in sinfos:
+        picard = parser.read_picard_metrics(**sinfo)
+        if picard:
+            metrics["picard_metrics"] = picard
+        fq_scr = parser.parse_fastq_screen(**sinfo)
+        if fq_scr:
+            metrics["fastq_scr"] = fq_scr
+        fastqc = parser.read_fastqc_metrics(**sinfo)
+        if fastqc.get("stats"):
+            metrics["fastqc"] = fastqc
+        gteval = parser.parse_eval_metrics(**sinfo)
+        if gteval:
+            metrics["gatk_variant_eval"] = gteval
+    return (name, metrics)
+
+def _run_task(args):
+    (fn, name, task_args, task_kw) = args
+    try:
+        return (name, fn(*task_args, **task_kw), None)
+    except Exception as e:
+        return (name, None, e)
+
+def run_in_pool(fn, tasks, workers=1, processes=False):
+    """Run fn for a list of per-sample tasks over a pool of workers.
+
+    :param fn: function to call; must be defined at module level if processes is True
+    :param tasks: list of (name, arg1, ..., argN, kwargs) tuples
+    :param workers: number of workers
+    :param processes: use a process pool instead of a thread pool
+
+    :returns: list of (name, result, exception) tuples in task order; exception is None on success
+    """
+    args = [(fn, t[0], t[1:-1], t[-1]) for t in tasks]
+    if workers is None or workers <= 1 or len(args) <= 1:
+        return map(_run_task, args)
+    pool = multiprocessing.Pool(workers) if processes else ThreadPool(workers)
+    try:
+        return pool.map(_run_task, args)
+    finally:
+        pool.close()
+        pool.join()
+
 class RunMetricsController(AbstractBaseController):
     """
     This class is an implementation of the :ref:`ICommand
@@ -41,6 +164,8 @@ class RunMetricsController(AbstractBaseController):
             (['--names'], dict(help="Sample name mapping from barcode name to project name as a JSON string, as in \"{'sample_run_name':'project_run_name'}\". Mapping can also be given in a file", default=None, action="store", type=str)),
             (['--extensive_matching'], dict(help="Perform extensive barcode to project sample name matcing", default=False, action="store_true")),
             (['--project_alias'], dict(help="True project name as defined in project summary, as in 'J.Doe_00_01'.", default=None, action="store", type=str)),
+            (['--workers'], dict(help="Number of workers for collecting per-sample metrics in upload-qc and upload-analysis. Defaults to 1.", default=1, action="store", type=int)),
+            (['--processes'], dict(help="Use a process pool instead of a thread pool for --workers", default=False, action="store_true")),
             ]
 
 
@@ -109,8 +234,13 @@ class RunMetricsController(AbstractBaseController):
     ##############################
     ## New structures
     ##############################
-    def _parse_samplesheet(self, runinfo, qc_objects, fc_date, fc_name, fcdir, as_yaml=False, demultiplex_stats=None, setup=None):
-        """Parse samplesheet information and populate sample run metrics object"""
+    def _parse_samplesheet(self, runinfo, qc_objects, fc_date, fc_name, fcdir, as_yaml=False, demultiplex_stats=None, setup=None, catalog=None):
+        """Parse samplesheet information and populate sample run metrics object.
+        Metrics are collected per sample over --workers workers.
+
+        :param catalog: file catalog of fcdir, shared by the sample parsers of a flowcell
+        """
+        tasks = []
         if as_yaml:
             for info in runinfo:
                 if not info.get("multiplex"):
@@ -123,16 +253,9 @@ class RunMetricsController(AbstractBaseController):
                     sample.update({k: info.get(k, None) for k in ('analysis', 'description', 'flowcell_id', 'lane')})
                     sample_kw = dict(flowcell=fc_name, date=fc_date, lane=sample['lane'], barcode_name=sample['name'], sample_prj=sample.get('sample_prj', None),
                                      barcode_id=sample['barcode_id'], sequence=sample.get('sequence', "NoIndex"))
-                
-                    parser = SampleRunMetricsParser(fcdir)
-                    obj = SampleRunMetricsDocument(**sample_kw)
-                    obj["picard_metrics"] = parser.read_picard_metrics(**sample_kw)
-                    obj["fastq_scr"] = parser.parse_fastq_screen(**sample_kw)
-                    obj["bc_count"] = parser.get_bc_count(run_setup=setup, **sample_kw)
-                    obj["fastqc"] = parser.read_fastqc_metrics(**sample_kw)
-                    obj["bcbb_checkpoints"] = parser.parse_bcbb_checkpoints(**sample_kw)
-                    obj["software_versions"] = parser.parse_software_versions(**sample_kw)
-                    qc_objects.append(obj)
+                    if catalog is None:
+                        catalog = SampleRunMetricsParser(fcdir).catalog
+                    tasks.append((sample['name'], fcdir, sample_kw, dict(catalog=catalog, setup=setup)))
         else:
             for d in runinfo:
                 LOG.debug("Getting information for sample defined by {}".format(d.values()))
@@ -152,24 +275,13 @@ class RunMetricsController(AbstractBaseController):
                 if not modified_within_days(sample_fcdir, self.pargs.mtime):
                     continue
                 runinfo_yaml_file = os.path.join(sample_fcdir, "{}-bcbb-config.yaml".format(d['SampleID']))
-                if not os.path.exists(runinfo_yaml_file):
-                    self.app.log.warn("No such yaml file for sample: {}".format(runinfo_yaml_file))
-                    raise IOError(2, "No such yaml file for sample: {}".format(runinfo_yaml_file), runinfo_yaml_file)
-                with open(runinfo_yaml_file) as fh:
-                    runinfo_yaml = yaml.load(fh)
-                if not runinfo_yaml['details'][0].get("multiplex", None):
-                    self.app.log.warn("No multiplex information for sample {}".format(d['SampleID']))
-                    runinfo_yaml['details'][0]['multiplex'] = [{'barcode_id': 0, 'sequence': 'NoIndex'}]
-                sample_kw = dict(flowcell=fc_name, date=fc_date, lane=d['Lane'], barcode_name=d['SampleID'], sample_prj=d['SampleProject'].replace("__", "."), barcode_id=runinfo_yaml['details'][0]['multiplex'][0]['barcode_id'], sequence=runinfo_yaml['details'][0]['multiplex'][0]['sequence'])
-                parser = SampleRunMetricsParser(sample_fcdir)
-                obj = SampleRunMetricsDocument(**sample_kw)
-                obj["picard_metrics"] = parser.read_picard_metrics(**sample_kw)
-                obj["fastq_scr"] = parser.parse_fastq_screen(**sample_kw)
-                obj["bc_count"] = parser.get_bc_count(demultiplex_stats=demultiplex_stats, run_setup=setup, **sample_kw)
-                obj["fastqc"] = parser.read_fastqc_metrics(**sample_kw)
-                obj["bcbb_checkpoints"] = parser.parse_bcbb_checkpoints(**sample_kw)
-                obj["software_versions"] = parser.parse_software_versions(**sample_kw)
-                qc_objects.append(obj)
+                sample_kw = dict(flowcell=fc_name, date=fc_date, lane=d['Lane'], barcode_name=d['SampleID'], sample_prj=d['SampleProject'].replace("__", "."))
+                tasks.append((d['SampleID'], sample_fcdir, sample_kw, dict(runinfo_yaml_file=runinfo_yaml_file, demultiplex_stats=demultiplex_stats, setup=setup)))
+        for (name, obj, error) in run_in_pool(collect_sample_run_metrics, tasks, self.pargs.workers, self.pargs.processes):
+            if error:
+                self.app.log.error("Failed to collect metrics for sample {}: {}".format(name, error))
+                continue
+            qc_objects.append(obj)
         return qc_objects
 
     def _collect_pre_casava_qc(self):
@@ -219,7 +331,7 @@ class RunMetricsController(AbstractBaseController):
         read_setup = fcobj["RunInfo"].get('Reads',[])
         fcobj["run_setup"] = self._run_setup(read_setup)
         qc_objects.append(fcobj)
-        qc_objects = self._parse_samplesheet(runinfo, qc_objects, fc_date, "{}{}".format(fc_pos,fc_name), fcdir, as_yaml=as_yaml, setup=read_setup)
+        qc_objects = self._parse_samplesheet(runinfo, qc_objects, fc_date, "{}{}".format(fc_pos,fc_name), fcdir, as_yaml=as_yaml, setup=read_setup, catalog=parser.catalog)
         return qc_objects
 
     def _collect_casava_qc(self):
@@ -300,69 +412,23 @@ class RunMetricsController(AbstractBaseController):
                 to_process[os.path.basename(pdir)] = plist
         
         # Collect the data from each folder
+        analysis_objects = []
         for project_name, sdirs in to_process.items():
             self.log.info("Processing {}".format(project_name))
             samples = {}
-            for sdir in sdirs:
-                config = glob.glob(os.path.join(sdir,"*-bcbb-config.yaml"))
-                if not config:
-                    self.log.error("Could not find sample configuration file in {}. Skipping sample.".format(sdir))
+            tasks = [(sdir, sdir, project_name, {}) for sdir in sdirs]
+            for (sdir, result, error) in run_in_pool(collect_analysis_metrics, tasks, self.pargs.workers, self.pargs.processes):
+                if error:
+                    self.log.error("Failed to collect analysis metrics in {}: {}. Skipping sample.".format(sdir, error))
                     continue
-                if len(config) > 1:
-                    self.log.warn("Multiple sample configuration files found in {}. Will only use {}.".format(sdir,os.path.basename(config[0])))
-                
-                # Parse the config file and get the flowcell, lane and index sequence that may be needed to parse
-                info = {}
-                sinfos = []
-                with open(config[0]) as fh:
-                    info = yaml.load(fh)
-                fcdate = info.get("fc_date")
-                fcname = info.get("fc_name")
-                for laneinfo in info.get("details",[]):
-                    for sampleinfo in laneinfo.get("multiplex",[laneinfo]):
-                        linfo = laneinfo
-                        linfo.update(sampleinfo)
-                        name = linfo.get("name",linfo.get("description","unknown"))
-                        m = re.match(r'(P[0-9_]{4,}[0-9])',name)
-                        if m:
-                            name = m.group(1)
-                        sample_kw = {'flowcell': linfo.get("flowcell_id") if not fcname else fcname,
-                                     'date': fcdate,
-                                     'lane': linfo.get("lane"),
-                                     'barcode_name': name,
-                                     'sample_prj': linfo.get("sample_prj",project_name),
-                                     'barcode_id': linfo.get("barcode_id","1"),
-                                     'sequence': linfo.get("sequence","NoIndex")}
-                        sinfos.append(sample_kw)
-                
-                # Create a parser object and collect the metrics
-                parser = SampleRunMetricsParser(sdir)
-                sinfo = sinfos[0]
-                name = sinfo.get("barcode_name","unknown")
-                samples[name] = {}
-                samples[name]["bcbb_checkpoints"] = parser.parse_bcbb_checkpoints(**sinfo)
-                samples[name]["software_versions"] = parser.parse_software_versions(**sinfo)
-                samples[name]["project_summary"] = parser.parse_project_summary(**sinfo)
-                samples[name]["snpeff_genes"] = parser.parse_snpeff_genes(**sinfo)
-                for sinfo in sinfos:
-                    picard = parser.read_picard_metrics(**sinfo)
-                    if picard:
-                        samples[name]["picard_metrics"] = picard
-                    fq_scr = parser.parse_fastq_screen(**sinfo)
-                    if fq_scr:
-                        samples[name]["fastq_scr"] = fq_scr
-                    fastqc = parser.read_fastqc_metrics(**sinfo)
-                    if fastqc.get("stats"):
-                        samples[name]["fastqc"] = fastqc
-                    gteval = parser.parse_eval_metrics(**sinfo)
-                    if gteval:
-                        samples[name]["gatk_variant_eval"] = gteval
-                        
+                (name, metrics) = result
+                samples[name] = metrics
+
             # Store the collected metrics in an analysis document
-            obj = AnalysisDocument(**{'project_name': project_name,
-                                      'name': project_name,
-                                      'samples': samples})
-            dry("Saving object {}".format(repr(obj)), acon.save(obj))
+            analysis_objects.append(AnalysisDocument(**{'project_name': project_name,
+                                                        'name': project_name,
+                                                        'samples': samples}))
+        dry("Saving objects {}".format(", ".join(repr(x) for x in analysis_objects)), acon.save_many(analysis_objects))
 
     @controller.expose(help="Upload run metrics to statusdb")
     def upload_qc(self):
@@ -395,16 +461,20 @@ class RunMetricsController(AbstractBaseController):
         s_con = SampleRunMetricsConnection(dbname=self.app.config.get("db", "samples"), **vars(self.app.pargs))
         fc_con = FlowcellRunMetricsConnection(dbname=self.app.config.get("db", "flowcells"), **vars(self.app.pargs))
         p_con = ProjectSummaryConnection(dbname=self.app.config.get("db", "projects"), **vars(self.app.pargs))
+        fc_objects = []
+        sample_objects = []
         for obj in qc_objects:
             if self.app.pargs.debug:
                 self.log.debug("{}: {}".format(str(obj), obj["_id"]))
             if isinstance(obj, FlowcellRunMetricsDocument):
-                dry("Saving object {}".format(repr(obj)), fc_con.save(obj))
+                fc_objects.append(obj)
             if isinstance(obj, SampleRunMetricsDocument):
                 project_sample = p_con.get_project_sample(obj.get("sample_prj", None), obj.get("barcode_name", None), self.pargs.extensive_matching)
                 if project_sample:
                     obj["project_sample_name"] = project_sample['sample_name']
-                dry("Saving object {}".format(repr(obj)), s_con.save(obj))
+                sample_objects.append(obj)
+        dry("Saving objects {}".format(", ".join(repr(x) for x in fc_objects)), fc_con.save_many(fc_objects))
+        dry("Saving objects {}".format(", ".join(repr(x) for x in sample_objects)), s_con.save_many(sample_objects))
 
     @controller.expose(help="Perform a multiplex QC")
     def multiplex_qc(self):
@@ -441,18 +511,21 @@ class RunMetricsController(AbstractBaseController):
         # Adjust the read pairs variable according to the run setup
         read_pairs = fc_con.is_paired_end(fcid) 
         
+        # Index the Demultiplex_Stats once for the checks below
+        stats = fc_con.get_barcode_lane_index(fcid, fc_doc)
+        
         # Get the yield per sample from the Demultiplex_Stats
         self.log.debug("Getting yield for flowcell {}".format(fcid))
-        sample_yield = self._get_yield_per_sample(fc_doc, read_pairs)
+        sample_yield = self._get_yield_per_sample(stats, read_pairs)
         
         # Get the yield per lane from the Demultiplex_Stats
         self.log.debug("Getting lane yield for flowcell {}".format(fcid))
-        lane_yield = self._get_yield_per_lane(fc_doc, read_pairs)
+        lane_yield = self._get_yield_per_lane(stats, read_pairs)
         lanes = lane_yield.keys()
         
         # Get the number of samples in the pools from the Demultiplex_Stats
         self.log.debug("Getting lane pool sizes for flowcell {}".format(fcid))
-        pool_size = self._get_pool_size(fc_doc)
+        pool_size = self._get_pool_size(stats)
         
         # Get the sample information from the csv samplesheet
         self.log.debug("Getting csv samplesheet data for flowcell {}".format(fcid))
@@ -506,7 +579,7 @@ class RunMetricsController(AbstractBaseController):
                                                             MAX_PHIX_ERROR_RATE)])
         
         # Check the %>=Q30 value for each sample
-        sample_quality = self._get_quality_per_sample(fc_doc)
+        sample_quality = self._get_quality_per_sample(stats)
         for id in sample_quality.keys():
             for key in sample_quality[id].keys():
                 lane, index = key.split("_")
@@ -581,16 +654,16 @@ class RunMetricsController(AbstractBaseController):
                                                        data["index_name"][i]])
         return undetermined_indexes
         
-    def _get_quality_per_sample(self, fc_doc):
+    def _get_quality_per_sample(self, stats):
         """
         Extract the quality per sample, keyed on SampleId and "Lane_Index"
+        from a <BarcodeLaneStatistics> index.
         Returns a dictionary of dictionaries    
         """     
         
         # Get the quality for each sample, lane, index
         sample_quality = {}
-        samples = fc_doc.get("illumina",{}).get("Demultiplex_Stats",{}).get("Barcode_lane_statistics",[])
-        for sample in samples:
+        for sample in stats or []:
             id = sample['Sample ID']
             lane = sample['Lane']
             index = sample['Index']
@@ -602,16 +675,16 @@ class RunMetricsController(AbstractBaseController):
             
         return sample_quality
     
-    def _get_yield_per_sample(self, fc_doc, read_pairs=True):
+    def _get_yield_per_sample(self, stats, read_pairs=True):
         """
         Extract the yield per sample, keyed on SampleId and "Lane_Index"
+        from a <BarcodeLaneStatistics> index.
         Returns a dictionary of dictionaries    
         """     
         
         # Get the yield for each sample, lane, index
         sample_yield = {}
-        counts = fc_doc.get("illumina",{}).get("Demultiplex_Stats",{}).get("Barcode_lane_statistics",[])
-        for sample in counts:
+        for sample in stats or []:
             id = sample['Sample ID']
             lane = sample['Lane']
             index = sample['Index']
@@ -624,16 +697,15 @@ class RunMetricsController(AbstractBaseController):
             
         return sample_yield
     
-    def _get_yield_per_lane(self, fc_doc, read_pairs=True):
+    def _get_yield_per_lane(self, stats, read_pairs=True):
         """
-        Extract the yield per lane.
+        Extract the yield per lane from a <BarcodeLaneStatistics> index.
         Returns a dictionary with key-value pairs of lane and yield    
         """     
         
         # Get the yield for each lane
         lane_yield = defaultdict(int)
-        counts = fc_doc.get("illumina",{}).get("Demultiplex_Stats",{}).get("Barcode_lane_statistics",[])
-        for sample in counts:
+        for sample in stats or []:
             lane = sample['Lane']
             reads = int(sample['# Reads'].replace(',',''))
             if read_pairs:
@@ -642,21 +714,15 @@ class RunMetricsController(AbstractBaseController):
             
         return lane_yield
     
-    def _get_pool_size(self, fc_doc):
+    def _get_pool_size(self, stats):
         """
-        Extract the pool size for each lane.
+        Extract the pool size for each lane from a <BarcodeLaneStatistics> index.
         Returns a dictionary with key-value pairs of lane and size    
         """     
         
-        pool_size = defaultdict(int)
-        counts = fc_doc.get("illumina",{}).get("Demultiplex_Stats",{}).get("Barcode_lane_statistics",[])
-        for sample in counts:
-            lane = sample['Lane']
-            index = sample['Index']
-            if index != "Undetermined":
-                pool_size[lane] += 1
-                
-        return pool_size
+        if stats is None:
+            return defaultdict(int)
+        return stats.pool_size()
        
     def _get_samplesheet_sample_data(self, fc_doc):
         """
@@ -20,3 +20,5 @@ config_defaults['db']['username'] = None
 config_defaults['db']['samples'] = "samples"
 config_defaults['db']['projects'] = "projects" 
 config_defaults['db']['flowcells'] = "flowcells"
+config_defaults['db']['x_flowcells'] = "x_flowcells"
+config_defaults['db']['replica'] = None
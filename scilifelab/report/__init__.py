@@ -1,6 +1,7 @@
 """Reporting utilities module"""
 import os
 import sys
+import multiprocessing
 from mako.template import Template
 from collections import OrderedDict
 
@@ -16,6 +17,27 @@ import scilifelab.log
 LOG = scilifelab.log.minimal_logger(__name__)
 
 FILEPATH=os.path.dirname(os.path.realpath(__file__))
+
+def _apply(task):
+    (fn, args, kw) = task
+    return fn(*args, **kw)
+
+def run_jobs(tasks, jobs=1):
+    """Run rendering tasks in a pool of processes.
+
+    :param tasks: list of (function, args, kwargs) tuples; functions must be defined at module level
+    :param jobs: number of processes; tasks are run in this process if jobs <= 1
+
+    :returns: list of task results, in task order
+    """
+    if jobs is None or jobs <= 1 or len(tasks) <= 1:
+        return map(_apply, tasks)
+    pool = multiprocessing.Pool(min(jobs, len(tasks)))
+    try:
+        return pool.map(_apply, tasks)
+    finally:
+        pool.close()
+        pool.join()
              
 def sequencing_success(parameters, cutoffs):
     """Set sequencing success for a sample. It is assumed that ordered
@@ -11,11 +11,13 @@ import texttable
 import unicodedata
 from cStringIO import StringIO
 from collections import Counter
+from scilifelab.db import CACHE_SIZE
 from scilifelab.db.statusdb import SampleRunMetricsConnection, ProjectSummaryConnection, FlowcellRunMetricsConnection, calc_avg_qv
 from scilifelab.utils.misc import query_ok
 from scilifelab.report import sequencing_success
 from scilifelab.report.rst import make_sample_rest_notes, make_rest_note
-from scilifelab.report.rl import make_note, concatenate_notes, sample_note_paragraphs, sample_note_headers, project_note_paragraphs, project_note_headers, make_sample_table
+from scilifelab.report import run_jobs
+from scilifelab.report.rl import make_sample_notes, make_project_note, concatenate_notes
 import scilifelab.log
 
 LOG = scilifelab.log.minimal_logger(__name__)
@@ -245,6 +247,8 @@ def sample_status_note(project_name=None, flowcell=None, username=None, password
     :param project_alias: project alias name
     :param phix: phix error rate
     :param is_paired: True if run is paired-end, False for single-end
+    :param cache_size: number of documents to cache per database connection; 0 disables caching
+    :param jobs: number of processes for rendering notes
     """
     # Cutoffs
     cutoffs = {
@@ -282,14 +286,11 @@ def sample_status_note(project_name=None, flowcell=None, username=None, password
         return output_data
     output_data = _update_sample_output_data(output_data, cutoffs)
 
-    # Connect and run
-    s_con = SampleRunMetricsConnection(dbname=samplesdb, username=username, password=password, url=url)
-    fc_con = FlowcellRunMetricsConnection(dbname=flowcelldb, username=username, password=password, url=url)
-    p_con = ProjectSummaryConnection(dbname=projectdb, username=username, password=password, url=url)
-
-    # Set up paragraphs
-    paragraphs = sample_note_paragraphs()
-    headers = sample_note_headers()
+    # Connect and run; documents are cached for the lifetime of the connections
+    cache_size = kw.get("cache_size", CACHE_SIZE)
+    s_con = SampleRunMetricsConnection(dbname=samplesdb, username=username, password=password, url=url, cache_size=cache_size)
+    fc_con = FlowcellRunMetricsConnection(dbname=flowcelldb, username=username, password=password, url=url, cache_size=cache_size)
+    p_con = ProjectSummaryConnection(dbname=projectdb, username=username, password=password, url=url, cache_size=cache_size)
 
     # Get project
     project = p_con.get_entry(project_name)
@@ -432,8 +433,9 @@ def sample_status_note(project_name=None, flowcell=None, username=None, password
 
     # Write final output to reportlab and rst files
     output_data["debug"].write(json.dumps({'s_param': s_param_out, 'sample_runs':{s["name"]:s["barcode_name"] for s in sample_run_list}}))
-    notes = [make_note(headers=headers, paragraphs=paragraphs, **sp) for sp in s_param_out]
-    rest_notes = make_sample_rest_notes("{}_{}_{}_sample_summary.rst".format(project_name, s.get("date", None), s.get("flowcell", None)), s_param_out)
+    jobs = kw.get("jobs", 1)
+    notes = make_sample_notes(s_param_out, jobs=jobs)
+    rest_notes = make_sample_rest_notes("{}_{}_{}_sample_summary.rst".format(project_name, s.get("date", None), s.get("flowcell", None)), s_param_out, jobs=jobs)
     concatenate_notes(notes, "{}_{}_{}_sample_summary.pdf".format(project_name, s.get("date", None), s.get("flowcell", None)))
     return output_data
 
@@ -562,6 +564,8 @@ def project_status_note(project_name=None, username=None, password=None, url=Non
     :param flowcelldb: flowcells db name
     :param include_all_samples: include all samples in report
     :param flat_table: Just create a simple tab-separated version of the table instead of the fancy pdf
+    :param cache_size: number of documents to cache per database connection; 0 disables caching
+    :param jobs: number of processes for rendering notes
     """
 
     # parameters
@@ -579,17 +583,10 @@ def project_status_note(project_name=None, username=None, password=None, url=Non
                                                                   parameters, **kw)
 
     if not flat_table:
-        # Set report paragraphs
-        paragraphs = project_note_paragraphs()
-        headers = project_note_headers()
-
-        #Hack: removes Comments paragraph if it is empty
-        if not param["finished"]:
-            paragraphs.pop("Comments",None)
-
-        paragraphs["Samples"]["tpl"] = make_sample_table(sample_table)
-        make_note("{}_project_summary.pdf".format(project_name), headers, paragraphs, **param)
-        make_rest_note("{}_project_summary.rst".format(project_name), sample_table=sample_table, report="project_report", **param)
+        # Make pdf and reST notes, concurrently if jobs > 1
+        rest_kw = dict(param, sample_table=sample_table, report="project_report")
+        run_jobs([(make_project_note, ("{}_project_summary.pdf".format(project_name), sample_table), param),
+                  (make_rest_note, ("{}_project_summary.rst".format(project_name),), rest_kw)], kw.get("jobs", 1))
 
     else:
         # Write tab-separated output
@@ -624,10 +621,11 @@ def _project_status_note_table(project_name=None, username=None, password=None,
     table_keys = ['ScilifeID', 'SubmittedID', 'BarcodeSeq', 'MSequenced', 'MOrdered']
 
     output_data = {'stdout':StringIO(), 'stderr':StringIO(), 'debug':StringIO()}
-    # Connect and run
-    s_con = SampleRunMetricsConnection(dbname=samplesdb, username=username, password=password, url=url)
-    fc_con = FlowcellRunMetricsConnection(dbname=flowcelldb, username=username, password=password, url=url)
-    p_con = ProjectSummaryConnection(dbname=projectdb, username=username, password=password, url=url)
+    # Connect and run; documents are cached for the lifetime of the connections
+    cache_size = kw.get("cache_size", CACHE_SIZE)
+    s_con = SampleRunMetricsConnection(dbname=samplesdb, username=username, password=password, url=url, cache_size=cache_size)
+    fc_con = FlowcellRunMetricsConnection(dbname=flowcelldb, username=username, password=password, url=url, cache_size=cache_size)
+    p_con = ProjectSummaryConnection(dbname=projectdb, username=username, password=password, url=url, cache_size=cache_size)
 
     #Get the information source for this project
     source = p_con.get_info_source(project_name)
@@ -108,7 +108,8 @@ def compile_qc(path, application="seqcap", **kw):
 
     """
     output_data = {'stdout':StringIO(), 'stderr':StringIO()}
-    ### find_samples excrutiatingly slow for multi-sample projects where we can have > 100k files...
+    ### find_samples is slow for multi-sample projects where we can have > 100k files,
+    ### unless the project tree is indexed with pm project index --rebuild
     flist = find_samples(path, **kw)
     srm_l = []
     for f in flist:
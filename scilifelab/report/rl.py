@@ -6,6 +6,7 @@ from collections import OrderedDict
 from mako.template import Template
 
 from scilifelab.log import minimal_logger
+from scilifelab.report import run_jobs
 
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.lib.units import cm
@@ -29,34 +30,44 @@ h2 = styles['Heading2']
 h3 = styles['Heading3']
 h4 = styles['Heading4']
 
+# Compiled paragraph templates, keyed by template text
+_TEMPLATES = {}
+
+def _template(text):
+    """Get the compiled mako template for <text>. Templates are
+    compiled once per process."""
+    if text not in _TEMPLATES:
+        _TEMPLATES[text] = Template(text)
+    return _TEMPLATES[text]
+
 def sample_note_paragraphs():
     """Get paragraphs for sample notes."""
     paragraphs = OrderedDict()
     paragraphs["Project name"] = dict(style=h3,
-                                      tpl=Template("${project_name} ${'({})'.format(customer_reference) if customer_reference not in ['', 'N/A'] else ''}"))
+                                      tpl=_template("${project_name} ${'({})'.format(customer_reference) if customer_reference not in ['', 'N/A'] else ''}"))
 
     paragraphs["UPPNEX project id"] = dict(style=h3,
-                                           tpl=Template("${uppnex_project_id}"))
+                                           tpl=_template("${uppnex_project_id}"))
 
     paragraphs["Flow cell id"] = dict(style=h3,
-                                      tpl=Template("${FC_id}"))
+                                      tpl=_template("${FC_id}"))
 
     paragraphs["Lane"] = dict(style=h3,
-                              tpl=Template("${lane}"))
+                              tpl=_template("${lane}"))
 
     paragraphs["Sequence data directory"] = dict(style=h3,
-                                                 tpl=Template("/proj/${uppnex_project_id}/INBOX/${project_name}/${scilifelab_name}/${start_date}_${FC_id}"))
+                                                 tpl=_template("/proj/${uppnex_project_id}/INBOX/${project_name}/${scilifelab_name}/${start_date}_${FC_id}"))
 
     paragraphs["Sample"] = dict(style=h3,
-                                tpl=Template("""${scilifelab_name} / ${customer_name}.
+                                tpl=_template("""${scilifelab_name} / ${customer_name}.
 Ordered amount: ${ordered_amount} million read${'{}'.format(' pair') if is_paired else ''}s."""))
 
     paragraphs["Method"] = dict(style=h3,
-                                tpl = Template("""Clustered using ${clustering_method} and sequenced on ${sequencing_platform} (${sequencing_software})
+                                tpl = _template("""Clustered using ${clustering_method} and sequenced on ${sequencing_platform} (${sequencing_software})
                                 with a ${sequencing_setup} setup in ${sequencing_mode} mode. Bcl to Fastq conversion was performed using bcl2Fastq v1.8.3
                                 from the CASAVA software suite. The quality scale is Sanger / phred33 / Illumina 1.8+."""))
     paragraphs["Results"] = dict(style=h3,
-                                 tpl = Template("""${rounded_read_count} million read${'{}'.format(' pair') if is_paired else ''}s${' in lane with PhiX error rate {}%'.format(phix_error_rate) if phix_error_rate != 'N/A' else ''}.
+                                 tpl = _template("""${rounded_read_count} million read${'{}'.format(' pair') if is_paired else ''}s${' in lane with PhiX error rate {}%'.format(phix_error_rate) if phix_error_rate != 'N/A' else ''}.
                                  Average quality score ${avg_quality_score} (${pct_q30_bases}% bases >= Q30)."""))
     return paragraphs
 
@@ -98,23 +109,23 @@ def make_sample_table(data,  header_size=11, row_size=9, **kw):
 def project_note_paragraphs():
     """Get paragraphs for project notes."""
     paragraphs = OrderedDict()
-    paragraphs["Project name"] = dict(style=h3, tpl=Template("${project_name} ${'({})'.format(customer_reference) if customer_reference not in ['','N/A'] else ''}"))
+    paragraphs["Project name"] = dict(style=h3, tpl=_template("${project_name} ${'({})'.format(customer_reference) if customer_reference not in ['','N/A'] else ''}"))
 
-    paragraphs["UPPNEX project id"] = dict(style=h3, tpl=Template("${uppnex_project_id}"))
+    paragraphs["UPPNEX project id"] = dict(style=h3, tpl=_template("${uppnex_project_id}"))
 
-    paragraphs["Sequence data directories"] = dict(style=h3, tpl=Template("/proj/${uppnex_project_id}/INBOX/${project_name}/"))
+    paragraphs["Sequence data directories"] = dict(style=h3, tpl=_template("/proj/${uppnex_project_id}/INBOX/${project_name}/"))
     
-    paragraphs["Flowcells Delivered"] = dict(style=h3, tpl=Template("${flowcells_run}"))
+    paragraphs["Flowcells Delivered"] = dict(style=h3, tpl=_template("${flowcells_run}"))
 
-    paragraphs["Samples"] = dict(style=h3, tpl=Template(""))
+    paragraphs["Samples"] = dict(style=h3, tpl=_template(""))
 
-    paragraphs["Comments"] = dict(style=h3, tpl=Template("${finished}"))
+    paragraphs["Comments"] = dict(style=h3, tpl=_template("${finished}"))
 
     paragraphs["Information"] = OrderedDict()
 
     paragraphs["Information"]["Naming conventions"] = dict(
         style=h4,
-        tpl=Template("""The data is delivered in fastq format using Illumina 1.8 quality
+        tpl=_template("""The data is delivered in fastq format using Illumina 1.8 quality
 scores. There will be one file for the forward reads and one file for
 the reverse reads (if the run was a paired-end run).
 
@@ -124,7 +135,7 @@ The naming of the files follow the convention:
 
     paragraphs["Information"]["Data access at UPPMAX"] = dict(
         style=h4,
-        tpl=Template("""Data from the sequencing will be uploaded to the UPPNEX (UPPMAX Next
+        tpl=_template("""Data from the sequencing will be uploaded to the UPPNEX (UPPMAX Next
 Generation sequence Cluster Storage, www.uppmax.uu.se), from which the
 user can access it. You can find the data in the INBOX folder of the UPPNEX project, which
 was created for you when your order was placed, e.g.
@@ -137,7 +148,7 @@ questions regarding UPPNEX, please contact support@uppmax.uu.se."""))
 
     paragraphs["Information"]["Acknowledgement"] = dict(
         style=h4,
-        tpl=Template("""In publications based on data from the work covered by
+        tpl=_template("""In publications based on data from the work covered by
 this contract, the authors must acknowledge SciLifeLab, NGI and Uppmax: \"The
 authors would like to acknowledge support from Science for Life Laboratory,
 the National Genomics Infrastructure, NGI, and Uppmax for providing assistance
@@ -191,6 +202,37 @@ def make_note(outfile, headers, paragraphs, **kw):
     doc.build(story, onFirstPage=formatted_page, onLaterPages=formatted_page)
     return doc
 
+def _make_sample_note(kw):
+    make_note(headers=sample_note_headers(), paragraphs=sample_note_paragraphs(), **kw)
+    return kw["outfile"]
+
+def make_sample_notes(s_param_list, jobs=1):
+    """Build one sample note per sample parameter dictionary, in a
+    pool of <jobs> processes.
+
+    :param s_param_list: list of sample parameter dictionaries, with outfile names in key 'outfile'
+    :param jobs: number of processes
+
+    :returns: list of outfile names, in the order of s_param_list
+    """
+    return run_jobs([(_make_sample_note, (s_param,), {}) for s_param in s_param_list], jobs)
+
+def make_project_note(outfile, sample_table, **kw):
+    """Build a project note with a sample table.
+
+    :param outfile: outfile name
+    :param sample_table: list of list sample table representation
+    :param kw: keyword arguments for formatting
+    """
+    paragraphs = project_note_paragraphs()
+    headers = project_note_headers()
+    #Hack: removes Comments paragraph if it is empty
+    if not kw.get("finished"):
+        paragraphs.pop("Comments",None)
+    paragraphs["Samples"]["tpl"] = make_sample_table(sample_table)
+    make_note(outfile, headers, paragraphs, **kw)
+    return outfile
+
 def concatenate_notes(notes, outfile, numpages=1):
     """Concatenate documents. Warn if numpages in document > numpages.
 
@@ -234,14 +276,12 @@ def make_example_project_note(outfile):
     make_note(outfile, headers, paragraphs, **kw)
 
 
-def make_example_sample_note(outfile):
-    """Make a note with some simple nonsensical data. Looking at this function
-    and running it to make a PDF should give an idea about the structure of the
-    script.
+def example_sample_note_params(**kw):
+    """Get sample note parameters with some simple nonsensical data.
+
+    :param kw: keyword arguments overriding the example parameters
     """
-    headers = sample_note_headers()
-    paragraphs = sample_note_paragraphs()
-    kw = {
+    param = {
         "project_name": "A_test",
         "customer_reference": "Some_test",
         "is_paired": True,
@@ -249,16 +289,34 @@ def make_example_sample_note(outfile):
         "ordered_amount":"23",
         "start_date": "000101",
         "FC_id": "SN001_001_AABCD99XX",
+        "lane": "1",
         "scilifelab_name": "Test sample",
         "customer_name": "That sample for a test",
         "rounded_read_count": "1",
         "phix_error_rate": "1",
         "avg_quality_score": "1",
+        "pct_q30_bases": "1",
         "success": "How should I know if it was successful or not?",
         "instrument":"HiSeq 2000",
         "baseconversion_version":"OLB v1.9",
         "casava_version" : "CASAVA v1.8",
+        "clustering_method": "cBot",
+        "sequencing_platform": "HiSeq2500",
+        "sequencing_software": "HiSeq Control Software 2.0/RTA 1.17",
+        "sequencing_setup": "2x101",
+        "sequencing_mode": "High Output",
         }
+    param.update(kw)
+    return param
+
+def make_example_sample_note(outfile):
+    """Make a note with some simple nonsensical data. Looking at this function
+    and running it to make a PDF should give an idea about the structure of the
+    script.
+    """
+    headers = sample_note_headers()
+    paragraphs = sample_note_paragraphs()
+    kw = example_sample_note_params()
 
     LOG.debug("Making example sample note with parameters {}".format(kw))
     make_note(outfile, headers, paragraphs, **kw)
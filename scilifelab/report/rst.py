@@ -6,6 +6,7 @@ from scilifelab.log import minimal_logger
 from mako.template import Template
 from mako.exceptions import RichTraceback
 from cStringIO import StringIO
+from scilifelab.report import run_jobs
 
 # Set minimal logger
 LOG = minimal_logger(__name__)
@@ -98,14 +99,21 @@ def make_rest_note(outfile, sample_table=None, outdir="rst", report="sample_repo
     with open(os.path.join(outdir, os.path.basename(outfile)), "w") as fh:
         fh.write(_render(report_templates[report], **kw))
     
-def make_sample_rest_notes(concat_outfile, s_param_list, outdir="rst"):
+def _write_rest_note(rst_file, report, kw):
+    rst_out = _render(report_templates[report], **kw)
+    with open(rst_file, "w") as fh:
+        fh.write(rst_out)
+    return rst_out
+
+def make_sample_rest_notes(concat_outfile, s_param_list, outdir="rst", jobs=1):
     """Make reST-formatted sample note and concatenated ditto
 
     :param outdir: output directory
     :param concat_outfile: concatenated outfile
     :param s_param_list: list of samples parameter dictionaries
+    :param jobs: number of processes for rendering notes
     """
-    concatenated_rst = StringIO()
+    tasks = []
     for s_param in s_param_list:
         if s_param["outfile"].endswith(".pdf"):
             s_param["outfile"] = s_param["outfile"].replace(".pdf", ".rst")
@@ -122,14 +130,14 @@ def make_sample_rest_notes(concat_outfile, s_param_list, outdir="rst"):
             os.makedirs(rst_path)
         # add makefile if not present
         _install_makefile(rst_path, **s_param)
-        # Write report note
-        rst_out = _render(report_templates["sample_report"], **s_param)
-        with open(os.path.join(outdir, os.path.basename(s_param["outfile"])), "w") as fh:
-            fh.write(rst_out)
+        tasks.append((_write_rest_note, (os.path.join(outdir, os.path.basename(s_param["outfile"])), "sample_report", s_param), {}))
+
+    # Write report notes
+    concatenated_rst = StringIO()
+    for rst_out in run_jobs(tasks, jobs):
         concatenated_rst.write(rst_out)
         concatenated_rst.write(".. raw:: pdf\n\n   PageBreak\n\n")
 
     # Write concatenated outfile
     with open(os.path.join(outdir, concat_outfile), "w") as fh:
         fh.write(concatenated_rst.getvalue())
-    
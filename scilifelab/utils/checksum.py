@@ -0,0 +1,245 @@
+"""Checksums of files, cached across runs.
+
+A file is read once to compute its md5 and adler32 checksums together.
+The checksums are cached with the inode, size and modification time of
+the file, and are reused for as long as these are unchanged. The cache
+is kept in extended attributes of the file where the filesystem supports
+them and the file is writable, and otherwise in an SQLite database,
+~/.scilifelab/checksums.sqlite unless overridden with the environment
+variable SCILIFELAB_CHECKSUM_DB. The adler32 checksum is also stored in
+the attributes read by scripts/adler32.
+"""
+import os
+import zlib
+import shutil
+import hashlib
+import sqlite3
+import threading
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+try:
+    from os import getxattr, setxattr
+except ImportError:
+    try:
+        from xattr import getxattr, setxattr
+    except ImportError:
+        getxattr = setxattr = None
+
+# Size of the chunks files are read in
+CHUNK_SIZE = 1024 * 1024
+
+# Extended attribute holding "<inode> <size> <mtime> <md5> <adler32>"
+XATTR = "user.scilifelab.checksums"
+
+DEFAULT_DB = os.path.join(os.path.expanduser("~"), ".scilifelab", "checksums.sqlite")
+
+Checksums = namedtuple("Checksums", ["md5", "adler32", "size"])
+
+class ChecksumHasher(object):
+    """Incremental md5 and adler32 checksums of a stream of data"""
+    def __init__(self):
+        self._md5 = hashlib.md5()
+        self._adler32 = 1
+        self.size = 0
+
+    def update(self, data):
+        self._md5.update(data)
+        self._adler32 = zlib.adler32(data, self._adler32)
+        self.size += len(data)
+
+    def checksums(self):
+        return Checksums(self._md5.hexdigest(), "{:08x}".format(self._adler32 & 0xffffffff), self.size)
+
+def compute(path, chunk_size=CHUNK_SIZE):
+    """Compute the checksums of a file, reading it once.
+
+    :param path: file name
+    :param chunk_size: size of the chunks to read
+
+    :returns: Checksums
+    """
+    hasher = ChecksumHasher()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.checksums()
+
+def _signature(st):
+    return [str(st.st_ino), str(st.st_size), repr(st.st_mtime)]
+
+class ChecksumCache(object):
+    """Cache of file checksums, in extended attributes or an SQLite
+    database. Entries are keyed by device and inode in the database, and
+    are only valid for as long as the inode, size and modification time
+    of the file are unchanged.
+
+    :param db: SQLite database file name
+    :param use_xattr: use extended attributes where possible
+    """
+    def __init__(self, db=None, use_xattr=True):
+        self.db = db or os.getenv("SCILIFELAB_CHECKSUM_DB", DEFAULT_DB)
+        self.use_xattr = use_xattr and getxattr is not None
+        self.hits = 0
+        self.misses = 0
+        self._con = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._con is None:
+            if not os.path.exists(os.path.dirname(os.path.abspath(self.db))):
+                os.makedirs(os.path.dirname(os.path.abspath(self.db)))
+            self._con = sqlite3.connect(self.db, check_same_thread=False)
+            self._con.execute("CREATE TABLE IF NOT EXISTS checksums (dev INTEGER, ino INTEGER, size INTEGER, mtime REAL, "
+                              "md5 TEXT, adler32 TEXT, PRIMARY KEY (dev, ino))")
+            self._con.commit()
+        return self._con
+
+    def _get_xattr(self, path, st):
+        try:
+            fields = getxattr(path, XATTR).decode("ascii").split()
+        except (IOError, OSError):
+            return None
+        if len(fields) == 5 and fields[0:3] == _signature(st):
+            return Checksums(str(fields[3]), str(fields[4]), st.st_size)
+
+    def _set_xattr(self, path, st, checksums):
+        try:
+            setxattr(path, XATTR, " ".join(_signature(st) + [checksums.md5, checksums.adler32]).encode("ascii"))
+            setxattr(path, "user.adler_mtime", str(int(st.st_mtime)).encode("ascii"))
+            setxattr(path, "user.adler_value", checksums.adler32.encode("ascii"))
+        except (IOError, OSError):
+            return False
+        return True
+
+    def _get_db(self, st):
+        with self._lock:
+            row = self._connect().execute("SELECT size, mtime, md5, adler32 FROM checksums WHERE dev=? AND ino=?",
+                                          (st.st_dev, st.st_ino)).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime:
+            return Checksums(str(row[2]), str(row[3]), st.st_size)
+
+    def _set_db(self, st, checksums):
+        with self._lock:
+            con = self._connect()
+            con.execute("INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?)",
+                        (st.st_dev, st.st_ino, st.st_size, st.st_mtime, checksums.md5, checksums.adler32))
+            con.commit()
+
+    def get(self, path, st=None):
+        """Get the cached checksums of a file.
+
+        :param path: file name
+        :param st: os.stat of the file, if already known
+
+        :returns: Checksums, or None if there are no valid cached checksums
+        """
+        st = st or os.stat(path)
+        checksums = None
+        if self.use_xattr:
+            checksums = self._get_xattr(path, st)
+        return checksums or self._get_db(st)
+
+    def set(self, path, checksums, st=None):
+        """Cache the checksums of a file.
+
+        :param path: file name
+        :param checksums: Checksums
+        :param st: os.stat of the file the checksums were computed from
+        """
+        st = st or os.stat(path)
+        if not (self.use_xattr and self._set_xattr(path, st, checksums)):
+            self._set_db(st, checksums)
+
+    def checksum(self, path, cached=True):
+        """Get the checksums of a file, from the cache if valid, and
+        otherwise by reading it and caching the result.
+
+        :param path: file name
+        :param cached: use cached checksums; if False, always read the file
+
+        :returns: Checksums
+        """
+        st = os.stat(path)
+        if cached:
+            checksums = self.get(path, st)
+            if checksums:
+                with self._lock:
+                    self.hits += 1
+                return checksums
+        with self._lock:
+            self.misses += 1
+        checksums = compute(path)
+        ## Don't cache checksums of a file that changed while it was read
+        if _signature(os.stat(path)) == _signature(st):
+            self.set(path, checksums, st)
+        return checksums
+
+    def checksums(self, paths, threads=4, cached=True):
+        """Get the checksums of many files, reading the files without
+        valid cached checksums concurrently.
+
+        :param paths: file names
+        :param threads: number of files to read at a time
+        :param cached: use cached checksums
+
+        :returns: dictionary of file name to Checksums
+        """
+        paths = list(paths)
+        if threads <= 1 or len(paths) < 2:
+            return dict((path, self.checksum(path, cached)) for path in paths)
+        pool = ThreadPool(min(threads, len(paths)))
+        try:
+            return dict(zip(paths, pool.map(lambda path: self.checksum(path, cached), paths)))
+        finally:
+            pool.close()
+            pool.join()
+
+    def copy(self, src, dst, chunk_size=CHUNK_SIZE):
+        """Copy a file, with its permissions and times, computing the
+        checksums of the data while copying, so that the source is read
+        once. The checksums are cached for the source.
+
+        :param src: source file name
+        :param dst: destination file name
+        :param chunk_size: size of the chunks to copy
+
+        :returns: Checksums
+        """
+        hasher = ChecksumHasher()
+        with open(src, "rb") as fin:
+            st = os.fstat(fin.fileno())
+            with open(dst, "wb") as fout:
+                for chunk in iter(lambda: fin.read(chunk_size), b""):
+                    hasher.update(chunk)
+                    fout.write(chunk)
+                fout.flush()
+                os.fsync(fout.fileno())
+        shutil.copystat(src, dst)
+        checksums = hasher.checksums()
+        if _signature(os.stat(src)) == _signature(st):
+            self.set(src, checksums, st)
+        return checksums
+
+    def close(self):
+        if self._con is not None:
+            self._con.close()
+            self._con = None
+
+_cache = None
+
+def get_cache():
+    """Get the checksum cache of this process"""
+    global _cache
+    if _cache is None:
+        _cache = ChecksumCache()
+    return _cache
+
+def checksum(path, cached=True):
+    """Get the checksums of a file with the checksum cache of this process.
+    See ChecksumCache.checksum."""
+    return get_cache().checksum(path, cached)
+
+def checksums(paths, threads=4, cached=True):
+    """Get the checksums of many files with the checksum cache of this
+    process. See ChecksumCache.checksums."""
+    return get_cache().checksums(paths, threads, cached)
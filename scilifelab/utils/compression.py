@@ -0,0 +1,380 @@
+"""Gzip codec backends for reading and writing compressed files.
+
+The backends are
+
+  pigz  - external pigz process, multi-threaded compression
+  igzip - external igzip (ISA-L) process, fast single-threaded (de)compression
+  bgzf  - built-in writer compressing independent BGZF blocks on a thread pool
+  gzip  - the python gzip module
+
+All backends produce standard gzip output (possibly with several
+members), readable by gzip, zcat and the python gzip module. The
+backend is selected automatically among the available ones, in the
+order of READ_CODECS and WRITE_CODECS, except for the OPT_IN_CODECS,
+which are only used when requested. Selection can be overridden per
+call with the codec argument, or globally with the environment
+variable GZIP_CODEC.
+"""
+import os
+import io
+import gzip
+import zlib
+import struct
+import bisect
+import threading
+import subprocess
+import multiprocessing
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+from scilifelab.log import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+# Preference order of codecs, per direction
+READ_CODECS = ["igzip", "pigz", "gzip"]
+WRITE_CODECS = ["pigz", "igzip", "bgzf", "gzip"]
+
+# Codecs that change the output format, never selected automatically
+OPT_IN_CODECS = ["bgzf"]
+
+# Default number of compression threads
+THREADS = min(4, multiprocessing.cpu_count())
+
+# Pipe buffer size
+BUFSIZE = 1024*1024
+
+# Uncompressed BGZF block size, as used by bgzip
+BGZF_BLOCK_SIZE = 0xff00
+
+def which(program):
+    """Return the full path to <program> if found in PATH, otherwise None"""
+    for d in os.environ.get("PATH", "").split(os.pathsep):
+        exe = os.path.join(d, program)
+        if os.path.isfile(exe) and os.access(exe, os.X_OK):
+            return exe
+    return None
+
+_AVAILABLE = {}
+
+def available(codec):
+    """Check whether <codec> can be used on this system"""
+    if codec in ["gzip", "bgzf"]:
+        return True
+    if codec not in _AVAILABLE:
+        _AVAILABLE[codec] = which(codec) is not None
+    return _AVAILABLE[codec]
+
+def select_codec(mode="rb", codec=None):
+    """Select the gzip codec to use for files opened with <mode>.
+
+    :param mode: file mode, 'rb', 'wb' or 'ab'
+    :param codec: requested codec; overrides GZIP_CODEC and automatic selection
+
+    :returns: codec name
+    """
+    candidates = READ_CODECS if mode.startswith("r") else WRITE_CODECS
+    if not codec and os.environ.get("GZIP_CODEC", None) in candidates:
+        ## GZIP_CODEC applies to the directions the codec supports, e.g. bgzf to writing only
+        codec = os.environ["GZIP_CODEC"]
+    if codec:
+        if codec not in candidates:
+            raise ValueError("codec '{}' not supported for mode '{}'; choose one of {}".format(codec, mode, ", ".join(candidates)))
+        if available(codec):
+            return codec
+        LOG.warn("codec '{}' not available; selecting codec automatically".format(codec))
+    for c in candidates:
+        if c not in OPT_IN_CODECS and available(c):
+            return c
+
+def open_gzip(fname, mode="rb", codec=None, threads=None, level=6):
+    """Open a gzip compressed file.
+
+    :param fname: file name
+    :param mode: 'rb', 'wb' or 'ab'
+    :param codec: codec to use, see select_codec
+    :param threads: number of compression threads for pigz and bgzf
+    :param level: compression level
+
+    :returns: file-like object
+    """
+    codec = select_codec(mode, codec)
+    threads = threads or THREADS
+    LOG.debug("opening {} in mode '{}' with codec {}".format(fname, mode, codec))
+    if mode.startswith("r"):
+        if codec == "pigz":
+            return PipeReader(["pigz", "-dc", "-p", str(threads)], fname)
+        if codec == "igzip":
+            return PipeReader(["igzip", "-dc"], fname)
+        return io.BufferedReader(gzip.GzipFile(fname, mode), BUFSIZE)
+    if codec == "pigz":
+        return PipeWriter(["pigz", "-c", "-p", str(threads), "-{}".format(level)], fname, mode)
+    if codec == "igzip":
+        # igzip compression levels range from 0 to 3
+        return PipeWriter(["igzip", "-c", "-{}".format(min(level, 3))], fname, mode)
+    if codec == "bgzf":
+        return BlockGzipWriter(fname, mode, threads=threads, level=level)
+    return gzip.GzipFile(fname, mode, level)
+
+class PipeReader(object):
+    """Read the output of an external decompression command.
+
+    :param cmd: command, to which the file name is appended
+    :param fname: file name
+    """
+    def __init__(self, cmd, fname):
+        # Raise IOError for missing files as for ordinary files
+        open(fname, "rb").close()
+        self.name = fname
+        self._cmd = cmd
+        self._start()
+
+    def _start(self):
+        self._proc = subprocess.Popen(self._cmd + [self.name], stdout=subprocess.PIPE, bufsize=BUFSIZE)
+        self._fh = self._proc.stdout
+
+    def _check(self):
+        if self._proc.wait() != 0:
+            raise IOError("'{}' failed with exit code {}".format(" ".join(self._cmd + [self.name]), self._proc.returncode))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            return self._fh.next()
+        except StopIteration:
+            self._check()
+            raise
+
+    def readline(self, size=-1):
+        line = self._fh.readline(size)
+        if not line:
+            self._check()
+        return line
+
+    def read(self, size=-1):
+        data = self._fh.read(size)
+        if not data:
+            self._check()
+        return data
+
+    def seek(self, offset, whence=0):
+        """Only rewinding to the start of the file is supported"""
+        if offset != 0 or whence:
+            raise IOError("seek to other position than start of file not supported for {}".format(self.name))
+        self.close()
+        self._start()
+
+    def close(self):
+        """Close the pipe. Exit status is not checked if the stream was
+        not read to the end, since the process then gets SIGPIPE"""
+        if not self._fh.closed:
+            self._fh.close()
+            self._proc.wait()
+
+    @property
+    def closed(self):
+        return self._fh.closed
+
+class PipeWriter(object):
+    """Write through an external compression command.
+
+    :param cmd: command reading from stdin and writing to stdout
+    :param fname: output file name
+    :param mode: 'wb' or 'ab'
+    """
+    def __init__(self, cmd, fname, mode="wb"):
+        self.name = fname
+        self._cmd = cmd
+        self._out = open(fname, mode)
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=self._out, bufsize=BUFSIZE)
+        self._fh = self._proc.stdin
+
+    def write(self, data):
+        self._fh.write(data)
+
+    def flush(self):
+        self._fh.flush()
+
+    def close(self):
+        if not self._fh.closed:
+            self._fh.close()
+            self._proc.wait()
+            self._out.close()
+            if self._proc.returncode != 0:
+                raise IOError("'{}' failed with exit code {}".format(" ".join(self._cmd), self._proc.returncode))
+
+    @property
+    def closed(self):
+        return self._fh.closed
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+def _get_pool(threads):
+    """Get the shared compression thread pool with <threads> workers.
+    Pools are kept per process, since forked processes, such as
+    multiprocessing workers, inherit the pools but not their threads."""
+    key = (os.getpid(), threads)
+    with _POOLS_LOCK:
+        if key not in _POOLS:
+            _POOLS[key] = ThreadPool(threads)
+        return _POOLS[key]
+
+def bgzf_block(data, level=6):
+    """Compress <data> into a BGZF block, i.e. a gzip member with a
+    'BC' extra field holding the total block size minus one.
+
+    :param data: uncompressed data, at most 65536 bytes
+    :param level: compression level
+
+    :returns: compressed block
+    """
+    c = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    cdata = c.compress(data) + c.flush()
+    header = struct.pack("<BBBBIBBHBBHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25)
+    return header + cdata + struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+
+class BlockGzipWriter(object):
+    """Gzip writer that compresses independent BGZF blocks on a thread
+    pool, writing them in order. Each block is a complete gzip member,
+    so the output is readable by gzip as well as by bgzip-aware tools.
+
+    :param fname: output file name
+    :param mode: 'wb' or 'ab'
+    :param threads: size of the compression thread pool
+    :param level: compression level
+    :param block_size: uncompressed block size
+    """
+    def __init__(self, fname, mode="wb", threads=THREADS, level=6, block_size=BGZF_BLOCK_SIZE):
+        self.name = fname
+        self.level = level
+        self.block_size = block_size
+        self._out = open(fname, mode)
+        self._pool = _get_pool(threads)
+        self._max_pending = 2 * threads
+        self._pending = deque()
+        self._buf = []
+        self._buflen = 0
+
+    def _submit(self, data):
+        self._pending.append(self._pool.apply_async(bgzf_block, (data, self.level)))
+        while len(self._pending) > self._max_pending:
+            self._out.write(self._pending.popleft().get())
+
+    def write(self, data):
+        self._buf.append(data)
+        self._buflen += len(data)
+        if self._buflen >= self.block_size:
+            data = "".join(self._buf)
+            n = len(data) - len(data) % self.block_size
+            for i in xrange(0, n, self.block_size):
+                self._submit(data[i:i + self.block_size])
+            self._buf = [data[n:]]
+            self._buflen = len(data) - n
+
+    def flush(self):
+        """Compress buffered data and write all pending blocks"""
+        if self._buflen > 0:
+            self._submit("".join(self._buf))
+            self._buf = []
+            self._buflen = 0
+        while self._pending:
+            self._out.write(self._pending.popleft().get())
+        self._out.flush()
+
+    def close(self):
+        if not self._out.closed:
+            self.flush()
+            # Empty block used as end-of-file marker in BGZF
+            self._out.write(bgzf_block("", self.level))
+            self._out.close()
+
+    @property
+    def closed(self):
+        return self._out.closed
+
+def is_bgzf(fname):
+    """Check whether <fname> starts with a BGZF block"""
+    with open(fname, "rb") as fh:
+        header = fh.read(18)
+    return len(header) == 18 and header[0:4] == "\x1f\x8b\x08\x04" and header[10:16] == "\x06\x00BC\x02\x00"
+
+def bgzf_blocks(fname):
+    """List the blocks of a BGZF file, reading only block headers and trailers.
+
+    :param fname: BGZF file name
+
+    :returns: list of (compressed offset, uncompressed offset, uncompressed size) tuples
+    """
+    blocks = []
+    (coffset, uoffset) = (0, 0)
+    with open(fname, "rb") as fh:
+        while True:
+            header = fh.read(18)
+            if not header:
+                break
+            if len(header) < 18 or header[10:16] != "\x06\x00BC\x02\x00":
+                raise IOError("{} is not a BGZF file; invalid block at offset {}".format(fname, coffset))
+            bsize = struct.unpack("<H", header[16:18])[0] + 1
+            fh.seek(coffset + bsize - 4)
+            usize = struct.unpack("<I", fh.read(4))[0]
+            blocks.append((coffset, uoffset, usize))
+            coffset += bsize
+            uoffset += usize
+    return blocks
+
+def bgzf_seek_offset(blocks, offset):
+    """Translate an uncompressed offset to the compressed offset of the
+    block holding it and the offset within the uncompressed block
+
+    :param blocks: block list, see bgzf_blocks
+    :param offset: uncompressed offset
+
+    :returns: tuple of (compressed offset, offset within block)
+    """
+    i = max(0, bisect.bisect_right([b[1] for b in blocks], offset) - 1)
+    return (blocks[i][0], offset - blocks[i][1])
+
+class BGZFReader(object):
+    """Sequential reader of a BGZF file, starting at the block at
+    compressed offset <coffset>, <skip> bytes into the uncompressed block.
+
+    :param fname: BGZF file name
+    :param coffset: compressed offset of first block
+    :param skip: number of uncompressed bytes to skip in first block
+    """
+    def __init__(self, fname, coffset=0, skip=0):
+        self.name = fname
+        self._fh = open(fname, "rb")
+        self._fh.seek(coffset)
+        self._skip = skip
+
+    def blocks(self):
+        """Generate the uncompressed data of each block"""
+        while True:
+            header = self._fh.read(18)
+            if len(header) < 18:
+                return
+            bsize = struct.unpack("<H", header[16:18])[0] + 1
+            data = zlib.decompress(self._fh.read(bsize - 26), -zlib.MAX_WBITS)
+            self._fh.read(8)
+            if self._skip:
+                data = data[self._skip:]
+                self._skip = 0
+            if data:
+                yield data
+
+    def __iter__(self):
+        pending = ""
+        for data in self.blocks():
+            lines = (pending + data).split("\n")
+            pending = lines.pop()
+            for line in lines:
+                yield line + "\n"
+        if pending:
+            yield pending
+
+    def close(self):
+        self._fh.close()
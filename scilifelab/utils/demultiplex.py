@@ -0,0 +1,456 @@
+"""Demultiplexing of fastq files.
+
+Index reads are matched to the supplied indexes with an IndexMatcher,
+which precomputes every sequence within the allowed number of
+mismatches of an index, so that matching is one dictionary lookup per
+read. Records are written through an OutputPool, which buffers records
+per output file and keeps a bounded number of files open.
+"""
+import os
+import errno
+import shutil
+import itertools
+import multiprocessing
+from collections import OrderedDict
+
+from scilifelab.log import minimal_logger
+from scilifelab.illumina.hiseq import HiSeqRun
+from scilifelab.utils.fastq_utils import FastQParser, FastQWriter, fastq_chunks, paired_fastq_chunks, iter_chunk
+
+LOG = minimal_logger(__name__)
+
+# Match status
+MATCH = "match"
+AMBIGUOUS = "ambiguous"
+UNMATCHED = "unmatched"
+
+BASES = "ACGTN"
+
+def hamming(str_01, str_02):
+    """Number of mismatches between two strings, the longer truncated
+    to the length of the shorter"""
+    return sum([a != b for a, b in itertools.izip(str_01, str_02)])
+
+def neighbours(seq, max_mismatches, alphabet=BASES):
+    """Generate all sequences within <max_mismatches> substitutions of <seq>.
+
+    :param seq: sequence
+    :param max_mismatches: maximum number of substitutions
+    :param alphabet: substitution alphabet
+
+    :returns: generator of (sequence, mismatches) tuples, in order of increasing mismatches
+    """
+    yield (seq, 0)
+    for k in xrange(1, max_mismatches + 1):
+        for positions in itertools.combinations(xrange(len(seq)), k):
+            choices = [[c for c in alphabet if c != seq[p]] for p in positions]
+            for subst in itertools.product(*choices):
+                variant = list(seq)
+                for p, c in itertools.izip(positions, subst):
+                    variant[p] = c
+                yield ("".join(variant), k)
+
+class IndexMatcher(object):
+    """Match index reads to a set of indexes, allowing mismatches.
+
+    Indexes are tried in the order given; an exact match to an index
+    wins over matches to later indexes. Otherwise, the indexes with the
+    fewest mismatches are reported, and the match is ambiguous if there
+    are several of them. Indexes are compared to the index read prefix
+    of the same length, or with prefix=False only to index reads of the
+    same length. Any base that differs from the index, including bases
+    outside ACGTN, counts as a mismatch.
+
+    :param indexes: list of index sequences, in order of priority
+    :param max_mismatches: maximum number of mismatches
+    :param prefix: match indexes to index read prefixes
+    """
+    def __init__(self, indexes, max_mismatches=0, prefix=True):
+        self.indexes = list(indexes)
+        self.max_mismatches = max_mismatches
+        self.prefix = prefix
+        lengths = []
+        for ix in self.indexes:
+            if len(ix) not in lengths:
+                lengths.append(len(ix))
+        self._tables = []
+        for length in sorted(lengths, reverse=True):
+            table = {}
+            for ix in [x for x in self.indexes if len(x) == length]:
+                for (seq, k) in neighbours(ix, max_mismatches):
+                    hit = table.get(seq, None)
+                    if hit is None or k < hit[0]:
+                        table[seq] = (k, (ix,))
+                    elif k == hit[0] and k > 0:
+                        table[seq] = (k, hit[1] + (ix,))
+            self._tables.append((length, table))
+        self._single = self._tables[0] if len(self._tables) == 1 else None
+
+    def __len__(self):
+        return sum([len(t) for _, t in self._tables])
+
+    def _lookup(self, seq, length, table):
+        if not self.prefix and len(seq) != length:
+            return None
+        if len(seq) >= length:
+            hit = table.get(seq[0:length], None)
+            if hit is None and self.max_mismatches and seq[0:length].translate(None, BASES):
+                # Bases outside the alphabet of the table; compare with every index
+                return self._scan(seq[0:length], length)
+            return hit
+        # Index read shorter than index; compare with truncated indexes
+        return self._scan(seq, length)
+
+    def _scan(self, seq, length):
+        """Compare <seq> with every index of length <length>"""
+        hits = [(hamming(ix, seq), ix) for ix in self.indexes if len(ix) == length]
+        hits = [(k, ix) for k, ix in hits if k <= self.max_mismatches]
+        if not hits:
+            return None
+        k = min(hits)[0]
+        if k == 0:
+            return (0, ([ix for d, ix in hits if d == 0][0],))
+        return (k, tuple([ix for d, ix in hits if d == k]))
+
+    def match(self, seq):
+        """Match an index read.
+
+        :param seq: index read sequence
+
+        :returns: tuple of (status, indexes, mismatches)
+        """
+        if self._single is not None:
+            hit = self._lookup(seq, *self._single)
+        else:
+            hit = None
+            for (length, table) in self._tables:
+                h = self._lookup(seq, length, table)
+                if h is None:
+                    continue
+                if h[0] == 0:
+                    hit = h
+                    break
+                if hit is None or h[0] < hit[0]:
+                    hit = h
+                elif h[0] == hit[0]:
+                    hit = (hit[0], hit[1] + h[1])
+        if hit is None:
+            return (UNMATCHED, (), None)
+        if len(hit[1]) > 1:
+            return (AMBIGUOUS, hit[1], hit[0])
+        return (MATCH, hit[1], hit[0])
+
+class OutputPool(object):
+    """Buffered fastq output files, of which at most <max_open> are open
+    at any time. Records are buffered per file and written when the
+    buffer exceeds <buffer_size> bytes. When the limit of open files is
+    reached, the least recently written file is closed, and reopened in
+    append mode when needed again.
+
+    :param max_open: maximum number of open files
+    :param buffer_size: per file buffer size in bytes
+    :param codec: gzip codec for compressed output files
+    """
+    def __init__(self, max_open=64, buffer_size=256*1024, codec=None):
+        self.max_open = max_open
+        self.buffer_size = buffer_size
+        self.codec = codec
+        self.counts = {}
+        self._handles = OrderedDict()
+        self._buffers = {}
+        self._sizes = {}
+        self._opened = set()
+
+    def write(self, fname, record):
+        """Buffer a record for output file <fname>"""
+        data = "{}\n".format("\n".join([r.strip() for r in record]))
+        if fname not in self._buffers:
+            self._buffers[fname] = []
+            self._sizes[fname] = 0
+            self.counts[fname] = 0
+        self._buffers[fname].append(data)
+        self._sizes[fname] += len(data)
+        self.counts[fname] += 1
+        if self._sizes[fname] >= self.buffer_size:
+            self._flush(fname)
+
+    def _open(self, fname):
+        mode = "ab" if fname in self._opened else "wb"
+        while True:
+            try:
+                fh = FastQWriter(fname, codec=self.codec, mode=mode)
+                break
+            except (IOError, OSError) as e:
+                if e.errno != errno.EMFILE or not self._handles:
+                    raise
+                self.max_open = max(1, len(self._handles) - 1)
+                LOG.warn("too many open files; lowering number of open output files to {}".format(self.max_open))
+                self._handles.popitem(last=False)[1].close()
+        self._opened.add(fname)
+        return fh
+
+    def _handle(self, fname):
+        fh = self._handles.pop(fname, None)
+        if fh is None:
+            while len(self._handles) >= self.max_open:
+                self._handles.popitem(last=False)[1].close()
+            fh = self._open(fname)
+        self._handles[fname] = fh
+        return fh
+
+    def _flush(self, fname):
+        self._handle(fname).write_block("".join(self._buffers[fname]), len(self._buffers[fname]))
+        self._buffers[fname] = []
+        self._sizes[fname] = 0
+
+    def flush(self):
+        for fname in self._buffers.keys():
+            if self._buffers[fname]:
+                self._flush(fname)
+
+    def close(self):
+        """Write buffered records and close all files
+
+        :returns: dictionary of file name to number of records written
+        """
+        self.flush()
+        while self._handles:
+            self._handles.popitem(last=False)[1].close()
+        return self.counts
+
+def casava_lane_index(header):
+    """Get lane and index sequence from a CASAVA 1.8+ header, see parse_header"""
+    return (header.split(":", 4)[3], header.rsplit(":", 1)[-1])
+
+def merge_parts(fname, parts):
+    """Concatenate partial output files in order into <fname> and remove
+    them. Concatenated gzip files are valid gzip files.
+
+    :param fname: output file name
+    :param parts: list of partial file names; missing files are skipped
+
+    :returns: True if any partial file existed
+    """
+    parts = [p for p in parts if os.path.exists(p)]
+    if not parts:
+        return False
+    with open(fname, "wb") as out:
+        for p in parts:
+            with open(p, "rb") as fh:
+                shutil.copyfileobj(fh, out, 4*1024*1024)
+            os.unlink(p)
+    return True
+
+def _part(fname, k):
+    """Name of partial output file <k> for <fname>, with the extension
+    of <fname>, so that parts are compressed as the output file"""
+    (root, ext) = os.path.splitext(fname)
+    if ext == ".gz":
+        (root, fext) = os.path.splitext(root)
+        ext = fext + ext
+    return "{}.part{:05d}{}".format(root, k, ext)
+
+def _run_chunks(fn, tasks, processes):
+    """Run <fn> on tasks in a process pool, yielding results in task order"""
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap(fn, tasks):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def _casava_records(records, r, outfiles, matchers, pool, counts, part=None):
+    """Demultiplex records from read file <r>, see demultiplex_casava"""
+    for record in records:
+        (lane, index) = casava_lane_index(record[0])
+        matcher = matchers.get(lane, None)
+        if matcher is None:
+            continue
+        (status, ixs, _) = matcher.match(index)
+        if status == MATCH:
+            fname = outfiles[lane][ixs[0]][r]
+            pool.write(fname if part is None else _part(fname, part), record)
+            counts[lane][ixs[0]] += 1
+
+def _casava_setup(outdir, samplesheet, reads, max_mismatches):
+    outfiles = {}
+    for sd in HiSeqRun.parse_samplesheet(samplesheet):
+        outfiles.setdefault(sd['Lane'], OrderedDict())[sd['Index']] = \
+            [os.path.join(outdir, "tmp_{}_{}_L00{}_R{}_001.fastq.gz".format(sd['SampleID'], sd['Index'], sd['Lane'], read)) for read in reads]
+    matchers = {lane: IndexMatcher(ixs.keys(), max_mismatches, prefix=False) for lane, ixs in outfiles.iteritems()}
+    counts = {lane: dict([(ix, 0) for ix in ixs]) for lane, ixs in outfiles.iteritems()}
+    return (outfiles, matchers, counts)
+
+def _casava_chunk(args):
+    """Demultiplex one chunk of a read file into partial output files"""
+    (outdir, samplesheet, reads, max_mismatches, fastq, r, chunk, k, kw) = args
+    (outfiles, matchers, counts) = _casava_setup(outdir, samplesheet, reads, max_mismatches)
+    pool = OutputPool(**kw)
+    _casava_records(iter_chunk(fastq, *chunk), r, outfiles, matchers, pool, counts, part=k)
+    pool.close()
+    return counts
+
+def demultiplex_casava(outdir, samplesheet, fastq1, fastq2=None, max_mismatches=0, processes=1, **kw):
+    """Demultiplex a bcl-converted illumina fastq file, using the index
+    sequence in the header a la CASAVA 1.8+.
+
+    With processes > 1, plain and BGZF compressed input files are split
+    into record-aligned chunks that are demultiplexed in a process pool,
+    and the partial outputs are concatenated in input order.
+
+    :param outdir: output directory
+    :param samplesheet: samplesheet with the lanes and indexes to demultiplex
+    :param fastq1: read 1 fastq file
+    :param fastq2: optional read 2 fastq file
+    :param max_mismatches: maximum number of mismatches in index
+    :param processes: number of processes
+    :param kw: keyword arguments passed to OutputPool
+
+    :returns: dictionary of lane to dictionary of index to list of output file names
+    """
+    reads = [1] if fastq2 is None else [1, 2]
+    fastqs = [fastq1, fastq2][0:len(reads)]
+    (outfiles, matchers, counts) = _casava_setup(outdir, samplesheet, reads, max_mismatches)
+
+    chunks = [fastq_chunks(f, 4 * processes) for f in fastqs] if processes > 1 else [None]
+    if processes > 1 and all([c is not None for c in chunks]):
+        tasks = []
+        for r, (fastq, fchunks) in enumerate(zip(fastqs, chunks)):
+            tasks.extend([(outdir, samplesheet, reads, max_mismatches, fastq, r, c, k, kw) for k, c in enumerate(fchunks)])
+        LOG.debug("demultiplexing {} chunks in {} processes".format(len(tasks), processes))
+        for c in _run_chunks(_casava_chunk, tasks, processes):
+            for lane in c.keys():
+                for index in c[lane].keys():
+                    counts[lane][index] += c[lane][index]
+        for lane in outfiles.keys():
+            for index in outfiles[lane].keys():
+                for r, fname in enumerate(outfiles[lane][index]):
+                    merge_parts(fname, [_part(fname, k) for k in xrange(len(chunks[r]))])
+    else:
+        if processes > 1:
+            LOG.warn("input files are gzip compressed but not BGZF and cannot be split; demultiplexing in one process")
+        pool = OutputPool(**kw)
+        for r, fastq in enumerate(fastqs):
+            _casava_records(FastQParser(fastq), r, outfiles, matchers, pool, counts)
+        pool.close()
+
+    # If no sequences were written, remove the entry from the results,
+    # otherwise rename the temporary files to persistent names. Output
+    # files are created on the first record, so a read without records
+    # for an index written for the other read gets an empty file
+    for lane in outfiles.keys():
+        for index in outfiles[lane].keys():
+            if counts[lane][index] == 0:
+                del outfiles[lane][index]
+                continue
+            for r, fname in enumerate(outfiles[lane][index]):
+                if not os.path.exists(fname):
+                    FastQWriter(fname, codec=kw.get("codec", None)).close()
+                nname = fname.replace("tmp_", "")
+                os.rename(fname, nname)
+                outfiles[lane][index][r] = nname
+        outfiles[lane] = dict(outfiles[lane])
+    return outfiles
+
+def _mctag_files(outdir, index_dict):
+    def _outfiles(name):
+        return [os.path.join(outdir, "{sample_name}_R{read_num}.fastq".format(sample_name=name, read_num=n)) for n in [1, 2]]
+    sample_files = {ix: _outfiles(name if name else ix) for ix, name in index_dict.iteritems()}
+    return (sample_files, _outfiles("Ambiguous"), _outfiles("Undetermined"))
+
+def _mctag_records(records, matcher, files, pool, counts, part=None, progress=None, progress_interval=1000):
+    """Demultiplex (read 1, read 2, index read) records, see demultiplex_mctag"""
+    (sample_files, ambiguous_files, unmatched_files) = files
+    for read_1, read_2, read_ind in records:
+        read_ind_seq = read_ind[1]
+        (status, ixs, mismatches) = matcher.match(read_ind_seq)
+        if status == MATCH:
+            tag = "{}:{}:".format(ixs[0], read_ind_seq[len(ixs[0]):])
+            fnames = sample_files[ixs[0]]
+            if mismatches > 0:
+                counts['corrected'] += 1
+        elif status == AMBIGUOUS:
+            tag = "{}:{}:".format(",".join(ixs), read_ind_seq)
+            fnames = ambiguous_files
+        else:
+            tag = ":{}:".format(read_ind_seq)
+            fnames = unmatched_files
+        if part is not None:
+            fnames = [_part(f, part) for f in fnames]
+        counts[status] += 1
+        read_1[0] += tag
+        read_2[0] += tag
+        pool.write(fnames[0], read_1)
+        pool.write(fnames[1], read_2)
+        counts['reads_processed'] += 1
+        if progress and counts['reads_processed'] % progress_interval == 0:
+            progress(counts['reads_processed'])
+
+def _mctag_counts():
+    return {'reads_processed': 0, MATCH: 0, AMBIGUOUS: 0, UNMATCHED: 0, 'corrected': 0}
+
+def _mctag_chunk(args):
+    """Demultiplex one chunk of a read set into partial output files"""
+    (fastqs, chunks, index_dict, outdir, max_mismatches, k, kw) = args
+    matcher = IndexMatcher(sorted(index_dict.keys(), key=lambda x: (-len(x))), max_mismatches)
+    counts = _mctag_counts()
+    pool = OutputPool(**kw)
+    records = itertools.izip(*[iter_chunk(f, *c) for f, c in zip(fastqs, chunks)])
+    _mctag_records(records, matcher, _mctag_files(outdir, index_dict), pool, counts, part=k)
+    pool.close()
+    return counts
+
+def demultiplex_mctag(read_1_fq, read_2_fq, read_index_fq, index_dict, outdir, max_mismatches=1, progress=None, progress_interval=1000, processes=1, **kw):
+    """Demultiplex read pairs on an index read holding an index followed
+    by a molecular tag. The matched index and the molecular tag are
+    appended to the read headers. Read pairs are written to
+    <sample_name>_R[12].fastq, or to Ambiguous_R[12].fastq and
+    Undetermined_R[12].fastq.
+
+    With processes > 1, plain and BGZF compressed input files are split
+    into chunks holding the same records from each file, which are
+    demultiplexed in a process pool; the partial outputs are
+    concatenated in input order, and progress is reported per chunk.
+
+    :param read_1_fq: read 1 fastq file
+    :param read_2_fq: read 2 fastq file
+    :param read_index_fq: index read fastq file
+    :param index_dict: dictionary of index sequence to sample name or None
+    :param outdir: output directory
+    :param max_mismatches: maximum number of mismatches in index
+    :param progress: function called with the number of processed reads every <progress_interval> reads
+    :param progress_interval: progress interval
+    :param processes: number of processes
+    :param kw: keyword arguments passed to OutputPool
+
+    :returns: dictionary of counts for keys reads_processed, match, ambiguous, unmatched, corrected
+    """
+    fastqs = [read_1_fq, read_2_fq, read_index_fq]
+    files = _mctag_files(outdir, index_dict)
+    counts = _mctag_counts()
+    chunks = paired_fastq_chunks(fastqs, 4 * processes) if processes > 1 else None
+    if chunks is not None:
+        tasks = [(fastqs, c, index_dict, outdir, max_mismatches, k, kw) for k, c in enumerate(chunks)]
+        LOG.debug("demultiplexing {} chunks in {} processes".format(len(tasks), processes))
+        for c in _run_chunks(_mctag_chunk, tasks, processes):
+            for key in counts.keys():
+                counts[key] += c[key]
+            if progress:
+                progress(counts['reads_processed'])
+        (sample_files, ambiguous_files, unmatched_files) = files
+        for fname in set([f for fnames in sample_files.values() + [ambiguous_files, unmatched_files] for f in fnames]):
+            merge_parts(fname, [_part(fname, k) for k in xrange(len(chunks))])
+        return counts
+
+    if processes > 1:
+        LOG.warn("input files are gzip compressed but not BGZF and cannot be split; demultiplexing in one process")
+    matcher = IndexMatcher(sorted(index_dict.keys(), key=lambda x: (-len(x))), max_mismatches)
+    pool = OutputPool(**kw)
+    records = itertools.izip(FastQParser(read_1_fq), FastQParser(read_2_fq), FastQParser(read_index_fq))
+    _mctag_records(records, matcher, files, pool, counts, progress=progress, progress_interval=progress_interval)
+    pool.close()
+    return counts
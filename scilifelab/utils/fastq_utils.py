@@ -2,22 +2,25 @@
 import gzip
 import os
 import re
-from scilifelab.illumina.hiseq import HiSeqRun
+import itertools
+import numpy as np
+from scilifelab.utils.compression import open_gzip, is_bgzf, bgzf_blocks, bgzf_seek_offset, BGZFReader
          
 class FastQParser:
     """Parser for fastq files, possibly compressed with gzip. 
        Iterates over one record at a time. A record consists 
        of a list with 4 elements corresponding to 1) Header, 
-       2) Nucleotide sequence, 3) Optional header, 4) Qualities"""
+       2) Nucleotide sequence, 3) Optional header, 4) Qualities.
+       Compressed files are read with the gzip codec given by codec,
+       by default selected automatically (see scilifelab.utils.compression)"""
     
-    def __init__(self,file,filter=None):
+    def __init__(self,file,filter=None,codec=None):
         self.fname = file
         self.filter = filter
-        fh = open(file,"rb")
         if file.endswith(".gz"):
-            self._fh = gzip.GzipFile(fileobj=fh)
+            self._fh = open_gzip(file,"rb",codec=codec)
         else:
-            self._fh = fh
+            self._fh = open(file,"rb")
         self._records_read = 0
         self._next = self.setup_next()
         
@@ -32,8 +35,9 @@ class FastQParser:
         """
         if self.filter is None or len(self.filter.keys()) == 0:
             def _next(self):
+                record = [self._fh.next().strip() for n in range(4)]
                 self._records_read += 1
-                return [self._fh.next().strip() for n in range(4)]
+                return record
         else:
             def _next(self):
                 while True:
@@ -49,31 +53,197 @@ class FastQParser:
                         return record 
         return _next
     
+    def iter_batches(self, n=100000):
+        """Iterate over blocks of up to n records, returned as FastQBatch
+        objects. The header filter applies as for single records.
+        """
+        while True:
+            records = list(itertools.islice(self, n))
+            if len(records) == 0:
+                return
+            yield FastQBatch(records)
+
     def name(self):
         return self.fname
     
     def rread(self):
         return self._records_read
 
-    def seek(self,offset,whence=None):
+    def seek(self,offset,whence=0):
         self._fh.seek(offset,whence)
         
     def close(self):
         self._fh.close()
 
+class FastQBatch:
+    """A block of fastq records held in one contiguous byte buffer.
+       Line k of the block (record k/4, field k%4) spans
+       buffer[offsets[k]:offsets[k+1]]. The buffer is exposed as a
+       NumPy uint8 array for the vectorized quality kernels."""
+
+    def __init__(self, records):
+        lines = [line for record in records for line in record]
+        lengths = np.fromiter((len(line) for line in lines), dtype=np.int64, count=len(lines))
+        self._data = "".join(lines)
+        self.buffer = np.frombuffer(self._data, dtype=np.uint8)
+        self.offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+
+    def __len__(self):
+        return (len(self.offsets) - 1) // 4
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self.record(i)
+
+    def record(self, i):
+        """Return record i as a list with 4 elements"""
+        o = self.offsets
+        return [self._data[o[k]:o[k+1]] for k in xrange(4*i, 4*i + 4)]
+
+    def field(self, n):
+        """Return start and end offsets of field n (0-3) for all records"""
+        return (self.offsets[n:-1:4], self.offsets[n+1::4])
+
+    def qualities(self):
+        """Return the concatenated quality strings of all records as a
+           uint8 array, together with the start offset of each record
+           in that array and the quality string lengths"""
+        (starts, ends) = self.field(3)
+        lengths = ends - starts
+        pos = np.zeros(len(lengths), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=pos[1:])
+        idx = np.repeat(starts - pos, lengths) + np.arange(lengths.sum(), dtype=np.int64)
+        return (self.buffer[idx], pos, lengths)
+
+    def _quality_sums(self, values):
+        """Per-record sums of values over the quality string"""
+        (starts, ends) = self.field(3)
+        csum = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum(values, out=csum[1:])
+        return (csum[ends] - csum[starts], ends - starts)
+
+def _open_at(file, offset, blocks=None):
+    """Open a plain or BGZF compressed file at an uncompressed offset, returning a line iterator"""
+    if blocks is not None:
+        return BGZFReader(file, *bgzf_seek_offset(blocks, offset))
+    fh = open(file, "rb")
+    fh.seek(offset)
+    return fh
+
+def _chunkable(file):
+    """Return the BGZF block list for BGZF files, an empty list for plain
+       files and None for files that cannot be read from an offset"""
+    if not file.endswith(".gz"):
+        return []
+    if is_bgzf(file):
+        return bgzf_blocks(file)
+    return None
+
+def _record_start(file, offset, blocks=None):
+    """Return the offset of the first record starting at or after offset, 
+       or None if there is none. A record start is a line beginning with '@' 
+       two lines before a line beginning with '+'"""
+    if offset == 0:
+        return 0
+    fh = _open_at(file, offset-1, blocks or None)
+    lines = iter(fh)
+    # Skip the remainder of the line holding offset-1
+    pos = offset - 1 + len(next(lines, ""))
+    window = list(itertools.islice(lines, 3))
+    while len(window) == 3:
+        if window[0].startswith("@") and window[2].startswith("+"):
+            fh.close()
+            return pos
+        pos += len(window.pop(0))
+        window.append(next(lines, None))
+        if window[-1] is None:
+            break
+    fh.close()
+    return None
+
+def fastq_chunks(file, n):
+    """Split a fastq file into at most n record-aligned chunks of similar size. 
+       Plain files are split at byte offsets and BGZF files at block boundaries. 
+       Chunks are returned as (start, end, blocks) tuples, where start and end 
+       are uncompressed offsets (end None for the last chunk) and blocks is 
+       the BGZF block list, or None for plain files. Returns None if the file 
+       cannot be split, i.e. if it is compressed but not with BGZF"""
+    blocks = _chunkable(file)
+    if blocks is None:
+        return None
+    if blocks:
+        offsets = [blocks[len(blocks)*k//n][1] for k in xrange(n)]
+    else:
+        offsets = [os.path.getsize(file)*k//n for k in xrange(n)]
+    starts = sorted(set([x for x in [_record_start(file, o, blocks) for o in offsets] if x is not None]))
+    return [(start, end, blocks or None) for start, end in zip(starts, starts[1:] + [None])]
+
+def _line_offsets(file, every, blocks=None):
+    """Return the offsets of lines 0, every, 2*every, ... by scanning the file"""
+    fh = BGZFReader(file) if blocks else open(file, "rb")
+    data_blocks = fh.blocks() if blocks else iter(lambda: fh.read(4*1024*1024), "")
+    offsets = [0]
+    (pos, nlines, target) = (0, 0, every)
+    for data in data_blocks:
+        start = 0
+        remaining = data.count("\n")
+        while nlines + remaining >= target:
+            i = start - 1
+            for k in xrange(target - nlines):
+                i = data.index("\n", i + 1)
+            offsets.append(pos + i + 1)
+            (nlines, target, start) = (target, target + every, i + 1)
+            remaining = data.count("\n", start)
+        nlines += remaining
+        pos += len(data)
+    fh.close()
+    return offsets
+
+def paired_fastq_chunks(files, n, sample=4096):
+    """Split paired fastq files into at most n chunks holding the same 
+       records from each file. Chunk boundaries are placed at multiples 
+       of <sample> records, found by scanning each file for line breaks. 
+       Returns a list with one list of (start, end, blocks) tuples per 
+       chunk, see fastq_chunks, or None if any file cannot be split"""
+    blocks = [_chunkable(f) for f in files]
+    if any([b is None for b in blocks]):
+        return None
+    offsets = [_line_offsets(f, 4*sample, b) for f, b in zip(files, blocks)]
+    m = min([len(o) for o in offsets])
+    bounds = sorted(set([m*k//n for k in xrange(n)]))
+    chunks = []
+    for j, k in zip(bounds, bounds[1:] + [None]):
+        chunks.append([(o[j], o[k] if k is not None else None, b or None) for o, b in zip(offsets, blocks)])
+    return chunks
+
+def iter_chunk(file, start=0, end=None, blocks=None):
+    """Iterate over the fastq records starting at uncompressed offsets 
+       from start up to, but not including, end, see fastq_chunks"""
+    fh = _open_at(file, start, blocks)
+    lines = iter(fh)
+    pos = start
+    while end is None or pos < end:
+        record = list(itertools.islice(lines, 4))
+        if len(record) < 4:
+            break
+        pos += sum([len(r) for r in record])
+        yield [r.strip() for r in record]
+    fh.close()
+
 class FastQWriter:
     """Writes fastq records, where each record is a list with 4 elements
        corresponding to 1) Header, 2) Nucleotide sequence, 3) Optional header, 
        4) Qualities. If the supplied filename ends with .gz, the output file 
-       will be compressed with gzip"""
+       will be compressed with gzip, using the codec given by codec or 
+       an automatically selected one (see scilifelab.utils.compression)"""
        
-    def __init__(self,file):
+    def __init__(self,file,codec=None,mode="wb"):
         self.fname = file
-        fh = open(file,"wb")
         if file.endswith(".gz"):
-            self._fh = gzip.GzipFile(fileobj=fh)
+            self._fh = open_gzip(file,mode,codec=codec)
         else:    
-            self._fh = fh
+            self._fh = open(file,mode)
         self._records_written = 0
         
     def name(self):
@@ -83,6 +253,11 @@ class FastQWriter:
         self._fh.write("{}\n".format("\n".join([r.strip() for r in record])))
         self._records_written += 1
     
+    def write_block(self,data,n):
+        """Write a block of n already formatted records"""
+        self._fh.write(data)
+        self._records_written += n
+    
     def rwritten(self):
         return self._records_written
     
@@ -139,6 +314,32 @@ def gtQ30(record,offset=33):
             g += 1
     return round(100*float(g)/len(qual),1)
 
+def _round(values, ndigits=1):
+    """Round like round() on each value, so that batch results equal the per-record ones"""
+    return np.array([round(v, ndigits) for v in values.tolist()], dtype=np.float64)
+
+def batch_avgQ(batch, offset=33, rounded=True):
+    """Vectorized avgQ: average quality for each record in a FastQBatch"""
+    (sums, lengths) = batch._quality_sums(batch.buffer)
+    avg = (sums - lengths*offset) / lengths.astype(np.float64)
+    return _round(avg) if rounded else avg
+
+def batch_gtQ30(batch, offset=33, rounded=True):
+    """Vectorized gtQ30: percentage of bases with quality >= 30 for each record in a FastQBatch"""
+    (counts, lengths) = batch._quality_sums(batch.buffer >= 30 + offset)
+    pct = 100*counts.astype(np.float64) / lengths
+    return _round(pct) if rounded else pct
+
+def batch_minQ(batch, offset=33):
+    """Minimum quality for each record in a FastQBatch; -1 for empty quality strings"""
+    (quals, pos, lengths) = batch.qualities()
+    minq = np.empty(len(lengths), dtype=np.int64)
+    minq.fill(-1)
+    nonempty = lengths > 0
+    if nonempty.any():
+        minq[nonempty] = np.minimum.reduceat(quals, pos[nonempty]).astype(np.int64) - offset
+    return minq
+
 def parse_header(header):
     """Parses the FASTQ header as specified by CASAVA 1.8.2 and returns the fields in a dictionary
        @<instrument>:<run number>:<flowcell ID>:<lane>:<tile>:<x-pos>:<y-pos> <read>:<is filtered>:<control number>:<index sequence>
@@ -172,65 +373,12 @@ def is_read_pair(rec1, rec2, casava18=True):
     r2 = rec2[0].split(' ')
     return (len(r1) == 2 and len(r2) == 2 and r1[0] == r2[0] and r1[1][1:] == r2[1][1:])
 
-def demultiplex_fastq(outdir, samplesheet, fastq1, fastq2=None):
+def demultiplex_fastq(outdir, samplesheet, fastq1, fastq2=None, max_mismatches=0, processes=1):
     """Demultiplex a bcl-converted illumina fastq file. Assumes it has the index sequence
-    in the header a la CASAVA 1.8+
+    in the header a la CASAVA 1.8+. See scilifelab.utils.demultiplex.demultiplex_casava
     """
-    outfiles = {}
-    counts = {}
-    sdata = HiSeqRun.parse_samplesheet(samplesheet)
-    reads = [1]
-    if fastq2 is not None:
-        reads.append(2)
-        
-    # For each Lane-Index combination, create a file and open a filehandle
-    for sd in sdata:
-        lane = sd['Lane']
-        index = sd['Index']
-        if lane not in outfiles:
-            outfiles[lane] = {}
-            counts[lane] = {}
-        outfiles[lane][index] = []
-        counts[lane][index] = 0
-        for read in reads:
-            fname = "tmp_{}_{}_L00{}_R{}_001.fastq.gz".format(sd['SampleID'],
-                                                              index,
-                                                              lane,
-                                                              read)
-            outfiles[lane][index].append(FastQWriter(os.path.join(outdir,fname)))
-    
-    # Parse the input file(s) and write the records to the appropriate output files
-    fhs = [FastQParser(fastq1)]
-    if fastq2 is not None:
-        fhs.append(FastQParser(fastq2))
-        
-    for r, fh in enumerate(fhs):
-        for record in fh:
-            header = parse_header(record[0])
-            lane = str(header['lane'])
-            index = header['index']
-            if lane in outfiles and index in outfiles[lane]:
-                outfiles[lane][index][r].write(record)
-                counts[lane][index] += 1
-    
-    # Close filehandles and replace the handles with the file names
-    for lane in outfiles.keys():
-        for index in outfiles[lane].keys():
-            for r, fh in enumerate(outfiles[lane][index]):
-                fh.close()
-                fname = fh.name()
-                # If no sequences were written, remove the temporary file and the entry from the results
-                if counts[lane][index] == 0:
-                    os.unlink(fname)
-                    del outfiles[lane][index]
-                    break
-                
-                # Rename the temporary file to a persistent name
-                nname = fname.replace("tmp_","")
-                os.rename(fname,nname)
-                outfiles[lane][index][r] = nname
-    
-    return outfiles
+    from scilifelab.utils.demultiplex import demultiplex_casava
+    return demultiplex_casava(outdir, samplesheet, fastq1, fastq2, max_mismatches=max_mismatches, processes=processes)
 
   
 def create_final_name(fname, date, fc_id, sample_name):
@@ -2,6 +2,9 @@
 import httplib
 import urlparse
 
+# Cache of server status codes, so that each url is probed once per process
+_STATUS_CODES = {}
+
 ## From http://pythonadventures.wordpress.com/2010/10/17/check-if-url-exists/
 def get_server_status_code(url):
     """
@@ -16,10 +19,13 @@ def get_server_status_code(url):
     except StandardError:
         return None
 
-def check_url(url):
+def check_url(url, cache=True):
     """
     Check if a URL exists without downloading the whole file.
-    We only check the URL header.
+    We only check the URL header. Unless cache is False, the
+    result is cached for the lifetime of the process.
     """
     good_codes = [httplib.OK, httplib.FOUND, httplib.MOVED_PERMANENTLY]
-    return get_server_status_code(url) in good_codes
+    if not cache or url not in _STATUS_CODES:
+        _STATUS_CODES[url] = get_server_status_code(url)
+    return _STATUS_CODES[url] in good_codes
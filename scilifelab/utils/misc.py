@@ -4,11 +4,12 @@ import os
 import re
 import contextlib
 import itertools
-import hashlib
 import scilifelab.log
 import collections
 
 from subprocess import check_output
+from multiprocessing.pool import ThreadPool
+from scilifelab.utils.checksum import checksum
 
 LOG = scilifelab.log.minimal_logger(__name__)
 
@@ -74,6 +75,106 @@ def query_ok(statement="", force=False):
         else:
             sys.stdout.write("Please respond with <enter>")
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+def scan_dir(path):
+    """List a directory, using the file types cached by scandir where
+    available.
+
+    :param path: directory
+
+    :returns: tuple of subdirectory names, file names and names of
+      subdirectories to descend into, i.e. that are not symlinks
+    """
+    dirs, files, descend = [], [], []
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                dirs.append(entry.name)
+                if not entry.is_symlink():
+                    descend.append(entry.name)
+            else:
+                files.append(entry.name)
+    else:
+        for name in os.listdir(path):
+            fullname = os.path.join(path, name)
+            if os.path.isdir(fullname):
+                dirs.append(name)
+                if not os.path.islink(fullname):
+                    descend.append(name)
+            else:
+                files.append(name)
+    return dirs, files, descend
+
+class DirFilter(object):
+    """Directory restrictions of filtered_walk, compiled once.
+
+    A directory is selected if a path component is in include_dirs, or
+    if the include_dirs joined as a regular expression match its path,
+    and if neither holds for exclude_dirs. Excluded directories are
+    pruned from the walk, unless the exclude_dirs pattern is anchored
+    in a way that could still select a subdirectory.
+
+    :param include_dirs: Only select these directories (list)
+    :param exclude_dirs: Exclude these directories (list)
+    """
+    def __init__(self, include_dirs=None, exclude_dirs=None):
+        self.include = set(include_dirs or [])
+        self.include_re = re.compile("|".join(include_dirs)) if include_dirs else None
+        self.exclude = set(exclude_dirs or [])
+        self.exclude_re = re.compile("|".join(exclude_dirs)) if exclude_dirs else None
+        self.prune_re = self.exclude_re is not None and not re.search(r"\$|\\Z|\(\?<?[=!]", self.exclude_re.pattern)
+
+    def excluded(self, path):
+        if not self.exclude_re:
+            return False
+        return not self.exclude.isdisjoint(path.split(os.sep)) or self.exclude_re.search(path) is not None
+
+    def prunes(self, path):
+        """Return True if path and everything below it is excluded"""
+        if not self.exclude_re:
+            return False
+        if not self.exclude.isdisjoint(path.split(os.sep)):
+            return True
+        return self.prune_re and self.exclude_re.search(path) is not None
+
+    def selects(self, path):
+        """Return True if the contents of path should be listed"""
+        if self.include_re and self.include.isdisjoint(path.split(os.sep)) and not self.include_re.search(path):
+            return False
+        return not self.excluded(path)
+
+def _walk_tree(top, dir_filter):
+    """Top-down directory walk, like os.walk, that does not descend into
+    or list directories pruned by dir_filter.
+
+    :param top: Root directory
+    :param dir_filter: DirFilter
+
+    :returns: generator of (root, dirs, files) tuples
+    """
+    stack = [top]
+    while stack:
+        root = stack.pop()
+        try:
+            dirs, files, descend = scan_dir(root)
+        except OSError:
+            continue
+        dirs = [x for x in dirs if not dir_filter.prunes(os.path.join(root, x))]
+        yield root, dirs, files
+        kept = set(dirs)
+        stack.extend(reversed([os.path.join(root, x) for x in descend if x in kept]))
+
 def walk(rootdir):
     """
     Perform a directory walk
@@ -82,40 +183,67 @@ def walk(rootdir):
 
     :returns: List of files
     """
-    flist = []
-    for root, dirs, files in os.walk(rootdir):
-        flist = flist + [os.path.join(root, x) for x in files]
-    return flist
+    return [os.path.join(root, x) for root, dirs, files in _walk_tree(rootdir, DirFilter()) for x in files]
+
+def iter_filtered_walk(rootdir, filter_fn, include_dirs=None, exclude_dirs=None, get_dirs=False, threads=1):
+    """Perform a filtered directory walk, yielding paths as they are
+    found. See filtered_walk.
+
+    :param rootdir: Root directory
+    :param filter_fn: Filtering function on file names that returns boolean
+    :param include_dirs: Only list the contents of these directories (list)
+    :param exclude_dirs: Exclude these directories (list)
+    :param get_dirs: Yield directories instead of files
+    :param threads: Walk the top-level subdirectories of rootdir
+      concurrently in this many threads. Helps on network file systems.
 
-def filtered_walk(rootdir, filter_fn, include_dirs=None, exclude_dirs=None, get_dirs=False):
+    :returns: Generator of filtered paths
+    """
+    dir_filter = DirFilter(include_dirs, exclude_dirs)
+    def _paths(root, dirs, files):
+        if not dir_filter.selects(root):
+            return []
+        if get_dirs:
+            return [os.path.join(root, x) for x in dirs]
+        return [os.path.join(root, x) for x in files if filter_fn(x)]
+    if threads <= 1:
+        for root, dirs, files in _walk_tree(rootdir, dir_filter):
+            for path in _paths(root, dirs, files):
+                yield path
+        return
+    try:
+        dirs, files, descend = scan_dir(rootdir)
+    except OSError:
+        return
+    dirs = [x for x in dirs if not dir_filter.prunes(os.path.join(rootdir, x))]
+    for path in _paths(rootdir, dirs, files):
+        yield path
+    kept = set(dirs)
+    subdirs = [os.path.join(rootdir, x) for x in descend if x in kept]
+    def _subtree(top):
+        return [path for root, dirs, files in _walk_tree(top, dir_filter) for path in _paths(root, dirs, files)]
+    pool = ThreadPool(min(threads, max(1, len(subdirs))))
+    try:
+        for paths in pool.imap(_subtree, subdirs):
+            for path in paths:
+                yield path
+    finally:
+        pool.close()
+        pool.join()
+
+def filtered_walk(rootdir, filter_fn, include_dirs=None, exclude_dirs=None, get_dirs=False, threads=1):
     """Perform a filtered directory walk.
 
     :param rootdir: Root directory
     :param filter_fn: Filtering function that returns boolean
     :param include_dirs: Only traverse these directories (list)
     :param exclude_dirs: Exclude these directories (list)
+    :param get_dirs: Return directories instead of files
+    :param threads: Number of threads to walk top-level subdirectories in
 
     :returns: Filtered file list
     """
-    flist = []
-    dlist = []
-    for root, dirs, files in os.walk(rootdir):
-        if include_dirs and len(set(root.split(os.sep)).intersection(set(include_dirs))) == 0:
-            ## Also try re.search in case we have patterns
-            if re.search("|".join(include_dirs), root):
-                pass
-            else:
-                continue
-        if exclude_dirs and len(set(root.split(os.sep)).intersection(set(exclude_dirs))) > 0:
-            continue
-        if exclude_dirs and re.search("|".join(exclude_dirs), root):
-            continue
-        dlist = dlist + [os.path.join(root, x) for x in dirs]
-        flist = flist + [os.path.join(root, x) for x in filter(filter_fn, files)]
-    if get_dirs:
-        return dlist
-    else:
-        return flist
+    return list(iter_filtered_walk(rootdir, filter_fn, include_dirs, exclude_dirs, get_dirs, threads))
 
 def filtered_output(pattern, data):
     """
@@ -200,15 +328,15 @@ def prune_option_list(opts, keys):
             del opt_d[k]
     return [k for item in opt_d.iteritems() for k in item]
 
-def md5sum(infile):
-    """Calculate the md5sum of a file
+def md5sum(infile, cached=True):
+    """Calculate the md5sum of a file. The checksum is cached (see
+    scilifelab.utils.checksum), and only recalculated if the file has
+    changed since.
+
+    :param infile: file name
+    :param cached: use a cached checksum; if False, always read the file
     """
-    # Implementation taken from: http://stackoverflow.com/a/4213255
-    md5 = hashlib.md5()
-    with open(infile,'rb') as f:
-        for chunk in iter(lambda: f.read(128*md5.block_size), b''):
-            md5.update(chunk)
-    return md5.hexdigest()
+    return checksum(infile, cached).md5
 
 def soft_update(a, b):
     """Do a "soft" update of two dictionaries, meaning that the entries for
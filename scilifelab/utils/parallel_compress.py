@@ -0,0 +1,146 @@
+"""Compress and decompress files in parallel on the local node.
+
+Files are scheduled on a bounded pool of compressor processes, largest
+first, so that the longest jobs do not start last. Multithreaded
+compressors (pigz, pbzip2) are given a number of threads per job, and
+the number of concurrent jobs is the core budget divided by the threads
+per job.
+
+Each job writes to a temporary file next to its output, tests the
+output, and renames it into place only if the compressor and the test
+succeeded. The input file is then removed, as gzip and bzip2 do.
+"""
+import os
+import time
+import shutil
+import subprocess
+import multiprocessing
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+from scilifelab.log import minimal_logger
+
+LOG = minimal_logger(__name__)
+
+# Suffix of output files being written
+TMP_SUFFIX = ".pm-tmp"
+
+# Output suffix, and whether the program is multithreaded, per program
+PROGRAMS = {
+    "gzip": (".gz", False),
+    "pigz": (".gz", True),
+    "bzip2": (".bz2", False),
+    "pbzip2": (".bz2", True),
+    }
+
+CompressResult = namedtuple("CompressResult", ["src", "dst", "in_size", "out_size", "elapsed", "error"])
+
+def _program_args(prog, threads):
+    args = [prog]
+    if PROGRAMS[prog][1]:
+        args += ["-p{}".format(threads)]
+    return args
+
+def output_name(fname, prog="gzip", decompress=False):
+    """Get the output file name of compressing or decompressing a file.
+
+    :param fname: input file name
+    :param prog: compression program
+    :param decompress: decompress instead of compress
+
+    :returns: output file name, or None if a file to decompress lacks the suffix of prog
+    """
+    suffix = PROGRAMS[prog][0]
+    if not decompress:
+        return fname + suffix
+    if not fname.endswith(suffix):
+        return None
+    return fname[0:-len(suffix)]
+
+def compress_file(fname, prog="gzip", decompress=False, threads=1, verify=True):
+    """Compress or decompress a file, atomically.
+
+    :param fname: input file name
+    :param prog: compression program, one of PROGRAMS
+    :param decompress: decompress instead of compress
+    :param threads: number of threads for multithreaded programs
+    :param verify: test the compressed output before replacing the input
+
+    :returns: CompressResult
+    """
+    t0 = time.time()
+    dst = output_name(fname, prog, decompress)
+    if dst is None:
+        return CompressResult(fname, None, 0, 0, 0.0, "no {} suffix".format(PROGRAMS[prog][0]))
+    if os.path.exists(dst):
+        return CompressResult(fname, dst, 0, 0, 0.0, "{} already exists".format(dst))
+    tmp = dst + TMP_SUFFIX
+    args = _program_args(prog, threads) + (["-dc"] if decompress else ["-c"]) + [fname]
+    try:
+        in_size = os.path.getsize(fname)
+        with open(tmp, "wb") as fh:
+            proc = subprocess.Popen(args, stdout=fh, stderr=subprocess.PIPE)
+            (_, stderr) = proc.communicate()
+        if proc.returncode:
+            raise RuntimeError("{} failed with return code {}: {}".format(" ".join(args), proc.returncode, stderr.strip()))
+        if verify and not decompress:
+            test = _program_args(prog, threads) + ["-t", tmp]
+            proc = subprocess.Popen(test, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            (_, stderr) = proc.communicate()
+            if proc.returncode:
+                raise RuntimeError("{} failed with return code {}: {}".format(" ".join(test), proc.returncode, stderr.strip()))
+        shutil.copystat(fname, tmp)
+        os.rename(tmp, dst)
+        os.unlink(fname)
+    except (IOError, OSError, RuntimeError) as e:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        return CompressResult(fname, dst, 0, 0, time.time() - t0, str(e))
+    return CompressResult(fname, dst, in_size, os.path.getsize(dst), time.time() - t0, None)
+
+def compress_files(flist, prog="gzip", decompress=False, cores=None, job_threads=None, verify=True):
+    """Compress or decompress files on a pool of parallel jobs, largest
+    first. Logs the throughput of each file, counted on the
+    uncompressed size, and of all files.
+
+    :param flist: input file names
+    :param prog: compression program, one of PROGRAMS
+    :param decompress: decompress instead of compress
+    :param cores: number of cores to use; defaults to all
+    :param job_threads: threads per job for multithreaded programs; defaults to 4
+    :param verify: test compressed output before replacing the input
+
+    :returns: list of CompressResult, in order of completion
+    """
+    if prog not in PROGRAMS:
+        raise ValueError("unsupported compression program '{}'; must be one of {}".format(prog, ", ".join(sorted(PROGRAMS.keys()))))
+    cores = cores or multiprocessing.cpu_count()
+    threads = 1
+    if PROGRAMS[prog][1]:
+        threads = max(1, min(job_threads or 4, cores))
+    jobs = max(1, min(cores // threads, len(flist)))
+    flist = sorted(flist, key=lambda f: os.path.getsize(f) if os.path.exists(f) else 0, reverse=True)
+    LOG.info("{}ing {} files with {} jobs of {} {} thread(s)".format("decompress" if decompress else "compress", len(flist), jobs, prog, threads))
+    def _run(fname):
+        return compress_file(fname, prog, decompress, threads, verify)
+    results = []
+    t0 = time.time()
+    pool = ThreadPool(jobs)
+    try:
+        for res in pool.imap_unordered(_run, flist):
+            if res.error:
+                LOG.warn("{}: FAILED: {}".format(res.src, res.error))
+            else:
+                size = res.out_size if decompress else res.in_size
+                LOG.info("{} -> {}: {:.1f} MB in {:.1f} s, {:.1f} MB/s".format(res.src, res.dst, size / 1e6, res.elapsed,
+                                                                           size / 1e6 / res.elapsed if res.elapsed > 0 else 0.0))
+            results.append(res)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - t0
+    total = sum(r.out_size if decompress else r.in_size for r in results if not r.error)
+    LOG.info("{} files, {:.1f} MB in {:.1f} s, {:.1f} MB/s; {} failed".format(len(results), total / 1e6, elapsed,
+                                                                         total / 1e6 / elapsed if elapsed > 0 else 0.0,
+                                                                         len([r for r in results if r.error])))
+    return results
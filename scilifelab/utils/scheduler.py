@@ -0,0 +1,218 @@
+"""Job scheduler backends for distributed commands.
+
+A backend submits jobs described by job template dictionaries, whose
+keys are attribute names of a drmaa job template (remoteCommand, args,
+jobName, outputPath, errorPath, workingDirectory, nativeSpecification
+and email), and reports job states as the strings of drmaa.JobState.
+The backends are
+
+  drmaa - a drmaa session, initialized on first use and kept open
+          for the lifetime of the process
+  fake  - a local stand-in for a scheduler, which records submissions
+          and optionally runs the jobs synchronously
+
+There is one backend instance per process, as returned by get_backend.
+The backend is drmaa unless overridden with the environment variable
+PM_DISTRIBUTED_BACKEND.
+"""
+import os
+import atexit
+import itertools
+import subprocess
+try:
+    import drmaa
+except:
+    pass
+
+## Placeholder for the task index of an array job in the working
+## directory and paths of a job template (drmaa.JobTemplate.PARAMETRIC_INDEX)
+PARAMETRIC_INDEX = "$drmaa_incr_ph$"
+
+## Job states, as the values of drmaa.JobState
+UNDETERMINED = 'undetermined'
+QUEUED_ACTIVE = 'queued_active'
+SYSTEM_ON_HOLD = 'system_on_hold'
+USER_ON_HOLD = 'user_on_hold'
+USER_SYSTEM_ON_HOLD = 'user_system_on_hold'
+RUNNING = 'running'
+SYSTEM_SUSPENDED = 'system_suspended'
+USER_SUSPENDED = 'user_suspended'
+DONE = 'done'
+FAILED = 'failed'
+
+## http://code.google.com/p/drmaa-python/wiki/Tutorial
+DECODE_STATUS = {
+    UNDETERMINED: 'process status cannot be determined',
+    QUEUED_ACTIVE: 'job is queued and active',
+    SYSTEM_ON_HOLD: 'job is queued and in system hold',
+    USER_ON_HOLD: 'job is queued and in user hold',
+    USER_SYSTEM_ON_HOLD: 'job is queued and in user and system hold',
+    RUNNING: 'job is running',
+    SYSTEM_SUSPENDED: 'job is system suspended',
+    USER_SUSPENDED: 'job is user suspended',
+    DONE: 'job finished normally',
+    FAILED: 'job finished, but failed',
+    }
+
+## States of jobs that have to be terminated before they are rerun
+ACTIVE_STATES = [QUEUED_ACTIVE, RUNNING, UNDETERMINED]
+
+class DrmaaBackend(object):
+    """Backend submitting jobs through one drmaa session"""
+    label = 'drmaa'
+
+    def __init__(self):
+        self._session = None
+
+    @property
+    def session(self):
+        """The drmaa session, initialized on first use"""
+        if self._session is None:
+            self._session = drmaa.Session()
+            self._session.initialize()
+            atexit.register(self.exit)
+        return self._session
+
+    def _submit(self, template, run):
+        jt = self.session.createJobTemplate()
+        try:
+            for k, v in template.iteritems():
+                setattr(jt, k, v)
+            return run(jt)
+        finally:
+            self.session.deleteJobTemplate(jt)
+
+    def run_job(self, template):
+        """Submit a job.
+
+        :param template: job template dictionary
+
+        :returns: jobid
+        """
+        return self._submit(template, self.session.runJob)
+
+    def run_array(self, template, n):
+        """Submit an array of n jobs, the template of task i having
+        PARAMETRIC_INDEX replaced by i, for i in 1..n.
+
+        :param template: job template dictionary
+        :param n: number of tasks
+
+        :returns: list of jobids of the tasks
+        """
+        return list(self._submit(template, lambda jt: self.session.runBulkJobs(jt, 1, n, 1)))
+
+    def job_status(self, jobids):
+        """Get the states of jobs. One synchronize call over all jobs
+        returns without waiting if they have all finished, in which
+        case their states are read from the job information the session
+        then holds. Otherwise, as for jobs of other sessions, the states
+        are queried job by job.
+
+        :param jobids: jobids
+
+        :returns: dictionary of jobid to state, None for unknown jobs
+        """
+        jobids = [str(jobid) for jobid in jobids]
+        if not jobids:
+            return {}
+        try:
+            self.session.synchronize(jobids, drmaa.Session.TIMEOUT_NO_WAIT, False)
+        except (drmaa.errors.ExitTimeoutException, drmaa.errors.InternalException, drmaa.errors.InvalidJobException):
+            return self._poll(jobids)
+        status = {}
+        for jobid in jobids:
+            info = self.session.wait(jobid, drmaa.Session.TIMEOUT_NO_WAIT)
+            status[jobid] = DONE if info.hasExited and info.exitStatus == 0 else FAILED
+        return status
+
+    def _poll(self, jobids):
+        status = {}
+        for jobid in jobids:
+            try:
+                status[jobid] = self.session.jobStatus(jobid)
+            except (drmaa.errors.InternalException, drmaa.errors.InvalidJobException):
+                status[jobid] = None
+        return status
+
+    def exit(self):
+        """Exit the drmaa session"""
+        if self._session is not None:
+            self._session.exit()
+            self._session = None
+
+class FakeBackend(object):
+    """Local stand-in for a scheduler. Jobs get consecutive jobids and
+    stay queued, unless execute is set, in which case they are run
+    synchronously in their working directory and are done or failed
+    when submission returns. Submissions and status queries are
+    counted in submissions and status_queries."""
+    label = 'fake'
+
+    def __init__(self, execute=False):
+        self.execute = execute
+        self.jobs = {}
+        self.status = {}
+        self.submissions = 0
+        self.status_queries = 0
+        self._ids = itertools.count(1)
+
+    def _run(self, template):
+        def open_path(p):
+            p = (p or "").lstrip(":")
+            return open(p, "a") if p else open(os.devnull, "w")
+        with open_path(template.get('outputPath')) as out:
+            with open_path(template.get('errorPath')) as err:
+                returncode = subprocess.call([template['remoteCommand']] + list(template.get('args', [])),
+                                             cwd=template.get('workingDirectory'), stdout=out, stderr=err)
+        return DONE if returncode == 0 else FAILED
+
+    def _add(self, jobid, template):
+        self.jobs[jobid] = template
+        self.status[jobid] = self._run(template) if self.execute else QUEUED_ACTIVE
+        return jobid
+
+    def run_job(self, template):
+        self.submissions += 1
+        return self._add(str(next(self._ids)), template)
+
+    def run_array(self, template, n):
+        self.submissions += 1
+        arrayid = next(self._ids)
+        jobids = []
+        for i in range(1, n + 1):
+            task = dict((k, v.replace(PARAMETRIC_INDEX, str(i)) if isinstance(v, basestring) else v)
+                        for k, v in template.iteritems())
+            jobids.append(self._add("{}.{}".format(arrayid, i), task))
+        return jobids
+
+    def job_status(self, jobids):
+        self.status_queries += 1
+        return dict((jobid, self.status.get(str(jobid))) for jobid in jobids)
+
+    def exit(self):
+        pass
+
+BACKENDS = {DrmaaBackend.label: DrmaaBackend, FakeBackend.label: FakeBackend}
+
+_instances = {}
+
+def get_backend(label=None):
+    """Get the backend instance of this process.
+
+    :param label: backend label, by default $PM_DISTRIBUTED_BACKEND or drmaa
+
+    :returns: backend instance
+    """
+    label = label or os.getenv("PM_DISTRIBUTED_BACKEND", DrmaaBackend.label)
+    if label not in BACKENDS:
+        raise ValueError("unknown distributed backend '{}'; must be one of {}".format(label, ", ".join(sorted(BACKENDS.keys()))))
+    if label not in _instances:
+        _instances[label] = BACKENDS[label]()
+    return _instances[label]
+
+def reset_backends():
+    """Exit and discard the backend instances of this process"""
+    for backend in _instances.values():
+        backend.exit()
+    _instances.clear()
@@ -3,10 +3,8 @@
 
 import subprocess
 import getpass
-try:
-    import drmaa
-except:
-    pass
+
+from scilifelab.utils.scheduler import get_backend
 
 def get_slurm_jobid(jobname,user=getpass.getuser()):
     """Attempt to get the job id for a slurm job name. Can this be done with python-drmaa instead?
@@ -24,9 +22,5 @@ def get_slurm_jobid(jobname,user=getpass.getuser()):
 def get_slurm_jobstatus(jobid):
     """Get the status for a jobid
     """
-    s = drmaa.Session()
-    s.initialize()
-    status = s.jobStatus(str(jobid))
-    s.exit()
-    return status
+    return get_backend().job_status([str(jobid)])[str(jobid)]
     
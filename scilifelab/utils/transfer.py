@@ -0,0 +1,182 @@
+"""Verified, resumable file transfers.
+
+Each file is copied to a temporary name next to its destination while
+the checksums of the source are computed from the data being copied, so
+that the source is read once. The copy is then read back and verified
+against the source checksums, and renamed into place if they match.
+Files are transferred and verified concurrently on a thread pool.
+
+Completed files are recorded in a manifest, one JSON object per line. A
+file recorded in the manifest, whose source is unchanged and whose
+destination still exists with the same size, is not transferred again,
+so that an interrupted delivery can be resumed without rehashing the
+files that were already delivered.
+"""
+import os
+import json
+import time
+import threading
+from multiprocessing.pool import ThreadPool
+
+from scilifelab.log import minimal_logger
+from scilifelab.utils.checksum import get_cache, compute
+
+LOG = minimal_logger(__name__)
+
+# Suffix of files being transferred
+PARTIAL_SUFFIX = ".part"
+
+class TransferManifest(object):
+    """Record of completed file transfers, in a file with one JSON
+    object per line.
+
+    :param path: manifest file name, or None to keep no record
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as fh:
+                for line in fh:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        ## Partially written last line of an interrupted run
+                        continue
+                    self.entries[entry["src"]] = entry
+
+    def get(self, src, dst):
+        """Get the manifest entry of a transfer, if it is still valid.
+
+        :param src: source file name
+        :param dst: destination file name
+
+        :returns: entry dictionary, or None
+        """
+        entry = self.entries.get(src)
+        if entry is None or entry["dst"] != dst:
+            return None
+        try:
+            st = os.stat(src)
+            dst_size = os.path.getsize(dst)
+        except OSError:
+            return None
+        if st.st_size != entry["size"] or st.st_mtime != entry["mtime"] or dst_size != entry["size"]:
+            return None
+        return entry
+
+    def add(self, src, dst, checksums, st):
+        """Record a completed transfer.
+
+        :param src: source file name
+        :param dst: destination file name
+        :param checksums: Checksums of the file
+        :param st: os.stat of the source
+        """
+        entry = {"src": src, "dst": dst, "md5": checksums.md5, "adler32": checksums.adler32,
+                 "size": st.st_size, "mtime": st.st_mtime}
+        with self._lock:
+            self.entries[src] = entry
+            if self.path:
+                with open(self.path, "a") as fh:
+                    fh.write(json.dumps(entry) + "\n")
+        return entry
+
+class TransferResult(object):
+    """Outcome of the transfer of one file"""
+    def __init__(self, src, dst, md5=None, size=0, passed=False, skipped=False, error=None):
+        self.src = src
+        self.dst = dst
+        self.md5 = md5
+        self.size = size
+        self.passed = passed
+        self.skipped = skipped
+        self.error = error
+
+    def __repr__(self):
+        return "<TransferResult {} -> {}: {}>".format(self.src, self.dst, "OK" if self.passed else "FAILED")
+
+def transfer_file(src, dst, manifest=None, cache=None, verify=True):
+    """Copy a file, verifying the copy against the checksums of the
+    source computed while copying.
+
+    :param src: source file name
+    :param dst: destination file name
+    :param manifest: TransferManifest of completed transfers
+    :param cache: ChecksumCache; defaults to the cache of this process
+    :param verify: read back and verify the copy
+
+    :returns: TransferResult
+    """
+    manifest = manifest or TransferManifest()
+    cache = cache or get_cache()
+    entry = manifest.get(src, dst)
+    if entry:
+        LOG.debug("{} already transferred to {}, skipping".format(src, dst))
+        return TransferResult(src, dst, entry["md5"], entry["size"], passed=True, skipped=True)
+    tmp = dst + PARTIAL_SUFFIX
+    try:
+        if not os.path.exists(os.path.dirname(dst)):
+            try:
+                os.makedirs(os.path.dirname(dst))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(dst)):
+                    raise
+        st = os.stat(src)
+        checksums = cache.copy(src, tmp)
+        if verify:
+            dst_checksums = compute(tmp)
+            if dst_checksums.md5 != checksums.md5:
+                LOG.warn("md5sum verification FAILED for {}. Source: {}, Target: {}".format(dst, checksums.md5, dst_checksums.md5))
+                os.unlink(tmp)
+                return TransferResult(src, dst, checksums.md5, checksums.size, error="md5sum mismatch")
+        os.rename(tmp, dst)
+    except (IOError, OSError) as e:
+        LOG.warn("Transfer of {} to {} failed: {}".format(src, dst, e))
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        return TransferResult(src, dst, error=str(e))
+    manifest.add(src, dst, checksums, st)
+    return TransferResult(src, dst, checksums.md5, checksums.size, passed=True)
+
+def transfer_files(sources, targets, manifest=None, threads=4, verify=True, cache=None):
+    """Transfer and verify many files concurrently, see transfer_file.
+    Larger files are started first. Logs the throughput of the files
+    actually transferred.
+
+    :param sources: source file names
+    :param targets: destination file names
+    :param manifest: TransferManifest, or manifest file name
+    :param threads: number of files to transfer at a time
+    :param verify: read back and verify the copies
+    :param cache: ChecksumCache
+
+    :returns: list of TransferResult, in the order of sources
+    """
+    if not isinstance(manifest, TransferManifest):
+        manifest = TransferManifest(manifest)
+    pairs = list(zip(sources, targets))
+    if not pairs:
+        return []
+    order = sorted(range(len(pairs)), key=lambda i: -os.path.getsize(pairs[i][0]) if os.path.exists(pairs[i][0]) else 0)
+    def _transfer(i):
+        return transfer_file(pairs[i][0], pairs[i][1], manifest, cache, verify)
+    t0 = time.time()
+    if threads <= 1 or len(pairs) < 2:
+        results = [_transfer(i) for i in order]
+    else:
+        pool = ThreadPool(min(threads, len(pairs)))
+        try:
+            results = pool.map(_transfer, order, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - t0
+    transferred = sum(r.size for r in results if r.passed and not r.skipped)
+    LOG.info("Transferred {} files ({:.2f} GB) in {:.1f} s, {:.3f} GB/s; {} already transferred, {} failed".format(
+        len([r for r in results if r.passed and not r.skipped]), transferred / 1e9, elapsed,
+        transferred / 1e9 / elapsed if elapsed > 0 else 0.0,
+        len([r for r in results if r.skipped]), len([r for r in results if not r.passed])))
+    by_index = dict(zip(order, results))
+    return [by_index[i] for i in range(len(pairs))]
@@ -34,7 +34,7 @@ def print_average_quals(qualities):
         avg_quality.insert(0,bin)
         print ",".join([str(i) for i in avg_quality])
         
-def process_fastq(fastq_r1, fastq_r2, bins, phred_offset, casava17):
+def process_fastq(fastq_r1, fastq_r2, bins, phred_offset, casava17, batch_size=100000):
     
     fh_r1 = fastq_utils.FastQParser(fastq_r1)
     fh_r2 = fastq_utils.FastQParser(fastq_r2)
@@ -46,16 +46,24 @@ def process_fastq(fastq_r1, fastq_r2, bins, phred_offset, casava17):
         oh1[b] = fastq_utils.FastQWriter("%s.Q%d%s" % (root1,b,ext1))
         oh2[b] = fastq_utils.FastQWriter("%s.Q%d%s" % (root2,b,ext2))
     
-    for r1 in fh_r1:
-        r2 = fh_r2.next()
-        assert fastq_utils.is_read_pair(r1,r2,not casava17), "FATAL: Read identifiers differ for paired reads ({:s} and {:s})".format(r1[0],r2[0])
+    # Average qualities are computed for a block of read pairs at a time
+    batches2 = fh_r2.iter_batches(batch_size)
+    for batch1 in fh_r1.iter_batches(batch_size):
+        batch2 = batches2.next()
+        assert len(batch1) == len(batch2), "FATAL: Different number of reads in {:s} and {:s}".format(fastq_r1,fastq_r2)
+        avg1 = fastq_utils.batch_avgQ(batch1,phred_offset)
+        avg2 = fastq_utils.batch_avgQ(batch2,phred_offset)
+        for i, (q1, q2) in enumerate(zip(avg1.tolist(),avg2.tolist())):
+            r1 = batch1.record(i)
+            r2 = batch2.record(i)
+            assert fastq_utils.is_read_pair(r1,r2,not casava17), "FATAL: Read identifiers differ for paired reads ({:s} and {:s})".format(r1[0],r2[0])
 
-        bin = min(int(round(fastq_utils.avgQ(r1,phred_offset))),int(round(fastq_utils.avgQ(r2,phred_offset))))
+            bin = min(int(round(q1)),int(round(q2)))
         
-        for b in bins:
-            if bin >= b:
-                oh1[b].write(r1)
-                oh2[b].write(r2)
+            for b in bins:
+                if bin >= b:
+                    oh1[b].write(r1)
+                    oh2[b].write(r2)
         
     for oh in oh1.values() + oh2.values():
         oh.close()
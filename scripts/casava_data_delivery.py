@@ -11,7 +11,7 @@ from datetime import datetime
 import argparse
 import stat
 from subprocess import check_call, CalledProcessError
-from scilifelab.utils.misc import filtered_walk, query_yes_no, touch_file
+from scilifelab.utils.misc import iter_filtered_walk, query_yes_no, touch_file
 from scilifelab.utils.timestamp import utc_time
 
 def fixProjName(pname):
@@ -72,7 +72,7 @@ def create_final_name(fname, date, fc_id, sample_name):
       
 def get_file_copy_list(proj_base_dir, dest_proj_path, fcid, deliver_all_fcs, deliver_nophix, skip_list):
     to_copy = []
-    for fqfile in filtered_walk(proj_base_dir, 
+    for fqfile in iter_filtered_walk(proj_base_dir, 
                                 is_fastq, 
                                 include_dirs=[fcid] if not deliver_all_fcs else None, 
                                 exclude_dirs=skip_list):
@@ -1,9 +1,10 @@
 import os
+import re
 import tempfile
 import shutil
 import unittest
 from ..data import data_files
-from scilifelab.bcbio.qc import RunInfoParser
+from scilifelab.bcbio.qc import RunInfoParser, FileCatalog, SampleRunMetricsParser, RunMetricsParser
 
 filedir = os.path.abspath(os.path.realpath(os.path.dirname(__file__)))
 
@@ -28,3 +29,33 @@ class TestBcbioQC(unittest.TestCase):
         self.assertEqual(res["Instrument"], "SN0002")
         self.assertEqual(res["Date"], "120924")
 
+
+    def test_file_catalog(self):
+        """Test that catalog lookups give the same files as regex scans"""
+        files = ["1_120924_AC003CCCXX_nophix_1-sort-dup.align_metrics",
+                 "1_120924_AC003CCCXX_nophix_2-sort-dup.align_metrics",
+                 "2_120924_AC003CCCXX_nophix_1-sort-dup.dup_metrics",
+                 "2_120924_AC003CCCXX_nophix_1_1_screen.txt",
+                 "1_120924_AC003CCCXX_nophix.bc_metrics",
+                 "fastqc/1_120924_AC003CCCXX_nophix_1-sort-dup_fastqc/fastqc_data.txt",
+                 "01_align.txt",
+                 "bcbb_software_versions.txt",
+                 "tmp/1_120924_AC003CCCXX_nophix_1-sort-dup.align_metrics"]
+        for f in files:
+            fn = os.path.join(self.rootdir, f)
+            if not os.path.exists(os.path.dirname(fn)):
+                os.makedirs(os.path.dirname(fn))
+            open(fn, "w").close()
+        catalog = FileCatalog(self.rootdir, RunMetricsParser.reignore)
+        self.assertEqual(len(catalog.files), 8)
+        for lane in [1, 2]:
+            for pattern in ["{}_[0-9]+_[0-9A-Za-z]+(_nophix)?(_1)?-.*.(align|hs|insert|dup)_metrics".format(lane),
+                            "{}_[0-9]+_[0-9A-Za-z]+(_nophix)?[\._]bc[\._]metrics".format(lane),
+                            "fastqc/{}_[0-9]+_[0-9A-Za-z]+(_nophix)?(_1)?-*".format(lane)]:
+                self.assertEqual(catalog.search(pattern, lane=lane), [f for f in catalog.files if re.search(pattern, f)])
+        self.assertEqual(catalog.search("_screen.txt", ext=".txt"), [os.path.join(self.rootdir, files[3])])
+        self.assertEqual(catalog.basename("bcbb_software_versions.txt"), [os.path.join(self.rootdir, files[7])])
+        # Parsers on the same directory share the catalog
+        parser = SampleRunMetricsParser(self.rootdir, catalog=catalog)
+        self.assertIs(parser.catalog, catalog)
+        self.assertEqual(len(parser.filter_files("align_metrics", lane=1)), 2)
@@ -0,0 +1,109 @@
+import os
+import time
+import yaml
+import shutil
+import tempfile
+import unittest
+import mock
+
+from scilifelab.bcbio import index as production_index
+from scilifelab.bcbio.index import ProductionIndex
+from scilifelab.bcbio.run import find_samples, sample_table, _group_samples
+from scilifelab.utils.misc import filtered_walk
+
+def bcbb_config(sample, lane, fc_name, barcode_id=1):
+    return {"fc_name": fc_name, "fc_date": "120924",
+            "details": [{"lane": lane, "flowcell_id": fc_name, "analysis": "Align_standard_seqcap",
+                         "multiplex": [{"name": sample, "barcode_id": barcode_id, "sequence": "TGACCA"}]}]}
+
+class TestProductionIndex(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_production_index_")
+        self.project = os.path.join(self.rootdir, "J.Doe_00_01")
+        self.configs = []
+        for (i, sample) in enumerate(["P001_101_index3", "P001_102_index6", "P001_103_index7"]):
+            for (lane, fc) in [(1, "AC003CCCXX"), (2, "BB002BBBXX")]:
+                self._write_config(sample, lane, fc, i + 1)
+        self.index = ProductionIndex(self.rootdir)
+        self.index.refresh()
+
+    def tearDown(self):
+        self.index.close()
+        production_index._INDEXES.clear()
+        production_index._ROOTS.clear()
+        shutil.rmtree(self.rootdir)
+
+    def _write_config(self, sample, lane, fc, barcode_id=1):
+        d = os.path.join(self.project, sample, "12092{}_{}".format(lane, fc))
+        if not os.path.exists(os.path.join(d, "fastqc")):
+            os.makedirs(os.path.join(d, "fastqc"))
+        fn = os.path.join(d, "{}_12092{}_{}-bcbb-config.yaml".format(lane, lane, fc))
+        with open(fn, "w") as fh:
+            fh.write(yaml.safe_dump(bcbb_config(sample, lane, fc, barcode_id), default_flow_style=False))
+        open(os.path.join(d, "fastqc", "{}_12092{}_{}-bcbb-config.yaml".format(lane, lane, fc)), "w").close()
+        open(os.path.join(d, "{}_12092{}_{}_{}_1.fastq.gz".format(lane, lane, fc, barcode_id)), "w").close()
+        if fn not in self.configs:
+            self.configs.append(fn)
+        return fn
+
+    def test_find_samples(self):
+        """Find samples in the index as by walking the tree"""
+        kw = {"exclude_dirs": ["fastqc"]}
+        walked = [os.path.abspath(x) for x in filtered_walk(self.project, lambda f: f.endswith("-bcbb-config.yaml"), **kw)]
+        self.assertEqual(find_samples(self.project, **kw), sorted(walked))
+        self.assertEqual(sorted(find_samples(self.project, use_index=False, **kw)), sorted(walked))
+        self.assertEqual(find_samples(self.project, sample="1_120921", **kw), sorted(find_samples(self.project, sample="1_120921", use_index=False, **kw)))
+        self.assertEqual(len(find_samples(self.project)), 12)
+
+    def test_refresh(self):
+        """Refresh only changed directories and configs"""
+        self.assertEqual(self.index.refresh(), (0, 0))
+        ## New sample run
+        time.sleep(0.01)
+        fn = self._write_config("P001_104_index8", 3, "AC003CCCXX", 4)
+        (n_dirs, n_configs) = self.index.refresh()
+        ## The config and its empty copy in fastqc
+        self.assertEqual(n_configs, 2)
+        self.assertIn(fn, self.index.configs(project="J.Doe_00_01", sample="P001_104_index8"))
+        ## Config rewritten in place
+        with open(self.configs[0], "w") as fh:
+            fh.write(yaml.safe_dump(bcbb_config("P001_101_index3", 1, "AC003CCCXX", 9), default_flow_style=False))
+        os.utime(self.configs[0], (time.time() + 10, time.time() + 10))
+        self.assertEqual(self.index.refresh(), (0, 1))
+        self.assertEqual(self.index.config_fields(self.configs[0])["rows"][0][2], 9)
+        ## Removed sample
+        shutil.rmtree(os.path.join(self.project, "P001_103_index7"))
+        self.index.refresh()
+        self.assertEqual(self.index.configs(sample="P001_103_index7"), [])
+        self.assertEqual(len(self.index.configs(project="J.Doe_00_01")), 10)
+
+    def test_find_samples_refresh(self):
+        """Find samples listing only changed directories, and parse configs when their fields are read"""
+        time.sleep(0.01)
+        fn = self._write_config("P001_104_index8", 3, "AC003CCCXX", 4)
+        with open(self.configs[0], "w") as fh:
+            fh.write(yaml.safe_dump(bcbb_config("P001_101_index3", 1, "AC003CCCXX", 9), default_flow_style=False))
+        os.utime(self.configs[0], (time.time() + 10, time.time() + 10))
+        with mock.patch.object(ProductionIndex, "_index_config") as index_config:
+            self.assertIn(fn, find_samples(self.project, exclude_dirs=["fastqc"]))
+            self.assertFalse(index_config.called)
+        self.assertEqual(self.index.refresh(configs=False), (0, 0))
+        self.assertEqual(self.index.config_fields(self.configs[0])["rows"][0][2], 9)
+        self.assertEqual(self.index.config_fields(fn)["rows"][0][2], 4)
+
+    def test_queries(self):
+        """Look up configs by location and lane, and their result files"""
+        self.assertEqual(self.index.configs(sample="P001_101_index3", lane=2), [self.configs[1]])
+        self.assertEqual(len([x for x in self.index.configs(flowcell="120921_AC003CCCXX") if not "fastqc" in x]), 3)
+        results = self.index.result_files(self.configs[0], lambda f: f.endswith(".fastq.gz"))
+        self.assertEqual([os.path.basename(x) for x in results], ["1_120921_AC003CCCXX_1_1.fastq.gz"])
+
+    def test_sample_table_group_samples(self):
+        """Tabulate and group samples from the index as from the configs"""
+        for fn in self.configs:
+            self.assertEqual(self.index.config_fields(fn), production_index.read_config_fields(fn))
+        table = sample_table(self.configs, index=self.index)
+        self.assertEqual(table.values.tolist()[0], ["P001_101_index3", 1, 1, "AC003CCCXX", None, os.path.dirname(self.configs[0])])
+        self.assertEqual(_group_samples(self.configs), {"P001_101_index3": {"AC003CCCXX": self.configs[0], "BB002BBBXX": self.configs[1]},
+                                                        "P001_102_index6": {"AC003CCCXX": self.configs[2], "BB002BBBXX": self.configs[3]},
+                                                        "P001_103_index7": {"AC003CCCXX": self.configs[4], "BB002BBBXX": self.configs[5]}})
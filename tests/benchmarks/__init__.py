@@ -0,0 +1,5 @@
+"""Benchmarks. Not collected by the test runner; run each module
+from the repository root, e.g.
+
+  python -m tests.benchmarks.bench_statusdb
+"""
@@ -0,0 +1,65 @@
+"""Benchmark verifying the md5sums of a synthetic project with a cold
+and a warm checksum cache, and delivering it with transfer_files,
+fresh and resumed from its manifest. Reports seconds and GB/s.
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+from scilifelab.utils.checksum import ChecksumCache
+from scilifelab.utils.transfer import transfer_files
+
+def make_project(rootdir, n_samples, n_files, size):
+    """Make <n_samples> sample directories with <n_files> files of <size> bytes"""
+    block = os.urandom(1024 * 1024)
+    fnames = []
+    for i in xrange(n_samples):
+        sdir = os.path.join(rootdir, "P001_{}".format(101 + i), "120924_AC003CCCXX")
+        os.makedirs(sdir)
+        for j in xrange(n_files):
+            fnames.append(os.path.join(sdir, "{}_P001_{}_{}.fastq.gz".format(j + 1, 101 + i, j % 2 + 1)))
+            with open(fnames[-1], "wb") as fh:
+                for k in xrange(size // len(block)):
+                    fh.write(block)
+                fh.write(block[0:size % len(block)])
+    return fnames
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--samples", type=int, default=24, help="number of samples")
+    parser.add_argument("--files", type=int, default=4, help="number of files per sample")
+    parser.add_argument("--size", type=int, default=64, help="file size in MB")
+    parser.add_argument("--threads", type=int, default=4, help="number of files to read at a time")
+    parser.add_argument("--xattr", action="store_true", default=False, help="cache checksums in extended attributes")
+    args = parser.parse_args()
+    rootdir = tempfile.mkdtemp(prefix="bench_checksum_")
+    try:
+        fnames = make_project(os.path.join(rootdir, "J.Doe_00_01"), args.samples, args.files, args.size * 1024 * 1024)
+        total = sum(os.path.getsize(f) for f in fnames)
+        cache = ChecksumCache(db=os.path.join(rootdir, "checksums.sqlite"), use_xattr=args.xattr)
+        print "{:>10} {:>10} {:>10}".format("step", "time_s", "GB/s")
+        def report(step, t0):
+            elapsed = time.time() - t0
+            print "{:>10} {:>10.2f} {:>10.3f}".format(step, elapsed, total / 1e9 / elapsed)
+        t0 = time.time()
+        cache.checksums(fnames, threads=args.threads, cached=False)
+        report("cold", t0)
+        t0 = time.time()
+        cache.checksums(fnames, threads=args.threads)
+        report("warm", t0)
+        targets = [os.path.join(rootdir, "INBOX", os.path.relpath(f, rootdir)) for f in fnames]
+        manifest = os.path.join(rootdir, "manifest.json")
+        t0 = time.time()
+        transfer_files(fnames, targets, manifest=manifest, threads=args.threads, cache=cache)
+        report("deliver", t0)
+        t0 = time.time()
+        transfer_files(fnames, targets, manifest=manifest, threads=args.threads, cache=cache)
+        report("resume", t0)
+        cache.close()
+    finally:
+        shutil.rmtree(rootdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""Benchmark file classification of a synthetic flowcell, comparing the
+previous per-file compiled patterns with the precompiled FileClassifier
+for both the collect_files filter and Flowcell.classify_file. Checks
+that both give the same classification and reports files per second.
+
+The previous implementation joined all sample patterns into one regular
+expression, which Python 2 cannot compile for more than about 50
+samples (100 groups). The reference implementation here applies the
+same patterns one at a time, in the same order, which matches the same
+files.
+"""
+import os
+import re
+import time
+import copy
+import shutil
+import random
+import argparse
+import tempfile
+
+import yaml
+
+from scilifelab.bcbio.flowcell import Flowcell
+
+def legacy_file_filter(fc):
+    """collect_files filter as implemented before FileClassifier"""
+    patterns = fc.glob_pfx_str()
+    def file_filter(f):
+        for pattern in patterns:
+            if re.search(pattern, f) != None:
+                return True
+        return False
+    return file_filter
+
+def legacy_classify_file(fc, f):
+    """Flowcell.classify_file as implemented before FileClassifier"""
+    re_lane = re.compile('^([0-9]+)_[0-9]+_[A-Za-z0-9]+(_nophix)?\.(filter|bc)_metrics|^([0-9]+)_[0-9]+_[A-Za-z0-9]+(_nophix)?_[12]_fastq.txt')
+    m_lane = re_lane.search(os.path.basename(f))
+    if m_lane:
+        lane = os.path.basename(f).split("_")[0]
+        fc.lane_files[lane].append(os.path.abspath(f))
+        return
+    re_sample = re.compile('^([0-9]+)_[0-9]+_[A-Za-z0-9]+(_nophix)?_([0-9]+|unmatched)?.*')
+    m_sample = re_sample.search(os.path.basename(f))
+    if m_sample:
+        lane = m_sample.group(1)
+        sample = m_sample.group(3)
+        if sample == "unmatched":
+            fc.lane_files[lane].append(os.path.abspath(f))
+            return
+        lane_fc = fc.subset("lane", lane)
+        sequence = dict(zip(lane_fc._column("barcode_id"), lane_fc._column("sequence"))).get(int(sample), None)
+        key = "{}_{}".format(lane, sequence)
+        if f.find("fastq.txt") > 0:
+            fc.append_to_entry(key, "files", os.path.abspath(f))
+        else:
+            fc.append_to_entry(key, "results", os.path.abspath(f))
+        return
+    names = fc._column("name")
+    for (i, name) in enumerate(names):
+        if re.search("^({}).*".format(name), os.path.basename(f)):
+            row = fc._row(i)
+            key = "{}_{}".format(row[0], row[10])
+            if re.search("fastq(\.gz)?$", f):
+                fc.append_to_entry(key, "files", os.path.abspath(f))
+            else:
+                fc.append_to_entry(key, "results", os.path.abspath(f))
+            return
+
+def make_runinfo(fname, lanes, samples):
+    """Write a run_info.yaml with <lanes> lanes of <samples> samples"""
+    details = []
+    for lane in range(1, lanes + 1):
+        multiplex = [dict(barcode_id=i, name="P{}_{}_index{}".format(lane, 100 + i, i), sample_prj="J.Doe_00_01",
+                          sequence="{}{:06d}".format(lane, i), barcode_type="SampleSheet") for i in range(1, samples + 1)]
+        details.append(dict(lane=str(lane), flowcell_id="AA001AAAXX", analysis="Align_standard_seqcap", multiplex=multiplex))
+    with open(fname, "w") as fh:
+        fh.write(yaml.dump(dict(details=details)))
+
+def make_files(n_files, lanes, samples):
+    """Make file names of lanes, samples and casava samples"""
+    templates = ["{lane}_120829_AA001AAAXX_nophix_{bc}_1_fastq.txt", "{lane}_120829_AA001AAAXX_nophix_{bc}-sort-dup.bam",
+                 "P{lane}_{name}_index{bc}_{lane}{bc:06d}_L00{lane}_R1_001.fastq.gz", "P{lane}_{name}_index{bc}-bcbb-command.txt",
+                 "{lane}_120829_AA001AAAXX_nophix.bc_metrics", "09_realign_sample.txt", "other_{bc}.txt"]
+    rand = random.Random(1)
+    flist = []
+    for i in xrange(n_files):
+        lane = rand.randint(1, lanes)
+        bc = rand.randint(1, samples)
+        flist.append(os.path.join("bench_classify", rand.choice(templates).format(lane=lane, bc=bc, name=100 + bc)))
+    return flist
+
+def _state(fc):
+    return (copy.deepcopy(fc.data), dict((k, list(v)) for (k, v) in fc.lane_files.items()))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=100000, help="number of files to classify")
+    parser.add_argument("--lanes", type=int, default=8, help="number of lanes")
+    parser.add_argument("--samples", type=int, default=384, help="number of samples per lane")
+    parser.add_argument("--legacy-files", type=int, default=100, help="number of files for the previous implementation, which is slow")
+    args = parser.parse_args()
+    rootdir = tempfile.mkdtemp(prefix="bench_classify_")
+    try:
+        runinfo = os.path.join(rootdir, "run_info.yaml")
+        make_runinfo(runinfo, args.lanes, args.samples)
+        flist = make_files(args.files, args.lanes, args.samples)
+        print "{} lanes x {} samples, {} files".format(args.lanes, args.samples, args.files)
+        print "{:>10} {:>10} {:>10} {:>10} {:>12}".format("step", "impl", "files", "time_s", "files/s")
+        results = {}
+        for (label, n, classify, file_filter) in [
+            ("legacy", min(args.legacy_files, args.files), legacy_classify_file, legacy_file_filter),
+            ("compiled", args.files, lambda fc, f: fc.classify_file(f), lambda fc: fc.classifier().file_filter)]:
+            fc = Flowcell(runinfo)
+            t0 = time.time()
+            fn = file_filter(fc)
+            selected = [f for f in flist[0:n] if fn(os.path.basename(f))]
+            elapsed = time.time() - t0
+            print "{:>10} {:>10} {:>10} {:>10.2f} {:>12.0f}".format("filter", label, n, elapsed, n / elapsed)
+            t0 = time.time()
+            for f in flist[0:n]:
+                classify(fc, f)
+            elapsed = time.time() - t0
+            print "{:>10} {:>10} {:>10} {:>10.2f} {:>12.0f}".format("classify", label, n, elapsed, n / elapsed)
+            results[label] = (selected, _state(fc))
+        ## Compare on the files classified by both
+        n = min(args.legacy_files, args.files)
+        fc = Flowcell(runinfo)
+        fn = fc.classifier().file_filter
+        selected = [f for f in flist[0:n] if fn(os.path.basename(f))]
+        for f in flist[0:n]:
+            fc.classify_file(f)
+        same = selected == results["legacy"][0] and _state(fc) == results["legacy"][1]
+        print "classification identical on {} files: {}".format(n, same)
+    finally:
+        shutil.rmtree(rootdir)
+
+if __name__ == "__main__":
+    main()
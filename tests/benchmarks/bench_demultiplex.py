@@ -0,0 +1,86 @@
+"""Benchmark index matching and demultiplexing of molecular tagged
+read sets, reporting reads per second for matching by comparison with
+every index (as in the former demultiplex_mctag.py loop) and by lookup
+table, and for end-to-end demultiplexing with demultiplex_mctag.
+"""
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import collections
+
+import scilifelab.utils.fastq_utils as fu
+import scilifelab.utils.demultiplex as dm
+
+def make_readset(outdir, n, indexes, tag_length=10, read_length=100):
+    """Write <n> synthetic read pairs with index reads to <outdir>"""
+    rnd = random.Random(0)
+    seq = "".join([rnd.choice("ACGT") for i in xrange(read_length)])
+    qual = "I" * read_length
+    fqs = [os.path.join(outdir, "{}.fastq".format(r)) for r in ["R1", "R2", "I"]]
+    fhs = [fu.FastQWriter(f) for f in fqs]
+    for i in xrange(n):
+        index = list(rnd.choice(indexes))
+        # One in ten index reads has a sequencing error
+        if rnd.random() < 0.1:
+            index[rnd.randint(0, len(index) - 1)] = rnd.choice("ACGTN")
+        ind_seq = "".join(index) + "".join([rnd.choice("ACGT") for j in xrange(tag_length)])
+        header = "@HWI-ST1018:1:1101:{}:{}#0".format(i // 10000, i % 10000)
+        fhs[0].write([header + "/1", seq, "+", qual])
+        fhs[1].write([header + "/2", seq, "+", qual])
+        fhs[2].write([header + "/3", ind_seq, "+", "I" * len(ind_seq)])
+    for fh in fhs:
+        fh.close()
+    return fqs
+
+def match_all(seqs, indexes, max_mismatches):
+    """Compare each index read to every index, longer indexes first"""
+    for seq in seqs:
+        matches = collections.defaultdict(list)
+        for ix in sorted(indexes, key=lambda x: (-len(x))):
+            d = dm.hamming(ix, seq)
+            matches[d].append(ix)
+            if d == 0:
+                break
+
+def match_table(seqs, matcher):
+    for seq in seqs:
+        matcher.match(seq)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--reads", type=int, default=1000000, help="number of synthetic read pairs")
+    parser.add_argument("--indexes", type=int, default=96, help="number of indexes")
+    parser.add_argument("--mismatches", type=int, default=1, help="maximum number of mismatches")
+    args = parser.parse_args()
+    rnd = random.Random(1)
+    indexes = list(set(["".join([rnd.choice("ACGT") for j in xrange(8)]) for i in xrange(args.indexes)]))
+    index_dict = dict([(ix, "Sample_{}".format(i)) for i, ix in enumerate(indexes)])
+    tmpdir = tempfile.mkdtemp(prefix="bench_demultiplex_")
+    try:
+        fqs = make_readset(tmpdir, args.reads, indexes)
+        seqs = [r[1] for r in fu.FastQParser(fqs[2])]
+        t0 = time.time()
+        matcher = dm.IndexMatcher(sorted(indexes, key=lambda x: (-len(x))), args.mismatches)
+        print "lookup table with {} entries built in {:.2f} s".format(len(matcher), time.time() - t0)
+        print "{:>12} {:>10} {:>12}".format("mode", "time_s", "reads/s")
+        n = min(len(seqs), 100000)
+        for (mode, fn, m) in [("match_all", lambda: match_all(seqs[0:n], indexes, args.mismatches), n),
+                              ("match_table", lambda: match_table(seqs, matcher), len(seqs))]:
+            t0 = time.time()
+            fn()
+            t = time.time() - t0
+            print "{:>12} {:>10.2f} {:>12.0f}".format(mode, t, m / t)
+        outdir = os.path.join(tmpdir, "out")
+        os.mkdir(outdir)
+        t0 = time.time()
+        counts = dm.demultiplex_mctag(fqs[0], fqs[1], fqs[2], index_dict, outdir, args.mismatches)
+        t = time.time() - t0
+        print "{:>12} {:>10.2f} {:>12.0f}".format("demultiplex", t, counts['reads_processed'] / t)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""Benchmark parallel demultiplexing of molecular tagged read sets,
+reporting wall time, reads per second and speedup for 1 to N processes,
+and checking that the counts equal those of the serial run.
+"""
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+import scilifelab.utils.demultiplex as dm
+from tests.benchmarks.bench_demultiplex import make_readset
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--reads", type=int, default=1000000, help="number of synthetic read pairs")
+    parser.add_argument("--indexes", type=int, default=96, help="number of indexes")
+    parser.add_argument("--mismatches", type=int, default=1, help="maximum number of mismatches")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count(), help="maximum number of processes")
+    args = parser.parse_args()
+    rnd = random.Random(1)
+    indexes = list(set(["".join([rnd.choice("ACGT") for j in xrange(8)]) for i in xrange(args.indexes)]))
+    index_dict = dict([(ix, "Sample_{}".format(i)) for i, ix in enumerate(indexes)])
+    tmpdir = tempfile.mkdtemp(prefix="bench_demultiplex_parallel_")
+    try:
+        fqs = make_readset(tmpdir, args.reads, indexes)
+        print "{:>10} {:>10} {:>12} {:>8} {:>8}".format("processes", "time_s", "reads/s", "speedup", "counts")
+        (serial, t1) = (None, None)
+        p = 1
+        while p <= args.processes:
+            outdir = os.path.join(tmpdir, "out{}".format(p))
+            os.mkdir(outdir)
+            t0 = time.time()
+            counts = dm.demultiplex_mctag(fqs[0], fqs[1], fqs[2], index_dict, outdir, args.mismatches, processes=p)
+            t = time.time() - t0
+            if serial is None:
+                (serial, t1) = (counts, t)
+            print "{:>10} {:>10.2f} {:>12.0f} {:>8.2f} {:>8}".format(p, t, counts['reads_processed'] / t, t1 / t, "same" if counts == serial else "DIFFER")
+            shutil.rmtree(outdir)
+            p = p * 2 if p * 2 <= args.processes or p == args.processes else args.processes
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
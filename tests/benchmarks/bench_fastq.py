@@ -0,0 +1,66 @@
+"""Benchmark FastQParser quality metrics on a synthetic fastq file,
+comparing per-record avgQ/gtQ30 with the vectorized batch kernels.
+Reports wall time and reads per second for each mode.
+"""
+import os
+import time
+import random
+import argparse
+import tempfile
+
+import scilifelab.utils.fastq_utils as fu
+
+def make_fastq(fname, n, length=100, seed=0):
+    """Write <n> synthetic reads of length <length> to <fname>"""
+    rnd = random.Random(seed)
+    # Draw from a pool of quality strings to keep file generation cheap
+    quals = ["".join([chr(33 + rnd.randint(2, 41)) for i in xrange(length)]) for j in xrange(1000)]
+    seqs = ["".join([rnd.choice("ACGTN") for i in xrange(length)]) for j in xrange(1000)]
+    fqw = fu.FastQWriter(fname)
+    for i in xrange(n):
+        fqw.write(["@HWI-ST1018:1:1101:{}:{}#0/1".format(i // 10000, i % 10000), seqs[i % 1000], "+", quals[(i * 7) % 1000]])
+    fqw.close()
+
+def per_record(fname):
+    n = 0
+    for r in fu.FastQParser(fname):
+        fu.avgQ(r)
+        fu.gtQ30(r)
+        n += 1
+    return n
+
+def batched(fname, batch_size):
+    n = 0
+    for b in fu.FastQParser(fname).iter_batches(batch_size):
+        fu.batch_avgQ(b)
+        fu.batch_gtQ30(b)
+        fu.batch_minQ(b)
+        n += len(b)
+    return n
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--reads", type=int, default=10000000, help="number of synthetic reads")
+    parser.add_argument("--batch_size", type=int, default=100000, help="records per batch")
+    parser.add_argument("--fastq", default=None, help="use this fastq file instead of generating one")
+    args = parser.parse_args()
+    fname = args.fastq
+    if not fname:
+        (fd, fname) = tempfile.mkstemp(suffix=".fastq")
+        os.close(fd)
+        t0 = time.time()
+        make_fastq(fname, args.reads)
+        print "generated {} reads in {:.1f} s".format(args.reads, time.time() - t0)
+    try:
+        print "{:>10} {:>10} {:>12}".format("mode", "time_s", "reads/s")
+        for (mode, fn) in [("record", lambda: per_record(fname)), ("batch", lambda: batched(fname, args.batch_size))]:
+            t0 = time.time()
+            n = fn()
+            t = time.time() - t0
+            print "{:>10} {:>10.2f} {:>12.0f}".format(mode, t, n / t)
+    finally:
+        if not args.fastq:
+            os.unlink(fname)
+
+if __name__ == "__main__":
+    main()
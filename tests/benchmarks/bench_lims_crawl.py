@@ -0,0 +1,44 @@
+"""Benchmark building the process info of a synthetic project against a
+LIMS stand-in serving recorded responses with a fixed latency per
+request. Reports the number of HTTP requests and the wall time when
+retrieving one entity at a time, and through the entity cache with
+batch requests, for each number of threads.
+"""
+import time
+import argparse
+
+from scilifelab.lims_utils.entity_cache import LimsCache
+from scilifelab.lims_utils.objectsDB import ProcessInfo
+from tests.lims_utils import lims_standin
+
+PROJECT = "J.Doe_00_01"
+
+def crawl_one_at_a_time(lims):
+    """Touch the entities ProcessInfo uses, one entity at a time"""
+    for process in lims.get_processes(projectname=PROJECT):
+        (process.type.name, process.date_run)
+        for in_art_id, out_art_id in process.input_output_maps:
+            [samp.name for samp in in_art_id['uri'].samples]
+
+def crawl_cached(lims, threads):
+    cache = LimsCache(lims, threads)
+    ProcessInfo(lims, cache.get_processes(projectname=PROJECT), cache)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--samples", type=int, default=96, help="number of samples in project")
+    parser.add_argument("--processes", type=int, default=8, help="number of processes the samples go through")
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds per request")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4, 8], help="numbers of threads to compare")
+    args = parser.parse_args()
+    responses = lims_standin.record_project(lims_standin.RecordedLims({}), PROJECT, "P001", args.samples, args.processes)
+    print "{:>12} {:>8} {:>10} {:>10}".format("method", "threads", "requests", "time_s")
+    runs = [("one_at_time", 1, crawl_one_at_a_time)] + [("cached", t, lambda lims, t=t: crawl_cached(lims, t)) for t in args.threads]
+    for (method, threads, crawl) in runs:
+        lims = lims_standin.RecordedLims(responses, latency=args.latency)
+        t0 = time.time()
+        crawl(lims)
+        print "{:>12} {:>8} {:>10} {:>10.2f}".format(method, threads, lims.requests, time.time() - t0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""Benchmark sample note rendering for a synthetic project, reporting
+wall time and notes per second for the pdf notes, their concatenation
+and the reST notes, for each number of rendering processes.
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+from scilifelab.report.rl import example_sample_note_params, make_sample_notes, concatenate_notes
+from scilifelab.report.rst import make_sample_rest_notes
+
+def make_params(n, prefix):
+    """Make sample note parameters for <n> samples"""
+    return [example_sample_note_params(scilifelab_name="P001_{}".format(101 + i), customer_name="Sample {}".format(i),
+                                       lane=str(1 + i % 8), outfile="{}_P001_{}.pdf".format(prefix, 101 + i)) for i in xrange(n)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--samples", type=int, default=384, help="number of samples in project")
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1, 2, 4, multiprocessing.cpu_count()], help="numbers of processes to compare")
+    args = parser.parse_args()
+    cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp(prefix="bench_report_")
+    os.chdir(tmpdir)
+    try:
+        print "{:>5} {:>10} {:>10} {:>10} {:>10} {:>10}".format("jobs", "pdf_s", "concat_s", "rst_s", "total_s", "notes/s")
+        for jobs in sorted(set(args.jobs)):
+            s_params = make_params(args.samples, "j{}".format(jobs))
+            t0 = time.time()
+            notes = make_sample_notes(s_params, jobs=jobs)
+            t1 = time.time()
+            concatenate_notes(notes, "j{}_sample_summary.pdf".format(jobs))
+            t2 = time.time()
+            make_sample_rest_notes("j{}_sample_summary.rst".format(jobs), s_params, jobs=jobs)
+            t3 = time.time()
+            print "{:>5} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.1f}".format(jobs, t1 - t0, t2 - t1, t3 - t2, t3 - t0, args.samples / (t3 - t0))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    main()
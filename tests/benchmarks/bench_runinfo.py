@@ -0,0 +1,99 @@
+"""Benchmark run information lookups of a synthetic flowcell, comparing
+the previous row scanning accessors with the indexed Flowcell accessors.
+Checks that both give the same results and reports lookups per second.
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+import yaml
+
+from scilifelab.bcbio.flowcell import Flowcell
+
+def legacy_column(fc, label):
+    i = fc.keys.index(label)
+    return [row[i] for row in fc.data if not row[i] is None]
+
+def legacy_subset(fc, column, query):
+    """Flowcell.subset as implemented before RunInfoIndex"""
+    pruned_fc = Flowcell()
+    vals = legacy_column(fc, column)
+    i = [j for j in range(0, len(vals)) if vals[j]==query]
+    pruned_fc.data = [fc.data[j] for j in i]
+    pruned_fc.filename = fc.filename.replace(".yaml", "-pruned.yaml")
+    pruned_fc._set_sample_dict()
+    return pruned_fc
+
+def legacy_lane_lookups(fc, lane):
+    barcodes = legacy_column(legacy_subset(fc, "lane", lane), "barcode_id")
+    names = legacy_column(legacy_subset(fc, "lane", lane), "name")
+    sequences = legacy_column(legacy_subset(fc, "lane", lane), "sequence")
+    return (barcodes, names, dict(zip(barcodes, sequences)))
+
+def lane_lookups(fc, lane):
+    return (fc.barcodes(lane), fc.names(lane), fc.barcode_id_to_sequence(lane))
+
+def legacy_entries(fc, keys):
+    for key in keys:
+        fc.data[fc.samples[key]][fc.keys.index("sequence")]
+        row = fc.data[fc.samples[key]]
+        if not row[fc.keys.index("results")]:
+            row[fc.keys.index("results")] = []
+        row[fc.keys.index("results")].append(key)
+
+def entries(fc, keys):
+    for key in keys:
+        fc.get_entry(key, "sequence")
+        fc.append_to_entry(key, "results", key)
+
+def make_runinfo(fname, lanes, barcodes):
+    """Write a run_info.yaml with <lanes> lanes of <barcodes> barcodes"""
+    details = []
+    for lane in range(1, lanes + 1):
+        multiplex = [dict(barcode_id=i, name="P{}_{}_index{}".format(lane % 10, 100 + i, i), sample_prj="J.Doe_00_{:02d}".format(lane % 10),
+                          sequence="{:06d}".format(i), barcode_type="SampleSheet") for i in range(1, barcodes + 1)]
+        details.append(dict(lane=str(lane), flowcell_id="AA001AAAXX", analysis="Align_standard_seqcap", multiplex=multiplex))
+    with open(fname, "w") as fh:
+        fh.write(yaml.dump(dict(details=details)))
+
+def _time(fn, *args):
+    t0 = time.time()
+    res = fn(*args)
+    return (res, time.time() - t0)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--lanes", type=int, default=96, help="number of lanes")
+    parser.add_argument("--barcodes", type=int, default=384, help="number of barcodes per lane")
+    args = parser.parse_args()
+    rootdir = tempfile.mkdtemp(prefix="bench_runinfo_")
+    try:
+        runinfo = os.path.join(rootdir, "run_info.yaml")
+        make_runinfo(runinfo, args.lanes, args.barcodes)
+        (fc, elapsed) = _time(Flowcell, runinfo)
+        print "{} lanes x {} barcodes, {} rows, read in {:.2f} s".format(args.lanes, args.barcodes, len(fc), elapsed)
+        print "{:>10} {:>10} {:>10} {:>10} {:>12}".format("lookup", "impl", "n", "time_s", "lookups/s")
+        legacy_fc = Flowcell(runinfo)
+        lanes = sorted(fc.lanes(), key=int)
+        keys = sorted(fc.samples.keys())
+        same = True
+        for (label, n, legacy, indexed) in [
+            ("lane", len(lanes), lambda: [legacy_lane_lookups(legacy_fc, x) for x in lanes], lambda: [lane_lookups(fc, x) for x in lanes]),
+            ("entry", len(keys), lambda: legacy_entries(legacy_fc, keys), lambda: entries(fc, keys)),
+            ("subset", 10, lambda: [legacy_subset(legacy_fc, "sample_prj", "J.Doe_00_{:02d}".format(x)).data for x in range(10)],
+             lambda: [fc.subset("sample_prj", "J.Doe_00_{:02d}".format(x)).data for x in range(10)])]:
+            (res_legacy, elapsed) = _time(legacy)
+            print "{:>10} {:>10} {:>10} {:>10.3f} {:>12.0f}".format(label, "legacy", n, elapsed, n / elapsed if elapsed > 0 else 0)
+            (res, elapsed) = _time(indexed)
+            print "{:>10} {:>10} {:>10} {:>10.3f} {:>12.0f}".format(label, "indexed", n, elapsed, n / elapsed if elapsed > 0 else 0)
+            same = same and res == res_legacy
+        (out, elapsed) = _time(fc.as_yaml)
+        print "{:>10} {:>10} {:>10} {:>10.3f}".format("as_yaml", "indexed", 1, elapsed)
+        print "results identical: {}".format(same and legacy_fc.as_yaml() == out)
+    finally:
+        shutil.rmtree(rootdir)
+
+if __name__ == "__main__":
+    main()
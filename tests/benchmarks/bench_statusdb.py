@@ -0,0 +1,54 @@
+"""Benchmark statusdb connection startup against an in-memory couchdb
+stand-in, reporting construction time, time to look up the samples of
+one flowcell and peak RSS growth as the number of sample run documents
+grows.
+"""
+import time
+import resource
+import argparse
+import multiprocessing
+
+from scilifelab.db.statusdb import SampleRunMetricsConnection, SampleRunMetricsDocument
+from tests.statusdb import couchdb_standin
+
+def make_server(n):
+    """Make a stand-in server with <n> sample run documents, 96 per flowcell"""
+    server = couchdb_standin.Server()
+    db = server.create("samples")
+    for i in xrange(n):
+        fc = "FC{:07d}XX".format(i // 96)
+        db.docs[str(i)] = dict(SampleRunMetricsDocument(_id=str(i), _rev="1-0", flowcell=fc, date="120924", lane=(i % 8) + 1,
+                                                        sequence="{:06d}".format(i), sample_prj="P{}".format(i // 400),
+                                                        barcode_name="P{}_{}".format(i // 400, i % 400)))
+    return server
+
+def run(n, lazy, queue):
+    server = make_server(n)
+    # Build view indexes up front, as a running couchdb server would have done
+    for name in server["samples"].views:
+        server["samples"]._emit(name)
+    server.reset_requests()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.time()
+    s_con = couchdb_standin.connect(SampleRunMetricsConnection, server, lazy=lazy)
+    t1 = time.time()
+    samples = s_con.get_samples(fc_id="FC0000000XX")
+    t2 = time.time()
+    queue.put((t1 - t0, t2 - t1, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss, server.requests, len(samples)))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="1000,10000,100000,300000", help="comma-separated document counts")
+    args = parser.parse_args()
+    print "{:>8} {:>6} {:>10} {:>10} {:>12} {:>9}".format("docs", "mode", "startup_s", "lookup_s", "peak_rss_kb", "requests")
+    for n in [int(x) for x in args.sizes.split(",")]:
+        for lazy in [False, True]:
+            queue = multiprocessing.Queue()
+            p = multiprocessing.Process(target=run, args=(n, lazy, queue))
+            p.start()
+            (startup, lookup, rss, requests, _) = queue.get()
+            p.join()
+            print "{:>8} {:>6} {:>10.3f} {:>10.3f} {:>12} {:>9}".format(n, "lazy" if lazy else "eager", startup, lookup, rss, requests)
+
+if __name__ == "__main__":
+    main()
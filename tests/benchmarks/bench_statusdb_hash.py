@@ -0,0 +1,59 @@
+"""Benchmark saving unchanged project summary documents with
+save_couchdb_obj against an in-memory couchdb stand-in, comparing the
+content hash view lookup with retrieving and comparing every stored
+document. Reports documents per second and the bytes of stored
+documents retrieved.
+"""
+import json
+import time
+import argparse
+
+from scilifelab.db.statusDB_utils import save_couchdb_obj
+from tests.statusdb import couchdb_standin
+
+def make_project(i, n_samples):
+    """Make a project summary object with <n_samples> samples"""
+    samples = {"P{}_{}".format(i, 101 + j) : {"scilifelab_name":"P{}_{}".format(i, 101 + j), "customer_name":"Sample {}".format(j),
+                                               "status":"P", "m_reads_sequenced":"12.3",
+                                               "library_prep":{"A":{"prep_status":"PASSED", "sample_run_metrics":{"1_120924_AC003CCCXX_TGACCA":{"dillution_and_pooling_start_date":"2012-09-20"}}}}}
+               for j in xrange(n_samples)}
+    return {"_id":"project_{}".format(i), "project_name":"J.Doe_{:02d}_01".format(i), "project_id":"P{}".format(i),
+            "entity_type":"project_summary", "samples":samples, "details":{"application":"WG re-seq"}}
+
+def run(db, projects):
+    """Save unchanged projects, counting the bytes of retrieved documents"""
+    fetched = [0]
+    get = db.get
+    def counting_get(docid, default=None, **options):
+        doc = get(docid, default, **options)
+        if doc is not None:
+            fetched[0] += len(json.dumps(doc))
+        return doc
+    db.get = counting_get
+    t0 = time.time()
+    for obj in projects:
+        save_couchdb_obj(db, dict(obj))
+    elapsed = time.time() - t0
+    db.get = get
+    return (elapsed, fetched[0])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--projects", type=int, default=50, help="number of projects")
+    parser.add_argument("--samples", type=int, nargs="+", default=[100, 1000, 5000], help="numbers of samples per project to compare")
+    args = parser.parse_args()
+    print "{:>8} {:>10} {:>10} {:>10} {:>14}".format("samples", "method", "time_s", "docs/s", "fetched_MB")
+    for n_samples in args.samples:
+        server = couchdb_standin.Server()
+        db = server.create("projects")
+        projects = [make_project(i, n_samples) for i in xrange(args.projects)]
+        for obj in projects:
+            save_couchdb_obj(db, dict(obj))
+        for method in ["hash", "compare"]:
+            if method == "compare":
+                del db.views["hash/content_hash"]
+            (elapsed, fetched) = run(db, projects)
+            print "{:>8} {:>10} {:>10.2f} {:>10.1f} {:>14.1f}".format(n_samples, method, elapsed, args.projects / elapsed, fetched / 1e6)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Benchmark filtered_walk on a synthetic production tree, comparing
+the previous os.walk based implementation with the pruning walker,
+sequentially and with threads over the top-level subdirectories.
+Reports seconds and files per second.
+"""
+import os
+import re
+import time
+import shutil
+import argparse
+import tempfile
+
+from scilifelab.utils.misc import filtered_walk
+
+EXCLUDE_DIRS = ['realign-split', 'variants-split', 'tmp', 'tx', 'fastqc', 'fastq_screen', 'alignments', 'nophix']
+
+def legacy_filtered_walk(rootdir, filter_fn, include_dirs=None, exclude_dirs=None, get_dirs=False):
+    """filtered_walk as implemented before the pruning walker"""
+    flist = []
+    dlist = []
+    for root, dirs, files in os.walk(rootdir):
+        if include_dirs and len(set(root.split(os.sep)).intersection(set(include_dirs))) == 0:
+            if re.search("|".join(include_dirs), root):
+                pass
+            else:
+                continue
+        if exclude_dirs and len(set(root.split(os.sep)).intersection(set(exclude_dirs))) > 0:
+            continue
+        if exclude_dirs and re.search("|".join(exclude_dirs), root):
+            continue
+        dlist = dlist + [os.path.join(root, x) for x in dirs]
+        flist = flist + [os.path.join(root, x) for x in filter(filter_fn, files)]
+    if get_dirs:
+        return dlist
+    else:
+        return flist
+
+def make_tree(rootdir, n_files):
+    """Make a project tree of sample/flowcell directories with about
+    <n_files> files, half of them in excluded subdirectories"""
+    subdirs = ["", "fastqc", "alignments", "tmp/tx"]
+    per_dir = 50
+    n = 0
+    i = 0
+    while n < n_files:
+        sdir = os.path.join(rootdir, "P001_{}".format(101 + i // 4), "12092{}_AC003CCCXX".format(i % 4))
+        for sub in subdirs:
+            d = os.path.join(sdir, sub)
+            os.makedirs(d)
+            for j in xrange(per_dir):
+                open(os.path.join(d, "{}_P001_{}_{}.fastq.gz".format(j, 101 + i // 4, sub.replace("/", "_"))), "w").close()
+            n += per_dir
+        i += 1
+    return n
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=500000, help="number of files in the tree")
+    parser.add_argument("--threads", type=int, default=8, help="number of threads for the threaded walk")
+    parser.add_argument("--root", default=os.getcwd(), help="make the tree below this directory, e.g. on a network file system. Must not match the excluded directories, such as tmp. Default current directory")
+    args = parser.parse_args()
+    rootdir = tempfile.mkdtemp(prefix="bench_walk_", dir=args.root)
+    try:
+        n = make_tree(os.path.join(rootdir, "J.Doe_00_01"), args.files)
+        filter_fn = lambda f: re.search("fastq.gz$", f) != None
+        project = os.path.join(rootdir, "J.Doe_00_01")
+        print "{} files".format(n)
+        print "{:>10} {:>10} {:>10} {:>12}".format("walker", "found", "time_s", "files/s")
+        for label, fn in [("legacy", lambda: legacy_filtered_walk(project, filter_fn, exclude_dirs=EXCLUDE_DIRS)),
+                          ("pruning", lambda: filtered_walk(project, filter_fn, exclude_dirs=EXCLUDE_DIRS)),
+                          ("threaded", lambda: filtered_walk(project, filter_fn, exclude_dirs=EXCLUDE_DIRS, threads=args.threads))]:
+            t0 = time.time()
+            flist = fn()
+            elapsed = time.time() - t0
+            print "{:>10} {:>10} {:>10.2f} {:>12.0f}".format(label, len(flist), elapsed, n / elapsed)
+    finally:
+        shutil.rmtree(rootdir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Local stand-in for a LIMS server, serving recorded XML responses.
+
+``RecordedLims`` is a genologics Lims whose HTTP GET and POST are
+answered from a dictionary of recorded responses keyed by uri, so that
+the genologics entities are parsed as for a real server. Batch
+retrievals are answered with the recorded responses of the requested
+entities. Every call that would be an HTTP request against a real
+server is counted in ``requests``, and can be given a latency.
+"""
+import time
+import urllib
+import threading
+from xml.etree import ElementTree
+from genologics.lims import Lims
+
+BASEURI = "http://lims.example.com:8080/"
+
+class RecordedLims(Lims):
+    """Lims answering requests with recorded responses
+
+    :param responses: dictionary of uri, including any query, to response XML
+    :param latency: seconds to wait per request
+    """
+    def __init__(self, responses, baseuri=BASEURI, latency=0):
+        Lims.__init__(self, baseuri, "user", "password")
+        self.responses = responses
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def _count(self):
+        with self._lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get(self, uri, params=dict()):
+        self._count()
+        return ElementTree.fromstring(self.responses[_query_uri(uri, params)])
+
+    def post(self, uri, data, params=dict()):
+        self._count()
+        if not uri.endswith("batch/retrieve"):
+            raise NotImplementedError("Only batch retrievals are supported by the stand-in")
+        root = ElementTree.Element("details")
+        for link in ElementTree.fromstring(data).findall("link"):
+            root.append(ElementTree.fromstring(self.responses[link.attrib["uri"].split("?")[0]]))
+        return root
+
+    def put(self, uri, data, params=dict()):
+        raise NotImplementedError("The stand-in is read-only")
+
+    def reset_requests(self):
+        self.requests = 0
+
+
+def _query_uri(uri, params):
+    if not params:
+        return uri
+    return "{}?{}".format(uri, urllib.urlencode(sorted(params.items()), doseq=True))
+
+def record_list(lims, klass, tag, limsids, **params):
+    """Record the response of a list query
+
+    :param klass: entity uri segment, e.g. 'processes'
+    :param tag: entity tag, e.g. 'process'
+    :param limsids: lims ids of the listed entities
+    :param params: query parameters, as passed to Lims.get
+
+    :returns: tuple (uri, recorded response)
+    """
+    return (_query_uri(lims.get_uri(klass), params), _list(lims, tag, klass, limsids))
+
+def _ref(tag, lims, klass, limsid, **attrib):
+    attrib = " ".join(['{}="{}"'.format(k.replace("_", "-"), v) for k, v in sorted(attrib.items())])
+    return '<{} uri="{}" limsid="{}" {}/>'.format(tag, lims.get_uri(klass, limsid), limsid, attrib)
+
+def _list(lims, tag, klass, limsids):
+    return '<list>{}</list>'.format("".join([_ref(tag, lims, klass, x) for x in limsids]))
+
+def record_project(lims, project_name="J.Doe_00_01", project_id="P001", n_samples=24, n_processes=4, process_type="Aggregate QC (Library Validation) 4.0"):
+    """Record the responses of a project whose samples all go through
+    <n_processes> processes of type <process_type>, each process with
+    one input and one output artifact per sample.
+
+    :returns: dictionary of uri to recorded response, to be added to lims.responses
+    """
+    responses = {}
+    uri = lims.get_uri
+    samples = ["{}_{}".format(project_id, 101 + i) for i in range(n_samples)]
+    # Process and artifact ids are made unique per project with the project number
+    number = project_id.lstrip("P")
+    processes = ["24-{}{}".format(number, 1000 + j) for j in range(n_processes)]
+    responses[uri("processtypes", "1")] = '<process-type uri="{}" name="{}"/>'.format(uri("processtypes", "1"), process_type)
+    for i, name in enumerate(samples):
+        artifact = "{}PA1".format(name)
+        responses[uri("samples", name)] = ('<sample uri="{}" limsid="{}"><name>{}</name>{}{}</sample>'
+                                           .format(uri("samples", name), name, name, _ref("project", lims, "projects", project_id),
+                                                   _ref("artifact", lims, "artifacts", artifact)))
+        responses[uri("artifacts", artifact)] = ('<artifact uri="{}" limsid="{}"><name>{}</name><type>Analyte</type>'
+                                                 '<location><container uri="{}" limsid="27-1"/><value>{}:{}</value></location>{}</artifact>'
+                                                 .format(uri("artifacts", artifact), artifact, name, uri("containers", "27-1"),
+                                                         "ABCDEFGH"[i % 8], 1 + i // 8, _ref("sample", lims, "samples", name)))
+    for j, process in enumerate(processes):
+        maps = []
+        for i, name in enumerate(samples):
+            inart = "{}PA1".format(name) if j == 0 else "2-{}{}".format(number, 1000 * j + i)
+            outart = "2-{}{}".format(number, 1000 * (j + 1) + i)
+            maps.append('<input-output-map>{}{}</input-output-map>'.format(_ref("input", lims, "artifacts", inart),
+                                                                          _ref("output", lims, "artifacts", outart, output_type="Analyte")))
+            responses[uri("artifacts", outart)] = ('<artifact uri="{}" limsid="{}"><name>{}</name><type>Analyte</type>{}{}</artifact>'
+                                                   .format(uri("artifacts", outart), outart, name,
+                                                           _ref("parent-process", lims, "processes", process), _ref("sample", lims, "samples", name)))
+        responses[uri("processes", process)] = ('<process uri="{}" limsid="{}"><type uri="{}">{}</type><date-run>2014-01-{:02d}</date-run>{}</process>'
+                                                .format(uri("processes", process), process, uri("processtypes", "1"), process_type, j + 1, "".join(maps)))
+    responses.update([record_list(lims, "processes", "process", processes, projectname=project_name),
+                      record_list(lims, "samples", "sample", samples, projectlimsid=project_id)])
+    return responses
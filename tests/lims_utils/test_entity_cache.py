@@ -0,0 +1,96 @@
+import threading
+import unittest
+
+try:
+    from scilifelab.lims_utils.entity_cache import LimsCache
+    from . import lims_standin
+except ImportError:
+    LimsCache = None
+try:
+    from scilifelab.lims_utils import objectsDB
+except (ImportError, SystemExit):
+    # genologics.lims_utils exits if there is no genologics configuration
+    objectsDB = None
+
+PROJECT = "J.Doe_00_01"
+
+def _ids(info):
+    """Replace the artifacts of ProcessInfo.info by their ids"""
+    return {pid: dict(proc, samples={name: {art_id: [a.id for a in arts] for art_id, arts in s.iteritems()}
+                                     for name, s in proc['samples'].iteritems()}) for pid, proc in info.iteritems()}
+
+def _reference_process_info(processes):
+    """ProcessInfo._get_process_info, one entity at a time"""
+    process_info = {}
+    for process in processes:
+        process_info[process.id] = {'type' : process.type.name, 'start_date': process.date_run, 'samples' : {}}
+        for in_art_id, out_art_id in process.input_output_maps:
+            in_art = in_art_id['uri']
+            for samp in in_art.samples:
+                process_info[process.id]['samples'].setdefault(samp.name, {})[in_art.id] = [in_art, out_art_id['uri']]
+    return process_info
+
+@unittest.skipIf(LimsCache is None, "genologics is not installed")
+class TestLimsCache(unittest.TestCase):
+    """Tests for the lims query and entity cache, against a stand-in serving recorded responses"""
+    def setUp(self):
+        self.lims = lims_standin.RecordedLims({})
+        self.lims.responses.update(lims_standin.record_project(self.lims, PROJECT, "P001", n_samples=24, n_processes=4))
+
+    def test_queries(self):
+        """Test that queries are only made once"""
+        cache = LimsCache(self.lims)
+        processes = cache.get_processes(projectname=PROJECT)
+        self.assertEqual(len(processes), 4)
+        self.assertEqual(cache.get_processes(projectname=PROJECT), processes)
+        self.assertEqual(self.lims.requests, 1)
+
+    def test_prefetch_batch(self):
+        """Test retrieving samples and artifacts with batch requests"""
+        cache = LimsCache(self.lims, batch_size=10)
+        samples = cache.prefetch(cache.get_samples(projectlimsid="P001"))
+        self.assertEqual(self.lims.requests, 1 + 3)
+        cache.prefetch([s.artifact for s in samples])
+        self.assertEqual(self.lims.requests, 1 + 3 + 3)
+        self.assertEqual([s.name for s in samples], ["P001_{}".format(101 + i) for i in range(24)])
+        self.assertEqual(samples[9].artifact.location[1], "B:2")
+        cache.prefetch(samples)
+        self.assertEqual(self.lims.requests, 7)
+
+    def test_prefetch_threads(self):
+        """Test retrieving processes, which have no batch endpoint, in threads"""
+        cache = LimsCache(self.lims, threads=3)
+        processes = cache.prefetch(cache.get_processes(projectname=PROJECT))
+        self.assertEqual(self.lims.requests, 1 + 4)
+        self.assertEqual([p.date_run for p in processes], ["2014-01-0{}".format(j + 1) for j in range(4)])
+        self.assertEqual(self.lims.requests, 1 + 4)
+
+    def test_map(self):
+        """Test that map returns results in order"""
+        self.assertEqual(LimsCache(self.lims, threads=4).map(lambda x: x * x, range(50)), [x * x for x in range(50)])
+
+    def test_map_nested(self):
+        """Test that map called from within map runs in the calling thread"""
+        cache = LimsCache(self.lims, threads=4)
+        def outer(x):
+            thread = threading.current_thread()
+            return all(cache.map(lambda y: threading.current_thread() is thread, range(4)))
+        self.assertEqual(cache.map(outer, range(8)), [True] * 8)
+        processes = cache.get_processes(projectname=PROJECT)
+        cache.map(lambda p: cache.prefetch([p]), processes)
+        self.assertEqual(self.lims.requests, 1 + 4)
+
+    @unittest.skipIf(objectsDB is None, "no genologics configuration")
+    def test_process_info(self):
+        """Test building process info with batch requests, with the same result as one entity at a time"""
+        reference = lims_standin.RecordedLims(self.lims.responses)
+        expected = _reference_process_info(reference.get_processes(projectname=PROJECT))
+        # One list, four processes, one process type, 96 artifacts and 24 samples
+        self.assertEqual(reference.requests, 126)
+        cache = LimsCache(self.lims, threads=4)
+        info = objectsDB.ProcessInfo(self.lims, cache.get_processes(projectname=PROJECT), cache).info
+        self.assertEqual(_ids(info), _ids(expected))
+        # One list, four processes, one process type, one artifact batch and one sample batch
+        self.assertEqual(self.lims.requests, 8)
+        objectsDB.ProcessInfo(self.lims, cache.get_processes(projectname=PROJECT), cache)
+        self.assertEqual(self.lims.requests, 8)
@@ -0,0 +1,114 @@
+import os
+import time
+import signal
+import logging
+import unittest
+
+from scilifelab.lims_utils import executor
+from scilifelab.lims_utils.executor import Executor, DONE, FAILED, TIMEOUT, timing_report
+
+def _sleep(log, key, seconds):
+    """Task function: sleep and return the key and pid"""
+    time.sleep(seconds)
+    return (key, os.getpid())
+
+def _ignore_sigterm(log, key, seconds):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    return _sleep(log, key, seconds)
+
+def _fail(log, key):
+    raise ValueError(key)
+
+def _exit(log, key):
+    os._exit(1)
+
+def _log(log, key):
+    log.info("task {}".format(key))
+    return key
+
+def _init(log, offset):
+    return {'log': log, 'offset': offset}
+
+def _add(context, value):
+    return context['offset'] + value
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+class TestExecutor(unittest.TestCase):
+    """Tests for the process pool shared by the lims uploaders"""
+    def test_longest_first(self):
+        """Test that tasks are run highest cost first"""
+        tasks = [(key, (key, 0), cost) for key, cost in [("P1", 2), ("P2", 10), ("P3", 5)]]
+        results = Executor(_sleep, processes=1).run(tasks)
+        self.assertEqual([r.key for r in results], ["P2", "P3", "P1"])
+        self.assertEqual(set([r.status for r in results]), set([DONE]))
+        self.assertEqual([r.result[0] for r in results], ["P2", "P3", "P1"])
+
+    def test_initializer(self):
+        """Test that the context of the initializer is passed to tasks"""
+        results = Executor(_add, _init, (10,), processes=2).run([(i, (i,), i) for i in range(4)])
+        self.assertEqual(sorted([r.result for r in results]), [10, 11, 12, 13])
+
+    def test_failures(self):
+        """Test that errors and crashed workers fail their task only"""
+        results = Executor(_fail, processes=1).run([("P1", ("P1",), 1)])
+        self.assertEqual(results[0].status, FAILED)
+        self.assertIn("ValueError: P1", results[0].result)
+        results = Executor(_exit, processes=2).run([(i, (i,), 1) for i in range(3)])
+        self.assertEqual(sorted([r.key for r in results]), [0, 1, 2])
+        self.assertEqual(set([r.status for r in results]), set([FAILED]))
+
+    def test_timeout(self):
+        """Test that tasks running past the timeout are stopped"""
+        tasks = [("slow", ("slow", 30), 2), ("fast", ("fast", 0), 1)]
+        start = time.time()
+        results = dict([(r.key, r) for r in Executor(_sleep, processes=1, timeout=0.5).run(tasks)])
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual(results["slow"].status, TIMEOUT)
+        self.assertEqual(results["fast"].status, DONE)
+
+    def test_timeout_signal_handlers(self):
+        """Test that workers are stopped regardless of the signal handlers of the master, and killed if they ignore SIGTERM"""
+        handler = signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        try:
+            start = time.time()
+            results = Executor(_sleep, processes=1, timeout=0.5).run([("slow", ("slow", 30), 1)])
+            self.assertLess(time.time() - start, 10)
+            self.assertEqual(results[0].status, TIMEOUT)
+        finally:
+            signal.signal(signal.SIGTERM, handler)
+        kill_timeout = executor.KILL_TIMEOUT
+        executor.KILL_TIMEOUT = 0.5
+        try:
+            start = time.time()
+            results = Executor(_ignore_sigterm, processes=1, timeout=0.5).run([("slow", ("slow", 30), 1)])
+            self.assertLess(time.time() - start, 10)
+            self.assertEqual(results[0].status, TIMEOUT)
+        finally:
+            executor.KILL_TIMEOUT = kill_timeout
+
+    def test_recycle(self):
+        """Test that workers are replaced after max_tasks tasks"""
+        results = Executor(_sleep, processes=1, max_tasks=2).run([(i, (i, 0), 1) for i in range(6)])
+        pids = [r.result[1] for r in results]
+        self.assertEqual(len(set(pids)), 3)
+        self.assertEqual(set([r.worker for r in results]), set(pids))
+
+    def test_log(self):
+        """Test that log records of the workers are handled by the master log"""
+        log = logging.getLogger("test_executor")
+        log.propagate = False
+        handler = ListHandler()
+        log.addHandler(handler)
+        Executor(_log, processes=2, log=log).run([(i, (i,), 1) for i in range(3)])
+        self.assertEqual(sorted([r.getMessage() for r in handler.records]), ["task 0", "task 1", "task 2"])
+        lines = timing_report(Executor(_log, processes=1, log=log).run([("P1", ("P1",), 1)]))
+        self.assertEqual(len(lines), 5)
+        self.assertTrue(lines[1].startswith("P1 "))
+        self.assertTrue(lines[2].startswith("1 tasks done"))
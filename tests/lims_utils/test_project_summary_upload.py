@@ -0,0 +1,68 @@
+import os
+import shutil
+import datetime
+import tempfile
+import unittest
+
+try:
+    from . import lims_standin
+    from scilifelab.lims_utils import project_summary_upload_LIMS as psul
+except (ImportError, SystemExit):
+    # genologics.config exits if there is no genologics configuration
+    psul = None
+
+@unittest.skipIf(psul is None, "genologics is not installed or configured")
+class TestIncrementalUpload(unittest.TestCase):
+    """Tests for selecting the projects that changed since the previous incremental upload"""
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_psul_")
+        self.state_file = os.path.join(self.rootdir, "state.json")
+        self.lims = lims_standin.RecordedLims({})
+        for i in range(3):
+            self.lims.responses.update(lims_standin.record_project(self.lims, "J.Doe_00_0{}".format(i + 1), "P00{}".format(i + 1),
+                                                                   n_samples=4, n_processes=2))
+        self.projects = [psul.Project(self.lims, id="P00{}".format(i + 1)) for i in range(3)]
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def _record_changes(self, since, projects, processes):
+        """Record the changed since queries"""
+        self.lims.responses.update([lims_standin.record_list(self.lims, "projects", "project", projects, **{"last-modified":since}),
+                                    lims_standin.record_list(self.lims, "processes", "process", processes, **{"last-modified":since})])
+
+    def test_changed_project_ids(self):
+        """Test finding projects that were modified, or have samples in modified processes"""
+        self._record_changes("2014-06-30T00:00:00Z", ["P003"], ["24-0011001"])
+        self.assertEqual(psul.changed_project_ids(self.lims, "2014-06-30T00:00:00Z", threads=2), set(["P001", "P003"]))
+        self._record_changes("2014-07-01T00:00:00Z", [], [])
+        self.assertEqual(psul.changed_project_ids(self.lims, "2014-07-01T00:00:00Z"), set())
+
+    def test_state(self):
+        """Test that projects are rebuilt on the first run, and only when changed or not handled after that"""
+        state = psul.ProjectState(self.state_file)
+        self.assertEqual(state.select(self.lims, self.projects), (self.projects, []))
+        state.mark("P001", 4)
+        state.mark("P002", 12)
+        state.save()
+        state = psul.ProjectState(self.state_file)
+        state.start += datetime.timedelta(hours=24)
+        since = datetime.datetime.strptime(state.since, state.time_format) - state.margin
+        self._record_changes(since.strftime(state.time_format), ["P002"], [])
+        rebuild, skipped = state.select(self.lims, self.projects)
+        self.assertEqual([p.id for p in rebuild], ["P002", "P003"])
+        self.assertEqual([p.id for p in skipped], ["P001"])
+        self.assertTrue(state.projects["P001"]["modified"] > state.since)
+        self.assertEqual(state.no_of_samples("P002"), 12)
+        self.assertIsNone(state.no_of_samples("P003"))
+
+    def test_log_metrics(self):
+        """Test counting skipped, rebuilt and uploaded projects"""
+        log = psul.logging.getLogger("test_psul")
+        records = []
+        log.info = records.append
+        results = [("P001", "J.Doe_00_01", "rebuilt", True, 4, 2.0), ("P002", "J.Doe_00_02", "rebuilt", False, 12, 5.0),
+                   ("P003", "J.Doe_00_03", "failed", False, None, 1.0)]
+        psul.log_metrics(log, results, self.projects[0:1])
+        self.assertEqual(records[0], "Projects: 1 skipped, 2 rebuilt, 1 uploaded, 0 not updated, 1 failed")
+        self.assertEqual(len(records), 1)
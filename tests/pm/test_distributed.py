@@ -0,0 +1,155 @@
+"""
+Test distributed extension with the fake scheduler backend
+"""
+import os
+import glob
+import shutil
+import tempfile
+import unittest
+import mock
+from cement.core import handler
+from test_default import PmTest, safe_makedir
+from scilifelab.pm.core.project import ProjectController
+from scilifelab.pm.ext.ext_distributed import write_array_tasks, common_dir
+from scilifelab.utils.scheduler import DrmaaBackend, FakeBackend, get_backend, reset_backends, DONE, FAILED, QUEUED_ACTIVE, RUNNING, PARAMETRIC_INDEX
+
+flowcell = "120829_SN0001_0001_AA001AAAXX"
+FASTQ_FILES = ['1_120829_AA001AAAXX_nophix_{}_{}_fastq.txt'.format(i, r) for i in [1, 2, 3] for r in [1, 2]]
+
+class FakeBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_distributed_")
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_common_dir(self):
+        """Test getting the directory containing the working directories of an array"""
+        self.assertEqual(common_dir(["/data/P1/s1", "/data/P1/s2"]), "/data/P1")
+        self.assertEqual(common_dir(["/data/P1/s1", "/data/P1/s1"]), "/data/P1/s1")
+
+    def test_run_array(self):
+        """Test running the task scripts of a job array in their working directories"""
+        templates = []
+        for name in ["s1", "s 2", "s3"]:
+            work_dir = safe_makedir(os.path.join(self.rootdir, name))
+            templates.append({'remoteCommand':'ls', 'args':['-a', "."], 'jobName':'jobname', 'workingDirectory':work_dir,
+                              'outputPath':":{}".format(os.path.join(work_dir, "ls.out")), 'errorPath':":{}".format(os.path.join(work_dir, "ls.err"))})
+        templates[2]['args'] = ["missing_file"]
+        arraydir = os.path.join(self.rootdir, "array")
+        template = write_array_tasks(arraydir, templates)
+        self.assertEqual(template['workingDirectory'], os.path.join(arraydir, PARAMETRIC_INDEX))
+        backend = FakeBackend(execute=True)
+        jobids = backend.run_array(template, len(templates))
+        self.assertEqual(backend.submissions, 1)
+        self.assertEqual(backend.job_status(jobids), {jobids[0]:DONE, jobids[1]:DONE, jobids[2]:FAILED})
+        with open(os.path.join(self.rootdir, "s 2", "ls.out")) as fh:
+            self.assertIn("ls.err", fh.read().split())
+        self.assertEqual(backend.job_status(["unknown"]), {"unknown":None})
+
+    def test_unknown_backend(self):
+        """Test that an unknown backend label gives an error listing the backends"""
+        with self.assertRaisesRegexp(ValueError, "unknown distributed backend 'slurm'; must be one of drmaa, fake"):
+            get_backend("slurm")
+
+class DrmaaBackendTest(unittest.TestCase):
+    """Tests for the drmaa backend, with a mock drmaa module"""
+    def setUp(self):
+        self.drmaa = mock.Mock()
+        self.drmaa.Session.TIMEOUT_NO_WAIT = 0
+        for exc in ["ExitTimeoutException", "InternalException", "InvalidJobException"]:
+            setattr(self.drmaa.errors, exc, type(exc, (Exception,), {}))
+        patcher = mock.patch("scilifelab.utils.scheduler.drmaa", self.drmaa, create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.backend = DrmaaBackend()
+        self.session = self.backend._session = mock.Mock()
+
+    def test_job_status_finished(self):
+        """Test getting the states of finished jobs with one synchronize call"""
+        self.session.wait.side_effect = lambda jobid, timeout: mock.Mock(hasExited=True, exitStatus=int(jobid) - 1)
+        self.assertEqual(self.backend.job_status([1, 2]), {"1":DONE, "2":FAILED})
+        self.session.synchronize.assert_called_once_with(["1", "2"], 0, False)
+        self.assertFalse(self.session.jobStatus.called)
+
+    def test_job_status_active(self):
+        """Test querying the states of jobs one by one if not all have finished"""
+        self.session.synchronize.side_effect = self.drmaa.errors.ExitTimeoutException()
+        def job_status(jobid):
+            if jobid == "3":
+                raise self.drmaa.errors.InvalidJobException()
+            return RUNNING
+        self.session.jobStatus.side_effect = job_status
+        self.assertEqual(self.backend.job_status(["1", "3"]), {"1":RUNNING, "3":None})
+        self.assertEqual(self.session.synchronize.call_count, 1)
+
+class DistributedTest(PmTest):
+    def setUp(self):
+        super(DistributedTest, self).setUp()
+        self.env = os.environ.get("PM_DISTRIBUTED_BACKEND")
+        os.environ["PM_DISTRIBUTED_BACKEND"] = "fake"
+        reset_backends()
+        self.app = self.make_app(argv = [])
+        self.app.setup()
+        self.project_dir = os.path.join(self.app.config.get("project", "root"), "j_doe_00_09")
+        self.fastq_dir = os.path.join(self.project_dir, "data", flowcell)
+        safe_makedir(self.fastq_dir)
+        for f in FASTQ_FILES:
+            open(os.path.join(self.fastq_dir, f), "w").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.project_dir)
+        reset_backends()
+        if self.env is None:
+            del os.environ["PM_DISTRIBUTED_BACKEND"]
+        else:
+            os.environ["PM_DISTRIBUTED_BACKEND"] = self.env
+
+    def _compress(self, *args):
+        self.app = self.make_app(argv = ['project', 'compress', 'j_doe_00_09', '--fastq', '--drmaa', '-A', 'jobaccount', '--jobname', 'compressdist', '-t', '00:01:00', '--partition', 'devel', '--force'] + list(args), extensions=['scilifelab.pm.ext.ext_distributed'])
+        handler.register(ProjectController)
+        self._run_app()
+
+    def test_compress(self):
+        """Test that jobs are submitted one at a time through one backend"""
+        self._compress()
+        backend = get_backend()
+        self.assertEqual(backend.submissions, len(FASTQ_FILES))
+        self.assertEqual(sorted([t['args'][-1] for t in backend.jobs.values()]), sorted([os.path.join(self.fastq_dir, f) for f in FASTQ_FILES]))
+
+    def test_compress_array(self):
+        """Test that jobs are submitted as one job array with --array"""
+        self._compress('--array')
+        backend = get_backend()
+        self.assertEqual(backend.submissions, 1)
+        self.assertEqual(len(backend.jobs), len(FASTQ_FILES))
+        scripts = glob.glob(os.path.join(self.fastq_dir, "compressdist-array-*", "*", "task.sh"))
+        self.assertEqual(len(scripts), len(FASTQ_FILES))
+        self.assertEqual(set([t['remoteCommand'] for t in backend.jobs.values()]), set(["/bin/sh"]))
+
+    def test_compress_array_failed(self):
+        """Test that the task scripts of an array are removed if it is not submitted"""
+        with mock.patch.object(FakeBackend, "run_array", side_effect=RuntimeError("submission failed")):
+            self.assertRaises(RuntimeError, self._compress, '--array')
+        self.assertEqual(glob.glob(os.path.join(self.fastq_dir, "compressdist-array-*")), [])
+
+    def test_compress_array_dry_run(self):
+        """Test that job arrays are not submitted in a dry run"""
+        self._compress('--array', '-n')
+        self.assertEqual(get_backend().submissions, 0)
+        self.assertIn("job array of {} tasks".format(len(FASTQ_FILES)), self.app._output_data['stderr'].getvalue())
+
+    def test_monitor_jobs(self):
+        """Test polling the status of the jobs of several working directories at once"""
+        self._compress('-n')
+        backend = get_backend()
+        work_dirs = [safe_makedir(os.path.join(self.fastq_dir, "s{}".format(i))) for i in range(3)]
+        jobids = [backend.run_job({}), backend.run_job({}), "unknown"]
+        backend.status[jobids[1]] = DONE
+        for work_dir, jobid in zip(work_dirs, jobids):
+            with open(os.path.join(work_dir, "JOBID"), "w") as fh:
+                fh.write(jobid)
+        self.assertEqual(self.app.cmd.monitor_jobs(work_dirs), {work_dirs[0]:True})
+        self.assertEqual(backend.status_queries, 1)
+        self.assertTrue(self.app.cmd.monitor(work_dirs[0]))
+        self.assertEqual(backend.status[jobids[0]], QUEUED_ACTIVE)
@@ -3,11 +3,16 @@ Test extensions
 """
 
 import os
+import shutil
+import tempfile
 import unittest
+import mock
 from cement.core import handler
 from cement.utils import shell
 from scilifelab.pm.core.production import ProductionController
+from scilifelab.db.statusdb import FlowcellRunMetricsDocument, ProjectSummaryDocument
 from test_default import PmTest
+from tests.statusdb import couchdb_standin
 
 filedir = os.path.abspath(os.path.dirname(os.path.realpath(__file__)))
 
@@ -47,3 +52,51 @@ class PmHsMetricsTest(PmTest):
         self._run_app()
         hsmetrics_str = "(DRY_RUN): java -Xmx3g -jar {}/CalculateHsMetrics.jar INPUT={}/120829_SN0001_0001_AA001AAAXX/1_120829_AA001AAAXX_nophix_8-sort-dup.bam TARGET_INTERVALS={}/regionfile BAIT_INTERVALS={}/regionfile OUTPUT={}/120829_SN0001_0001_AA001AAAXX/1_120829_AA001AAAXX_nophix_8-sort-dup.hs_metrics VALIDATION_STRINGENCY=SILENT".format(os.getenv("PICARD_HOME"), self.app.config.get("production", "root"), filedir, filedir, self.app.config.get("production", "root"))
         self.eq(hsmetrics_str, str(sorted(self.app._output_data['stderr'].getvalue().rstrip().split("\n"))[-1]))
+
+
+class PmCouchdbReplicaTest(PmTest):
+    def setUp(self):
+        super(PmCouchdbReplicaTest, self).setUp()
+        self.rootdir = tempfile.mkdtemp(prefix="test_replica_")
+        self.server = couchdb_standin.Server()
+        self.server.create("flowcells-test").save(FlowcellRunMetricsDocument(fc_date="120924", fc_name="AC003CCCXX", projects=["P001"]))
+        self.server.create("x_flowcells").save({"name":"130101_BB001BBBXX", "projects":["P002"]})
+        self.server.create("projects-test").save(ProjectSummaryDocument(project_name="J.Doe_00_01", project_id="P001"))
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def _run_replica(self, *args):
+        self.app = self.make_app(argv=['db', 'replica', '--replica', self.rootdir] + list(args), extensions=['scilifelab.pm.ext.ext_couchdb'])
+        with mock.patch("scilifelab.db.get_server", return_value=(self.server, False)), mock.patch("scilifelab.db.check_url", return_value=True):
+            self._run_app()
+        return [x.split("\t") for x in self.app._output_data['stdout'].getvalue().splitlines()]
+
+    def test_replica(self):
+        """Sync and rebuild the replicas of all replicated databases"""
+        lines = self._run_replica()
+        self.eq([(x[0], x[2]) for x in lines], [("flowcells-test", "1 changes"), ("projects-test", "1 changes"), ("x_flowcells", "1 changes")])
+        self.assertTrue(all(os.path.exists(x[1]) for x in lines))
+        self.server.reset_requests()
+        lines = self._run_replica()
+        self.eq([x[2] for x in lines], ["0 changes"] * 3)
+        # One changes request per database; server views are not copied again
+        self.eq(self.server.requests, 3)
+        lines = self._run_replica('--rebuild')
+        self.eq([x[2] for x in lines], ["1 changes"] * 3)
+
+def _square(x, offset=0):
+    if x < 0:
+        raise ValueError("negative")
+    return x * x + offset
+
+class PmQcPoolTest(unittest.TestCase):
+    def test_run_in_pool(self):
+        """Test that per-sample tasks keep their order and report errors per sample"""
+        from scilifelab.pm.ext.ext_qc import run_in_pool
+        tasks = [("s{}".format(i), i, {'offset': 1}) for i in [3, -1, 2, 5]]
+        for workers, processes in [(1, False), (3, False), (2, True)]:
+            res = run_in_pool(_square, tasks, workers, processes)
+            self.assertEqual([x[0] for x in res], ["s3", "s-1", "s2", "s5"])
+            self.assertEqual([x[1] for x in res], [10, None, 5, 26])
+            self.assertIsInstance(res[1][2], ValueError)
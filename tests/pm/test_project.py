@@ -68,6 +68,15 @@ class ProjectTest(PmTest):
         handler.register(ProjectController)
         self._run_app()
 
+    def test_compress_local(self):
+        """Test local parallel compression and decompression of project data"""
+        self.app = self.make_app(argv = ['project', 'compress', 'j_doe_00_01', '--fastq', '--local', '--cores', '2', '--force'])
+        handler.register(ProjectController)
+        self._run_app()
+        self.app = self.make_app(argv = ['project', 'decompress', 'j_doe_00_01', '--fastq', '--local', '--cores', '2', '--force'])
+        handler.register(ProjectController)
+        self._run_app()
+
     @unittest.skipIf(not os.getenv("DRMAA_LIBRARY_PATH"), "not running production test: no $DRMAA_LIBRARY_PATH")
     def test_compress_distributed(self):
         """Test distributed compression of project data"""
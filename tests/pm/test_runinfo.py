@@ -5,6 +5,8 @@ import os
 import yaml
 import glob
 import re
+import shutil
+import tempfile
 from cement.core import handler
 from test_default import PmTest
 from scilifelab.bcbio.flowcell import *
@@ -104,3 +106,133 @@ class FlowcellTest(PmTest):
         For files without fastq info conversion to yaml fails.
         """
         pass
+
+
+def write_runinfo(fname, lanes=2, samples=12):
+    """Write a run_info.yaml with <lanes> lanes of <samples> samples"""
+    details = []
+    for lane in range(1, lanes + 1):
+        multiplex = [dict(barcode_id=i, name="P{}_{}_index{}".format(lane, 100 + i, i), sample_prj="J.Doe_00_0{}".format(lane),
+                          sequence="ACGT{}{}".format(lane, i), barcode_type="SampleSheet") for i in range(1, samples + 1)]
+        details.append(dict(lane=str(lane), flowcell_id="AA001AAAXX", analysis="Align_standard_seqcap", multiplex=multiplex))
+    with open(fname, "w") as fh:
+        fh.write(yaml.dump(dict(details=details)))
+
+class FileClassifierTest(unittest.TestCase):
+    """Test precompiled file classification"""
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_file_classifier_")
+        self.runinfo = os.path.join(self.rootdir, "run_info.yaml")
+        write_runinfo(self.runinfo)
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_file_filter(self):
+        """Test that file filter matches the glob prefix patterns"""
+        fc = Flowcell(self.runinfo)
+        files = ["1_120829_AA001AAAXX_nophix_10_1_fastq.txt", "2_120829_AA001AAAXX_3-sort-dup.bam",
+                 "3_120829_AA001AAAXX_3-sort-dup.bam", "1_120829_BB001BBBXX_1.bam",
+                 "P1_101_index1_ACGT11_L001_R1_001.fastq.gz", "P1_101_index1-bcbb-command.txt",
+                 "P1_101_index10_ACGT110_L001_R1_001.fastq.gz", "P1_101_index1.fastq", "P1_999_index1_R1.fastq",
+                 "09_realign_sample.txt", "29_realign_sample.txt", "bcbb_software_versions.txt", "run_info.yaml"]
+        pattern = "|".join(fc.glob_pfx_str())
+        classifier = fc.classifier()
+        for f in files:
+            self.assertEqual(classifier.file_filter(f), re.search(pattern, f) is not None, f)
+
+    def test_classify_file(self):
+        """Test file classification by lane and sample"""
+        fc = Flowcell(self.runinfo)
+        fc.classify_file("1_120829_AA001AAAXX_nophix.bc_metrics")
+        fc.classify_file("2_120829_AA001AAAXX_nophix_unmatched_1_fastq.txt")
+        fc.classify_file("1_120829_AA001AAAXX_nophix_10_1_fastq.txt")
+        fc.classify_file("2_120829_AA001AAAXX_nophix_3-sort-dup.bam")
+        fc.classify_file("P2_112_index12_ACGT212_L002_R1_001.fastq.gz")
+        fc.classify_file("P1_110_index10-bcbb-command.txt")
+        self.assertEqual(fc.lane_files["1"], [os.path.abspath("1_120829_AA001AAAXX_nophix.bc_metrics")])
+        self.assertEqual(fc.lane_files["2"], [os.path.abspath("2_120829_AA001AAAXX_nophix_unmatched_1_fastq.txt")])
+        self.assertEqual(fc.get_entry("1_ACGT110", "files"), [os.path.abspath("1_120829_AA001AAAXX_nophix_10_1_fastq.txt")])
+        self.assertEqual(fc.get_entry("2_ACGT23", "results"), [os.path.abspath("2_120829_AA001AAAXX_nophix_3-sort-dup.bam")])
+        self.assertEqual(fc.get_entry("2_ACGT212", "files"), [os.path.abspath("P2_112_index12_ACGT212_L002_R1_001.fastq.gz")])
+        self.assertEqual(fc.get_entry("1_ACGT110", "results"), [os.path.abspath("P1_110_index10-bcbb-command.txt")])
+
+    def test_classifier_first_name(self):
+        """Test that the first name in the flowcell that prefixes a file name wins"""
+        fc = Flowcell(self.runinfo)
+        classifier = fc.classifier()
+        names = fc._column("name")
+        self.assertEqual(names[classifier.match_name("P1_101_index1_ACGT11_L001_R1_001.fastq")], "P1_101_index1")
+        self.assertEqual(names[classifier.match_name("P1_110_index10_ACGT110_L001_R1_001.fastq")], "P1_110_index10")
+        self.assertEqual(classifier.match_name("P3_101_index1.fastq"), None)
+
+    def test_classifier_invalidation(self):
+        """Test that the classifier follows changes to names and barcodes"""
+        fc = Flowcell(self.runinfo)
+        classifier = fc.classifier()
+        self.assertIs(fc.classifier(), classifier)
+        self.assertEqual(classifier.barcode_id_to_sequence("1")[1], "ACGT11")
+        fc.set_entry("1_ACGT11", "name", "Q1_101")
+        self.assertEqual(fc.classifier().match_name("Q1_101_L001_R1_001.fastq"), 0)
+        new_fc = fc.fc_with_unique_lanes()
+        self.assertIsNot(new_fc.classifier(), fc.classifier())
+        self.assertEqual(new_fc.classifier().match_name("Q1_101_L001_R1_001.fastq"), 0)
+
+
+class RunInfoIndexTest(unittest.TestCase):
+    """Test indexed run information lookups"""
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_runinfo_index_")
+        self.runinfo = os.path.join(self.rootdir, "run_info.yaml")
+        write_runinfo(self.runinfo, lanes=3, samples=4)
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_lane_lookups(self):
+        """Test that lane lookups match subsets"""
+        fc = Flowcell(self.runinfo)
+        for lane in fc.lanes():
+            lane_fc = fc.subset("lane", lane)
+            self.assertEqual(fc.barcodes(lane), lane_fc._column("barcode_id"))
+            self.assertEqual(fc.names(lane), lane_fc._column("name"))
+            self.assertEqual(fc.barcode_sequences(lane), lane_fc._column("sequence"))
+        self.assertEqual(fc.barcode_id_to_sequence("2"), {1: "ACGT21", 2: "ACGT22", 3: "ACGT23", 4: "ACGT24"})
+        self.assertEqual(fc.barcodes("4"), [])
+        self.assertEqual(len(fc.subset("name", "P3_102_index2")), 1)
+        self.assertEqual(fc.subset("sample_prj", "J.Doe_00_01").lanes(), ["1"])
+
+    def test_index_updates(self):
+        """Test that lookups follow set_entry and append_to_entry"""
+        fc = Flowcell(self.runinfo)
+        self.assertEqual(fc.barcode_id_to_sequence("1")[1], "ACGT11")
+        fc.set_entry("1_ACGT11", "barcode_id", 13)
+        self.assertEqual(fc.barcodes("1"), [13, 2, 3, 4])
+        self.assertEqual(fc.barcode_id_to_sequence("1")[13], "ACGT11")
+        self.assertEqual(fc._column("files"), [[]] * 12)
+        fc.append_to_entry("1_ACGT12", "files", "1_120829_AA001AAAXX_2_1_fastq.txt")
+        self.assertEqual(fc.get_entry("1_ACGT12", "files"), ["1_120829_AA001AAAXX_2_1_fastq.txt"])
+        self.assertEqual(fc._column("files")[1], ["1_120829_AA001AAAXX_2_1_fastq.txt"])
+
+    def test_subset_updates(self):
+        """Test that lookups of subsets and their flowcell follow updates of either"""
+        fc = Flowcell(self.runinfo)
+        lane_fc = fc.subset("lane", "1")
+        name_fc = lane_fc.subset("name", "P1_101_index1")
+        self.assertEqual(lane_fc.barcodes("1"), [1, 2, 3, 4])
+        self.assertEqual(name_fc.barcodes("1"), [1])
+        fc.set_entry("1_ACGT11", "barcode_id", 13)
+        self.assertEqual(lane_fc.barcodes("1"), [13, 2, 3, 4])
+        self.assertEqual(name_fc.barcode_id_to_sequence("1"), {13: "ACGT11"})
+        lane_fc.set_entry("1_ACGT12", "barcode_id", 14)
+        self.assertEqual(fc.barcodes("1"), [13, 14, 3, 4])
+        self.assertEqual(fc.fc_with_unique_lanes().subset("lane", "1").barcodes("1"), [13])
+
+    def test_yaml_round_trip(self):
+        """Test that run information round-trips through yaml"""
+        fc = Flowcell(self.runinfo)
+        fc.barcodes("1")
+        outfile = os.path.join(self.rootdir, "run_info-out.yaml")
+        with open(outfile, "w") as fh:
+            fh.write(fc.as_yaml())
+        self.assertEqual(Flowcell(outfile).as_yaml(), fc.as_yaml())
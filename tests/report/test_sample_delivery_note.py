@@ -1,10 +1,17 @@
 import os
+import shutil
+import tempfile
 import unittest
 import logbook
+import mock
 from scilifelab.report import sequencing_success
-from scilifelab.report.rl import make_example_sample_note
+from scilifelab.report.rl import make_example_sample_note, example_sample_note_params, make_sample_notes
+from scilifelab.report.rst import make_sample_rest_notes
+from scilifelab.report.delivery_notes import sample_status_note
+from scilifelab.db.statusdb import SampleRunMetricsDocument, FlowcellRunMetricsDocument, ProjectSummaryDocument
 
 from ..classes import has_couchdb_installation
+from ..statusdb import couchdb_standin
 
 filedir = os.path.abspath(os.path.realpath(os.path.dirname(__file__)))
 flowcells = ["120924_SN0002_0003_AC003CCCXX", "121015_SN0001_0002_BB002BBBXX"]
@@ -52,3 +59,79 @@ class TestSampleDeliveryFunctions(unittest.TestCase):
 
 
         
+
+class TestSampleStatusNoteRequests(unittest.TestCase):
+    """Count database requests made when collecting sample status note
+    data, using an in-memory couchdb stand-in"""
+    def _make_server(self, n_samples):
+        """Stand-in server with one flowcell and one project of <n_samples> samples"""
+        server = couchdb_standin.Server()
+        samples = {}
+        s_db = server.create("samples")
+        for i in range(n_samples):
+            sample = "P001_{}".format(101 + i)
+            srm = SampleRunMetricsDocument(flowcell="AC003CCCXX", date="120924", lane=str(1 + i % 8), sequence="TGACCA{:02d}".format(i),
+                                           sample_prj="J.Doe_00_01", barcode_name=sample, project_sample_name=sample, bc_count=10000000)
+            s_db.save(srm)
+            samples[sample] = {"customer_name":"cust_{}".format(i), "scilife_name":sample,
+                               "sample_run_metrics":{srm["name"]:srm["_id"]}}
+        server.create("flowcells").save(FlowcellRunMetricsDocument(fc_date="120924", fc_name="AC003CCCXX",
+                                                                   RunInfo={"Instrument":"SN0002", "Reads":[{"IsIndexedRead":"N"}, {"IsIndexedRead":"Y"}, {"IsIndexedRead":"N"}]},
+                                                                   RunParameters={"RunMode":"High Output", "RTAVersion":"1.13.48"},
+                                                                   illumina={"Demultiplex_Stats":{"Barcode_lane_statistics":[]}}))
+        server.create("projects").save(ProjectSummaryDocument(project_name="J.Doe_00_01", samples=samples, min_m_reads_per_sample_ordered=10))
+        server.reset_requests()
+        return server
+
+    def _sample_status_note(self, server, **kw):
+        with mock.patch("scilifelab.db.get_server", return_value=(server, False)), \
+                mock.patch("scilifelab.db.check_url", return_value=True), \
+                mock.patch("scilifelab.report.delivery_notes.make_sample_notes"), \
+                mock.patch("scilifelab.report.delivery_notes.make_sample_rest_notes"), \
+                mock.patch("scilifelab.report.delivery_notes.concatenate_notes"):
+            return sample_status_note(project_name="J.Doe_00_01", flowcell="AC003CCCXX", username="u", password="p", url="localhost", **kw)
+
+    def test_document_requests(self):
+        """Retrieve each flowcell and project document once per sample status note"""
+        cached = {}
+        for n_samples in [48, 96]:
+            server = self._make_server(n_samples)
+            self._sample_status_note(server)
+            self.assertEqual(server["flowcells"].gets, 1)
+            self.assertEqual(server["projects"].gets, 1)
+            cached[n_samples] = server.requests
+            server.reset_requests()
+            output_data = self._sample_status_note(server, cache_size=0)
+            # Without the cache, the flowcell and project documents are
+            # retrieved at least once per sample
+            self.assertGreaterEqual(server["flowcells"].gets, n_samples)
+            self.assertGreaterEqual(server["projects"].gets, n_samples)
+            self.assertGreater(server.requests, cached[n_samples] + 2 * n_samples)
+            self.assertEqual(len([x for x in output_data["stdout"].getvalue().splitlines() if x.strip().startswith("P001_")]), n_samples)
+        # With the cache, the number of requests does not depend on the number of samples
+        self.assertEqual(cached[48], cached[96])
+
+class TestNoteRendering(unittest.TestCase):
+    """Render sample notes in one and several processes"""
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.rootdir = tempfile.mkdtemp(prefix="test_note_rendering_")
+        os.chdir(self.rootdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.rootdir)
+
+    def test_make_sample_notes(self):
+        """Render notes in parallel, in sample order"""
+        for jobs in [1, 3]:
+            s_params = [example_sample_note_params(scilifelab_name="P001_{}".format(101 + i), outfile="P001_{}_{}.pdf".format(101 + i, jobs)) for i in range(8)]
+            notes = make_sample_notes(s_params, jobs=jobs)
+            self.assertEqual(notes, [x["outfile"] for x in s_params])
+            self.assertTrue(all(os.path.exists(x) for x in notes))
+            make_sample_rest_notes("summary_{}.rst".format(jobs), s_params, jobs=jobs)
+        with open(os.path.join("rst", "summary_1.rst")) as fh:
+            serial = fh.read()
+        with open(os.path.join("rst", "summary_3.rst")) as fh:
+            self.assertEqual(fh.read(), serial)
+        self.assertTrue(serial.index("P001_101") < serial.index("P001_108"))
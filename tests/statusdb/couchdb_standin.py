@@ -0,0 +1,264 @@
+"""In-memory stand-in for a couchdb server.
+
+Mimics the parts of the couchdb-python Server/Database API that the
+statusdb connections use, with python equivalents of the javascript
+views in scilifelab.db.statusdb.VIEWS. Every call that would be an
+HTTP request against a real server is counted in ``requests``, and
+single document retrievals are in addition counted in ``gets``.
+"""
+import re
+import copy
+import mock
+from uuid import uuid4
+from couchdb.http import ResourceNotFound, ResourceConflict
+
+def _is_run(doc):
+    return re.search("_[0-9]+$", doc.get("name") or "") is not None
+
+def _barcode_lane_stat(doc):
+    return doc.get("illumina", {}).get("Demultiplex_Stats", {}).get("Barcode_lane_statistics", None)
+
+def _content_hash(doc):
+    return [(doc["_id"], [doc["_rev"], doc["content_hash"]])] if doc.get("content_hash") else []
+
+# Python versions of the views, keyed by database label as in VIEWS
+VIEWS = {'samples' : {'names/name' : lambda doc: [] if _is_run(doc) else [(doc["name"], None)],
+                      'names/name_fc' : lambda doc: [] if _is_run(doc) else [(doc["name"], doc.get("flowcell"))],
+                      'names/name_proj' : lambda doc: [] if _is_run(doc) else [(doc["name"], doc.get("sample_prj"))],
+                      'names/name_fc_proj' : lambda doc: [] if _is_run(doc) else [(doc["name"], [doc.get("flowcell"), doc.get("sample_prj")])],
+                      'names/id_to_name' : lambda doc: [(doc["_id"], doc["name"])],
+                      'names/fc_name' : lambda doc: [] if _is_run(doc) else [(doc.get("flowcell"), doc["name"])],
+                      'names/proj_name' : lambda doc: [] if _is_run(doc) else [(doc.get("sample_prj"), doc["name"])],
+                      'hash/content_hash' : _content_hash,
+                      },
+         'flowcells' : {'names/name' : lambda doc: [(doc["name"], None)],
+                        'names/id_to_name' : lambda doc: [(doc["_id"], doc["name"])],
+                        'names/Barcode_lane_stat' : lambda doc: [(doc["name"], _barcode_lane_stat(doc))],
+                        'names/project_ids_list' : lambda doc: [(doc["name"], doc.get("projects", []))],
+                        'info/storage_status' : lambda doc: [(doc["name"], {"storage_status": doc.get("storage_status")})],
+                        'info/id' : lambda doc: [(doc["name"], doc["_id"])],
+                        'hash/content_hash' : _content_hash,
+                        },
+         'x_flowcells' : {'info/name' : lambda doc: [(doc.get("name"), None)],
+                          'names/project_ids_list' : lambda doc: [(doc.get("name"), doc.get("projects", []))],
+                          },
+         'projects' : {'project/project_id' : lambda doc: [(doc.get("project_id"), doc["_id"])],
+                       'project/project_name' : lambda doc: [(doc.get("project_name"), doc["_id"])],
+                       'names/id_to_name' : lambda doc: [(doc["_id"], doc.get("project_name"))],
+                       'names/name' : lambda doc: [(doc.get("project_name"), None)],
+                       'hash/content_hash' : _content_hash,
+                       },
+         }
+
+
+class Row(dict):
+    """View row, as couchdb.client.Row"""
+    @property
+    def id(self):
+        return self.get("id")
+
+    @property
+    def key(self):
+        return self.get("key")
+
+    @property
+    def value(self):
+        return self.get("value")
+
+    @property
+    def doc(self):
+        return self.get("doc")
+
+
+class Document(dict):
+    """Document, as couchdb.client.Document"""
+    @property
+    def id(self):
+        return self["_id"]
+
+    @property
+    def rev(self):
+        return self["_rev"]
+
+
+class Database(object):
+    """In-memory couchdb database"""
+    def __init__(self, name, server=None, views=None):
+        self.name = name
+        self.server = server
+        self.docs = {}
+        self.views = dict(views or {})
+        self.requests = 0
+        self.gets = 0
+        self.seq = 0
+        self._changes = {}
+        self._index = {}
+
+    def __repr__(self):
+        return "<Database '{}'>".format(self.name)
+
+    def _request(self):
+        self.requests += 1
+        if self.server:
+            self.server.requests += 1
+
+    def _rev(self, doc):
+        n = int(doc.get("_rev", "0-").split("-")[0]) + 1
+        return "{}-{}".format(n, uuid4().hex)
+
+    def __contains__(self, docid):
+        self._request()
+        return docid in self.docs
+
+    def __getitem__(self, docid):
+        doc = self.get(docid)
+        if doc is None:
+            raise ResourceNotFound(("not_found", "missing"))
+        return doc
+
+    def __len__(self):
+        return len(self.docs)
+
+    def get(self, docid, default=None, **options):
+        self._request()
+        self.gets += 1
+        if docid not in self.docs:
+            return default
+        return Document(copy.deepcopy(self.docs[docid]))
+
+    def _store(self, doc):
+        docid = doc.get("_id") or uuid4().hex
+        stored = self.docs.get(docid)
+        if stored is not None and stored.get("_rev") != doc.get("_rev"):
+            return (docid, None)
+        doc["_id"] = docid
+        doc["_rev"] = self._rev(stored or {})
+        self._index = {}
+        self.docs[docid] = copy.deepcopy(dict(doc))
+        self._changed(docid, doc["_rev"])
+        return (docid, doc["_rev"])
+
+    def save(self, doc, **options):
+        self._request()
+        (docid, rev) = self._store(doc)
+        if rev is None:
+            raise ResourceConflict(("conflict", "Document update conflict."))
+        return (docid, rev)
+
+    def update(self, documents, **options):
+        """Bulk update, as POST /db/_bulk_docs"""
+        self._request()
+        results = []
+        for doc in documents:
+            (docid, rev) = self._store(doc)
+            if rev is None:
+                results.append((False, docid, ResourceConflict(("conflict", "Document update conflict."))))
+            else:
+                results.append((True, docid, rev))
+        return results
+
+    def delete(self, doc):
+        self._request()
+        del self.docs[doc["_id"]]
+        self._index = {}
+        self._changed(doc["_id"], self._rev(doc), deleted=True)
+
+    def _changed(self, docid, rev, deleted=False):
+        """Record a change; like couchdb, only the last change of a document is kept"""
+        self.seq += 1
+        self._changes[docid] = (self.seq, rev, deleted)
+
+    def changes(self, since=0, include_docs=False, limit=None, **options):
+        """Changes feed, as GET /db/_changes with feed=normal"""
+        self._request()
+        changes = sorted([(seq, docid, rev, deleted) for docid, (seq, rev, deleted) in self._changes.iteritems() if seq > since])
+        if limit:
+            changes = changes[0:limit]
+        results = []
+        for (seq, docid, rev, deleted) in changes:
+            result = {"seq":seq, "id":docid, "changes":[{"rev":rev}]}
+            if deleted:
+                result["deleted"] = True
+            if include_docs:
+                result["doc"] = Document(copy.deepcopy(self.docs[docid])) if not deleted else {"_id":docid, "_rev":rev, "_deleted":True}
+            results.append(result)
+        return {"results":results, "last_seq":changes[-1][0] if changes else max(since, 0)}
+
+    def _emit(self, name):
+        """Emit sorted view rows; like a view index, rows are kept until a document changes"""
+        if name not in self._index:
+            self._index[name] = self._map(name)
+        return [Row(r) for r in self._index[name]]
+
+    def _map(self, name):
+        if name == "_all_docs":
+            return sorted([Row(id=docid, key=docid, value={"rev":doc["_rev"]}) for docid, doc in self.docs.iteritems()], key=lambda r: r.key)
+        if name not in self.views:
+            raise ResourceNotFound(("not_found", "missing_named_view"))
+        rows = []
+        for docid, doc in self.docs.iteritems():
+            for (key, value) in self.views[name](doc):
+                rows.append(Row(id=docid, key=key, value=value))
+        return sorted(rows, key=lambda r: (r.key, r.id))
+
+    def view(self, name, wrapper=None, **options):
+        """Query a view; supports key, keys, startkey, endkey and include_docs"""
+        self._request()
+        rows = self._emit(name)
+        if "key" in options:
+            rows = [r for r in rows if r.key == options["key"]]
+        if "startkey" in options:
+            rows = [r for r in rows if r.key >= options["startkey"]]
+        if "endkey" in options:
+            rows = [r for r in rows if r.key <= options["endkey"]]
+        if "keys" in options:
+            by_key = {}
+            for r in rows:
+                by_key.setdefault(r.key, []).append(r)
+            if name == "_all_docs":
+                rows = [by_key[k][0] if k in by_key else Row(key=k, error="not_found") for k in options["keys"]]
+            else:
+                rows = [r for k in options["keys"] for r in by_key.get(k, [])]
+        if options.get("include_docs"):
+            for r in rows:
+                if r.id in self.docs:
+                    r["doc"] = Document(copy.deepcopy(self.docs[r.id]))
+                elif "error" not in r:
+                    r["doc"] = None
+        if wrapper:
+            return [wrapper(r) for r in rows]
+        return rows
+
+
+class Server(object):
+    """In-memory couchdb server"""
+    def __init__(self, url="http://localhost:5984"):
+        self.resource = url
+        self.dbs = {}
+        self.requests = 0
+
+    def __contains__(self, name):
+        return name in self.dbs
+
+    def __getitem__(self, name):
+        if name not in self.dbs:
+            raise ResourceNotFound(("not_found", "no_db_file"))
+        return self.dbs[name]
+
+    def create(self, name, label=None):
+        """Create database <name> with the views of database label <label>"""
+        views = VIEWS.get(label or name.replace("-test", ""), {})
+        self.dbs[name] = Database(name, server=self, views=views)
+        return self.dbs[name]
+
+    def reset_requests(self):
+        self.requests = 0
+        for db in self.dbs.values():
+            db.requests = 0
+            db.gets = 0
+
+
+def connect(cls, server, **kwargs):
+    """Instantiate statusdb connection class <cls> against <server>"""
+    with mock.patch("scilifelab.db.get_server", return_value=(server, False)), mock.patch("scilifelab.db.check_url", return_value=True):
+        return cls(username="u", password="p", url="localhost", **kwargs)
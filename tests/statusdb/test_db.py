@@ -2,9 +2,14 @@ import os
 import unittest
 import ConfigParser
 import logbook
-from scilifelab.db.statusdb import  _match_barcode_name_to_project_sample
+import mock
+import scilifelab.db
+from scilifelab.utils import http
+from scilifelab.db.statusdb import  _match_barcode_name_to_project_sample, SampleRunMetricsConnection, SampleRunMetricsDocument, FlowcellRunMetricsConnection, FlowcellRunMetricsDocument
+from scilifelab.db.statusDB_utils import save_couchdb_obj, content_hash, stamp_hash, HASH_FIELD
 
 from ..classes import has_couchdb_installation
+from . import couchdb_standin
 
 filedir = os.path.abspath(__file__)
 flowcells = ["120924_SN0002_0003_AC003CCCXX", "121015_SN0001_0002_BB002BBBXX"]
@@ -76,3 +81,298 @@ class TestStatusdbFunctions(unittest.TestCase):
         self.assertEqual(None, res)
 
 
+
+
+class TestLazyViews(unittest.TestCase):
+    """Tests for on-demand view queries, using an in-memory couchdb stand-in"""
+    def setUp(self):
+        self.server = couchdb_standin.Server()
+        db = self.server.create("samples")
+        for fc, prj, lanes in [("AC003CCCXX", "J.Doe_00_01", [1, 2]), ("BB002BBBXX", "J.Doe_00_01", [1]), ("AC003CCCXX", "J.Doe_00_02", [3])]:
+            for lane in lanes:
+                db.save(SampleRunMetricsDocument(flowcell=fc, date="120924", lane=lane, sequence="TGACCA", sample_prj=prj, barcode_name="P001_10{}".format(lane)))
+        self.server.reset_requests()
+
+    def test_no_view_downloads_on_connect(self):
+        """Test that constructing a connection does not query any views"""
+        s_con = couchdb_standin.connect(SampleRunMetricsConnection, self.server)
+        self.assertEqual(self.server.requests, 0)
+        self.assertIsNotNone(s_con.get_entry("1_120924_AC003CCCXX_TGACCA"))
+        self.assertIsNone(s_con.get_entry("1_120924_XXXXXXXXXX_TGACCA"))
+
+    def test_get_samples(self):
+        """Test getting samples filtered on the server"""
+        s_con = couchdb_standin.connect(SampleRunMetricsConnection, self.server)
+        self.assertEqual(len(s_con.get_sample_ids(fc_id="AC003CCCXX")), 3)
+        self.assertEqual(len(s_con.get_samples(sample_prj="J.Doe_00_01")), 3)
+        samples = s_con.get_samples(fc_id="AC003CCCXX", sample_prj="J.Doe_00_01")
+        self.assertEqual(set(x["name"] for x in samples), set(["1_120924_AC003CCCXX_TGACCA", "2_120924_AC003CCCXX_TGACCA"]))
+        self.assertEqual(s_con.get_samples(fc_id="AC003CCCXX", sample_prj="bogusproject"), [])
+        self.assertFalse(s_con.name_fc_view._complete)
+
+    def test_missing_view_fallback(self):
+        """Test falling back on client side filtering if keyed view is missing"""
+        del self.server["samples"].views["names/fc_name"]
+        s_con = couchdb_standin.connect(SampleRunMetricsConnection, self.server)
+        self.assertEqual(len(s_con.get_sample_ids(fc_id="AC003CCCXX")), 3)
+        self.assertTrue(s_con.name_fc_view._complete)
+
+    def test_eager(self):
+        """Test loading all views up front"""
+        s_con = couchdb_standin.connect(SampleRunMetricsConnection, self.server, lazy=False)
+        self.assertEqual(self.server.requests, 4)
+        self.assertEqual(len(s_con.name_view), 4)
+
+    def test_get_entries(self):
+        """Test bulk retrieval of entries in chunks"""
+        s_con = couchdb_standin.connect(SampleRunMetricsConnection, self.server)
+        names = ["1_120924_AC003CCCXX_TGACCA", "bogus", "3_120924_AC003CCCXX_TGACCA", "1_120924_BB002BBBXX_TGACCA"]
+        docs = s_con.get_entries(names, chunk_size=2)
+        self.assertEqual([x["name"] if x else None for x in docs], [names[0], None, names[2], names[3]])
+        # One name lookup and two _all_docs chunks
+        self.assertEqual(self.server.requests, 3)
+
+    def test_get_samples_requests(self):
+        """Test that getting samples does not make one request per sample"""
+        s_con = couchdb_standin.connect(SampleRunMetricsConnection, self.server)
+        samples = s_con.get_samples(sample_prj="J.Doe_00_01")
+        self.assertEqual(len(samples), 3)
+        self.assertEqual(self.server.requests, 2)
+
+    def test_save_many(self):
+        """Test saving objects with one lookup, one hash query, one fetch and one bulk write"""
+        s_con = couchdb_standin.connect(SampleRunMetricsConnection, self.server)
+        kw = dict(flowcell="AC003CCCXX", date="120924", sequence="TGACCA", sample_prj="J.Doe_00_01")
+        unchanged = SampleRunMetricsDocument(lane=1, barcode_name="P001_101", **kw)
+        modified = SampleRunMetricsDocument(lane=2, barcode_name="P001_102", bc_count=10, **kw)
+        new = SampleRunMetricsDocument(lane=5, barcode_name="P001_105", **kw)
+        results = s_con.save_many([unchanged, modified, new])
+        self.assertEqual(self.server.requests, 4)
+        self.assertEqual(len(results), 2)
+        self.assertTrue(all(x[0] for x in results))
+        self.assertEqual(s_con.get_entry("2_120924_AC003CCCXX_TGACCA")["bc_count"], 10)
+        self.assertIsNotNone(s_con.get_entry("5_120924_AC003CCCXX_TGACCA"))
+
+    def test_save_many_unchanged(self):
+        """Test that documents whose content hash is unchanged are not fetched"""
+        s_con = couchdb_standin.connect(SampleRunMetricsConnection, self.server)
+        kw = dict(flowcell="AC003CCCXX", date="120924", sequence="TGACCA", sample_prj="J.Doe_00_01")
+        objs = lambda: [SampleRunMetricsDocument(lane=i, barcode_name="P001_10{}".format(i), **kw) for i in [5, 6]]
+        self.assertEqual(len(s_con.save_many(objs())), 2)
+        s_con = couchdb_standin.connect(SampleRunMetricsConnection, self.server)
+        self.server.reset_requests()
+        self.assertEqual(s_con.save_many(objs()), [])
+        # One name lookup and one hash query
+        self.assertEqual(self.server.requests, 2)
+        results = s_con.save_many(objs()[0:1] + [SampleRunMetricsDocument(lane=6, barcode_name="P001_106", bc_count=10, **kw)])
+        self.assertEqual(len(results), 1)
+        self.assertEqual(s_con.get_entry("6_120924_AC003CCCXX_TGACCA")["bc_count"], 10)
+
+    def test_save_many_names(self):
+        """Test that names excluded from the name view and repeated names do not create duplicates"""
+        s_con = couchdb_standin.connect(SampleRunMetricsConnection, self.server)
+        kw = dict(flowcell="AC003CCCXX", date="120924", lane=1, sequence="1", sample_prj="J.Doe_00_01")
+        self.server["samples"].save(SampleRunMetricsDocument(**kw))
+        self.assertNotIn("1_120924_AC003CCCXX_1", s_con.name_view)
+        results = s_con.save_many([SampleRunMetricsDocument(bc_count=10, **kw), SampleRunMetricsDocument(bc_count=20, **kw)])
+        self.assertEqual(len(results), 1)
+        docs = [row.id for row in self.server["samples"].view("names/id_to_name") if row.value == "1_120924_AC003CCCXX_1"]
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(self.server["samples"][docs[0]]["bc_count"], 20)
+
+    def test_save_many_conflict(self):
+        """Test that conflicting writes are reported per document"""
+        s_con = couchdb_standin.connect(SampleRunMetricsConnection, self.server)
+        docid = s_con.name_view["1_120924_AC003CCCXX_TGACCA"]
+        obj = SampleRunMetricsDocument(_id=docid, flowcell="AC003CCCXX", date="120924", lane=6, sequence="TGACCA")
+        results = s_con.save_many([obj])
+        self.assertEqual(len(results), 1)
+        self.assertFalse(results[0][0])
+        self.assertEqual(results[0][1], docid)
+
+    def test_document_cache(self):
+        """Test that cached entries are retrieved once and invalidated on save"""
+        s_con = couchdb_standin.connect(SampleRunMetricsConnection, self.server, cache_size=2)
+        name = "1_120924_AC003CCCXX_TGACCA"
+        doc = s_con.get_entry(name)
+        doc["bc_count"] = 10
+        self.assertIsNone(s_con.get_entry(name)["bc_count"])
+        self.assertEqual(self.server["samples"].gets, 1)
+        s_con.save(doc)
+        self.assertEqual(s_con.get_entry(name)["bc_count"], 10)
+        self.assertEqual(self.server["samples"].gets, 3)
+        for n in ["2_120924_AC003CCCXX_TGACCA", "3_120924_AC003CCCXX_TGACCA"]:
+            s_con.get_entry(n)
+        self.assertEqual(len(s_con.cache), 2)
+        self.assertNotIn(s_con.name_view[name], s_con.cache)
+        s_con.invalidate()
+        self.assertEqual(len(s_con.cache), 0)
+
+
+class TestContentHash(unittest.TestCase):
+    """Tests for skipping unchanged documents by content hash"""
+    def setUp(self):
+        self.server = couchdb_standin.Server()
+        self.server.create("samples")
+        self.server.create("projects")
+
+    def test_content_hash(self):
+        """Test that the hash ignores id, revision and timestamps, but not content"""
+        obj = {"_id":"a", "_rev":"1-a", "creation_time":"2012", "project_name":"J.Doe_00_01", "samples":{"P001_101":{"status":"P"}}}
+        h = content_hash(obj)
+        self.assertEqual(h, content_hash({"samples":{"P001_101":{"status":"P"}}, "project_name":"J.Doe_00_01", HASH_FIELD:"x"}))
+        self.assertNotEqual(h, content_hash(dict(obj, samples={"P001_101":{"status":"F"}})))
+
+    def test_save_couchdb_obj(self):
+        """Test that an unchanged object is not retrieved, and that documents without hash are rewritten once"""
+        db = self.server["projects"]
+        obj = {"_id":"a", "project_name":"J.Doe_00_01", "samples":{"P001_101":{"status":"P"}}}
+        self.assertEqual(save_couchdb_obj(db, dict(obj)), "created")
+        self.server.reset_requests()
+        self.assertEqual(save_couchdb_obj(db, dict(obj)), "not uppdated")
+        self.assertEqual(db.gets, 0)
+        self.assertEqual(save_couchdb_obj(db, dict(obj, samples={})), "uppdated")
+        self.assertEqual(db.gets, 1)
+        doc = db["a"]
+        del doc[HASH_FIELD]
+        db.save(doc)
+        self.assertEqual(save_couchdb_obj(db, {"_id":"a", "project_name":"J.Doe_00_01", "samples":{}}), "uppdated")
+        self.assertEqual(db["a"][HASH_FIELD], stamp_hash(content_hash({"project_name":"J.Doe_00_01", "samples":{}}), doc["_rev"]))
+        self.assertEqual(db["a"][HASH_FIELD].split("-")[0], db["a"]["_rev"].split("-")[0])
+
+    def test_modified_without_hash(self):
+        """Test that documents modified without updating the hash are retrieved and compared"""
+        db = self.server["projects"]
+        obj = {"_id":"a", "project_name":"J.Doe_00_01", "samples":{"P001_101":{"status":"P"}}}
+        self.assertEqual(save_couchdb_obj(db, dict(obj)), "created")
+        doc = db["a"]
+        doc["samples"] = {}
+        db.save(doc)
+        self.server.reset_requests()
+        self.assertEqual(save_couchdb_obj(db, dict(obj)), "uppdated")
+        self.assertEqual(db.gets, 1)
+        self.assertEqual(db["a"]["samples"], obj["samples"])
+        self.assertEqual(save_couchdb_obj(db, dict(obj)), "not uppdated")
+
+    def test_save(self):
+        """Test that saving an unchanged document only queries the hash view"""
+        s_con = couchdb_standin.connect(SampleRunMetricsConnection, self.server)
+        kw = dict(flowcell="AC003CCCXX", date="120924", lane=1, sequence="TGACCA", sample_prj="J.Doe_00_01")
+        s_con.save(SampleRunMetricsDocument(**kw))
+        self.server.reset_requests()
+        s_con.save(SampleRunMetricsDocument(**kw))
+        self.assertEqual(self.server["samples"].gets, 0)
+        s_con.save(SampleRunMetricsDocument(bc_count=10, **kw))
+        self.assertEqual(self.server["samples"].gets, 1)
+        self.assertEqual(s_con.get_entry("1_120924_AC003CCCXX_TGACCA")["bc_count"], 10)
+
+    def test_save_modified_without_hash(self):
+        """Test that connections merge documents modified without updating the hash, and then skip them"""
+        s_con = couchdb_standin.connect(SampleRunMetricsConnection, self.server)
+        kw = dict(flowcell="AC003CCCXX", date="120924", lane=1, sequence="TGACCA", sample_prj="J.Doe_00_01")
+        s_con.save(SampleRunMetricsDocument(bc_count=10, **kw))
+        db = self.server["samples"]
+        doc = db[s_con.name_view["1_120924_AC003CCCXX_TGACCA"]]
+        doc["bc_count"] = 20
+        doc["extra"] = "added on the server"
+        db.save(doc)
+        for save in [s_con.save, lambda obj: s_con.save_many([obj])]:
+            self.server.reset_requests()
+            save(SampleRunMetricsDocument(bc_count=10, **kw))
+            self.assertEqual(s_con.get_entry("1_120924_AC003CCCXX_TGACCA")["bc_count"], 10)
+            self.assertEqual(s_con.get_entry("1_120924_AC003CCCXX_TGACCA")["extra"], "added on the server")
+            doc = db[doc["_id"]]
+            doc["bc_count"] = 20
+            db.save(doc)
+        # Saved with the hash of the object, the merged document is skipped next time
+        s_con.save(SampleRunMetricsDocument(bc_count=20, **kw))
+        self.server.reset_requests()
+        s_con.save(SampleRunMetricsDocument(bc_count=20, **kw))
+        s_con.save_many([SampleRunMetricsDocument(bc_count=20, **kw)])
+        # One name lookup and one hash query each
+        self.assertEqual(db.requests, 4)
+        self.assertEqual(db.gets, 0)
+
+    def test_missing_hash_view(self):
+        """Test falling back on retrieving documents if the hash view is missing"""
+        del self.server["projects"].views["hash/content_hash"]
+        db = self.server["projects"]
+        obj = {"_id":"a", "project_name":"J.Doe_00_01"}
+        self.assertEqual(save_couchdb_obj(db, dict(obj)), "created")
+        self.assertEqual(save_couchdb_obj(db, dict(obj)), "not uppdated")
+        self.assertEqual(db.gets, 2)
+
+class TestBarcodeLaneStatistics(unittest.TestCase):
+    """Tests for the per-flowcell barcode lane statistics index"""
+    def setUp(self):
+        self.server = couchdb_standin.Server()
+        db = self.server.create("flowcells")
+        for fc in ["120924_AC003CCCXX", "121015_BB002BBBXX"]:
+            stats = [{"Project":"J__Doe_00_01", "Sample ID":"P001_10{}_index{}".format(i, i), "Lane":str(lane), "Index":"ACGTA{}".format(i),
+                      "Mean Quality Score (PF)":"35.{}".format(i), "% of >= Q30 Bases (PF)":"9{}.00".format(lane), "# Reads":"1,000,000"}
+                     for lane in [1, 2] for i in [1, 2, 3]]
+            stats.append({"Project":"FC_Undetermined", "Sample ID":"lane1", "Lane":"1", "Index":"Undetermined", "# Reads":"10,000"})
+            db.save(FlowcellRunMetricsDocument(fc_date=fc.split("_")[0], fc_name=fc.split("_")[1], illumina={"Demultiplex_Stats":{"Barcode_lane_statistics":stats}}))
+        self.server.reset_requests()
+
+    def test_get_barcode_lane_statistics(self):
+        """Test that statistics are fetched once, for the requested flowcell only"""
+        fc_con = couchdb_standin.connect(FlowcellRunMetricsConnection, self.server)
+        self.server.reset_requests()
+        self.assertEqual(fc_con.get_barcode_lane_statistics("J.Doe_00_01", "P001_103_index3", "120924_AC003CCCXX", 2), ("35.3", "92.00"))
+        self.assertEqual(fc_con.get_barcode_lane_statistics("J.Doe_00_01", "P001_101_index1", "120924_AC003CCCXX", "1"), ("35.1", "91.00"))
+        self.assertEqual(fc_con.get_barcode_lane_statistics("J.Doe_00_01", "P001_101_index6", "120924_AC003CCCXX", "1"), (None, None))
+        self.assertEqual(fc_con.get_barcode_lane_statistics("J.Doe_00_01", "P001_101_index1", "121212_CC001CCCXX", "1"), (None, None))
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(sorted(fc_con.stat_view.keys()), ["120924_AC003CCCXX", "121015_BB002BBBXX"])
+
+    def test_index_from_document(self):
+        """Test building the index from an already retrieved document"""
+        fc_con = couchdb_standin.connect(FlowcellRunMetricsConnection, self.server)
+        fc_doc = fc_con.get_entry("121015_BB002BBBXX")
+        self.server.reset_requests()
+        stats = fc_con.get_barcode_lane_index("121015_BB002BBBXX", fc_doc)
+        self.assertEqual(self.server.requests, 0)
+        self.assertIs(fc_con.get_barcode_lane_index("121015_BB002BBBXX"), stats)
+        self.assertEqual(len(stats), 7)
+        self.assertEqual(dict(stats.pool_size()), {"1":3, "2":3})
+
+class TestServerPool(unittest.TestCase):
+    """Tests for process-wide server sessions"""
+    def setUp(self):
+        scilifelab.db._SERVERS.clear()
+        http._STATUS_CODES.clear()
+
+    def test_get_server(self):
+        """Test that servers are shared per url and session settings"""
+        (server, reused) = scilifelab.db.get_server("http://u:p@localhost:5984", pool_size=2)
+        self.assertFalse(reused)
+        (server2, reused) = scilifelab.db.get_server("http://u:p@localhost:5984", pool_size=2)
+        self.assertTrue(reused)
+        self.assertIs(server, server2)
+        (server2, reused) = scilifelab.db.get_server("http://u:p@localhost:5984")
+        self.assertFalse(reused)
+        self.assertIsNot(server, server2)
+        (server3, reused) = scilifelab.db.get_server("http://u:p@otherhost:5984", timeout=30)
+        self.assertFalse(reused)
+        if scilifelab.db.BoundedConnectionPool:
+            self.assertEqual(server3.resource.session.connection_pool.timeout, 30)
+            self.assertEqual(server3.resource.session.connection_pool.pool_size, 10)
+
+    def test_connect_timeout(self):
+        """Test that connections pass their timeout and pool size to get_server"""
+        with mock.patch("scilifelab.db.check_url", return_value=True), \
+                mock.patch("scilifelab.db.get_server", return_value=(couchdb_standin.Server(), False)) as get_server:
+            scilifelab.db.Couch(username="u", password="p", url="localhost", pool_size=3, timeout=5)
+            self.assertEqual(get_server.call_args[0][1:], (3, 5))
+            scilifelab.db.Couch(username="u", password="p", url="localhost")
+            self.assertEqual(get_server.call_args[0][1:], (scilifelab.db.POOL_SIZE, scilifelab.db.TIMEOUT))
+
+    def test_check_url_cached(self):
+        """Test that urls are only probed once"""
+        with mock.patch("scilifelab.utils.http.get_server_status_code", return_value=200) as probe:
+            self.assertTrue(http.check_url("http://localhost:5984"))
+            self.assertTrue(http.check_url("http://localhost:5984"))
+            self.assertEqual(probe.call_count, 1)
+            self.assertTrue(http.check_url("http://localhost:5984", cache=False))
+            self.assertEqual(probe.call_count, 2)
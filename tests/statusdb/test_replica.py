@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from scilifelab.db.replica import open_replica, VIEWS, SERVER_VIEWS
+from scilifelab.db.statusdb import VIEWS as STATUSDB_VIEWS, FlowcellRunMetricsConnection, FlowcellRunMetricsDocument, ProjectSummaryConnection, ProjectSummaryDocument
+from . import couchdb_standin
+
+class TestViewReplica(unittest.TestCase):
+    """Tests for local view replicas synced from the changes feed of an in-memory couchdb stand-in"""
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_replica_")
+        self.server = couchdb_standin.Server()
+        db = self.server.create("flowcells")
+        for i in range(20):
+            db.save(FlowcellRunMetricsDocument(fc_date="1209{:02d}".format(i + 1), fc_name="AC{:03d}CCCXX".format(i),
+                                               storage_status="On disk", projects=["P00{}".format(i % 3)]))
+        self.server.create("projects").save(ProjectSummaryDocument(project_name="J.Doe_00_01", project_id="P001"))
+        self.server.reset_requests()
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_views_defined(self):
+        """Test that only views defined in the repository design documents are replicated"""
+        for (label, views) in VIEWS.items():
+            for viewname in views.keys():
+                (design, view) = viewname.split("/")
+                self.assertIn(view, STATUSDB_VIEWS[label][design])
+        for (label, views) in SERVER_VIEWS.items():
+            for viewname in views.keys():
+                (design, view) = viewname.split("/")
+                self.assertNotIn(view, STATUSDB_VIEWS.get(label, {}).get(design, {}))
+        self.assertIsNone(open_replica(self.server.create("samples"), self.rootdir, "samples"))
+
+    def _views(self, con):
+        return (con.name_view, con.storage_status_view, con.id_view, con.proj_list)
+
+    def test_initial_sync(self):
+        """Test that views read from a new replica equal the database views"""
+        fc_con = couchdb_standin.connect(FlowcellRunMetricsConnection, self.server, replica=self.rootdir)
+        self.assertIsNotNone(fc_con.replica)
+        self.assertTrue(os.path.exists(fc_con.replica.checkpoint))
+        self.assertEqual(self._views(fc_con), self._views(couchdb_standin.connect(FlowcellRunMetricsConnection, self.server)))
+        p_con = couchdb_standin.connect(ProjectSummaryConnection, self.server, replica=self.rootdir)
+        self.assertEqual(p_con.name_view.keys(), ["J.Doe_00_01"])
+
+    def test_incremental_sync(self):
+        """Test that a connection only pulls changes since the last sync"""
+        couchdb_standin.connect(FlowcellRunMetricsConnection, self.server, replica=self.rootdir)
+        self.server.reset_requests()
+        fc_con = couchdb_standin.connect(FlowcellRunMetricsConnection, self.server, replica=self.rootdir)
+        self.assertEqual(self.server.requests, 1)
+        db = self.server["flowcells"]
+        doc = db[fc_con.id_view["120901_AC000CCCXX"]]
+        doc["storage_status"] = "Archived"
+        db.save(doc)
+        db.delete(db[fc_con.id_view["120902_AC001CCCXX"]])
+        db.save(FlowcellRunMetricsDocument(fc_date="121001", fc_name="BB001BBBXX", projects=["P005"]))
+        replica = open_replica(db, self.rootdir, "flowcells", "localhost", sync=False)
+        self.assertEqual(replica.sync(), 3)
+        fc_con = couchdb_standin.connect(FlowcellRunMetricsConnection, self.server, replica=self.rootdir)
+        self.assertEqual(self._views(fc_con), self._views(couchdb_standin.connect(FlowcellRunMetricsConnection, self.server)))
+        self.assertEqual(fc_con.get_storage_status("Archived").keys(), ["120901_AC000CCCXX"])
+        self.assertNotIn("120902_AC001CCCXX", fc_con.name_view)
+        self.assertEqual(fc_con.proj_list["121001_BB001BBBXX"], ["P005"])
+
+    def test_rebuild(self):
+        """Test rebuilding a replica, and replicating from scratch when the checkpoint is lost"""
+        db = self.server["flowcells"]
+        replica = open_replica(db, self.rootdir, "flowcells", "localhost")
+        replica._batch_size = 7
+        self.assertEqual(replica.rebuild(), 20)
+        self.assertEqual(replica.sync(), 0)
+        os.unlink(replica.checkpoint)
+        self.assertEqual(replica.sync(), 20)
+        self.assertEqual(len(replica.rows("names/name")), 20)
@@ -0,0 +1,67 @@
+import os
+import zlib
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+import scilifelab.utils.checksum as cs
+
+class TestChecksum(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_checksum_")
+        self.cache = cs.ChecksumCache(db=os.path.join(self.rootdir, "checksums.sqlite"), use_xattr=False)
+        self.data = "".join(["@read{}\nACGTACGTNN\n+\nIIIIIHHH##\n".format(i) for i in xrange(20000)])
+        self.fname = os.path.join(self.rootdir, "test.fastq")
+        with open(self.fname, "w") as fh:
+            fh.write(self.data)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.rootdir)
+
+    def test_compute(self):
+        """Compute md5 and adler32 in one pass"""
+        checksums = cs.compute(self.fname, chunk_size=1000)
+        self.assertEqual(checksums.md5, hashlib.md5(self.data).hexdigest())
+        self.assertEqual(checksums.adler32, "{:08x}".format(zlib.adler32(self.data) & 0xffffffff))
+        self.assertEqual(checksums.size, len(self.data))
+
+    def test_cache(self):
+        """Reuse cached checksums until the file changes"""
+        checksums = self.cache.checksum(self.fname)
+        self.assertEqual(self.cache.checksum(self.fname), checksums)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        ## Cached in the database across instances
+        cache = cs.ChecksumCache(db=self.cache.db, use_xattr=False)
+        self.assertEqual(cache.checksum(self.fname), checksums)
+        self.assertEqual(cache.hits, 1)
+        cache.close()
+        with open(self.fname, "a") as fh:
+            fh.write("@extra\nA\n+\nI\n")
+        self.assertNotEqual(self.cache.checksum(self.fname), checksums)
+        self.assertEqual(self.cache.misses, 2)
+        self.assertEqual(self.cache.checksum(self.fname, cached=False).md5, hashlib.md5(self.data + "@extra\nA\n+\nI\n").hexdigest())
+
+    def test_checksums(self):
+        """Checksum many files concurrently"""
+        fnames = []
+        for i in xrange(8):
+            fnames.append(os.path.join(self.rootdir, "test{}.fastq".format(i)))
+            with open(fnames[-1], "w") as fh:
+                fh.write(self.data[i:])
+        checksums = self.cache.checksums(fnames, threads=4)
+        self.assertEqual(set(checksums.keys()), set(fnames))
+        for i, fname in enumerate(fnames):
+            self.assertEqual(checksums[fname].md5, hashlib.md5(self.data[i:]).hexdigest())
+
+    def test_copy(self):
+        """Checksum the source while copying"""
+        dst = os.path.join(self.rootdir, "copy.fastq")
+        checksums = self.cache.copy(self.fname, dst, chunk_size=1000)
+        with open(dst) as fh:
+            self.assertEqual(fh.read(), self.data)
+        self.assertEqual(checksums, cs.compute(self.fname))
+        self.assertEqual(self.cache.get(self.fname), checksums)
+        # copystat may round the modification time on some filesystems
+        self.assertAlmostEqual(os.stat(dst).st_mtime, os.stat(self.fname).st_mtime, delta=1)
@@ -0,0 +1,70 @@
+import os
+import gzip
+import shutil
+import struct
+import tempfile
+import unittest
+
+import scilifelab.utils.compression as cmp
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_compression_")
+        self.data = "".join(["@read{}\nACGTACGTNN\n+\nIIIIIHHH##\n".format(i) for i in xrange(20000)])
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_select_codec(self):
+        """Select codecs automatically and by override"""
+        env = os.environ.pop("GZIP_CODEC", None)
+        try:
+            self.assertIn(cmp.select_codec("rb"), cmp.READ_CODECS)
+            self.assertIn(cmp.select_codec("wb"), cmp.WRITE_CODECS)
+            self.assertNotIn(cmp.select_codec("wb"), cmp.OPT_IN_CODECS)
+            self.assertEqual(cmp.select_codec("wb", "bgzf"), "bgzf")
+            self.assertEqual(cmp.select_codec("rb", "gzip"), "gzip")
+            self.assertRaises(ValueError, cmp.select_codec, "rb", "bgzf")
+            os.environ["GZIP_CODEC"] = "gzip"
+            self.assertEqual(cmp.select_codec("wb"), "gzip")
+            os.environ["GZIP_CODEC"] = "bgzf"
+            self.assertEqual(cmp.select_codec("wb"), "bgzf")
+            self.assertIn(cmp.select_codec("rb"), cmp.READ_CODECS)
+        finally:
+            os.environ.pop("GZIP_CODEC", None)
+            if env is not None:
+                os.environ["GZIP_CODEC"] = env
+
+    def test_bgzf_block(self):
+        """BGZF blocks are gzip members holding the block size"""
+        block = cmp.bgzf_block(self.data[0:cmp.BGZF_BLOCK_SIZE])
+        self.assertEqual(struct.unpack("<H", block[16:18])[0], len(block) - 1)
+        # Standard BGZF end-of-file marker
+        self.assertEqual(cmp.bgzf_block("").encode("hex"), "1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+    def test_bgzf_writer(self):
+        """Write and append with the threaded block writer and read back with gzip"""
+        fname = os.path.join(self.rootdir, "test.gz")
+        fh = cmp.BlockGzipWriter(fname, threads=2, block_size=1000)
+        for i in xrange(0, len(self.data), 777):
+            fh.write(self.data[i:i+777])
+        fh.close()
+        fh = cmp.BlockGzipWriter(fname, mode="ab", threads=2)
+        fh.write("appended\n")
+        fh.close()
+        self.assertEqual(gzip.open(fname).read(), self.data + "appended\n")
+
+    def test_pipe_reader_seek(self):
+        """Rewind a file read through an external process"""
+        if not cmp.available("pigz"):
+            self.skipTest("pigz not available")
+        fname = os.path.join(self.rootdir, "test.gz")
+        fh = gzip.open(fname, "wb")
+        fh.write(self.data)
+        fh.close()
+        fh = cmp.open_gzip(fname, codec="pigz")
+        first = fh.next()
+        fh.seek(0)
+        self.assertEqual(fh.next(), first)
+        self.assertEqual(first + fh.read(), self.data)
+        fh.close()
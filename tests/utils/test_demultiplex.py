@@ -0,0 +1,195 @@
+"""Test suite for the demultiplex module
+"""
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import collections
+
+import scilifelab.utils.fastq_utils as fu
+import scilifelab.utils.demultiplex as dm
+import tests.generate_test_data as td
+
+def _reference_match(seq, indexes, max_mismatches):
+    """Match by comparing to every index, longer indexes first, as in demultiplex_mctag.py"""
+    matches = collections.defaultdict(list)
+    for ix in sorted(indexes, key=lambda x: (-len(x))):
+        d = dm.hamming(ix, seq)
+        matches[d].append(ix)
+        if d == 0:
+            break
+    for x in range(0, max_mismatches + 1):
+        if matches.get(x):
+            return (dm.MATCH if len(matches[x]) == 1 else dm.AMBIGUOUS, tuple(matches[x]), x)
+    return (dm.UNMATCHED, (), None)
+
+class TestIndexMatcher(unittest.TestCase):
+    def test_neighbours(self):
+        """Generate sequences within mismatch distance"""
+        self.assertEqual(len(list(dm.neighbours("ACGTACGT", 1))), 1 + 8*4)
+        self.assertEqual(len(set([s for s, k in dm.neighbours("ACGTACGT", 2)])), 1 + 8*4 + 28*16)
+        self.assertTrue(all([dm.hamming(s, "ACGT") == k for s, k in dm.neighbours("ACGT", 2)]))
+
+    def test_match(self):
+        """Match index reads with a lookup table and compare to all-against-all matching"""
+        random.seed(11)
+        for max_mismatches in [0, 1, 2]:
+            indexes = list(set([td.generate_barcode(random.choice([6, 8])) for n in xrange(24)]))
+            matcher = dm.IndexMatcher(sorted(indexes, key=lambda x: (-len(x))), max_mismatches)
+            for n in xrange(2000):
+                seq = td.generate_barcode(random.choice([4, 6, 8, 12]))
+                if n % 3 == 0:
+                    seq = random.choice(indexes) + seq
+                self.assertEqual(_reference_match(seq, indexes, max_mismatches), matcher.match(seq),
+                                 "Lookup table match differs from reference for {}".format(seq))
+
+    def test_ambiguous(self):
+        """Index read one mismatch from two indexes"""
+        matcher = dm.IndexMatcher(["AAAA", "AAAT"], 1)
+        self.assertEqual(matcher.match("AAAAGG"), (dm.MATCH, ("AAAA",), 0))
+        self.assertEqual(matcher.match("AAACGG"), (dm.AMBIGUOUS, ("AAAA", "AAAT"), 1))
+        self.assertEqual(matcher.match("ACACGG"), (dm.UNMATCHED, (), None))
+
+    def test_exact_length(self):
+        """Match casava header indexes of the same length only"""
+        matcher = dm.IndexMatcher(["ACGTAC", "TTGCAA"], 0, prefix=False)
+        self.assertEqual(matcher.match("ACGTAC"), (dm.MATCH, ("ACGTAC",), 0))
+        self.assertEqual(matcher.match("ACGTACGG"), (dm.UNMATCHED, (), None))
+        self.assertEqual(matcher.match("ACGTA"), (dm.UNMATCHED, (), None))
+        self.assertEqual(dm.IndexMatcher(["ACGTAC"], 1, prefix=False).match("ACGTAA"), (dm.MATCH, ("ACGTAC",), 1))
+
+    def test_other_bases(self):
+        """Count bases outside ACGTN as mismatches"""
+        matcher = dm.IndexMatcher(["ACGTAC", "TTGCAA"], 1)
+        self.assertEqual(matcher.match("ACGTA."), (dm.MATCH, ("ACGTAC",), 1))
+        self.assertEqual(matcher.match("ACGTA.GG"), (dm.MATCH, ("ACGTAC",), 1))
+        self.assertEqual(matcher.match("AC.TA."), (dm.UNMATCHED, (), None))
+
+class TestOutputPool(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_demultiplex_")
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_output_pool(self):
+        """Write to more files than can be open at once"""
+        pool = dm.OutputPool(max_open=3, buffer_size=500)
+        expected = collections.defaultdict(list)
+        for n in xrange(2000):
+            fname = os.path.join(self.rootdir, "{}.fastq{}".format(n % 7, ".gz" if n % 2 else ""))
+            record = td.generate_fastq_record()
+            expected[fname].append(record)
+            pool.write(fname, record)
+            self.assertTrue(len(pool._handles) <= 3)
+        counts = pool.close()
+        for fname, records in expected.iteritems():
+            self.assertEqual(counts[fname], len(records))
+            self.assertEqual([r for r in fu.FastQParser(fname)], records)
+
+    def _write_readset(self, ext=".fastq", codec=None):
+        """Write read pairs with index reads"""
+        random.seed(3)
+        index_dict = {"ACGTAC": "s1", "TTGCAA": "s2", "GGATCC": None}
+        fqs = [os.path.join(self.rootdir, "{}{}".format(r, ext)) for r in ["R1", "R2", "I"]]
+        fhs = [fu.FastQWriter(f, codec=codec) for f in fqs]
+        for n in xrange(3000):
+            rec = td.generate_fastq_record(pair=True)
+            ind_seq = random.choice(index_dict.keys() + ["CCCCCC", "ACGTAA"]) + td.generate_barcode(8)
+            fhs[0].write(rec[0:4])
+            fhs[1].write(rec[4:])
+            fhs[2].write([rec[0], ind_seq, "+", "I"*len(ind_seq)])
+        for fh in fhs:
+            fh.close()
+        return (fqs, index_dict)
+
+    def test_demultiplex_mctag_parallel(self):
+        """Demultiplex read sets in parallel, with the same output as in one process"""
+        for (ext, codec) in [(".fastq", None), (".fastq.gz", "bgzf")]:
+            (fqs, index_dict) = self._write_readset(ext, codec)
+            outdirs = [os.path.join(self.rootdir, "out{}".format(p)) for p in [1, 3]]
+            counts = []
+            for p, outdir in zip([1, 3], outdirs):
+                os.mkdir(outdir)
+                counts.append(dm.demultiplex_mctag(fqs[0], fqs[1], fqs[2], index_dict, outdir, max_mismatches=1, processes=p))
+            self.assertEqual(counts[0], counts[1])
+            self.assertEqual(sorted(os.listdir(outdirs[0])), sorted(os.listdir(outdirs[1])))
+            for fname in os.listdir(outdirs[0]):
+                self.assertEqual(open(os.path.join(outdirs[0], fname)).read(), open(os.path.join(outdirs[1], fname)).read(),
+                                 "Parallel output {} differs from output in one process".format(fname))
+            for outdir in outdirs:
+                shutil.rmtree(outdir)
+
+    def test_demultiplex_casava_parallel(self):
+        """Demultiplex a BGZF compressed fastq file in parallel, with the same output as in one process"""
+        indexes = [td.generate_barcode() for n in xrange(4)]
+        args = {'instrument': td.generate_instrument(), 'run_number': 101, 'fcid': td.generate_fc_barcode(), 'lane': 1, 'pair': True}
+        fqs = [os.path.join(self.rootdir, "R{}.fastq.gz".format(r)) for r in [1, 2]]
+        fhs = [fu.FastQWriter(f, codec="bgzf") for f in fqs]
+        for n in xrange(3000):
+            args['index'] = random.choice(indexes)
+            record = td.generate_fastq_record(**args)
+            fhs[0].write(record[0:4])
+            fhs[1].write(record[4:])
+        for fh in fhs:
+            fh.close()
+        sdata = [[args['fcid'], "1", "Sample_{}".format(n), "unknown", ix, "DemuxTest", "0", "", "", "DemuxTestProject"] for n, ix in enumerate(indexes[0:-1])]
+        samplesheet = td._write_samplesheet(sdata, os.path.join(self.rootdir, "samplesheet.csv"))
+        results = []
+        for p in [1, 3]:
+            outdir = os.path.join(self.rootdir, "out{}".format(p))
+            os.mkdir(outdir)
+            outfiles = dm.demultiplex_casava(outdir, samplesheet, fqs[0], fqs[1], processes=p)
+            results.append(dict([(ix, [[r for r in fu.FastQParser(f)] for f in fnames]) for ix, fnames in outfiles["1"].iteritems()]))
+        self.assertEqual(sorted(results[0].keys()), sorted(indexes[0:-1]))
+        self.assertEqual(results[0], results[1])
+
+    def test_demultiplex_casava_one_mate(self):
+        """Demultiplex read pairs where only read 1 has records for an index"""
+        indexes = ["ACGTAC", "TTGCAA"]
+        args = {'instrument': td.generate_instrument(), 'run_number': 101, 'fcid': td.generate_fc_barcode(), 'lane': 1, 'pair': True}
+        fqs = [os.path.join(self.rootdir, "R{}.fastq.gz".format(r)) for r in [1, 2]]
+        fhs = [fu.FastQWriter(f, codec="bgzf") for f in fqs]
+        for n in xrange(400):
+            args['index'] = indexes[n % 2]
+            record = td.generate_fastq_record(**args)
+            fhs[0].write(record[0:4])
+            if args['index'] == indexes[0]:
+                fhs[1].write(record[4:])
+        for fh in fhs:
+            fh.close()
+        sdata = [[args['fcid'], "1", "Sample_{}".format(n), "unknown", ix, "DemuxTest", "0", "", "", "DemuxTestProject"] for n, ix in enumerate(indexes)]
+        samplesheet = td._write_samplesheet(sdata, os.path.join(self.rootdir, "samplesheet.csv"))
+        for p in [1, 3]:
+            outdir = os.path.join(self.rootdir, "out{}".format(p))
+            os.mkdir(outdir)
+            outfiles = dm.demultiplex_casava(outdir, samplesheet, fqs[0], fqs[1], processes=p)
+            self.assertEqual([len([r for r in fu.FastQParser(f)]) for f in outfiles["1"][indexes[0]]], [200, 200])
+            self.assertEqual([len([r for r in fu.FastQParser(f)]) for f in outfiles["1"][indexes[1]]], [200, 0])
+
+    def test_demultiplex_mctag(self):
+        """Demultiplex read pairs on index reads with molecular tags"""
+        random.seed(3)
+        index_dict = {"ACGTAC": "s1", "TTGCAA": "s2", "GGATCC": None}
+        fqs = [os.path.join(self.rootdir, "{}.fastq".format(r)) for r in ["R1", "R2", "I"]]
+        fhs = [fu.FastQWriter(f) for f in fqs]
+        expected = collections.Counter()
+        for n in xrange(500):
+            rec = td.generate_fastq_record(pair=True)
+            index = random.choice(index_dict.keys() + ["CCCCCC"])
+            ind_seq = index + td.generate_barcode(8)
+            fhs[0].write(rec[0:4])
+            fhs[1].write(rec[4:])
+            fhs[2].write([rec[0], ind_seq, "+", "I"*len(ind_seq)])
+            expected[index_dict.get(index, None) or (index if index in index_dict else "Undetermined")] += 1
+        for fh in fhs:
+            fh.close()
+        counts = dm.demultiplex_mctag(fqs[0], fqs[1], fqs[2], index_dict, self.rootdir, max_mismatches=1)
+        self.assertEqual(counts['reads_processed'], 500)
+        self.assertEqual(counts[dm.MATCH] + counts[dm.AMBIGUOUS] + counts[dm.UNMATCHED], 500)
+        for name, n in expected.iteritems():
+            r1 = [r for r in fu.FastQParser(os.path.join(self.rootdir, "{}_R1.fastq".format(name)))]
+            r2 = [r for r in fu.FastQParser(os.path.join(self.rootdir, "{}_R2.fastq".format(name)))]
+            self.assertEqual(len(r1), n)
+            self.assertEqual([r[0].split()[0] for r in r1], [r[0].split()[0] for r in r2])
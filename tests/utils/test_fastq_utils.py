@@ -7,7 +7,9 @@ import shutil
 import random
 import unittest
 import copy
+import gzip
 import scilifelab.utils.fastq_utils as fu
+import scilifelab.utils.compression as cmp
 import tests.generate_test_data as td
 import scilifelab.illumina.hiseq as hi
 from collections import Counter
@@ -71,6 +73,59 @@ class TestFastQParser(unittest.TestCase):
         self.assertEqual(expected,fqr.rread(),
                          "The returned number of filtered reads based on lanes did not match expected number")
         
+    def test_iter_batches(self):
+        """Parse records in batches and compare vectorized quality metrics with the per-record ones
+        """
+        records = [r for r in fu.FastQParser(self.example_fq)]
+        fqr = fu.FastQParser(self.example_fq)
+        batches = [b for b in fqr.iter_batches(100)]
+        self.assertEqual(len(records),fqr.rread())
+        self.assertEqual(len(records),sum([len(b) for b in batches]))
+        self.assertTrue(all([len(b) == 100 for b in batches[0:-1]]))
+        self.assertEqual(records,[r for b in batches for r in b])
+        
+        for offset in [33,64]:
+            self.assertEqual([fu.avgQ(r,offset) for r in records],
+                             [q for b in batches for q in fu.batch_avgQ(b,offset).tolist()],
+                             "Vectorized average qualities do not match per-record values")
+            self.assertEqual([fu.gtQ30(r,offset) for r in records],
+                             [q for b in batches for q in fu.batch_gtQ30(b,offset).tolist()],
+                             "Vectorized percentages of bases >= Q30 do not match per-record values")
+            self.assertEqual([min([ord(c) for c in r[3]]) - offset for r in records],
+                             [q for b in batches for q in fu.batch_minQ(b,offset).tolist()],
+                             "Vectorized minimum qualities do not match per-record values")
+        
+        # The header filter applies to batches as well
+        fltr = {'lane': range(1,5)}
+        expected = sum([sum(self.example_counts[l].values()) for l in fltr['lane']])
+        fqr = fu.FastQParser(self.example_fq,filter=fltr)
+        self.assertEqual(expected,sum([len(b) for b in fqr.iter_batches(1000)]))
+        
+    def test_fastq_chunks(self):
+        """Split plain and BGZF compressed fastq files in record-aligned chunks
+        """
+        records = [r for r in fu.FastQParser(self.example_fq)]
+        # Plain gzip files cannot be split
+        fqfile = os.path.join(self.rootdir,"chunks_gzip.fastq.gz")
+        fqw = fu.FastQWriter(fqfile,codec="gzip")
+        for r in records:
+            fqw.write(r)
+        fqw.close()
+        self.assertIsNone(fu.fastq_chunks(fqfile,4))
+        for (ext, codec) in [("fastq", None), ("fastq.gz", "bgzf")]:
+            fqfile = os.path.join(self.rootdir,"chunks.{}".format(ext))
+            fqw = fu.FastQWriter(fqfile,codec=codec)
+            for r in records:
+                fqw.write(r)
+            fqw.close()
+            for n in [1,3,10]:
+                chunks = fu.fastq_chunks(fqfile,n)
+                self.assertTrue(len(chunks) <= n)
+                self.assertEqual(records,[r for c in chunks for r in fu.iter_chunk(fqfile,*c)],
+                                 "Records in {} chunks of {} file differ from records in file".format(n,ext))
+                chunks = fu.paired_fastq_chunks([fqfile,fqfile],n,sample=50)
+                self.assertEqual(records,[r for c in chunks for r in fu.iter_chunk(fqfile,*c[0])])
+        
 class TestFastQWriter(unittest.TestCase):
     """Test the FastQWriter functionality
     """
@@ -84,7 +139,23 @@ class TestFastQWriter(unittest.TestCase):
     def test_write_fastq(self):
         """Write a fastq file
         """
-        
+        records = [td.generate_fastq_record() for n in xrange(2500)]
+        for codec in [c for c in cmp.WRITE_CODECS if cmp.available(c)]:
+            fqfile = os.path.join(self.rootdir,"{}.fastq.gz".format(codec))
+            fqw = fu.FastQWriter(fqfile,codec=codec)
+            for r in records:
+                fqw.write(r)
+            fqw.close()
+            self.assertEqual(len(records),fqw.rwritten())
+            # Output must be readable by the standard gzip module
+            fh = gzip.open(fqfile)
+            self.assertEqual("".join(["{}\n".format("\n".join(r)) for r in records]),fh.read(),
+                             "Data written with codec {} could not be read back with gzip".format(codec))
+            fh.close()
+            for rcodec in [c for c in cmp.READ_CODECS if cmp.available(c)]:
+                self.assertEqual(records,[r for r in fu.FastQParser(fqfile,codec=rcodec)],
+                                 "Data written with codec {} could not be read back with codec {}".format(codec,rcodec))
+
 
 class TestFastQUtils(unittest.TestCase):
     
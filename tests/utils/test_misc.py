@@ -5,7 +5,7 @@ import logbook
 
 import subprocess 
 
-from scilifelab.utils.misc import walk, filtered_walk, safe_makedir
+from scilifelab.utils.misc import walk, filtered_walk, iter_filtered_walk, safe_makedir
 
 filedir = os.path.abspath(__file__)
 LOG = logbook.Logger(__name__)
@@ -53,3 +53,23 @@ class TestMisc(unittest.TestCase):
         flist = filtered_walk("data", filter_fn=self.filter_fn, include_dirs=["nophix"], exclude_dirs=["fastqc"], get_dirs=False)
         self.assertEqual(set(flist), set(['data/nophix/file1.txt']))
 
+    def test_iter_filtered_walk(self):
+        """Perform a filtered walk of data dir, yielding files in os.walk order"""
+        flist = iter_filtered_walk("data", filter_fn=self.filter_fn, exclude_dirs=["nophix"])
+        self.assertFalse(isinstance(flist, list))
+        expected = [os.path.join(root, x) for root, dirs, files in os.walk("data") for x in files if x.startswith("file1") and not "nophix" in root.split(os.sep)]
+        self.assertEqual(list(flist), expected)
+
+    def test_filtered_walk_threads(self):
+        """Perform a filtered walk of data dir, walking subdirectories in threads"""
+        for kw in [{}, {"include_dirs":["nophix"]}, {"exclude_dirs":["fastqc"]}, {"get_dirs":True}]:
+            self.assertEqual(filtered_walk("data", filter_fn=self.filter_fn, threads=3, **kw), filtered_walk("data", filter_fn=self.filter_fn, **kw))
+
+    def test_filtered_walk_exclude_anchored(self):
+        """Perform a filtered walk of data dir, with an anchored exclude_dirs pattern"""
+        flist = filtered_walk("data", filter_fn=self.filter_fn, exclude_dirs=["fastqc$"])
+        self.assertEqual(set(flist), set(['data/file1.txt', 'data/alignments/file1.txt', 'data/nophix/file1.txt', 'data/fastqc/nophix/file1.txt']))
+
+    def test_walk(self):
+        """Perform a walk of data dir"""
+        self.assertEqual(set(walk("data")), set([os.path.join(root, x) for root, dirs, files in os.walk("data") for x in files]))
@@ -0,0 +1,58 @@
+import os
+import gzip
+import bz2
+import shutil
+import tempfile
+import unittest
+
+import scilifelab.utils.parallel_compress as pc
+from scilifelab.utils.compression import which
+
+class TestParallelCompress(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_parallel_compress_")
+        self.data = "".join(["@read{}\nACGTACGTNN\n+\nIIIIIHHH##\n".format(i) for i in xrange(2000)])
+        self.flist = []
+        for i in xrange(5):
+            self.flist.append(os.path.join(self.rootdir, "{}_P001_101_1.fastq".format(i + 1)))
+            with open(self.flist[-1], "w") as fh:
+                fh.write(self.data * (i + 1))
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_compress_decompress(self):
+        """Compress and decompress files in parallel with gzip"""
+        results = pc.compress_files(self.flist, prog="gzip", cores=3)
+        self.assertEqual(sorted(r.src for r in results), sorted(self.flist))
+        self.assertTrue(all(r.error is None for r in results))
+        for i, f in enumerate(self.flist):
+            self.assertFalse(os.path.exists(f))
+            with gzip.open(f + ".gz") as fh:
+                self.assertEqual(fh.read(), self.data * (i + 1))
+        self.assertEqual([f for f in os.listdir(self.rootdir) if f.endswith(pc.TMP_SUFFIX)], [])
+        results = pc.compress_files([f + ".gz" for f in self.flist], prog="gzip", decompress=True, cores=3)
+        self.assertTrue(all(r.error is None for r in results))
+        for i, f in enumerate(self.flist):
+            with open(f) as fh:
+                self.assertEqual(fh.read(), self.data * (i + 1))
+
+    @unittest.skipIf(not which("pbzip2"), "pbzip2 not installed")
+    def test_compress_multithreaded(self):
+        """Compress files with a multithreaded compressor"""
+        results = pc.compress_files(self.flist, prog="pbzip2", cores=4, job_threads=2)
+        self.assertTrue(all(r.error is None for r in results))
+        with open(self.flist[0] + ".bz2") as fh:
+            self.assertEqual(bz2.decompress(fh.read()), self.data)
+
+    def test_compress_failure(self):
+        """Keep the input when decompression fails"""
+        with open(self.flist[0] + ".gz", "w") as fh:
+            fh.write("not gzip data")
+        os.unlink(self.flist[0])
+        res = pc.compress_file(self.flist[0] + ".gz", prog="gzip", decompress=True)
+        self.assertIsNotNone(res.error)
+        self.assertTrue(os.path.exists(self.flist[0] + ".gz"))
+        self.assertFalse(os.path.exists(self.flist[0]))
+        self.assertFalse(os.path.exists(self.flist[0] + pc.TMP_SUFFIX))
+        self.assertEqual(pc.output_name(self.flist[1], "gzip", decompress=True), None)
@@ -0,0 +1,69 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+import scilifelab.utils.checksum as cs
+import scilifelab.utils.transfer as tr
+
+class TestTransfer(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_transfer_")
+        self.cache = cs.ChecksumCache(db=os.path.join(self.rootdir, "checksums.sqlite"), use_xattr=False)
+        self.manifest = os.path.join(self.rootdir, "manifest.json")
+        self.sources = []
+        self.targets = []
+        for i in xrange(6):
+            self.sources.append(os.path.join(self.rootdir, "src", "P001_10{}_1.fastq.gz".format(i)))
+            self.targets.append(os.path.join(self.rootdir, "dst", "P001_10{}".format(i), "P001_10{}_1.fastq.gz".format(i)))
+            if not os.path.exists(os.path.dirname(self.sources[-1])):
+                os.makedirs(os.path.dirname(self.sources[-1]))
+            with open(self.sources[-1], "w") as fh:
+                fh.write("{}".format(i) * (1000 * (i + 1)))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.rootdir)
+
+    def test_transfer_files(self):
+        """Transfer and verify files, recording them in the manifest"""
+        results = tr.transfer_files(self.sources, self.targets, manifest=self.manifest, threads=3, cache=self.cache)
+        self.assertEqual([r.src for r in results], self.sources)
+        for src, dst, r in zip(self.sources, self.targets, results):
+            self.assertTrue(r.passed)
+            self.assertFalse(r.skipped)
+            with open(src) as fh:
+                self.assertEqual(r.md5, hashlib.md5(fh.read()).hexdigest())
+            with open(dst) as fh:
+                self.assertEqual(hashlib.md5(fh.read()).hexdigest(), r.md5)
+            self.assertFalse(os.path.exists(dst + tr.PARTIAL_SUFFIX))
+        with open(self.manifest) as fh:
+            self.assertEqual(len([json.loads(line) for line in fh]), len(self.sources))
+
+    def test_resume(self):
+        """Resume a transfer, skipping files completed and unchanged"""
+        tr.transfer_files(self.sources[0:3], self.targets[0:3], manifest=self.manifest, threads=1, cache=self.cache)
+        ## Simulate a partially written last line of an interrupted run
+        with open(self.manifest, "a") as fh:
+            fh.write('{"src": ')
+        with open(self.sources[0], "a") as fh:
+            fh.write("changed")
+        results = tr.transfer_files(self.sources, self.targets, manifest=self.manifest, threads=2, cache=self.cache)
+        self.assertTrue(all(r.passed for r in results))
+        self.assertEqual([r.skipped for r in results], [False, True, True, False, False, False])
+        with open(self.targets[0]) as fh:
+            self.assertTrue(fh.read().endswith("changed"))
+
+    def test_verify_failure(self):
+        """Do not install a copy that fails verification"""
+        compute = tr.compute
+        tr.compute = lambda path: cs.Checksums("0" * 32, "00000000", 0)
+        try:
+            result = tr.transfer_file(self.sources[0], self.targets[0], cache=self.cache)
+        finally:
+            tr.compute = compute
+        self.assertFalse(result.passed)
+        self.assertFalse(os.path.exists(self.targets[0]))
+        self.assertFalse(os.path.exists(self.targets[0] + tr.PARTIAL_SUFFIX))